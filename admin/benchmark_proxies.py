@@ -0,0 +1,175 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Benchmark setting the proxies on a node which forwards many ports.
+
+Each scenario starts from a node with some proxies and sets a new
+collection of them with ``SetProxies``, using an in-memory network which
+counts the proxies it creates and deletes.  On a real node every proxy
+created or deleted costs about three ``iptables`` calls, so the report
+shows those alongside the count of proxies a full replacement (deleting
+every proxy and creating them all again) would have changed.
+"""
+
+from __future__ import print_function
+
+import sys
+from time import time
+
+from characteristic import attributes
+from twisted.python.usage import Options, UsageError
+
+from flocker.node._deploy import Deployer, SetProxies
+from flocker.route import Proxy, make_memory_network
+
+
+DEFAULT_SIZES = [1000, 5000]
+
+# iptables calls made for each proxy created or deleted:
+IPTABLES_PER_CHANGE = 3
+
+
+@attributes(["scenario", "proxies", "created", "deleted", "replaced",
+             "wall"])
+class Result(object):
+    """
+    The cost of setting the proxies in one scenario.
+
+    :ivar unicode scenario: The name of the scenario.
+    :ivar int proxies: The number of proxies required.
+    :ivar int created: The number of proxies created.
+    :ivar int deleted: The number of proxies deleted.
+    :ivar int replaced: The number of proxies a full replacement would have
+        created or deleted.
+    :ivar float wall: Elapsed seconds spent setting the proxies.
+    """
+
+
+class CountingNetwork(object):
+    """
+    Wrap an in-memory ``INetwork`` and count the changes made through it.
+
+    :ivar int created: The number of proxies created.
+    :ivar int deleted: The number of proxies deleted.
+    """
+    def __init__(self, network):
+        self._network = network
+        self.created = 0
+        self.deleted = 0
+
+    def create_proxy_to(self, ip, port):
+        self.created += 1
+        return self._network.create_proxy_to(ip, port)
+
+    def delete_proxy(self, proxy):
+        self.deleted += 1
+        return self._network.delete_proxy(proxy)
+
+    def enumerate_proxies(self):
+        return self._network.enumerate_proxies()
+
+    def enumerate_used_ports(self):
+        return self._network.enumerate_used_ports()
+
+
+def make_proxies(count, first_port=1024):
+    """
+    :param int count: The number of proxies.
+    :param int first_port: The port of the first proxy.
+
+    :return: A ``list`` of ``count`` ``Proxy`` instances to different
+        ports, spread over a number of nodes.
+    """
+    return [Proxy(ip=u"10.0.%d.%d" % (index // 250, index % 250 + 1),
+                  port=first_port + index)
+            for index in range(count)]
+
+
+def scenarios(size):
+    """
+    :param int size: The number of proxies on the node.
+
+    :return: A ``list`` of ``(name, current, desired)`` tuples, giving the
+        proxies on the node before and the proxies required.
+    """
+    proxies = make_proxies(size + 1)
+    existing = proxies[:size]
+    return [
+        (u"unchanged", existing, existing),
+        (u"one added", existing, proxies),
+        (u"one removed", existing, existing[1:]),
+        (u"all new", [], existing),
+    ]
+
+
+def measure(name, current, desired):
+    """
+    Measure one scenario.
+
+    :param unicode name: The name of the scenario.
+    :param list current: The ``Proxy`` instances on the node to start with.
+    :param list desired: The ``Proxy`` instances required.
+
+    :return: A ``Result``.
+    """
+    network = make_memory_network()
+    for proxy in current:
+        network.create_proxy_to(proxy.ip, proxy.port)
+    network = CountingNetwork(network)
+    deployer = Deployer(None, None, network)
+    start = time()
+    SetProxies(ports=desired).run(deployer)
+    wall = time() - start
+    return Result(
+        scenario=name, proxies=len(desired), created=network.created,
+        deleted=network.deleted, replaced=len(current) + len(desired),
+        wall=wall)
+
+
+def format_result(result):
+    """
+    :param Result result: A measurement.
+
+    :return: A line of the report for the measurement.
+    """
+    changed = result.created + result.deleted
+    return u"{:<12} {:>8} {:>8} {:>8} {:>10} {:>10} {:>10.4f}".format(
+        result.scenario, result.proxies, result.created, result.deleted,
+        changed * IPTABLES_PER_CHANGE,
+        result.replaced * IPTABLES_PER_CHANGE, result.wall)
+
+
+class BenchmarkOptions(Options):
+    """
+    Options for the proxy benchmark.
+    """
+    synopsis = "[<number of proxies> ...]"
+
+    longdesc = __doc__
+
+    def parseArgs(self, *sizes):
+        try:
+            self["sizes"] = [int(size) for size in sizes] or DEFAULT_SIZES
+        except ValueError as e:
+            raise UsageError(str(e))
+
+
+def main(args, base_path, top_level):
+    """
+    :param list args: The arguments passed to the script.
+    :param FilePath base_path: The executable being run.
+    :param FilePath top_level: The top-level of the flocker repository.
+    """
+    options = BenchmarkOptions()
+
+    try:
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write("%s: %s\n" % (base_path.basename(), e))
+        raise SystemExit(1)
+
+    print(u"{:<12} {:>8} {:>8} {:>8} {:>10} {:>10} {:>10}".format(
+        u"scenario", u"proxies", u"created", u"deleted", u"iptables",
+        u"replace", u"wall (s)"))
+    for size in options["sizes"]:
+        for name, current, desired in scenarios(size):
+            print(format_result(measure(name, current, desired)))
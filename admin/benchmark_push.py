@@ -0,0 +1,197 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+"""
+Benchmark the compression options for volume pushes.
+
+Each configuration compresses the same sample stream and then decompresses
+the result.  The report shows the bytes that would go over the wire and the
+CPU time each side spends.  A representative sample can be made with e.g.
+``zfs send flocker/<uuid>.<name>@<snapshot> > sample``; without one a
+generated sample, half repetitive text and half random bytes, is used.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from resource import getrusage, RUSAGE_CHILDREN
+from subprocess import Popen
+from contextlib import contextmanager
+from tempfile import TemporaryFile
+from time import time
+
+from characteristic import attributes
+from twisted.python.usage import Options, UsageError
+
+from flocker.volume._compression import ALGORITHMS, Compression
+
+
+DEFAULT_CONFIGURATIONS = [
+    b"zlib:1", b"zlib:6", b"lz4:1", b"lz4:9", b"zstd:1", b"zstd:3",
+    b"zstd:9",
+]
+
+# Size of the generated sample used when none is given:
+DEFAULT_SAMPLE_SIZE = 64 * 1024 * 1024
+
+# Size of each block written to the generated sample:
+_BLOCK_SIZE = 64 * 1024
+
+
+@attributes(["compression", "input_bytes", "output_bytes",
+             "compress_cpu", "decompress_cpu", "wall"])
+class Result(object):
+    """
+    The cost of compressing one sample with one configuration.
+
+    :ivar Compression compression: The configuration measured.
+    :ivar int input_bytes: Size of the uncompressed sample.
+    :ivar int output_bytes: Size of the compressed sample, i.e. the bytes
+        which would be sent over the network.
+    :ivar float compress_cpu: CPU seconds (user and system) spent
+        compressing.
+    :ivar float decompress_cpu: CPU seconds spent decompressing.
+    :ivar float wall: Elapsed seconds spent compressing.
+    """
+
+
+def _children_cpu():
+    """
+    :return: CPU seconds used so far by waited-for child processes.
+    """
+    usage = getrusage(RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _run(command, input_file, output_file):
+    """
+    Run a command to completion with the given standard input and output.
+
+    :return: CPU seconds and elapsed seconds the command used.
+    """
+    input_file.seek(0, 0)
+    cpu = _children_cpu()
+    start = time()
+    process = Popen(command, stdin=input_file, stdout=output_file)
+    if process.wait():
+        raise IOError("Bad exit", command, process.returncode)
+    return _children_cpu() - cpu, time() - start
+
+
+def make_sample(size):
+    """
+    Generate a sample which compresses about as well as a typical volume.
+
+    Blocks of repeated text, standing in for logs and configuration, alternate
+    with blocks of random bytes, standing in for already compressed data.
+
+    :param int size: The number of bytes in the sample.
+
+    :return: A temporary ``file`` holding the sample.
+    """
+    text = b"".join(
+        b"%d INFO request served from /var/lib/app/%d\n" % (line, line % 97)
+        for line in range(_BLOCK_SIZE // 32))[:_BLOCK_SIZE]
+    sample = TemporaryFile()
+    written = 0
+    while written < size:
+        if (written // _BLOCK_SIZE) % 2:
+            block = os.urandom(_BLOCK_SIZE)
+        else:
+            block = text
+        block = block[:size - written]
+        sample.write(block)
+        written += len(block)
+    sample.flush()
+    return sample
+
+
+@contextmanager
+def open_sample(path):
+    """
+    :param path: The path of the sample to read, or ``None`` to generate one
+        of ``DEFAULT_SAMPLE_SIZE`` bytes.
+
+    :return: A context manager giving the sample ``file``.
+    """
+    if path is None:
+        sample = make_sample(DEFAULT_SAMPLE_SIZE)
+    else:
+        sample = open(path, "rb")
+    with sample:
+        yield sample
+
+
+def measure(compression, sample):
+    """
+    Measure one configuration against a sample.
+
+    :param Compression compression: The configuration to measure.
+    :param file sample: The uncompressed sample.
+
+    :return: A ``Result``.
+    """
+    with TemporaryFile() as compressed:
+        compress_cpu, wall = _run(
+            compression.compress_command(), sample, compressed)
+        output_bytes = compressed.tell()
+        with open(os.devnull, "wb") as devnull:
+            decompress_cpu, _ = _run(
+                compression.decompress_command(), compressed, devnull)
+    return Result(
+        compression=compression,
+        input_bytes=os.fstat(sample.fileno()).st_size,
+        output_bytes=output_bytes, compress_cpu=compress_cpu,
+        decompress_cpu=decompress_cpu, wall=wall)
+
+
+def format_result(result):
+    """
+    :param Result result: A measurement.
+
+    :return: A line of the report for the measurement.
+    """
+    return u"{:<8} {:>14} {:>7.2f} {:>10.2f} {:>12.2f} {:>10.1f}".format(
+        result.compression.to_bytes(), result.output_bytes,
+        float(result.input_bytes) / max(result.output_bytes, 1),
+        result.compress_cpu, result.decompress_cpu,
+        result.input_bytes / max(result.wall, 1e-6) / 1024 / 1024)
+
+
+class BenchmarkOptions(Options):
+    """
+    Options for the compression benchmark.
+    """
+    synopsis = "[<sample> [<algorithm>[:<level>] ...]]"
+
+    longdesc = __doc__ + "\nSupported algorithms: " + ", ".join(ALGORITHMS)
+
+    def parseArgs(self, sample=None, *configurations):
+        self["sample"] = sample
+        try:
+            self["configurations"] = [
+                Compression.from_bytes(configuration)
+                for configuration in configurations or DEFAULT_CONFIGURATIONS]
+        except ValueError as e:
+            raise UsageError(str(e))
+
+
+def main(args, base_path, top_level):
+    """
+    :param list args: The arguments passed to the script.
+    :param FilePath base_path: The executable being run.
+    :param FilePath top_level: The top-level of the flocker repository.
+    """
+    options = BenchmarkOptions()
+
+    try:
+        options.parseOptions(args)
+    except UsageError as e:
+        sys.stderr.write("%s: %s\n" % (base_path.basename(), e))
+        raise SystemExit(1)
+
+    print(u"{:<8} {:>14} {:>7} {:>10} {:>12} {:>10}".format(
+        u"config", u"wire bytes", u"ratio", u"cpu (s)", u"decomp (s)",
+        u"MiB/s"))
+    with open_sample(options["sample"]) as sample:
+        for compression in options["configurations"]:
+            print(format_result(measure(compression, sample)))
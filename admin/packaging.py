@@ -623,6 +623,10 @@ def omnibus_package_builder(
                      flocker_node_path),
                     (FilePath('/opt/flocker/bin/flocker-volume'),
                      flocker_node_path),
+                    (FilePath('/opt/flocker/bin/flocker-serve'),
+                     flocker_node_path),
+                    (FilePath('/opt/flocker/bin/flocker-node-agent'),
+                     flocker_node_path),
                 ]
             ),
             BuildPackage(
@@ -806,6 +806,10 @@ class OmnibusPackageBuilderTests(TestCase):
                          flocker_node_path),
                         (FilePath('/opt/flocker/bin/flocker-volume'),
                          flocker_node_path),
+                        (FilePath('/opt/flocker/bin/flocker-serve'),
+                         flocker_node_path),
+                        (FilePath('/opt/flocker/bin/flocker-node-agent'),
+                         flocker_node_path),
                     ]
                 ),
                 BuildPackage(
@@ -7,7 +7,9 @@ The command-line ``flocker-deploy`` tool.
 from subprocess import CalledProcessError
 
 from twisted.internet.defer import DeferredList
+from twisted.internet.endpoints import connectProtocol
 from twisted.internet.threads import deferToThread
+from twisted.protocols.amp import AMP
 from twisted.python.filepath import FilePath
 from twisted.python.usage import Options, UsageError
 
@@ -23,15 +25,21 @@ from ..common.script import (flocker_standard_options, ICommandLineScript,
 from ..node import (FlockerConfiguration, ConfigurationError,
                     FigConfiguration, applications_to_flocker_yaml,
                     model_from_configuration)
+from ..node._agent import ReportState, ChangeState
 
-from ..common import ProcessNode, gather_deferreds
+from ..common import SSHConnectionPool, gather_deferreds
 from ._sshconfig import DEFAULT_SSH_DIRECTORY, OpenSSHConfiguration
 
 
-@attributes(['node', 'hostname'])
+@attributes(['endpoint', 'hostname'])
 class NodeTarget(object):
     """
-    A record for matching an ``INode`` implementation to its target host.
+    A record for matching an endpoint which connects to a node's convergence
+    agent to its target host.
+
+    :ivar IStreamClientEndpoint endpoint: Connects to the node's
+        ``ConvergenceProtocol``.
+    :ivar unicode hostname: The node's hostname.
     """
 
 
@@ -116,11 +124,20 @@ class DeployScript(object):
     """
     A script to start configured deployments on a Flocker cluster.
     """
-    def __init__(self, ssh_configuration=None, ssh_port=22):
+    def __init__(self, ssh_configuration=None, ssh_port=22,
+                 ssh_connections=None):
+        """
+        :param SSHConnectionPool ssh_connections: Creates the nodes that
+            commands are run on, so that each node is connected to only once.
+            By default one with a temporary directory.
+        """
         if ssh_configuration is None:
             ssh_configuration = OpenSSHConfiguration.defaults()
+        if ssh_connections is None:
+            ssh_connections = SSHConnectionPool()
         self.ssh_configuration = ssh_configuration
         self.ssh_port = ssh_port
+        self.ssh_connections = ssh_connections
 
     def _configure_ssh(self, deployment):
         """
@@ -158,56 +175,90 @@ class DeployScript(object):
                  has encountered an error.
         """
         deployment = options['deployment']
+        connections = []
         configuring = self._configure_ssh(deployment)
         configuring.addCallback(
-            lambda _: self._reportstate_on_nodes(deployment))
-
-        def configured(current_config):
-            return self._changestate_on_nodes(
-                deployment,
-                options["deployment_config"],
-                options["application_config"],
-                current_config)
-        configuring.addCallback(configured)
+            lambda _: self._connect_to_nodes(reactor, deployment))
+
+        def connected(targets):
+            connections.extend(protocol for _, protocol in targets)
+            reporting = self._reportstate_on_nodes(targets)
+            reporting.addCallback(
+                lambda current_config: self._changestate_on_nodes(
+                    targets,
+                    options["deployment_config"],
+                    options["application_config"],
+                    current_config))
+            return reporting
+        configuring.addCallback(connected)
         configuring.addCallback(lambda _: None)
+
+        def disconnect(result):
+            for protocol in connections:
+                protocol.transport.loseConnection()
+            self.ssh_connections.close()
+            return result
+        configuring.addBoth(disconnect)
         return configuring
 
-    def _get_destinations(self, deployment):
+    def _get_destinations(self, reactor, deployment):
         """
         Return iterable of ``NodeTargets`` to connect to for given deployment.
 
+        :param reactor: The ``IReactorProcess`` provider to run SSH with.
         :param Deployment deployment: The requested already parsed
             configuration.
 
         :return: Iterable of ``NodeTarget``\ s containing the node hostname and
-            corresponding ``INode`` provider with which to issue remote
-            procedures on that node.
+            an endpoint which connects to the convergence agent on that node
+            by running ``flocker-node-agent`` over SSH.
         """
         private_key = DEFAULT_SSH_DIRECTORY.child(b"id_rsa_flocker")
 
         for node in deployment.nodes:
             yield NodeTarget(
-                node=ProcessNode.using_ssh(
-                    node.hostname, 22, b"root", private_key),
+                endpoint=self.ssh_connections.node(
+                    node.hostname, 22, b"root", private_key).endpoint(
+                        reactor, [b"flocker-node-agent"]),
                 hostname=node.hostname
             )
 
-    def _reportstate_on_nodes(self, deployment):
+    def _connect_to_nodes(self, reactor, deployment):
         """
-        Connect to all nodes and run ``flocker-reportstate``.
+        Connect to the convergence agent on all nodes.
 
+        :param reactor: See ``_get_destinations``.
         :param Deployment deployment: The requested already parsed
             configuration.
 
+        :return: ``Deferred`` that fires with a ``list`` of ``(hostname,
+            AMP)`` tuples, one per node, or errbacks if connecting to any of
+            them failed.
+        """
+        results = []
+        for target in self._get_destinations(reactor, deployment):
+            d = connectProtocol(target.endpoint, AMP())
+            d.addCallback(
+                lambda protocol, hostname=target.hostname:
+                (hostname, protocol))
+            results.append(d)
+        return gather_deferreds(results)
+
+    def _reportstate_on_nodes(self, targets):
+        """
+        Ask all nodes for their state.
+
+        :param list targets: ``(hostname, AMP)`` tuples, as returned by
+            ``_connect_to_nodes``.
+
         :return: ``Deferred`` that fires with a ``bytes`` in YAML format
             describing the current configuration.
         """
-        command = [b"flocker-reportstate"]
         results = []
-        for target in self._get_destinations(deployment):
-            d = deferToThread(target.node.get_output, command)
-            d.addCallback(safe_load)
-            d.addCallback(lambda val, key=target.hostname: (key, val))
+        for hostname, protocol in targets:
+            d = protocol.callRemote(ReportState)
+            d.addCallback(lambda response: safe_load(response["state"]))
+            d.addCallback(lambda val, key=hostname: (key, val))
             results.append(d)
         d = DeferredList(results, fireOnOneErrback=False, consumeErrors=True)
 
@@ -220,33 +271,29 @@ class DeployScript(object):
         d.addCallback(got_results)
         return d
 
-    def _changestate_on_nodes(self, deployment, deployment_config,
+    def _changestate_on_nodes(self, targets, deployment_config,
                               application_config, cluster_config):
         """
-        Connect to all nodes and run ``flocker-changestate``.
+        Tell all nodes to converge on the new configuration.
 
-        :param Deployment deployment: The requested already parsed
-            configuration.
+        :param list targets: ``(hostname, AMP)`` tuples, as returned by
+            ``_connect_to_nodes``.
         :param bytes deployment_config: YAML-encoded deployment configuration.
         :param bytes application_config: YAML-encoded application
             configuration.
         :param bytes current_config: YAML-encoded current cluster
             configuration.
 
-        :return: ``Deferred`` that fires when all remote calls are finished.
+        :return: ``Deferred`` that fires when all nodes have converged.
         """
-        command = [b"flocker-changestate",
-                   deployment_config,
-                   application_config,
-                   cluster_config]
         results = []
-        for target in self._get_destinations(deployment):
-            # XXX if number of nodes is bigger than number of available
-            # threads we won't get the required parallelism...
-            # https://github.com/ClusterHQ/flocker/issues/347
-            results.append(
-                deferToThread(
-                    target.node.get_output, command + [target.hostname]))
+        for hostname, protocol in targets:
+            results.append(protocol.callRemote(
+                ChangeState,
+                deployment_configuration=deployment_config,
+                application_configuration=application_config,
+                cluster_configuration=cluster_config,
+                hostname=hostname))
         return DeferredList(results)
 
 
@@ -10,21 +10,77 @@ from threading import current_thread
 from twisted.python.filepath import FilePath
 from twisted.python.usage import UsageError
 from twisted.trial.unittest import TestCase, SynchronousTestCase
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, fail
 from twisted.internet import reactor
 
 from ...testtools import (
-    FlockerScriptTestsMixin, StandardOptionsTestsMixin, make_with_init_tests)
+    FlockerScriptTestsMixin, StandardOptionsTestsMixin, make_with_init_tests,
+    FakeProcessReactor)
 from ..script import DeployScript, DeployOptions, NodeTarget
 from .._sshconfig import DEFAULT_SSH_DIRECTORY
 from ...node import Application, Deployment, DockerImage, Node
-from ...common import ProcessNode, FakeNode
+from ...node._agent import ReportState, ChangeState
+from ...common import SSHConnectionPool
+
+
+class FakeConvergenceProtocol(object):
+    """
+    A stand-in for an ``AMP`` connection to the convergence agent on a node.
+
+    ``ReportState`` is answered with the given state; other commands
+    succeed with an empty response.  The arguments of every command are
+    serialized as they would be on a real connection, so commands with
+    invalid arguments fail.
+
+    :ivar list commands: ``(command, arguments, thread_id)`` tuples for the
+        commands sent.
+    :ivar bool disconnected: Whether the connection has been closed.
+    """
+    def __init__(self, state):
+        """
+        :param state: The ``bytes`` to answer ``ReportState`` with, or an
+            exception to fail every command with.
+        """
+        self.state = state
+        self.commands = []
+        self.disconnected = False
+        self.transport = self
+
+    def callRemote(self, command, **arguments):
+        self.commands.append((command, arguments, current_thread().ident))
+        command.makeArguments(arguments, None)
+        if isinstance(self.state, Exception):
+            return fail(self.state)
+        if command is ReportState:
+            return succeed({"state": self.state})
+        return succeed({})
+
+    def loseConnection(self):
+        self.disconnected = True
+
+
+class FakeConvergenceEndpoint(object):
+    """
+    An endpoint which connects to a ``FakeConvergenceProtocol``.
+
+    :ivar FakeConvergenceProtocol protocol: The connection made by every
+        ``connect`` call.
+    """
+    def __init__(self, state):
+        """
+        :param state: See ``FakeConvergenceProtocol.__init__``.
+        """
+        self.protocol = FakeConvergenceProtocol(state)
+
+    def connect(self, factory):
+        return succeed(self.protocol)
 
 
 class NodeTargetInitTests(
     make_with_init_tests(
         record_type=NodeTarget,
-        kwargs=dict(node=FakeNode(b''), hostname=u'node1.example.com')
+        kwargs=dict(endpoint=FakeConvergenceEndpoint(b''),
+                    hostname=u'node1.example.com')
     )
 ):
     """
@@ -38,11 +94,11 @@ class NodeTargetTests(SynchronousTestCase):
     """
     def test_repr(self):
         """
-        ``NodeTarget.__repr__`` includes the node and hostname.
+        ``NodeTarget.__repr__`` includes the endpoint and hostname.
         """
         self.assertEqual(
-            "<NodeTarget(node=None, hostname=u'node1.example.com')>",
-            repr(NodeTarget(node=None, hostname=u'node1.example.com'))
+            "<NodeTarget(endpoint=None, hostname=u'node1.example.com')>",
+            repr(NodeTarget(endpoint=None, hostname=u'node1.example.com'))
         )
 
 
@@ -272,9 +328,10 @@ class FlockerDeployMainTests(TestCase):
     """
     Tests for ``DeployScript.main``.
     """
-    def test_deferred_result(self):
+    def empty_options(self):
         """
-        ``DeployScript.main`` returns a ``Deferred`` on success.
+        :return: ``DeployOptions`` parsed from configuration files for an
+            empty deployment.
         """
         temp = FilePath(self.mktemp())
         temp.makedirs()
@@ -294,6 +351,13 @@ class FlockerDeployMainTests(TestCase):
         options = DeployOptions()
         options.parseOptions([
             deployment_config_path.path, application_config_path.path])
+        return options
+
+    def test_deferred_result(self):
+        """
+        ``DeployScript.main`` returns a ``Deferred`` on success.
+        """
+        options = self.empty_options()
 
         script = DeployScript()
         dummy_reactor = object()
@@ -303,11 +367,26 @@ class FlockerDeployMainTests(TestCase):
             self.successResultOf(script.main(dummy_reactor, options))
         )
 
+    def test_closes_ssh_connections(self):
+        """
+        ``DeployScript.main`` closes the shared SSH connections once the
+        deployment is complete.
+        """
+        closed = []
+
+        class RecordingPool(SSHConnectionPool):
+            def close(self):
+                closed.append(True)
+
+        script = DeployScript(ssh_connections=RecordingPool())
+        self.successResultOf(script.main(object(), self.empty_options()))
+        self.assertEqual(closed, [True])
+
     def test_get_destinations(self):
         """
         ``DeployScript._get_destinations`` uses the hostnames in the deployment
-        to create SSH ``INode`` destinations, returning them along with their
-        target hostnames.
+        to create endpoints which run ``flocker-node-agent`` over SSH,
+        returning them along with their target hostnames.
         """
         db = Application(
             name=u"db-example",
@@ -322,27 +401,42 @@ class FlockerDeployMainTests(TestCase):
 
         id_rsa_flocker = DEFAULT_SSH_DIRECTORY.child(b"id_rsa_flocker")
 
-        script = DeployScript()
+        connections = SSHConnectionPool(FilePath(self.mktemp()))
+        script = DeployScript(ssh_connections=connections)
         deployment = Deployment(nodes={node1, node2})
-        destinations = script._get_destinations(deployment)
+        dummy_reactor = FakeProcessReactor()
+        destinations = script._get_destinations(dummy_reactor, deployment)
 
         def node(hostname):
-            return NodeTarget(
-                node=ProcessNode.using_ssh(
-                    hostname, 22, b"root", id_rsa_flocker),
-                hostname=hostname)
+            arguments = connections.node(
+                hostname, 22, b"root",
+                id_rsa_flocker).initial_command_arguments
+            return (hostname, dummy_reactor,
+                    arguments + (b"flocker-node-agent",))
 
         self.assertEqual(
             {node(node1.hostname), node(node2.hostname)},
-            set(destinations))
+            set((target.hostname, target.endpoint._reactor,
+                 target.endpoint._args) for target in destinations))
+
+    def test_default_ssh_connections(self):
+        """
+        By default ``DeployScript`` shares SSH connections using an
+        ``SSHConnectionPool`` with a temporary control directory.
+        """
+        script = DeployScript()
+        self.assertEqual(
+            (type(script.ssh_connections),
+             script.ssh_connections.control_directory),
+            (SSHConnectionPool, None))
 
     def run_script(self, alternate_destinations):
         """
-        Run ``DeployScript.main`` with overridden destinations for
-        ``flocker-changestate`` and ``flocker-reportstate``.
+        Run ``DeployScript.main`` with overridden destinations for the
+        convergence agent.
 
-        :param list alternate_destinations: ``INode`` providers to connect
-             to instead of the default SSH-based ``ProcessNode``.
+        :param list alternate_destinations: ``NodeTarget``\ s with endpoints
+            to connect to instead of the default ones which use SSH.
 
         :return: ``Deferred`` that fires with result of ``DeployScript.main``.
         """
@@ -383,7 +477,8 @@ class FlockerDeployMainTests(TestCase):
 
         # Change destination of commands:
         script = DeployScript()
-        script._get_destinations = lambda nodes: alternate_destinations
+        script._get_destinations = (
+            lambda reactor, deployment: alternate_destinations)
 
         # Disable SSH configuration:
         script._configure_ssh = lambda deployment: succeed(None)
@@ -392,84 +487,128 @@ class FlockerDeployMainTests(TestCase):
 
     def test_calls_reportstate(self):
         """
-        ``DeployScript.main`` calls ``flocker-reportstatestate`` using the
-        destinations and hostnames from ``_get_destinations``.
+        ``DeployScript.main`` sends ``ReportState`` to the convergence agent
+        on each of the destinations from ``_get_destinations``.
         """
         # Make sure we're inspecting results on reportstate calls only:
         self.patch(DeployScript, "_changestate_on_nodes", lambda *args: None)
 
-        expected_hostname1 = b'node101.example.com'
-        expected_hostname2 = b'node102.example.com'
-
         destinations = [
-            NodeTarget(node=FakeNode([b"{}"]), hostname=expected_hostname1),
-            NodeTarget(node=FakeNode([b"{}"]), hostname=expected_hostname2),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
         ]
         running = self.run_script(destinations)
 
         def ran(ignored):
-            expected_command = [b"flocker-reportstate"]
-
             self.assertEqual(
-                list(target.node.remote_command for target in destinations),
-                [expected_command, expected_command],
+                list([command for (command, _, _)
+                      in target.endpoint.protocol.commands]
+                     for target in destinations),
+                [[ReportState], [ReportState]],
             )
         running.addCallback(ran)
         return running
 
-    def test_calls_reportstate_in_thread_pool(self):
+    def test_calls_reportstate_without_threads(self):
         """
-        ``DeployScript.main`` calls ``flocker-reportstate`` to destination
-        nodes in a thread pool.
-
-        (Proving actual parallelism is much more difficult...)
+        ``DeployScript.main`` sends ``ReportState`` to all destination nodes
+        from the reactor thread, so the number of nodes addressed at once is
+        not limited by the size of a thread pool.
         """
         # Make sure we're inspecting results on reportstate calls only:
         self.patch(DeployScript, "_changestate_on_nodes", lambda *args: None)
 
         destinations = [
-            NodeTarget(node=FakeNode([b"{}"]),
-                       hostname=b'node101.example.com'),
-            NodeTarget(node=FakeNode([b"{}"]),
-                       hostname=b'node102.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
         ]
 
         running = self.run_script(destinations)
 
         def ran(ignored):
-            self.assertNotEqual(
-                set(target.node.thread_id for target in destinations),
+            self.assertEqual(
+                set(thread_id
+                    for target in destinations
+                    for (_, _, thread_id)
+                    in target.endpoint.protocol.commands),
                 set([current_thread().ident]))
         running.addCallback(ran)
         return running
 
     def test_reportstate_failure_means_no_changestate(self):
         """
-        If ``flocker-reportstate`` fails to respond for some reason,
-        ``flocker-changestate`` is not called.
+        If ``ReportState`` fails on some node, ``ChangeState`` is not sent.
         """
         # If this is ever called we'll get a ZeroDivisionError:
         self.patch(DeployScript, "_changestate_on_nodes", lambda *args: 1/0)
 
         exception = RuntimeError()
         destinations = [
-            NodeTarget(node=FakeNode([exception]),
-                       hostname=b'node101.example.com'),
-            NodeTarget(node=FakeNode([b"{}"]),
-                       hostname=b'node102.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(exception),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
         ]
         running = self.run_script(destinations)
         self.assertFailure(running, RuntimeError)
         return running
 
+    def test_disconnects(self):
+        """
+        ``DeployScript.main`` closes its connections to the convergence
+        agents once the deployment is complete.
+        """
+        destinations = [
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
+        ]
+        running = self.run_script(destinations)
+
+        def ran(ignored):
+            self.assertEqual(
+                [target.endpoint.protocol.disconnected
+                 for target in destinations],
+                [True, True])
+        running.addCallback(ran)
+        return running
+
+    def test_disconnects_on_failure(self):
+        """
+        ``DeployScript.main`` closes its connections to the convergence
+        agents if the deployment fails.
+        """
+        destinations = [
+            NodeTarget(endpoint=FakeConvergenceEndpoint(RuntimeError()),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
+        ]
+        running = self.assertFailure(
+            self.run_script(destinations), RuntimeError)
+
+        def failed(ignored):
+            self.assertEqual(
+                [target.endpoint.protocol.disconnected
+                 for target in destinations],
+                [True, True])
+        running.addCallback(failed)
+        return running
+
     def test_calls_changestate(self):
         """
-        ``DeployScript.main`` calls ``flocker-changestate`` using the
-        destinations and hostnames from ``_get_destinations`` and the
-        aggreggated result for ``flocker-reportstate``.
+        ``DeployScript.main`` sends ``ChangeState`` to the convergence agent
+        on each of the destinations from ``_get_destinations``, with its
+        hostname, the configuration and the aggregated result of
+        ``ReportState``.
         """
-        expected_hostname1 = b'node101.example.com'
-        expected_hostname2 = b'node102.example.com'
+        expected_hostname1 = u'node101.example.com'
+        expected_hostname2 = u'node102.example.com'
 
         actual_config_host1 = {
             u"version": 1,
@@ -489,52 +628,64 @@ class FlockerDeployMainTests(TestCase):
         }
 
         destinations = [
-            NodeTarget(node=FakeNode([safe_dump(actual_config_host1), b""]),
-                       hostname=expected_hostname1),
-            NodeTarget(node=FakeNode([safe_dump(actual_config_host2), b""]),
-                       hostname=expected_hostname2),
+            NodeTarget(
+                endpoint=FakeConvergenceEndpoint(
+                    safe_dump(actual_config_host1)),
+                hostname=expected_hostname1),
+            NodeTarget(
+                endpoint=FakeConvergenceEndpoint(
+                    safe_dump(actual_config_host2)),
+                hostname=expected_hostname2),
         ]
         running = self.run_script(destinations)
 
         def ran(ignored):
-            expected_common = [
-                b"flocker-changestate",
+            expected_common = (
                 safe_load(self.deployment_config),
                 safe_load(self.application_config),
                 {expected_hostname1: actual_config_host1,
-                 expected_hostname2: actual_config_host2}]
+                 expected_hostname2: actual_config_host2})
 
             actual = []
             for target in destinations:
-                command = target.node.remote_command
-                actual.append(map(safe_load, command[:-1]) + [command[-1]])
+                [(command, arguments, _)] = [
+                    sent for sent in target.endpoint.protocol.commands
+                    if sent[0] is not ReportState]
+                actual.append((
+                    command,
+                    safe_load(arguments["deployment_configuration"]),
+                    safe_load(arguments["application_configuration"]),
+                    safe_load(arguments["cluster_configuration"]),
+                    arguments["hostname"]))
             self.assertEqual(
-                sorted(actual),
-                sorted([expected_common + [expected_hostname1],
-                        expected_common + [expected_hostname2]])
+                actual,
+                [(ChangeState,) + expected_common + (expected_hostname1,),
+                 (ChangeState,) + expected_common + (expected_hostname2,)]
             )
         running.addCallback(ran)
         return running
 
-    def test_calls_changestate_in_thread_pool(self):
+    def test_calls_changestate_without_threads(self):
         """
-        ``DeployScript.main`` calls ``flocker-changestate`` to destination
-        nodes in a thread pool.
-
-        (Proving actual parallelism is much more difficult...)
+        ``DeployScript.main`` sends ``ChangeState`` to all destination nodes
+        from the reactor thread, so the number of nodes addressed at once is
+        not limited by the size of a thread pool.
         """
         destinations = [
-            NodeTarget(node=FakeNode([b"{}", b""]),
-                       hostname=b'node101.example.com'),
-            NodeTarget(node=FakeNode([b"{}", b""]),
-                       hostname=b'node102.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node101.example.com'),
+            NodeTarget(endpoint=FakeConvergenceEndpoint(b"{}"),
+                       hostname=u'node102.example.com'),
         ]
 
         running = self.run_script(destinations)
 
         def ran(ignored):
-            self.assertNotEqual(
-                set(target.node.thread_id for target in destinations),
-                set([current_thread().ident]))
+            commands = [sent for target in destinations
+                        for sent in target.endpoint.protocol.commands]
+            self.assertEqual(
+                (set(command for (command, _, _) in commands),
+                 set(thread_id for (_, _, thread_id) in commands)),
+                ({ReportState, ChangeState}, set([current_thread().ident])))
         running.addCallback(ran)
         return running
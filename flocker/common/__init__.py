@@ -4,7 +4,21 @@
 Shared flocker components.
 """
 
-__all__ = ['INode', 'FakeNode', 'ProcessNode', 'gather_deferreds']
+__all__ = [
+    'INode', 'FakeNode', 'ProcessNode', 'gather_deferreds',
+    'IStreamConsumer', 'IStreamProducer', 'ProcessConsumer',
+    'ProcessProducer', 'MemoryConsumer', 'IDescriptorConsumer',
+    'IDescriptorProducer', 'splice', 'FilterConsumer', 'ThrottledConsumer',
+    'SSHConnectionPool', 'IAsyncNode', 'AsyncProcessNode', 'FakeAsyncNode',
+    'FinishingConsumer', 'PriorityLimiter', 'listen_private_unix',
+    'relay_stdio',
+]
 
-from ._ipc import INode, FakeNode, ProcessNode
-from ._defer import gather_deferreds
+from ._ipc import (
+    INode, FakeNode, ProcessNode, IStreamConsumer, IStreamProducer,
+    ProcessConsumer, ProcessProducer, MemoryConsumer, IDescriptorConsumer,
+    IDescriptorProducer, splice, FilterConsumer, ThrottledConsumer,
+    SSHConnectionPool, IAsyncNode, AsyncProcessNode, FakeAsyncNode,
+    FinishingConsumer, listen_private_unix, relay_stdio,
+)
+from ._defer import gather_deferreds, PriorityLimiter
@@ -5,7 +5,10 @@
 Various helpers for dealing with Deferred APIs in flocker.
 """
 
-from twisted.internet.defer import gatherResults
+from heapq import heappush, heappop
+from itertools import count
+
+from twisted.internet.defer import Deferred, gatherResults, maybeDeferred
 from twisted.python import log
 
 
@@ -53,3 +56,69 @@ def gather_deferreds(deferreds):
     # Then return the result of the first gather.
     gathering.addCallback(lambda ignored: results_or_first_failure)
     return gathering
+
+
+class PriorityLimiter(object):
+    """
+    Run at most a given number of operations at once.
+
+    Operations which have to wait are started in order of priority, lowest
+    first, and in the order they were requested when their priorities are
+    the same.
+
+    :ivar int limit: The number of operations which may run at once.
+    """
+    def __init__(self, limit):
+        """
+        :param int limit: See ``limit``.
+        """
+        self.limit = limit
+        self._running = 0
+        # Heap of (priority, sequence number, Deferred) for the operations
+        # waiting to start:
+        self._waiting = []
+        self._sequence = count()
+
+    def run(self, priority, f, *args, **kwargs):
+        """
+        Call a function once fewer than ``limit`` operations are running and
+        nothing with a lower priority is waiting.
+
+        :param priority: A value to order waiting operations by, lowest
+            first.
+        :param f: The function to call.  It may return a ``Deferred``, in
+            which case the operation is running until that fires.
+        :param args: Positional arguments for ``f``.
+        :param kwargs: Keyword arguments for ``f``.
+
+        :return: ``Deferred`` that fires with the result of ``f``.
+        """
+        ready = Deferred()
+        heappush(self._waiting, (priority, next(self._sequence), ready))
+
+        def start(_):
+            d = maybeDeferred(f, *args, **kwargs)
+            d.addBoth(self._finished)
+            return d
+        ready.addCallback(start)
+        self._start_waiting()
+        return ready
+
+    def _finished(self, result):
+        """
+        Record that an operation has finished and start the next one.
+
+        :param result: The result of the operation, which is passed through.
+        """
+        self._running -= 1
+        self._start_waiting()
+        return result
+
+    def _start_waiting(self):
+        """
+        Start waiting operations while there is room for them.
+        """
+        while self._waiting and self._running < self.limit:
+            _, _, ready = heappop(self._waiting)
+            self._running += 1
+            ready.callback(None)
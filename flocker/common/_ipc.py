@@ -4,16 +4,562 @@
 Inter-process communication for flocker.
 """
 
-from subprocess import Popen, PIPE, check_output, CalledProcessError
+import os
+from errno import EEXIST
+from hashlib import sha1
+from subprocess import Popen, PIPE, check_output, CalledProcessError, call
+from tempfile import mkdtemp
 from contextlib import contextmanager
 from io import BytesIO
 from threading import current_thread
 from pipes import quote
 
-from zope.interface import Interface, implementer
+from zope.interface import Interface, implementer, alsoProvides
 
 from characteristic import with_cmp, with_repr
 
+from twisted.internet.interfaces import IConsumer, IPushProducer
+from twisted.internet.protocol import ProcessProtocol, Protocol
+from twisted.internet.defer import (
+    Deferred, succeed, maybeDeferred, gatherResults)
+from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
+from twisted.internet.stdio import StandardIO
+from twisted.internet.error import (
+    ProcessDone, ProcessExitedAlready, ProcessTerminated,
+)
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+
+
+class IStreamConsumer(IConsumer):
+    """
+    A consumer of a stream of ``bytes`` which needs to be told when the stream
+    is complete.
+    """
+    def finish():
+        """
+        Indicate that the whole stream has been written.
+
+        :return: ``Deferred`` that fires when the consumer has finished
+            processing the stream, or errbacks if processing failed.
+        """
+
+
+class IStreamProducer(IPushProducer):
+    """
+    A streaming producer which writes a finite stream of ``bytes`` to a
+    consumer once started.
+    """
+    def startProducing(consumer):
+        """
+        Start writing the stream to a consumer.
+
+        The producer registers itself with the consumer and unregisters
+        itself once the stream has been written.  It does not call
+        ``IStreamConsumer.finish``.
+
+        :param IConsumer consumer: Where to write the stream.
+
+        :return: ``Deferred`` that fires when the whole stream has been
+            written, or errbacks if the stream could not be generated.
+        """
+
+
+class IDescriptorConsumer(IStreamConsumer):
+    """
+    A stream consumer which can read the stream directly from a file
+    descriptor, so the data need not pass through this process.
+    """
+    def consumeDescriptor(fd):
+        """
+        Read the whole stream from a file descriptor instead of having it
+        written to this consumer.
+
+        This must be called before anything is written to the consumer.
+        ``finish`` must still be called once the stream is complete.
+
+        :param int fd: A readable file descriptor.  Ownership passes to the
+            consumer, which closes it.
+        """
+
+
+class IDescriptorProducer(IStreamProducer):
+    """
+    A stream producer which can write the stream directly to a file
+    descriptor, so the data need not pass through this process.
+    """
+    def produceToDescriptor(fd):
+        """
+        Write the whole stream to a file descriptor.
+
+        :param int fd: A writeable file descriptor.  Ownership passes to the
+            producer, which closes it.
+
+        :return: ``Deferred`` that fires when the whole stream has been
+            written, or errbacks if the stream could not be generated.
+        """
+
+
+@implementer(IDescriptorConsumer)
+class ProcessConsumer(ProcessProtocol):
+    """
+    Write a stream to the standard input of a child process.
+
+    Producers registered with this consumer are paused whenever the pipe to
+    the child is full.
+    """
+    def __init__(self, reactor, arguments):
+        """
+        :param reactor: A ``IReactorProcess`` provider.
+        :param arguments: ``list`` of ``bytes``, the command to run.  The
+            first element is looked up on ``PATH``.
+
+        The child process is started when the consumer is first used.
+        """
+        self._reactor = reactor
+        self._arguments = arguments
+        self._ended = Deferred()
+        self._stdin = None
+        self._stdout = "r"
+
+    def _start(self, stdin):
+        """
+        Start the child process if it has not been started already.
+
+        :param stdin: ``"w"`` to give the child a pipe written by this
+            process, or a file descriptor to use as its standard input.
+        """
+        if self._stdin is None:
+            self._stdin = stdin
+            self._reactor.spawnProcess(
+                self, self._arguments[0], self._arguments, os.environ,
+                childFDs={0: stdin, 1: self._stdout, 2: 2})
+
+    def processEnded(self, reason):
+        if reason.check(ProcessDone):
+            self._ended.callback(None)
+        else:
+            self._ended.errback(reason)
+
+    def consumeDescriptor(self, fd):
+        try:
+            self._start(fd)
+        finally:
+            os.close(fd)
+
+    def write(self, data):
+        self._start("w")
+        self.transport.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self._start("w")
+        self.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.transport.unregisterProducer()
+
+    def finish(self):
+        """
+        Close the child's standard input.
+
+        :return: ``Deferred`` that fires when the child has exited
+            successfully, or errbacks with the ``ProcessTerminated`` reason
+            if it exited with an error.
+        """
+        self._start("w")
+        if self._stdin == "w":
+            self.transport.closeStdin()
+        return self._ended
+
+
+@implementer(IPushProducer)
+class FilterConsumer(ProcessConsumer):
+    """
+    Pass a stream through a child process, for example a compressor, on its
+    way to another consumer.
+
+    If the other consumer can read from a file descriptor the child's output
+    is connected to it directly.  Otherwise the output is written to it by
+    this process, with this object registered as its producer.
+    """
+    def __init__(self, reactor, arguments, consumer):
+        """
+        :param reactor: A ``IReactorProcess`` provider.
+        :param arguments: ``list`` of ``bytes``, the filter command to run.
+        :param IStreamConsumer consumer: Where to write the filtered stream.
+        """
+        ProcessConsumer.__init__(self, reactor, arguments)
+        self._consumer = consumer
+        self._registered = False
+
+    def _start(self, stdin):
+        if self._stdin is not None:
+            return
+        if IDescriptorConsumer.providedBy(self._consumer):
+            read_fd, write_fd = os.pipe()
+            try:
+                self._consumer.consumeDescriptor(read_fd)
+            except Exception:
+                os.close(write_fd)
+                raise
+            self._stdout = write_fd
+            try:
+                ProcessConsumer._start(self, stdin)
+            finally:
+                os.close(write_fd)
+        else:
+            ProcessConsumer._start(self, stdin)
+            self._consumer.registerProducer(self, True)
+            self._registered = True
+
+    def childDataReceived(self, child_fd, data):
+        self._consumer.write(data)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        try:
+            self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
+
+    def finish(self):
+        """
+        Wait for the filter to process the whole stream and then finish the
+        other consumer.
+
+        :return: ``Deferred`` that fires when the other consumer has
+            finished.  If the filter fails the other consumer is still
+            finished, and the ``Deferred`` errbacks with the filter's failure.
+        """
+        filtering = ProcessConsumer.finish(self)
+
+        def filtered(result):
+            if self._registered:
+                self._registered = False
+                self._consumer.unregisterProducer()
+            finishing = self._consumer.finish()
+            if isinstance(result, Failure):
+                finishing.addBoth(lambda _: result)
+            return finishing
+        filtering.addBoth(filtered)
+        return filtering
+
+
+@implementer(IDescriptorProducer)
+class ProcessProducer(ProcessProtocol):
+    """
+    Write the standard output of a child process to a consumer.
+
+    Pausing this producer stops reading from the child, so a child which
+    generates output faster than the consumer can accept it blocks.
+    """
+    def __init__(self, reactor, arguments):
+        """
+        :param reactor: A ``IReactorProcess`` provider.
+        :param arguments: ``list`` of ``bytes``, the command to run.  The
+            first element is looked up on ``PATH``.
+
+        The child process is started by ``startProducing`` or
+        ``produceToDescriptor``.
+        """
+        self._reactor = reactor
+        self._arguments = arguments
+        self._consumer = None
+        self._ended = None
+
+    def _start(self, stdout):
+        """
+        Start the child process with its standard input closed.
+
+        :param stdout: ``"r"`` to read the child's output in this process, or
+            a file descriptor to use as its standard output.
+
+        :return: ``Deferred`` that fires when the child exits.
+        """
+        self._ended = Deferred()
+        self._reactor.spawnProcess(
+            self, self._arguments[0], self._arguments, os.environ,
+            childFDs={0: "w", 1: stdout, 2: 2})
+        self.transport.closeStdin()
+        return self._ended
+
+    def startProducing(self, consumer):
+        self._consumer = consumer
+        ended = self._start("r")
+        consumer.registerProducer(self, True)
+        return ended
+
+    def produceToDescriptor(self, fd):
+        try:
+            return self._start(fd)
+        finally:
+            os.close(fd)
+
+    def childDataReceived(self, child_fd, data):
+        self._consumer.write(data)
+
+    def processEnded(self, reason):
+        if self._consumer is not None:
+            self._consumer.unregisterProducer()
+        if reason.check(ProcessDone):
+            self._ended.callback(None)
+        else:
+            self._ended.errback(reason)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        try:
+            self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
+
+
+@implementer(IStreamConsumer)
+class MemoryConsumer(object):
+    """
+    Accumulate a stream in memory.
+
+    Registered producers are never paused.
+
+    :ivar BytesIO output: The data written so far.  Once ``finish`` is called
+        it is rewound so it can be read from the start.
+    """
+    def __init__(self):
+        self.output = BytesIO()
+        self.producer = None
+
+    def write(self, data):
+        self.output.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def finish(self):
+        self.output.seek(0, 0)
+        return succeed(None)
+
+
+@implementer(IStreamConsumer, IPushProducer)
+class ThrottledConsumer(object):
+    """
+    Limit the rate at which a stream is written to another consumer.
+
+    Whenever more has been written than the rate allows, the registered
+    producer is paused until the average rate since the first write has
+    dropped back to the limit.  The producer is also paused while the other
+    consumer asks this object, its producer, to pause.
+    """
+    def __init__(self, reactor, consumer, rate):
+        """
+        :param reactor: A ``IReactorTime`` provider.
+        :param IStreamConsumer consumer: Where to write the stream.
+        :param int rate: The maximum average rate, in bytes per second.
+        """
+        self._reactor = reactor
+        self._consumer = consumer
+        self._rate = rate
+        self._producer = None
+        self._started = None
+        self._written = 0
+        self._delayed = None
+        self._paused = False
+
+    def write(self, data):
+        now = self._reactor.seconds()
+        if self._started is None:
+            self._started = now
+        self._consumer.write(data)
+        self._written += len(data)
+        delay = self._started + float(self._written) / self._rate - now
+        if delay > 0 and self._delayed is None:
+            self._delayed = self._reactor.callLater(delay, self._caught_up)
+            if self._producer is not None:
+                self._producer.pauseProducing()
+
+    def _caught_up(self):
+        self._delayed = None
+        if self._producer is not None and not self._paused:
+            self._producer.resumeProducing()
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._consumer.registerProducer(self, True)
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._consumer.unregisterProducer()
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._producer is not None:
+            self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._producer is not None and self._delayed is None:
+            self._producer.resumeProducing()
+
+    def stopProducing(self):
+        if self._producer is not None:
+            self._producer.stopProducing()
+
+    def finish(self):
+        if self._delayed is not None:
+            self._delayed.cancel()
+            self._delayed = None
+        return self._consumer.finish()
+
+
+@implementer(IStreamConsumer)
+class FinishingConsumer(object):
+    """
+    Pass a stream through to another consumer, and take a further step once
+    that consumer has finished.
+
+    If the other consumer provides ``IDescriptorConsumer`` so does this one,
+    so the stream can still be spliced into it.
+    """
+    def __init__(self, consumer, then):
+        """
+        :param IStreamConsumer consumer: Where to write the stream.
+        :param then: Callable called with the result of finishing
+            ``consumer``, once it has finished successfully.  Its result, or
+            the result of the ``Deferred`` it returns, is the result of
+            finishing this consumer.
+        """
+        self._consumer = consumer
+        self._then = then
+        if IDescriptorConsumer.providedBy(consumer):
+            alsoProvides(self, IDescriptorConsumer)
+
+    def consumeDescriptor(self, fd):
+        self._consumer.consumeDescriptor(fd)
+
+    def write(self, data):
+        self._consumer.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def finish(self):
+        d = self._consumer.finish()
+        d.addCallback(self._then)
+        return d
+
+
+def splice(producer, consumer):
+    """
+    Connect a producer directly to a consumer with a pipe, so the stream is
+    copied by the kernel instead of passing through this process.
+
+    :param IDescriptorProducer producer: Source of the stream.
+    :param IDescriptorConsumer consumer: Destination of the stream.
+
+    :return: ``Deferred`` as returned by
+        ``IDescriptorProducer.produceToDescriptor``.  ``finish`` must still be
+        called on the consumer afterwards.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        consumer.consumeDescriptor(read_fd)
+    except Exception:
+        os.close(write_fd)
+        raise
+    return producer.produceToDescriptor(write_fd)
+
+
+def listen_private_unix(reactor, path, factory):
+    """
+    Listen on a UNIX socket which only the user running this process (in
+    production, root) can connect to.
+
+    :param reactor: The ``IReactorUNIX`` provider to listen with.
+    :param FilePath path: The path of the socket.  Its directory is created
+        if it does not exist, and a socket left behind by a process which
+        is no longer running is replaced.
+    :param ServerFactory factory: Creates a protocol for each connection.
+
+    :return: The ``IListeningPort``.
+    """
+    parent = path.parent()
+    if not parent.exists():
+        try:
+            parent.makedirs()
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+    return reactor.listenUNIX(path.path, factory, mode=0o600, wantPID=True)
+
+
+class _RelayProtocol(Protocol):
+    """
+    One end of a relay, which writes what it receives to the other end and
+    closes the other end when it is closed.
+
+    :ivar _RelayProtocol other: The other end.
+    :ivar Deferred closed: Fires when this end's connection is lost.
+    """
+    def __init__(self):
+        self.other = None
+        self.closed = Deferred()
+
+    def dataReceived(self, data):
+        self.other.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+        if self.other.transport is not None:
+            self.other.transport.loseConnection()
+
+
+def relay_stdio(reactor, endpoint, stdio=StandardIO):
+    """
+    Connect to an endpoint, then copy standard input to the connection and
+    the connection's output to standard output until either is closed.
+
+    Run over SSH, this lets another node talk to a server which only listens
+    on a local UNIX socket, authenticated by the SSH connection.
+
+    :param reactor: The reactor to read and write standard I/O with.
+    :param IStreamClientEndpoint endpoint: Connects to the server.
+    :param stdio: ``StandardIO`` or a replacement for testing.
+
+    :return: ``Deferred`` that fires when both sides have been closed, or
+        errbacks if connecting failed.
+    """
+    inside = _RelayProtocol()
+    outside = _RelayProtocol()
+    inside.other = outside
+    outside.other = inside
+
+    def connected(_):
+        # Standard input is only read once there is somewhere to write it:
+        stdio(outside, reactor=reactor)
+        # Each side stops reading while the other can't keep up:
+        outside.transport.registerProducer(inside.transport, True)
+        inside.transport.registerProducer(outside.transport, True)
+        return gatherResults([inside.closed, outside.closed])
+    d = connectProtocol(endpoint, inside)
+    d.addCallback(connected)
+    d.addCallback(lambda _: None)
+    return d
+
 
 class INode(Interface):
     """
@@ -42,6 +588,79 @@ class INode(Interface):
         :return: ``bytes`` of stdout from the remote command.
         """
 
+    def run_stream(remote_command):
+        """
+        Run a remote command and stream data to its stdin without blocking.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: An ``IStreamConsumer`` provider.  Its ``finish`` method
+            returns a ``Deferred`` that fires with the ``bytes`` of stdout
+            from the remote command, or errbacks with ``IOError`` if the
+            remote command exits with an error.
+        """
+
+
+class IAsyncNode(Interface):
+    """
+    A remote node with which this node can communicate without blocking.
+    """
+
+    def get_output(remote_command):
+        """
+        Run a remote command and collect its stdout.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: ``Deferred`` that fires with the ``bytes`` of stdout from
+            the remote command, or errbacks with ``IOError`` if the remote
+            command exits with an error.
+        """
+
+    def run_stream(remote_command):
+        """
+        See ``INode.run_stream``.
+        """
+
+
+class _RemoteCommandConsumer(ProcessConsumer):
+    """
+    A ``ProcessConsumer`` which reports failures the same way as
+    ``ProcessNode.run``.
+    """
+    def __init__(self, reactor, arguments, remote_command):
+        """
+        :param remote_command: The part of ``arguments`` which is the remote
+            command, for error reporting.
+        """
+        ProcessConsumer.__init__(self, reactor, arguments)
+        self._remote_command = remote_command
+        self._output = []
+
+    def childDataReceived(self, child_fd, data):
+        self._output.append(data)
+
+    def finish(self):
+        d = ProcessConsumer.finish(self)
+        d.addCallback(lambda _: b"".join(self._output))
+
+        def failed(reason):
+            if not reason.check(ProcessTerminated):
+                return reason
+            # We should really capture this and stderr better:
+            # https://github.com/ClusterHQ/flocker/issues/155
+            raise IOError(
+                "Bad exit", self._remote_command, reason.value.exitCode)
+        d.addErrback(failed)
+        return d
+
+
+# The number of seconds a shared SSH connection is kept open after the last
+# command using it finishes.
+DEFAULT_CONTROL_PERSIST = 60
+
 
 @with_cmp(["initial_command_arguments"])
 @with_repr(["initial_command_arguments"])
@@ -50,7 +669,8 @@ class ProcessNode(object):
     """
     Communicate with a remote node using a subprocess.
     """
-    def __init__(self, initial_command_arguments, quote=lambda d: d):
+    def __init__(self, initial_command_arguments, quote=lambda d: d,
+                 reactor=None):
         """
         :param initial_command_arguments: ``tuple`` of ``bytes``, initial
             command arguments to prefix to whatever arguments get passed to
@@ -59,12 +679,22 @@ class ProcessNode(object):
         :param quote: Callable that transforms the non-initial command
             arguments, converting a list of ``bytes`` to a list of
             ``bytes``. By default does nothing.
+
+        :param reactor: The ``IReactorProcess`` provider ``run_stream`` uses
+            to start processes, or ``None`` to use the global reactor.
         """
         self.initial_command_arguments = tuple(initial_command_arguments)
         self._quote = quote
+        self._reactor = reactor
+
+    def _prepare(self):
+        """
+        Do anything needed before a command can be run.  By default nothing.
+        """
 
     @contextmanager
     def run(self, remote_command):
+        self._prepare()
         process = Popen(
             self.initial_command_arguments +
             tuple(map(self._quote, remote_command)),
@@ -80,6 +710,7 @@ class ProcessNode(object):
                 raise IOError("Bad exit", remote_command, exit_code)
 
     def get_output(self, remote_command):
+        self._prepare()
         try:
             return check_output(
                 self.initial_command_arguments +
@@ -89,8 +720,36 @@ class ProcessNode(object):
             # https://github.com/ClusterHQ/flocker/issues/155
             raise IOError("Bad exit", remote_command, e.returncode, e.output)
 
+    def run_stream(self, remote_command):
+        self._prepare()
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        return _RemoteCommandConsumer(
+            reactor,
+            list(self.initial_command_arguments) +
+            map(self._quote, remote_command),
+            remote_command)
+
+    def endpoint(self, reactor, remote_command):
+        """
+        Create an endpoint whose connections talk to a command run on the
+        node, through the command's standard input and output.
+
+        :param reactor: The ``IReactorProcess`` provider to run the command
+            with.
+        :param remote_command: ``list`` of ``bytes``, the command to run.
+
+        :return: An ``IStreamClientEndpoint`` provider.
+        """
+        self._prepare()
+        arguments = (self.initial_command_arguments +
+                     tuple(map(self._quote, remote_command)))
+        return ProcessEndpoint(reactor, arguments[0], arguments)
+
     @classmethod
-    def using_ssh(cls, host, port, username, private_key):
+    def using_ssh(cls, host, port, username, private_key, control_path=None,
+                  control_persist=DEFAULT_CONTROL_PERSIST):
         """Create a ``ProcessNode`` that communicate over SSH.
 
         :param bytes host: The hostname or IP.
@@ -98,9 +757,25 @@ class ProcessNode(object):
         :param bytes username: The username to SSH as.
         :param FilePath private_key: Path to private key to use when talking to
             SSH server.
+        :param FilePath control_path: If given, the path of a socket through
+            which commands share a single SSH connection to the server (see
+            ``ControlPath`` in ``ssh_config(5)``).  By default every command
+            makes its own connection.
+        :param int control_persist: The number of seconds a shared connection
+            is kept open after the last command using it finishes.
 
         :return: ``ProcessNode`` instance that communicates over SSH.
         """
+        if control_path is None:
+            # The tests hang if ControlMaster is set without ControlPersist,
+            # since OpenSSH won't ever close the connection to the test
+            # server.
+            multiplexing = (b"-oControlMaster=no",)
+        else:
+            multiplexing = (
+                b"-o", b"ControlMaster=auto",
+                b"-o", b"ControlPath=" + control_path.path,
+                b"-o", b"ControlPersist=%d" % (control_persist,))
         return cls(initial_command_arguments=(
             b"ssh",
             b"-q",  # suppress warnings
@@ -109,10 +784,7 @@ class ProcessNode(object):
             # We're ok with unknown hosts; we'll be switching away from
             # SSH by the time Flocker is production-ready and security is
             # a concern.
-            b"-o", b"StrictHostKeyChecking=no",
-            # The tests hang if ControlMaster is set, since OpenSSH won't
-            # ever close the connection to the test server.
-            b"-oControlMaster=no",
+            b"-o", b"StrictHostKeyChecking=no") + multiplexing + (
             # On some Ubuntu versions (and perhaps elsewhere) not
             # disabling this leads for mDNS lookups on every SSH, which
             # can slow down connections very noticeably:
@@ -120,6 +792,206 @@ class ProcessNode(object):
             b"-p", b"%d" % (port,), host), quote=quote)
 
 
+class _PooledSSHNode(ProcessNode):
+    """
+    A ``ProcessNode`` created by ``SSHConnectionPool``, which creates the
+    directory for the shared connection's socket before running a command.
+    """
+    def __init__(self, initial_command_arguments, control_directory):
+        """
+        :param initial_command_arguments: See ``ProcessNode.__init__``.
+        :param FilePath control_directory: The directory containing the
+            socket.
+        """
+        ProcessNode.__init__(self, initial_command_arguments, quote=quote)
+        self._control_directory = control_directory
+
+    def _prepare(self):
+        """
+        Create the socket directory, readable only by this user, if it does
+        not exist.
+        """
+        if not self._control_directory.exists():
+            parent = self._control_directory.parent()
+            if not parent.exists():
+                try:
+                    parent.makedirs()
+                except OSError as e:
+                    if e.errno != EEXIST:
+                        raise
+            try:
+                # Created with its final mode, so no other user can ever
+                # reach the sockets:
+                os.mkdir(self._control_directory.path, 0o700)
+            except OSError as e:
+                # Another thread may have just created it:
+                if e.errno != EEXIST:
+                    raise
+            else:
+                # The mode given to mkdir is masked by the umask:
+                self._control_directory.chmod(0o700)
+
+
+class _OutputCollector(ProcessProtocol):
+    """
+    Collect the output of a child process.
+
+    :ivar Deferred result: Fires with the output once the process has exited
+        successfully, or errbacks with ``IOError`` the same way as
+        ``ProcessNode.get_output`` raises it.
+    """
+    def __init__(self, remote_command):
+        """
+        :param remote_command: The command being run, for error reporting.
+        """
+        self._remote_command = remote_command
+        self._output = []
+        self.result = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def childDataReceived(self, child_fd, data):
+        self._output.append(data)
+
+    def processEnded(self, reason):
+        output = b"".join(self._output)
+        if reason.check(ProcessDone):
+            self.result.callback(output)
+        else:
+            # We should really capture this and stderr better:
+            # https://github.com/ClusterHQ/flocker/issues/155
+            self.result.errback(IOError(
+                "Bad exit", self._remote_command, reason.value.exitCode,
+                output))
+
+
+@with_cmp(["node"])
+@with_repr(["node"])
+@implementer(IAsyncNode)
+class AsyncProcessNode(object):
+    """
+    Run commands in the same way as a ``ProcessNode``, without blocking.
+
+    Each command is a child process started by the reactor, so any number of
+    commands can run at once without a thread each.
+
+    :ivar ProcessNode node: The node whose commands are run.
+    """
+    def __init__(self, node, reactor=None):
+        """
+        :param ProcessNode node: See ``node``.
+        :param reactor: The ``IReactorProcess`` provider to start processes
+            with, or ``None`` to use the global reactor.
+        """
+        self.node = node
+        self._reactor = reactor
+
+    def get_output(self, remote_command):
+        self.node._prepare()
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        arguments = (list(self.node.initial_command_arguments) +
+                     map(self.node._quote, remote_command))
+        collector = _OutputCollector(remote_command)
+        reactor.spawnProcess(
+            collector, arguments[0], arguments, os.environ,
+            childFDs={0: "w", 1: "r", 2: 2})
+        return collector.result
+
+    def run_stream(self, remote_command):
+        return self.node.run_stream(remote_command)
+
+
+def _control_path(control_directory, host, port, username):
+    """
+    Choose the socket of the shared connection to a server.
+
+    A hash keeps the path within the limit on the length of a socket's
+    path.  OpenSSH can hash it itself (``%C``), but only from version 6.7,
+    which is newer than the one on the supported node operating systems.
+
+    :param FilePath control_directory: The directory containing the sockets.
+    :param bytes host: The server's hostname or address.
+    :param int port: The server's SSH port.
+    :param bytes username: The user to connect as.
+
+    :return: ``FilePath`` of the socket.
+    """
+    identity = b"%s@%s:%d" % (username, host, port)
+    return control_directory.child(sha1(identity).hexdigest()[:16])
+
+
+class SSHConnectionPool(object):
+    """
+    Create SSH ``ProcessNode``\ s which share one authenticated connection
+    per server, using OpenSSH connection multiplexing, so that only the
+    first command run on each server pays for a handshake.
+
+    :ivar FilePath control_directory: The directory containing the sockets
+        of the shared connections, or ``None`` if a temporary directory is to
+        be used but has not been created yet.
+    """
+    def __init__(self, control_directory=None,
+                 control_persist=DEFAULT_CONTROL_PERSIST):
+        """
+        :param FilePath control_directory: The directory in which to keep the
+            shared connections' sockets.  It is created when first needed.
+            By default a new temporary directory is used, which is removed by
+            ``close``.
+        :param int control_persist: See ``ProcessNode.using_ssh``.
+        """
+        self._temporary = control_directory is None
+        self.control_directory = control_directory
+        self._control_persist = control_persist
+        self._nodes = {}
+
+    def node(self, host, port, username, private_key):
+        """
+        Get a ``ProcessNode`` which runs commands on a server over the shared
+        connection to it.
+
+        See ``ProcessNode.using_ssh`` for the parameters.
+
+        :return: ``ProcessNode`` instance that communicates over SSH.
+        """
+        key = (host, port, username, private_key)
+        if key not in self._nodes:
+            if self.control_directory is None:
+                self.control_directory = FilePath(
+                    mkdtemp(prefix=b"flocker-ssh-"))
+            node = ProcessNode.using_ssh(
+                host, port, username, private_key,
+                control_path=_control_path(
+                    self.control_directory, host, port, username),
+                control_persist=self._control_persist)
+            self._nodes[key] = _PooledSSHNode(
+                node.initial_command_arguments, self.control_directory)
+        return self._nodes[key]
+
+    def close(self):
+        """
+        Close the shared connections of all the nodes created by this pool,
+        and remove the control directory if it is a temporary one.
+        """
+        if self.control_directory is None:
+            return
+        # Without any sockets there are no shared connections to close:
+        if (self.control_directory.exists() and
+                self.control_directory.children()):
+            with open(os.devnull, "w") as discard:
+                for node in self._nodes.values():
+                    arguments = node.initial_command_arguments
+                    # Failure means this node's connection is already closed:
+                    call(arguments[:-1] + (b"-O", b"exit", arguments[-1]),
+                         stdout=discard, stderr=discard)
+        self._nodes.clear()
+        if self._temporary:
+            self.control_directory.remove()
+            self.control_directory = None
+
+
 @implementer(INode)
 class FakeNode(object):
     """
@@ -127,21 +999,25 @@ class FakeNode(object):
 
     This is useful for testing.
 
-    :ivar remote_command: The arguments to the last call to ``run()`` or
-        ``get_output()``.
+    :ivar remote_command: The arguments to the last call to ``run()``,
+        ``run_stream()`` or ``get_output()``.
 
-    :ivar stdin: `BytesIO` returned from last call to ``run()``.
+    :ivar stdin: `BytesIO` returned from last call to ``run()``, or which
+        accumulates the data written by the last call to ``run_stream()``.
 
     :ivar thread_id: The ID of the thread ``run()`` or ``get_output()``
         ran in.
     """
-    def __init__(self, outputs=()):
+    def __init__(self, outputs=(), stream_output=b""):
         """
         :param outputs: Sequence of results for ``get_output()``, either
             exceptions or ``bytes``. Exceptions will be raised, otherwise the
             object will be returned.
+        :param bytes stream_output: The stdout of commands run with
+            ``run_stream()``.
         """
         self._outputs = list(outputs)
+        self._stream_output = stream_output
 
     @contextmanager
     def run(self, remote_command):
@@ -154,6 +1030,15 @@ class FakeNode(object):
         yield self.stdin
         self.stdin.seek(0, 0)
 
+    def run_stream(self, remote_command):
+        """
+        Store arguments and in-memory "stdin".
+        """
+        consumer = MemoryConsumer()
+        self.stdin = consumer.output
+        self.remote_command = remote_command
+        return FinishingConsumer(consumer, lambda _: self._stream_output)
+
     def get_output(self, remote_command):
         """
         Return (or if an exception, raise) the next remaining output of the
@@ -166,3 +1051,19 @@ class FakeNode(object):
             raise result
         else:
             return result
+
+
+@implementer(IAsyncNode)
+class FakeAsyncNode(FakeNode):
+    """
+    Pretend to run a command without blocking.
+
+    This is useful for testing.
+    """
+    def get_output(self, remote_command):
+        """
+        Return a ``Deferred`` that fires with (or if an exception, errbacks
+        with) the next remaining output of the ones passed to the
+        constructor.
+        """
+        return maybeDeferred(FakeNode.get_output, self, remote_command)
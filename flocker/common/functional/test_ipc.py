@@ -4,11 +4,16 @@
 Functional tests for IPC.
 """
 
+from twisted.internet.defer import gatherResults
 from twisted.internet.threads import deferToThread
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
-from .. import ProcessNode
+from .. import (
+    ProcessNode, ProcessProducer, ProcessConsumer, splice, SSHConnectionPool,
+    AsyncProcessNode,
+)
+from .._ipc import _PooledSSHNode
 from ..test.test_ipc import make_inode_tests
 from ...testtools import create_ssh_server
 
@@ -66,6 +71,78 @@ class ProcessNodeTests(TestCase):
         else:
             self.fail("No IOError")
 
+    def test_run_stream_stdin(self):
+        """
+        Data written to the consumer returned by ``ProcessNode.run_stream`` is
+        written to the subprocess' stdin.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        temp_file = self.mktemp()
+        consumer = node.run_stream([b"cat > " + temp_file])
+        consumer.write(b"hello ")
+        consumer.write(b"world")
+        finishing = consumer.finish()
+        finishing.addCallback(lambda _: self.assertEqual(
+            FilePath(temp_file).getContent(), b"hello world"))
+        return finishing
+
+    def test_run_stream_stdout(self):
+        """
+        The ``Deferred`` returned by ``finish`` on the consumer returned by
+        ``ProcessNode.run_stream`` fires with the subprocess' stdout.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        consumer = node.run_stream([b"tr a-z A-Z"])
+        consumer.write(b"hello")
+        finishing = consumer.finish()
+        finishing.addCallback(self.assertEqual, b"HELLO")
+        return finishing
+
+    def test_run_stream_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``finish`` on the consumer returned by
+        ``ProcessNode.run_stream`` errbacks with ``IOError`` if the subprocess
+        has a non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+        consumer = node.run_stream([b"sh", b"-c", b"exit 3"])
+        return self.assertFailure(consumer.finish(), IOError)
+
+    def test_stream_between_processes(self):
+        """
+        ``ProcessProducer`` streams the output of one process into another
+        via ``ProcessConsumer``.
+        """
+        from twisted.internet import reactor
+        temp_file = self.mktemp()
+        # Enough data to fill the pipe buffers several times over:
+        producer = ProcessProducer(
+            reactor, [b"sh", b"-c", b"head -c 4000000 /dev/zero"])
+        consumer = ProcessConsumer(
+            reactor, [b"sh", b"-c", b"cat > " + temp_file])
+        producing = producer.startProducing(consumer)
+        producing.addCallback(lambda _: consumer.finish())
+        producing.addCallback(lambda _: self.assertEqual(
+            FilePath(temp_file).getContent(), b"\0" * 4000000))
+        return producing
+
+    def test_splice_between_processes(self):
+        """
+        ``splice`` connects the output of one process directly to the input
+        of another.
+        """
+        from twisted.internet import reactor
+        temp_file = self.mktemp()
+        producer = ProcessProducer(
+            reactor, [b"sh", b"-c", b"head -c 4000000 /dev/zero"])
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        consumer = node.run_stream([b"cat > " + temp_file])
+        producing = splice(producer, consumer)
+        producing.addCallback(lambda _: consumer.finish())
+        producing.addCallback(lambda _: self.assertEqual(
+            FilePath(temp_file).getContent(), b"\0" * 4000000))
+        return producing
+
     def test_get_output_runs_command(self):
         """
         ``ProcessNode.get_output()`` runs a command that is the combination of
@@ -94,6 +171,41 @@ class ProcessNodeTests(TestCase):
         self.assertRaises(IOError, node.get_output, [b"ls", nonexistent])
 
 
+class AsyncProcessNodeTests(TestCase):
+    """
+    Tests for ``AsyncProcessNode`` running real processes.
+    """
+    def test_get_output_result(self):
+        """
+        ``AsyncProcessNode.get_output`` returns a ``Deferred`` that fires
+        with the output of the command.
+        """
+        node = AsyncProcessNode(ProcessNode(initial_command_arguments=[]))
+        d = node.get_output([b"echo", b"-n", b"hello"])
+        d.addCallback(self.assertEqual, b"hello")
+        return d
+
+    def test_get_output_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``AsyncProcessNode.get_output`` errbacks
+        with ``IOError`` if the subprocess has a non-zero exit code.
+        """
+        node = AsyncProcessNode(ProcessNode(initial_command_arguments=[]))
+        return self.assertFailure(
+            node.get_output([b"ls", self.mktemp()]), IOError)
+
+    def test_many_at_once(self):
+        """
+        Many commands can be run at once, more than fit in the reactor's
+        thread pool.
+        """
+        node = AsyncProcessNode(ProcessNode(initial_command_arguments=[]))
+        d = gatherResults([node.get_output([b"echo", b"-n", b"%d" % (i,)])
+                           for i in range(50)])
+        d.addCallback(self.assertEqual, [b"%d" % (i,) for i in range(50)])
+        return d
+
+
 def make_sshnode(test_case):
     """
     Create a ``ProcessNode`` that can SSH into the local machine.
@@ -178,6 +290,74 @@ class SSHProcessNodeTests(TestCase):
         return d
 
 
+def make_pooled_sshnode(test_case):
+    """
+    Create a ``ProcessNode`` that can SSH into the local machine over a
+    shared connection.
+
+    :param TestCase test_case: The test case to use.
+
+    :return: A tuple of the ``SSHConnectionPool`` and the ``ProcessNode``.
+    """
+    server = create_ssh_server(FilePath(test_case.mktemp()))
+    test_case.addCleanup(server.restore)
+    pool = SSHConnectionPool(FilePath(test_case.mktemp()))
+    # The test server never closes connections itself, so they must be
+    # closed before it is stopped:
+    test_case.addCleanup(pool.close)
+
+    return pool, pool.node(
+        host=unicode(server.ip).encode("ascii"), port=server.port,
+        username=b"root", private_key=server.key_path)
+
+
+class SSHConnectionPoolTests(TestCase):
+    """Tests for ``SSHConnectionPool``."""
+
+    def test_creates_control_directory(self):
+        """
+        Running a command on a node creates the pool's control directory,
+        readable only by its owner.
+        """
+        directory = FilePath(self.mktemp())
+        node = _PooledSSHNode([], directory)
+        node.get_output([b"true"])
+        self.assertEqual(directory.getPermissions().shorthand(), "rwx------")
+
+    def test_shared_connection(self):
+        """
+        Commands run on a node from an ``SSHConnectionPool`` share a
+        connection, which persists between commands through a socket in the
+        control directory.
+        """
+        pool, node = make_pooled_sshnode(self)
+
+        def go():
+            first = node.get_output([b"echo", b"-n", b"hello"])
+            sockets = pool.control_directory.children()
+            second = node.get_output([b"echo", b"-n", b"there"])
+            return (first, second, len(sockets),
+                    len(pool.control_directory.children()))
+        d = deferToThread(go)
+        d.addCallback(self.assertEqual, (b"hello", b"there", 1, 1))
+        return d
+
+    def test_close(self):
+        """
+        ``SSHConnectionPool.close`` closes the shared connections, removing
+        their sockets.
+        """
+        pool, node = make_pooled_sshnode(self)
+
+        def go():
+            node.get_output([b"true"])
+            pool.close()
+            return pool.control_directory.children()
+        d = deferToThread(go)
+        d.addCallback(self.assertEqual, [])
+        return d
+
+
 class MutatingProcessNode(ProcessNode):
     """Mutate the command being run in order to make tests work.
 
@@ -6,7 +6,7 @@ Tests for ``flocker.common._defer``.
 
 import gc
 
-from .._defer import gather_deferreds
+from .._defer import gather_deferreds, PriorityLimiter
 
 from twisted.internet.defer import fail, FirstError, succeed, Deferred
 from twisted.python.failure import Failure
@@ -142,3 +142,61 @@ class GatherDeferredsTests(TestCase):
         del d1, d2, d3
         gc.collect()
         self.assertEqual([], self.flushLoggedErrors(ZeroDivisionError))
+
+
+class PriorityLimiterTests(TestCase):
+    """
+    Tests for ``PriorityLimiter``.
+    """
+    def test_result(self):
+        """
+        ``PriorityLimiter.run`` returns a ``Deferred`` that fires with the
+        result of calling the function with the given arguments.
+        """
+        limiter = PriorityLimiter(1)
+        self.assertEqual(
+            self.successResultOf(limiter.run(0, lambda a, b: (a, b), 1, b=2)),
+            (1, 2))
+
+    def test_failure(self):
+        """
+        ``PriorityLimiter.run`` returns a ``Deferred`` that errbacks with an
+        exception raised by the function, and the next operation is started.
+        """
+        limiter = PriorityLimiter(1)
+        result = limiter.run(0, lambda: 1 / 0)
+        self.failureResultOf(result, ZeroDivisionError)
+        self.assertEqual(self.successResultOf(limiter.run(0, lambda: 3)), 3)
+
+    def test_limit(self):
+        """
+        No more than ``limit`` operations run at once; the next one starts
+        when one of them finishes.
+        """
+        limiter = PriorityLimiter(2)
+        running = [Deferred(), Deferred(), Deferred()]
+        started = []
+
+        def operation(i):
+            started.append(i)
+            return running[i]
+        results = [limiter.run(0, operation, i) for i in range(3)]
+        before = started[:]
+        running[1].callback(u"done")
+        self.assertEqual(
+            (before, started, self.successResultOf(results[1])),
+            ([0, 1], [0, 1, 2], u"done"))
+
+    def test_priority(self):
+        """
+        Waiting operations are started lowest priority first, and in the
+        order they were requested if their priorities are the same.
+        """
+        limiter = PriorityLimiter(1)
+        first = Deferred()
+        started = []
+        limiter.run(0, lambda: first)
+        for name, priority in [(u"c", 2), (u"a", 1), (u"b", 1)]:
+            limiter.run(priority, started.append, name)
+        first.callback(None)
+        self.assertEqual(started, [u"a", u"b", u"c"])
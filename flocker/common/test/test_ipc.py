@@ -6,12 +6,32 @@ Unit tests for IPC.
 
 from __future__ import absolute_import
 
+import os
+from errno import EBADF
 from unittest import TestCase as PyTestCase
 
 from zope.interface.verify import verifyObject
 
-from .. import INode, FakeNode
-from ...testtools import assertNoFDsLeaked
+from twisted.internet.defer import fail, succeed
+from twisted.internet.error import (
+    ProcessDone, ProcessTerminated, ConnectionDone, ConnectionRefusedError)
+from twisted.internet.protocol import Factory
+from twisted.test.proto_helpers import MemoryReactor, StringTransport
+from twisted.python.failure import Failure
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import (
+    INode, FakeNode, IDescriptorConsumer, IDescriptorProducer,
+    ProcessConsumer, ProcessProducer, MemoryConsumer, FilterConsumer, splice,
+    ThrottledConsumer, ProcessNode, SSHConnectionPool, IAsyncNode,
+    AsyncProcessNode, FakeAsyncNode, FinishingConsumer, listen_private_unix,
+    relay_stdio,
+)
+from .. import _ipc
+from .._ipc import _control_path
+from ...testtools import assertNoFDsLeaked, FakeProcessReactor
 
 
 def make_inode_tests(fixture):
@@ -95,3 +115,934 @@ def make_inode_tests(fixture):
 
 class FakeINodeTests(make_inode_tests(lambda t: FakeNode([b"hello"]))):
     """``INode`` tests for ``FakeNode``."""
+
+
+class FakeNodeTests(SynchronousTestCase):
+    """
+    Tests for ``FakeNode``.
+    """
+    def test_run_stream(self):
+        """
+        ``FakeNode.run_stream`` records the command and makes the data written
+        to the returned consumer available as ``stdin`` once finished.
+        """
+        node = FakeNode()
+        consumer = node.run_stream([b"cat"])
+        consumer.write(b"hello")
+        self.successResultOf(consumer.finish())
+        self.assertEqual((node.remote_command, node.stdin.read()),
+                         ([b"cat"], b"hello"))
+
+    def test_run_stream_output(self):
+        """
+        Finishing the consumer returned by ``FakeNode.run_stream`` gives the
+        ``stream_output`` the ``FakeNode`` was created with.
+        """
+        node = FakeNode(stream_output=b"output")
+        consumer = node.run_stream([b"cat"])
+        self.assertEqual(self.successResultOf(consumer.finish()), b"output")
+
+
+class FakeAsyncNodeTests(SynchronousTestCase):
+    """
+    Tests for ``FakeAsyncNode``.
+    """
+    def test_interface(self):
+        """
+        ``FakeAsyncNode`` provides ``IAsyncNode``.
+        """
+        self.assertTrue(verifyObject(IAsyncNode, FakeAsyncNode()))
+
+    def test_get_output(self):
+        """
+        ``FakeAsyncNode.get_output`` records the command and returns a
+        ``Deferred`` that fires with the next output.
+        """
+        node = FakeAsyncNode([b"hello"])
+        result = self.successResultOf(node.get_output([b"echo"]))
+        self.assertEqual((result, node.remote_command), (b"hello", [b"echo"]))
+
+    def test_get_output_exception(self):
+        """
+        If the next output is an exception, the ``Deferred`` returned by
+        ``FakeAsyncNode.get_output`` errbacks with it.
+        """
+        node = FakeAsyncNode([RuntimeError()])
+        self.failureResultOf(node.get_output([b"echo"]), RuntimeError)
+
+
+class AsyncProcessNodeTests(SynchronousTestCase):
+    """
+    Tests for ``AsyncProcessNode``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.node = AsyncProcessNode(
+            ProcessNode(initial_command_arguments=(b"ssh", b"example.com")),
+            self.reactor)
+
+    def test_interface(self):
+        """
+        ``AsyncProcessNode`` provides ``IAsyncNode``.
+        """
+        self.assertTrue(verifyObject(IAsyncNode, self.node))
+
+    def test_spawns_command(self):
+        """
+        ``AsyncProcessNode.get_output`` starts a process with the node's
+        initial arguments followed by the given command, without waiting
+        for it to finish.
+        """
+        d = self.node.get_output([b"echo", b"hello"])
+        [process] = self.reactor.processes
+        self.assertNoResult(d)
+        self.assertEqual(
+            (process.executable, process.args, process.childFDs),
+            (b"ssh", [b"ssh", b"example.com", b"echo", b"hello"],
+             {0: "w", 1: "r", 2: 2}))
+
+    def test_quoted(self):
+        """
+        The command's arguments are quoted the same way as by
+        ``ProcessNode``.
+        """
+        node = AsyncProcessNode(
+            ProcessNode(initial_command_arguments=(b"ssh",),
+                        quote=lambda argument: b"'" + argument + b"'"),
+            self.reactor)
+        node.get_output([b"echo"])
+        self.assertEqual(self.reactor.processes[0].args,
+                         [b"ssh", b"'echo'"])
+
+    def test_stdin_closed(self):
+        """
+        The process's standard input is closed so a command waiting for
+        input does not hang.
+        """
+        self.node.get_output([b"cat"])
+        self.assertTrue(self.reactor.processes[0].transport.stdin_closed)
+
+    def test_output(self):
+        """
+        The ``Deferred`` returned by ``AsyncProcessNode.get_output`` fires
+        with everything the process wrote to stdout once it exits
+        successfully.
+        """
+        d = self.node.get_output([b"echo"])
+        protocol = self.reactor.processes[0].processProtocol
+        protocol.childDataReceived(1, b"hel")
+        protocol.childDataReceived(1, b"lo")
+        protocol.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual(self.successResultOf(d), b"hello")
+
+    def test_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``AsyncProcessNode.get_output`` errbacks
+        with ``IOError`` if the process exits with an error.
+        """
+        d = self.node.get_output([b"false"])
+        protocol = self.reactor.processes[0].processProtocol
+        protocol.processEnded(Failure(ProcessTerminated(1)))
+        self.failureResultOf(d, IOError)
+
+    def test_prepares_node(self):
+        """
+        ``AsyncProcessNode.get_output`` lets the wrapped node prepare before
+        the process is started, as ``ProcessNode.get_output`` would.
+        """
+        prepared = []
+        self.patch(self.node.node, "_prepare",
+                   lambda: prepared.append(len(self.reactor.processes)))
+        self.node.get_output([b"echo"])
+        self.assertEqual(prepared, [0])
+
+
+class ProcessNodeEndpointTests(SynchronousTestCase):
+    """
+    Tests for ``ProcessNode.endpoint``.
+    """
+    def test_command(self):
+        """
+        ``ProcessNode.endpoint`` creates an endpoint which runs the quoted
+        remote command after the node's initial arguments, using the given
+        reactor.
+        """
+        reactor = FakeProcessReactor()
+        node = ProcessNode(initial_command_arguments=(b"ssh", b"host"),
+                           quote=lambda argument: argument.upper())
+        endpoint = node.endpoint(reactor, [b"flocker-volume", b"agent"])
+        self.assertEqual(
+            (endpoint._reactor, endpoint._executable, endpoint._args),
+            (reactor, b"ssh",
+             (b"ssh", b"host", b"FLOCKER-VOLUME", b"AGENT")))
+
+    def test_prepares(self):
+        """
+        ``ProcessNode.endpoint`` prepares the node first, e.g. creating the
+        directory for an ``SSHConnectionPool``'s sockets.
+        """
+        directory = FilePath(self.mktemp())
+        pool = SSHConnectionPool(directory)
+        node = pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        node.endpoint(FakeProcessReactor(), [b"true"])
+        self.assertTrue(directory.isdir())
+
+
+class UsingSSHTests(SynchronousTestCase):
+    """
+    Tests for ``ProcessNode.using_ssh``.
+    """
+    def test_no_multiplexing(self):
+        """
+        By default the node makes a new SSH connection for each command.
+        """
+        node = ProcessNode.using_ssh(
+            b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        self.assertIn(b"-oControlMaster=no", node.initial_command_arguments)
+
+    def test_control_path(self):
+        """
+        Given a ``control_path``, the node shares a connection through a
+        socket at that path, which persists for ``control_persist`` seconds
+        after the last command.
+        """
+        node = ProcessNode.using_ssh(
+            b"example.com", 22, b"root", FilePath(b"/id_rsa"),
+            control_path=FilePath(b"/tmp/ssh/socket"), control_persist=30)
+        self.assertEqual(
+            node.initial_command_arguments[8:14],
+            (b"-o", b"ControlMaster=auto",
+             b"-o", b"ControlPath=/tmp/ssh/socket",
+             b"-o", b"ControlPersist=30"))
+
+
+class SSHConnectionPoolTests(SynchronousTestCase):
+    """
+    Tests for ``SSHConnectionPool``.
+    """
+    def test_node(self):
+        """
+        ``SSHConnectionPool.node`` creates a ``ProcessNode`` which shares a
+        connection through a socket in the control directory.
+        """
+        directory = FilePath(self.mktemp())
+        pool = SSHConnectionPool(directory, control_persist=30)
+        node = pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        self.assertEqual(
+            node.initial_command_arguments,
+            ProcessNode.using_ssh(
+                b"example.com", 22, b"root", FilePath(b"/id_rsa"),
+                control_path=_control_path(
+                    directory, b"example.com", 22, b"root"),
+                control_persist=30).initial_command_arguments)
+
+    def test_control_path(self):
+        """
+        Each server, port and user has its own socket, named without OpenSSH
+        tokens since older versions don't support ``%C``.
+        """
+        directory = FilePath(b"/tmp/sockets")
+        paths = [_control_path(directory, b"example.com", 22, b"root"),
+                 _control_path(directory, b"example.net", 22, b"root"),
+                 _control_path(directory, b"example.com", 2222, b"root"),
+                 _control_path(directory, b"example.com", 22, b"alice")]
+        self.assertEqual(
+            (len(set(paths)), set(path.parent() for path in paths),
+             [b"%" in path.basename() for path in paths]),
+            (4, {directory}, [False] * 4))
+
+    def test_directory_mode(self):
+        """
+        The control directory is created readable only by the user when a
+        command is first run.
+        """
+        directory = FilePath(self.mktemp()).child(b"sockets")
+        pool = SSHConnectionPool(directory)
+        pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))._prepare()
+        self.assertEqual(directory.getPermissions().shorthand(), "rwx------")
+
+    def test_same_node(self):
+        """
+        ``SSHConnectionPool.node`` returns the same node each time it is
+        called for the same server.
+        """
+        pool = SSHConnectionPool(FilePath(self.mktemp()))
+        self.assertIs(
+            pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa")),
+            pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa")))
+
+    def test_lazy_directory(self):
+        """
+        The control directory is not created until a command is run.
+        """
+        directory = FilePath(self.mktemp())
+        pool = SSHConnectionPool(directory)
+        pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        self.assertFalse(directory.exists())
+
+    def test_close_unused(self):
+        """
+        ``SSHConnectionPool.close`` runs nothing if no connection was ever
+        shared.
+        """
+        calls = []
+        self.patch(_ipc, "call",
+                   lambda arguments, **kwargs: calls.append(arguments))
+        pool = SSHConnectionPool(FilePath(self.mktemp()))
+        pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        pool.close()
+        self.assertEqual(calls, [])
+
+    def test_temporary_directory(self):
+        """
+        By default the control directory is a new temporary directory,
+        created along with the first node and removed by ``close``.
+        """
+        self.patch(_ipc, "call", lambda *args, **kwargs: 0)
+        pool = SSHConnectionPool()
+        pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        directory = pool.control_directory
+        existed = directory.isdir()
+        pool.close()
+        self.assertEqual((existed, directory.exists()), (True, False))
+
+    def test_close(self):
+        """
+        ``SSHConnectionPool.close`` asks the shared connection to each server
+        to exit, leaving a given control directory in place.
+        """
+        calls = []
+        self.patch(_ipc, "call",
+                   lambda arguments, **kwargs: calls.append(arguments))
+        directory = FilePath(self.mktemp())
+        directory.makedirs()
+        directory.child(b"socket").touch()
+        pool = SSHConnectionPool(directory)
+        node = pool.node(b"example.com", 22, b"root", FilePath(b"/id_rsa"))
+        pool.close()
+        self.assertEqual(
+            (calls, directory.exists()),
+            ([node.initial_command_arguments[:-1] +
+              (b"-O", b"exit", b"example.com")], True))
+
+
+class ProcessConsumerTests(SynchronousTestCase):
+    """
+    Tests for ``ProcessConsumer``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.consumer = ProcessConsumer(self.reactor, [b"cat", b"-"])
+
+    def transport(self):
+        """
+        :return: The transport of the process started by the consumer.
+        """
+        return self.reactor.processes[0].transport
+
+    def test_interface(self):
+        """
+        ``ProcessConsumer`` provides ``IDescriptorConsumer``.
+        """
+        self.assertTrue(verifyObject(IDescriptorConsumer, self.consumer))
+
+    def test_not_started(self):
+        """
+        No process is started until the consumer is used.
+        """
+        self.assertEqual(self.reactor.processes, [])
+
+    def test_spawns(self):
+        """
+        Writing to ``ProcessConsumer`` starts the given command with a pipe
+        for its standard input.
+        """
+        self.consumer.write(b"")
+        process = self.reactor.processes[0]
+        self.assertEqual(
+            (process.executable, process.args, process.childFDs[0]),
+            (b"cat", [b"cat", b"-"], "w"))
+
+    def test_write(self):
+        """
+        Data written to the consumer is written to the process.
+        """
+        self.consumer.write(b"abc")
+        self.consumer.write(b"def")
+        self.assertEqual(
+            (len(self.reactor.processes), self.transport().written),
+            (1, [b"abc", b"def"]))
+
+    def test_register_producer(self):
+        """
+        Producers are registered with the process transport, so they are
+        paused when the process's standard input is full.
+        """
+        producer = object()
+        self.consumer.registerProducer(producer, True)
+        self.assertIs(self.transport().producer, producer)
+
+    def test_finish_closes_stdin(self):
+        """
+        ``finish`` closes the standard input of the process.
+        """
+        self.consumer.finish()
+        self.assertTrue(self.transport().stdin_closed)
+
+    def test_finish_success(self):
+        """
+        The ``Deferred`` returned by ``finish`` fires with ``None`` when the
+        process exits successfully.
+        """
+        finishing = self.consumer.finish()
+        self.consumer.processEnded(Failure(ProcessDone(0)))
+        self.assertIs(self.successResultOf(finishing), None)
+
+    def test_finish_failure(self):
+        """
+        The ``Deferred`` returned by ``finish`` errbacks when the process
+        exits with an error.
+        """
+        finishing = self.consumer.finish()
+        self.consumer.processEnded(Failure(ProcessTerminated(1)))
+        self.failureResultOf(finishing, ProcessTerminated)
+
+    def test_consume_descriptor(self):
+        """
+        ``consumeDescriptor`` starts the command with the given file
+        descriptor as its standard input and closes it in this process.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        self.consumer.consumeDescriptor(read_fd)
+        self.assertEqual(
+            (self.reactor.processes[0].childFDs[0],
+             self.assertRaises(OSError, os.fstat, read_fd).errno),
+            (read_fd, EBADF))
+
+    def test_consume_descriptor_finish(self):
+        """
+        ``finish`` does not close the standard input of a process reading
+        from a file descriptor.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        self.consumer.consumeDescriptor(read_fd)
+        self.consumer.finish()
+        self.assertFalse(self.transport().stdin_closed)
+
+
+class ProcessNodeRunStreamTests(SynchronousTestCase):
+    """
+    Tests for the consumer returned by ``ProcessNode.run_stream``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        node = ProcessNode(initial_command_arguments=(b"ssh", b"example.com"),
+                           reactor=self.reactor)
+        self.consumer = node.run_stream([b"cat"])
+
+    def test_bad_exit(self):
+        """
+        If the command exits with an error, finishing the consumer errbacks
+        with an ``IOError``.
+        """
+        finishing = self.consumer.finish()
+        self.consumer.processEnded(Failure(ProcessTerminated(3)))
+        self.failureResultOf(finishing, IOError)
+
+    def test_other_failure(self):
+        """
+        If finishing the consumer fails for a reason other than the command
+        exiting with an error, it errbacks with that reason.
+        """
+        finishing = self.consumer.finish()
+        self.consumer.processEnded(Failure(ConnectionDone()))
+        self.failureResultOf(finishing, ConnectionDone)
+
+
+class FilterConsumerTests(SynchronousTestCase):
+    """
+    Tests for ``FilterConsumer``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+
+    def test_descriptor_consumer(self):
+        """
+        If the downstream consumer can read from a file descriptor, the
+        filter's standard output is connected to it with a pipe.
+        """
+        downstream = ProcessConsumer(self.reactor, [b"cat"])
+        consumer = FilterConsumer(self.reactor, [b"gzip"], downstream)
+        consumer.write(b"data")
+        downstream_process, filter_process = self.reactor.processes
+        self.assertEqual(
+            (filter_process.args, type(filter_process.childFDs[1]),
+             type(downstream_process.childFDs[0]),
+             filter_process.transport.written),
+            ([b"gzip"], int, int, [b"data"]))
+
+    def test_memory_consumer(self):
+        """
+        If the downstream consumer cannot read from a file descriptor, the
+        filter's output is written to it and the filter is registered as a
+        streaming producer.
+        """
+        downstream = MemoryConsumer()
+        consumer = FilterConsumer(self.reactor, [b"gzip"], downstream)
+        consumer.write(b"data")
+        consumer.childDataReceived(1, b"filtered")
+        self.assertEqual(
+            (self.reactor.processes[0].childFDs[1], downstream.producer,
+             downstream.output.getvalue()),
+            ("r", consumer, b"filtered"))
+
+    def test_pause_resume(self):
+        """
+        Pausing and resuming the filter pauses and resumes reading from the
+        filter process.
+        """
+        consumer = FilterConsumer(self.reactor, [b"gzip"], MemoryConsumer())
+        consumer.write(b"")
+        transport = self.reactor.processes[0].transport
+        consumer.pauseProducing()
+        paused = transport.paused
+        consumer.resumeProducing()
+        self.assertEqual((paused, transport.paused), (True, False))
+
+    def test_finish(self):
+        """
+        Once the filter process exits successfully the downstream consumer is
+        unregistered from and finished.
+        """
+        downstream = MemoryConsumer()
+        consumer = FilterConsumer(self.reactor, [b"gzip"], downstream)
+        consumer.childDataReceived(1, b"filtered")
+        finishing = consumer.finish()
+        consumer.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual(
+            (self.successResultOf(finishing), downstream.producer,
+             downstream.output.read()),
+            (None, None, b"filtered"))
+
+    def test_filter_fails(self):
+        """
+        If the filter process fails the downstream consumer is still finished
+        and the filter's failure is reported.
+        """
+        downstream = MemoryConsumer()
+        downstream.finish = lambda: fail(IOError())
+        consumer = FilterConsumer(self.reactor, [b"gzip"], downstream)
+        finishing = consumer.finish()
+        consumer.processEnded(Failure(ProcessTerminated(1)))
+        self.failureResultOf(finishing, ProcessTerminated)
+
+
+class RecordingProducer(object):
+    """
+    A producer which records whether it is paused.
+    """
+    paused = False
+    stopped = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class ThrottledConsumerTests(SynchronousTestCase):
+    """
+    Tests for ``ThrottledConsumer``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.downstream = MemoryConsumer()
+        self.consumer = ThrottledConsumer(self.clock, self.downstream, 10)
+        self.producer = RecordingProducer()
+        self.consumer.registerProducer(self.producer, True)
+
+    def test_write(self):
+        """
+        Data written to ``ThrottledConsumer`` is written to the downstream
+        consumer, with which it registers as a producer.
+        """
+        self.consumer.write(b"data")
+        self.assertEqual(
+            (self.downstream.output.getvalue(), self.downstream.producer),
+            (b"data", self.consumer))
+
+    def test_pause_over_rate(self):
+        """
+        Once more has been written than the rate allows, the producer is
+        paused until the average rate is back within the limit.
+        """
+        self.consumer.write(b"x" * 20)
+        paused = self.producer.paused
+        self.clock.advance(1.9)
+        still_paused = self.producer.paused
+        self.clock.advance(0.1)
+        self.assertEqual((paused, still_paused, self.producer.paused),
+                         (True, True, False))
+
+    def test_within_rate(self):
+        """
+        The producer is not paused while the rate is within the limit.
+        """
+        self.consumer.write(b"")
+        self.clock.advance(5)
+        self.consumer.write(b"x" * 40)
+        self.assertFalse(self.producer.paused)
+
+    def test_downstream_pause(self):
+        """
+        While the downstream consumer pauses ``ThrottledConsumer`` the
+        producer stays paused, even once the rate is within the limit.
+        """
+        self.consumer.write(b"x" * 20)
+        self.consumer.pauseProducing()
+        self.clock.advance(2)
+        paused = self.producer.paused
+        self.consumer.resumeProducing()
+        self.assertEqual((paused, self.producer.paused), (True, False))
+
+    def test_stop(self):
+        """
+        Stopping ``ThrottledConsumer`` stops the producer.
+        """
+        self.consumer.stopProducing()
+        self.assertTrue(self.producer.stopped)
+
+    def test_finish(self):
+        """
+        ``ThrottledConsumer.finish`` finishes the downstream consumer and
+        cancels any pending resumption.
+        """
+        self.consumer.write(b"x" * 20)
+        self.consumer.unregisterProducer()
+        finishing = self.consumer.finish()
+        self.assertEqual(
+            (self.successResultOf(finishing), self.clock.getDelayedCalls(),
+             self.downstream.producer),
+            (None, [], None))
+
+
+class FinishingConsumerTests(SynchronousTestCase):
+    """
+    Tests for ``FinishingConsumer``.
+    """
+    def test_write(self):
+        """
+        Data written to ``FinishingConsumer`` is written to the downstream
+        consumer, with which its producer is registered.
+        """
+        downstream = MemoryConsumer()
+        consumer = FinishingConsumer(downstream, lambda result: result)
+        producer = RecordingProducer()
+        consumer.registerProducer(producer, True)
+        consumer.write(b"data")
+        self.assertEqual(
+            (downstream.output.getvalue(), downstream.producer),
+            (b"data", producer))
+
+    def test_finish(self):
+        """
+        ``FinishingConsumer.finish`` finishes the downstream consumer and then
+        fires with the result of the given callable.
+        """
+        downstream = MemoryConsumer()
+        consumer = FinishingConsumer(downstream, lambda result: (result, 1))
+        self.assertEqual(self.successResultOf(consumer.finish()), (None, 1))
+
+    def test_finish_failed(self):
+        """
+        If the downstream consumer fails to finish, the given callable is not
+        called and ``FinishingConsumer.finish`` fails the same way.
+        """
+        downstream = MemoryConsumer()
+        downstream.finish = lambda: fail(ZeroDivisionError())
+        called = []
+        consumer = FinishingConsumer(downstream, called.append)
+        self.failureResultOf(consumer.finish(), ZeroDivisionError)
+        self.assertEqual(called, [])
+
+    def test_descriptor(self):
+        """
+        ``FinishingConsumer`` provides ``IDescriptorConsumer`` if the
+        downstream consumer does, passing descriptors on to it.
+        """
+        reactor = FakeProcessReactor()
+        downstream = ProcessConsumer(reactor, [b"cat"])
+        consumer = FinishingConsumer(downstream, lambda result: result)
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+        consumer.consumeDescriptor(read_fd)
+        self.assertEqual(
+            (IDescriptorConsumer.providedBy(consumer),
+             reactor.processes[0].childFDs[0]),
+            (True, read_fd))
+
+    def test_not_descriptor(self):
+        """
+        ``FinishingConsumer`` does not provide ``IDescriptorConsumer`` if the
+        downstream consumer does not.
+        """
+        consumer = FinishingConsumer(MemoryConsumer(), lambda result: result)
+        self.assertFalse(IDescriptorConsumer.providedBy(consumer))
+
+
+class ProcessProducerTests(SynchronousTestCase):
+    """
+    Tests for ``ProcessProducer``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.producer = ProcessProducer(self.reactor, [b"echo", b"hello"])
+        self.consumer = MemoryConsumer()
+
+    def start(self):
+        """
+        Start the producer.
+
+        :return: The ``Deferred`` returned by ``startProducing``.
+        """
+        producing = self.producer.startProducing(self.consumer)
+        self.transport = self.reactor.processes[0].transport
+        return producing
+
+    def test_interface(self):
+        """
+        ``ProcessProducer`` provides ``IDescriptorProducer``.
+        """
+        self.assertTrue(verifyObject(IDescriptorProducer, self.producer))
+
+    def test_not_started(self):
+        """
+        No process is started until ``startProducing`` is called.
+        """
+        self.assertEqual(self.reactor.processes, [])
+
+    def test_start(self):
+        """
+        ``startProducing`` starts the command with its standard input closed
+        and registers the producer as a streaming producer.
+        """
+        self.start()
+        process = self.reactor.processes[0]
+        self.assertEqual(
+            (process.args, process.childFDs[1], self.transport.stdin_closed,
+             self.consumer.producer),
+            ([b"echo", b"hello"], "r", True, self.producer))
+
+    def test_output(self):
+        """
+        Output from the process is written to the consumer.
+        """
+        self.start()
+        self.producer.childDataReceived(1, b"hello")
+        self.assertEqual(self.consumer.output.getvalue(), b"hello")
+
+    def test_pause_resume(self):
+        """
+        Pausing and resuming the producer pauses and resumes reading from the
+        process.
+        """
+        self.start()
+        self.producer.pauseProducing()
+        paused = self.transport.paused
+        self.producer.resumeProducing()
+        self.assertEqual((paused, self.transport.paused), (True, False))
+
+    def test_stop(self):
+        """
+        Stopping the producer terminates the process.
+        """
+        self.start()
+        self.producer.stopProducing()
+        self.assertEqual(self.transport.signals, ["TERM"])
+
+    def test_success(self):
+        """
+        When the process exits successfully the producer unregisters itself
+        and the ``Deferred`` returned by ``startProducing`` fires with
+        ``None``.
+        """
+        producing = self.start()
+        self.producer.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual((self.successResultOf(producing),
+                          self.consumer.producer), (None, None))
+
+    def test_failure(self):
+        """
+        When the process exits with an error the producer unregisters itself
+        and the ``Deferred`` returned by ``startProducing`` errbacks.
+        """
+        producing = self.start()
+        self.producer.processEnded(Failure(ProcessTerminated(2)))
+        self.failureResultOf(producing, ProcessTerminated)
+        self.assertIs(self.consumer.producer, None)
+
+    def test_produce_to_descriptor(self):
+        """
+        ``produceToDescriptor`` starts the command with the given file
+        descriptor as its standard output and closes it in this process.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.producer.produceToDescriptor(write_fd)
+        self.assertEqual(
+            (self.reactor.processes[0].childFDs[1],
+             self.assertRaises(OSError, os.fstat, write_fd).errno),
+            (write_fd, EBADF))
+
+    def test_produce_to_descriptor_result(self):
+        """
+        The ``Deferred`` returned by ``produceToDescriptor`` fires with
+        ``None`` when the process exits successfully.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        producing = self.producer.produceToDescriptor(write_fd)
+        self.producer.processEnded(Failure(ProcessDone(0)))
+        self.assertIs(self.successResultOf(producing), None)
+
+
+class SpliceTests(SynchronousTestCase):
+    """
+    Tests for ``splice``.
+    """
+    def test_connects_processes(self):
+        """
+        ``splice`` starts the consumer's process reading from a pipe and the
+        producer's process writing to the same pipe.
+        """
+        reactor = FakeProcessReactor()
+        splice(ProcessProducer(reactor, [b"echo"]),
+               ProcessConsumer(reactor, [b"cat"]))
+        consumer_process, producer_process = reactor.processes
+        stdin = consumer_process.childFDs[0]
+        stdout = producer_process.childFDs[1]
+        self.assertEqual((type(stdin), type(stdout), stdin == stdout),
+                         (int, int, False))
+
+
+class ListenPrivateUNIXTests(SynchronousTestCase):
+    """
+    Tests for ``listen_private_unix``.
+    """
+    def test_listens(self):
+        """
+        ``listen_private_unix`` listens on the given path with a socket only
+        its owner can connect to, replacing a socket left by a dead process.
+        """
+        reactor = MemoryReactor()
+        path = FilePath(self.mktemp()).child(b"agent.sock")
+        factory = Factory()
+        listen_private_unix(reactor, path, factory)
+        self.assertEqual(reactor.unixServers,
+                         [(path.path, factory, 50, 0o600, True)])
+
+    def test_creates_directory(self):
+        """
+        ``listen_private_unix`` creates the socket's directory if it does not
+        exist.
+        """
+        path = FilePath(self.mktemp()).child(b"agent.sock")
+        listen_private_unix(MemoryReactor(), path, Factory())
+        self.assertTrue(path.parent().isdir())
+
+
+class _FakeEndpoint(object):
+    """
+    An endpoint which connects protocols to ``StringTransport``\\ s.
+
+    :ivar protocol: The last protocol connected.
+    """
+    protocol = None
+
+    def connect(self, factory):
+        self.protocol = factory.buildProtocol(None)
+        self.protocol.makeConnection(StringTransport())
+        return succeed(self.protocol)
+
+
+class RelayStdioTests(SynchronousTestCase):
+    """
+    Tests for ``relay_stdio``.
+    """
+    def setUp(self):
+        self.endpoint = _FakeEndpoint()
+        self.stdio = []
+
+        def stdio(protocol, reactor):
+            protocol.makeConnection(StringTransport())
+            self.stdio.append(protocol)
+        self.relaying = relay_stdio(Clock(), self.endpoint, stdio)
+        [self.outside] = self.stdio
+        self.inside = self.endpoint.protocol
+
+    def test_input(self):
+        """
+        Data read from standard input is written to the connection.
+        """
+        self.outside.dataReceived(b"request")
+        self.assertEqual(self.inside.transport.value(), b"request")
+
+    def test_output(self):
+        """
+        Data received from the connection is written to standard output.
+        """
+        self.inside.dataReceived(b"response")
+        self.assertEqual(self.outside.transport.value(), b"response")
+
+    def test_flow_control(self):
+        """
+        Each side is registered as the producer of the other, so that reading
+        stops while writing can't keep up.
+        """
+        self.assertEqual(
+            (self.inside.transport.producer, self.outside.transport.producer),
+            (self.outside.transport, self.inside.transport))
+
+    def test_stdin_closed(self):
+        """
+        When standard input is closed the connection is closed.
+        """
+        self.outside.connectionLost(Failure(ConnectionDone()))
+        self.assertTrue(self.inside.transport.disconnecting)
+
+    def test_connection_closed(self):
+        """
+        When the connection is closed standard output is closed.
+        """
+        self.inside.connectionLost(Failure(ConnectionDone()))
+        self.assertTrue(self.outside.transport.disconnecting)
+
+    def test_finished(self):
+        """
+        The ``Deferred`` returned by ``relay_stdio`` fires once both sides
+        have been closed.
+        """
+        self.inside.connectionLost(Failure(ConnectionDone()))
+        self.assertNoResult(self.relaying)
+        self.outside.connectionLost(Failure(ConnectionDone()))
+        self.assertIs(self.successResultOf(self.relaying), None)
+
+    def test_connect_failure(self):
+        """
+        If connecting fails, the ``Deferred`` returned by ``relay_stdio``
+        errbacks and standard input is not read.
+        """
+        stdio = []
+        endpoint = _FakeEndpoint()
+        endpoint.connect = lambda factory: fail(ConnectionRefusedError())
+        relaying = relay_stdio(
+            Clock(), endpoint,
+            lambda protocol, reactor: stdio.append(protocol))
+        self.failureResultOf(relaying, ConnectionRefusedError)
+        self.assertEqual(stdio, [])
@@ -13,6 +13,7 @@ from ._model import (
     Application, Deployment, DockerImage, Node, Port, Link, AttachedVolume,
     NodeState)
 from ._deploy import Deployer
+from ._state import NodeStateCache, NodeStateSnapshot
 
 __all__ = [
     'FlockerConfiguration',
@@ -30,4 +31,6 @@ __all__ = [
     'Link',
     'AttachedVolume',
     'NodeState',
+    'NodeStateCache',
+    'NodeStateSnapshot',
 ]
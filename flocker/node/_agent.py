@@ -0,0 +1,235 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_agent -*-
+
+"""
+A resident convergence agent, run by ``flocker-serve``.
+
+``flocker-reportstate`` and ``flocker-changestate`` start a new process for
+every deployment, which pays for starting Python, parsing the configuration
+and discovering the node's state from scratch each time.  The agent instead
+keeps a ``Deployer`` with a running ``NodeStateCache``, and answers AMP
+requests to report the node's state or to converge it on a new
+configuration.  A deployment then costs one small request per node.
+
+Like the volume agent, it only listens on a UNIX socket which only root can
+connect to, since whoever can talk to it can run any container on the node.
+``flocker-deploy`` reaches it by running ``flocker-node-agent`` over SSH,
+which relays the connection to the socket.
+"""
+
+from yaml import safe_load, safe_dump
+from yaml.error import YAMLError
+
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.amp import AMP, Argument, Command, Unicode
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+
+from ._config import (
+    ConfigurationError, FlockerConfiguration, model_from_configuration,
+    current_from_configuration, marshal_configuration)
+
+
+# The socket the agent listens on:
+DEFAULT_CONVERGENCE_SOCKET = FilePath(b"/var/run/flocker/convergence.sock")
+
+# The most bytes AMP allows in a single value:
+MAX_VALUE_LENGTH = 0xffff
+
+
+class BigString(Argument):
+    """
+    An AMP argument for ``bytes`` of any length, such as the configuration of
+    a large cluster.
+
+    AMP limits each value to ``MAX_VALUE_LENGTH`` bytes, so the value is
+    split into parts sent as ``<name>.0``, ``<name>.1`` and so on, with the
+    number of parts sent as ``<name>``.  The argument's name must be a valid
+    Python identifier.
+    """
+    def toBox(self, name, strings, objects, proto):
+        value = self.retrieve(objects, name, proto)
+        parts = [value[offset:offset + MAX_VALUE_LENGTH]
+                 for offset in range(0, len(value), MAX_VALUE_LENGTH)]
+        strings[name] = b"%d" % (len(parts),)
+        for index, part in enumerate(parts):
+            strings[b"%s.%d" % (name, index)] = part
+
+    def fromBox(self, name, strings, objects, proto):
+        count = int(self.retrieve(strings, name, proto))
+        objects[name] = b"".join(
+            self.retrieve(strings, b"%s.%d" % (name, index), proto)
+            for index in range(count))
+
+
+class ReportState(Command):
+    """
+    Get the state of the node, as YAML in the same format as the output of
+    ``flocker-reportstate``.
+    """
+    arguments = []
+    response = [(b"state", BigString())]
+
+
+class ChangeState(Command):
+    """
+    Converge the node on a configuration, given as YAML in the same format
+    as the arguments of ``flocker-changestate``.  The answer is sent once
+    the node has converged on this configuration or a newer one.
+    """
+    arguments = [(b"deployment_configuration", BigString()),
+                 (b"application_configuration", BigString()),
+                 (b"cluster_configuration", BigString()),
+                 (b"hostname", Unicode())]
+    response = []
+    errors = {ConfigurationError: b"CONFIGURATION_ERROR"}
+
+
+def parse_configuration(deployment_configuration, application_configuration,
+                        cluster_configuration):
+    """
+    Parse the YAML configuration given to ``ChangeState``.
+
+    :param bytes deployment_configuration: The YAML describing the desired
+        deployment configuration.
+    :param bytes application_configuration: The YAML describing the desired
+        application configuration.
+    :param bytes cluster_configuration: The YAML describing the current
+        cluster configuration.
+
+    :raises ConfigurationError: If the YAML can't be parsed or the
+        configuration is invalid.
+
+    :return: A ``tuple`` of the desired and current ``Deployment``.
+    """
+    try:
+        deployment_configuration = safe_load(deployment_configuration)
+        application_configuration = safe_load(application_configuration)
+        cluster_configuration = safe_load(cluster_configuration)
+    except YAMLError as e:
+        raise ConfigurationError(
+            "Configuration could not be parsed as YAML:\n\n" + str(e))
+    desired = model_from_configuration(
+        applications=FlockerConfiguration(
+            application_configuration).applications(),
+        deployment_configuration=deployment_configuration)
+    # The current configuration is not written by a human, so don't bother
+    # with nice errors for failing to parse it:
+    return desired, current_from_configuration(cluster_configuration)
+
+
+class ConvergenceAgent(object):
+    """
+    Converge the local node on the configurations it is given, one
+    convergence at a time.
+
+    A configuration given while a convergence is running is applied once
+    that finishes.  If several are given meanwhile only the newest is
+    applied, and everyone who gave one is told the result of that.
+
+    :ivar Deployer deployer: The deployer used to discover and change the
+        node's state.
+    """
+    def __init__(self, deployer):
+        """
+        :param Deployer deployer: See ``deployer``.
+        """
+        self.deployer = deployer
+        self._converging = False
+        # The newest configuration not yet being applied, as the arguments
+        # for Deployer.change_node_state, or None:
+        self._next = None
+        # Deferreds to fire once the next configuration has been applied:
+        self._waiting = []
+
+    def report_state(self):
+        """
+        :return: ``Deferred`` that fires with the node's ``NodeState``.
+        """
+        return self.deployer.discover_node_configuration()
+
+    def change_state(self, desired_state, current_cluster_state, hostname):
+        """
+        Converge the node on a configuration.
+
+        :param Deployment desired_state: See
+            ``Deployer.change_node_state``.
+        :param Deployment current_cluster_state: See
+            ``Deployer.change_node_state``.
+        :param unicode hostname: See ``Deployer.change_node_state``.
+
+        :return: ``Deferred`` that fires with the result of converging on
+            this configuration, or on a newer one given before this one was
+            applied.
+        """
+        self._next = (desired_state, current_cluster_state, hostname)
+        d = Deferred()
+        self._waiting.append(d)
+        if not self._converging:
+            self._converge()
+        return d
+
+    def _converge(self):
+        """
+        Apply the newest configuration, then any given meanwhile.
+        """
+        configuration, self._next = self._next, None
+        waiting, self._waiting = self._waiting, []
+        self._converging = True
+        d = maybeDeferred(self.deployer.change_node_state, *configuration)
+
+        def converged(result):
+            self._converging = False
+            for waiter in waiting:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            if self._next is not None:
+                self._converge()
+        d.addBoth(converged)
+
+
+class ConvergenceProtocol(AMP):
+    """
+    Answer requests from ``flocker-deploy`` using a ``ConvergenceAgent``.
+    """
+    def __init__(self, agent):
+        """
+        :param ConvergenceAgent agent: The agent to answer with.
+        """
+        AMP.__init__(self)
+        self._agent = agent
+
+    @ReportState.responder
+    def report_state(self):
+        d = self._agent.report_state()
+        d.addCallback(marshal_configuration)
+        d.addCallback(lambda state: {"state": safe_dump(state)})
+        return d
+
+    @ChangeState.responder
+    def change_state(self, deployment_configuration,
+                     application_configuration, cluster_configuration,
+                     hostname):
+        desired, current = parse_configuration(
+            deployment_configuration, application_configuration,
+            cluster_configuration)
+        d = self._agent.change_state(desired, current, hostname)
+        d.addCallback(lambda _: {})
+        return d
+
+
+class ConvergenceAgentFactory(ServerFactory):
+    """
+    Create a ``ConvergenceProtocol`` for each connection.
+    """
+    def __init__(self, agent):
+        """
+        :param ConvergenceAgent agent: See ``ConvergenceProtocol.__init__``.
+        """
+        self._agent = agent
+
+    def buildProtocol(self, addr):
+        return ConvergenceProtocol(self._agent)
@@ -7,20 +7,36 @@ Deploy applications on nodes.
 
 from zope.interface import Interface, implementer
 
-from characteristic import attributes
+from characteristic import attributes, Attribute
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from eliot import Logger, MessageType, Field, writeFailure
 
-from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
+from twisted.internet.defer import (
+    gatherResults, fail, succeed, maybeDeferred)
+
+from ._docker import (
+    AsyncDockerClient, PortMap, Environment, Volume as DockerVolume)
 from ._model import (
     Application, VolumeChanges, AttachedVolume, VolumeHandoff,
     NodeState, DockerImage, Port, Link
     )
 from ..route import make_host_network, Proxy
-from ..volume._ipc import RemoteVolumeManager, standard_node
+from ..volume._agent import node_volume_manager
 from ..volume._model import VolumeSize
 from ..volume.service import VolumeName
-from ..common import gather_deferreds
+from ..common import gather_deferreds, PriorityLimiter
+
+
+# How little data must remain to be pushed, and how long to spend pushing,
+# before the applications using a volume are stopped so it can be handed off.
+DEFAULT_HANDOFF_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_HANDOFF_BUDGET = 300.0
+
+# How many operations of each kind may run at once: volume streams sent to
+# other nodes, images downloaded and Docker containers added or removed.
+# Within each kind, what gets applications running again soonest goes
+# first.
+DEFAULT_CONCURRENCY = {u"send": 2, u"network": 2, u"docker": 4}
 
 
 def _to_volume_name(name):
@@ -89,6 +105,112 @@ class InParallel(object):
             [change.run(deployer) for change in self.changes])
 
 
+@attributes(["change", Attribute("after", default_value=frozenset())])
+class Step(object):
+    """
+    A change in an ``InDependencyOrder`` graph.
+
+    :ivar IStateChange change: The change.
+    :ivar frozenset after: The keys of the steps which must succeed before
+        the change is run.
+    """
+
+
+GRAPH_FINISHED = MessageType(
+    u"flocker:node:deploy:graph_finished",
+    [Field.forTypes(u"critical_path", [list],
+                    u"The steps, one after the other, which determined how "
+                    u"long the changes took."),
+     Field.forTypes(u"duration", [float],
+                    u"Seconds from starting the changes to finishing.")],
+    u"A graph of changes finished running.")
+
+
+@implementer(IStateChange)
+@attributes(["steps"])
+class InDependencyOrder(object):
+    """
+    Run changes as soon as the changes they depend on have succeeded, so
+    that unrelated changes don't wait for each other.
+
+    If a change fails, the changes which depend on it are not run, but the
+    others carry on.  The failure is logged, and once everything that can
+    run has finished, the first failure is the result.
+
+    Once finished, the critical path through the changes is logged: the
+    change which finished last, preceded by whichever of its prerequisites
+    finished last, and so on.
+
+    :ivar dict steps: Map a key for each change, a ``tuple`` describing it,
+        to its ``Step``.
+    """
+    logger = Logger()
+
+    def run(self, deployer):
+        reactor = deployer.reactor
+        started = reactor.seconds()
+        # Map keys to a Deferred firing with whether the step succeeded:
+        results = {}
+        # Map the keys of steps which succeeded to the time they finished:
+        finished = {}
+        failures = []
+
+        def run_step(key):
+            if key in results:
+                if results[key] is None:
+                    raise ValueError("Changes depend on each other", key)
+                return results[key]
+            results[key] = None
+            step = self.steps[key]
+            d = gatherResults([run_step(before) for before in step.after])
+
+            def ready(succeeded):
+                if not all(succeeded):
+                    return False
+                running = maybeDeferred(step.change.run, deployer)
+
+                def ran(result):
+                    finished[key] = reactor.seconds()
+                    return True
+
+                def failed(reason):
+                    failures.append(reason)
+                    writeFailure(reason, self.logger, u"flocker:node:deploy")
+                    return False
+                running.addCallbacks(ran, failed)
+                return running
+            d.addCallback(ready)
+            results[key] = d
+            return d
+        d = gatherResults([run_step(key) for key in sorted(self.steps)])
+
+        def done(_):
+            GRAPH_FINISHED(
+                critical_path=[u" ".join(key)
+                               for key in self._critical_path(finished)],
+                duration=reactor.seconds() - started).write(self.logger)
+            if failures:
+                return failures[0]
+        d.addCallback(done)
+        return d
+
+    def _critical_path(self, finished):
+        """
+        :param dict finished: Map the keys of the steps which succeeded to
+            the time they finished.
+
+        :return: A ``list`` of the keys on the critical path, first to last.
+        """
+        path = []
+        candidates = finished
+        while candidates:
+            key = max(candidates, key=lambda key: (finished[key], key))
+            path.insert(0, key)
+            candidates = [before for before in self.steps[key].after
+                          if before in finished]
+        return path
+
+
 @implementer(IStateChange)
 @attributes(["application", "hostname"])
 class StartApplication(object):
@@ -138,7 +260,10 @@ class StartApplication(object):
         else:
             docker_environment = None
 
-        return deployer.docker_client.add(
+        # Containers being removed free up ports and volumes, so this waits
+        # for them:
+        return deployer.limiters[u"docker"].run(
+            1, deployer.docker_client.add,
             application.name,
             application.image.full_name,
             ports=port_maps,
@@ -175,6 +300,32 @@ def _link_environment(protocol, alias, local_port, hostname, remote_port):
     }
 
 
+@implementer(IStateChange)
+@attributes(["images"])
+class PullImages(object):
+    """
+    Make sure the images of applications which are about to be started are
+    present, pulling them in parallel, so the containers can be started
+    without waiting for a download.
+
+    Failing to pull an image is logged but doesn't fail this change; the
+    image will be pulled again when the application is started, and that
+    reports the failure.
+
+    :ivar frozenset images: The ``DockerImage``\ s to pull.
+    """
+    logger = Logger()
+
+    def run(self, deployer):
+        pulls = []
+        for image in self.images:
+            d = deployer.limiters[u"network"].run(
+                0, deployer.docker_client.pull, image.full_name)
+            d.addErrback(writeFailure, self.logger, u"flocker:node:deploy")
+            pulls.append(d)
+        return gatherResults(pulls)
+
+
 @implementer(IStateChange)
 @attributes(["application"])
 class StopApplication(object):
@@ -186,7 +337,8 @@ class StopApplication(object):
     def run(self, deployer):
         application = self.application
         unit_name = application.name
-        return deployer.docker_client.remove(unit_name)
+        return deployer.limiters[u"docker"].run(
+            0, deployer.docker_client.remove, unit_name)
 
 
 @implementer(IStateChange)
@@ -231,7 +383,8 @@ class WaitForVolume(object):
     """
     def run(self, deployer):
         return deployer.volume_service.wait_for_volume(
-            _to_volume_name(self.volume.name))
+            _to_volume_name(self.volume.name),
+            timeout=deployer.volume_wait_timeout)
 
 
 @implementer(IStateChange)
@@ -249,29 +402,42 @@ class HandoffVolume(object):
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
-        return service.handoff(service.get(_to_volume_name(self.volume.name)),
-                               RemoteVolumeManager(destination))
+        # The application using the volume has been stopped, so this goes
+        # ahead of pre-copies which need a full stream:
+        return deployer.limiters[u"send"].run(
+            0, service.handoff,
+            service.get(_to_volume_name(self.volume.name)),
+            deployer.volume_manager(self.hostname), peer=self.hostname,
+            compression=deployer.compression)
 
 
 @implementer(IStateChange)
-@attributes(["volume", "hostname"])
-class PushVolume(object):
+@attributes(["volumes", "hostname"])
+class PushVolumes(object):
     """
-    A volume push that needs to be performed from this node to another
-    node.
+    Volume pushes that need to be performed from this node to another
+    node ahead of a handoff, while the volumes are still in use.
 
-    See :cls:`flocker.volume.VolumeService.push` for more details.
+    Each volume is pushed repeatedly until little enough has changed that
+    the handoff will be quick, as configured by the ``Deployer``.  The other
+    node is asked once what it already has of all the volumes.  See
+    :cls:`flocker.volume.VolumeService.precopy_many` for more details.
 
-    :ivar AttachedVolume volume: The volume to push.
-    :ivar bytes hostname: The hostname of the node to which the volume is
+    :ivar frozenset volumes: The ``AttachedVolume`` instances to push.
+    :ivar bytes hostname: The hostname of the node to which the volumes are
          meant to be pushed.
     """
     def run(self, deployer):
         service = deployer.volume_service
-        destination = standard_node(self.hostname)
-        return service.push(service.get(_to_volume_name(self.volume.name)),
-                            RemoteVolumeManager(destination))
+        return service.precopy_many(
+            [service.get(_to_volume_name(volume.name))
+             for volume in self.volumes],
+            deployer.volume_manager(self.hostname),
+            threshold=deployer.handoff_threshold,
+            budget=deployer.handoff_budget,
+            peer=self.hostname,
+            limiter=deployer.limiters[u"send"],
+            compression=deployer.compression)
 
 
 @implementer(IStateChange)
@@ -280,25 +446,118 @@ class SetProxies(object):
     """
     Set the ports which will be forwarded to other nodes.
 
+    Only the proxies which differ from the current ones are deleted or
+    created, so that forwarded traffic which is unaffected isn't
+    interrupted and each change costs its own ``iptables`` calls only.
+
     :ivar ports: A collection of ``Port`` objects.
     """
     def run(self, deployer):
+        snapshot = deployer._cached_state()
+        if snapshot is None:
+            current = deployer.network.enumerate_proxies()
+        else:
+            current = snapshot.proxies
+        # Existing proxies have an IPAddress where the desired ones may have
+        # a unicode address, so they are compared by the address's text:
+        current = {_proxy_key(proxy): proxy for proxy in current}
+        desired = {_proxy_key(proxy): proxy for proxy in self.ports}
         results = []
         # XXX: The proxy manipulation operations are blocking. Convert to a
         # non-blocking API. See https://github.com/ClusterHQ/flocker/issues/320
-        for proxy in deployer.network.enumerate_proxies():
+        deleted = set(current) - set(desired)
+        created = set(desired) - set(current)
+        for key in deleted:
             try:
-                deployer.network.delete_proxy(proxy)
+                deployer.network.delete_proxy(current[key])
             except:
                 results.append(fail())
-        for proxy in self.ports:
+        for key in created:
+            proxy = desired[key]
             try:
                 deployer.network.create_proxy_to(proxy.ip, proxy.port)
             except:
                 results.append(fail())
+        if deployer.node_state_cache is not None and (deleted or created):
+            deployer.node_state_cache.proxies_changed()
         return gather_deferreds(results)
 
 
+def _proxy_key(proxy):
+    """
+    :param Proxy proxy: A proxy.
+
+    :return: A ``tuple`` which is the same for proxies to the same address
+        and port, whether the address is an ``IPAddress`` or text.
+    """
+    return (unicode(proxy.ip), proxy.port)
+
+
+def node_state_from_units(units, available_volumes, used_ports):
+    """
+    Work out the ``NodeState`` of a node from what Docker and the volume
+    manager know about it.
+
+    :param units: The ``Unit``\ s Docker knows about.
+    :param dict available_volumes: Map the names of the volumes owned by the
+        node to their maximum sizes.
+    :param used_ports: The TCP port numbers in use on the node.
+
+    :return: A ``NodeState`` instance.
+    """
+    running = []
+    not_running = []
+    for unit in units:
+        image = DockerImage.from_string(unit.container_image)
+        if unit.name in available_volumes:
+            # XXX we only support one volume per container at this time
+            # https://github.com/ClusterHQ/flocker/issues/49
+            volume = AttachedVolume.from_unit(unit).pop()
+            volume.maximum_size = available_volumes[unit.name]
+        else:
+            volume = None
+        ports = []
+        for portmap in unit.ports:
+            ports.append(Port(
+                internal_port=portmap.internal_port,
+                external_port=portmap.external_port
+            ))
+        links = []
+        if unit.environment:
+            environment_dict = unit.environment.to_dict()
+            for label, value in environment_dict.items():
+                # <ALIAS>_PORT_<PORTNUM>_TCP_PORT=<value>
+                parts = label.rsplit(b"_", 4)
+                try:
+                    alias, pad_a, port, pad_b, pad_c = parts
+                    local_port = int(port)
+                except ValueError:
+                    continue
+                if (pad_a, pad_b, pad_c) == (b"PORT", b"TCP", b"PORT"):
+                    links.append(Link(
+                        local_port=local_port,
+                        remote_port=int(value),
+                        alias=alias,
+                    ))
+        application = Application(
+            name=unit.name,
+            image=image,
+            ports=frozenset(ports),
+            volume=volume,
+            links=frozenset(links),
+            restart_policy=unit.restart_policy,
+        )
+        if unit.activation_state == u"active":
+            running.append(application)
+        else:
+            not_running.append(application)
+    return NodeState(
+        running=running,
+        not_running=not_running,
+        used_ports=used_ports
+    )
+
+
 class Deployer(object):
     """
     Start and stop applications.
@@ -308,15 +567,69 @@ class Deployer(object):
         deployment operations. Default ``DockerClient``.
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
+    :ivar int handoff_threshold: Before a volume is handed off it is pushed
+        repeatedly until fewer than this many bytes have been written to it
+        since the last push.
+    :ivar float handoff_budget: The number of seconds after which no more
+        pushes are started before a handoff, however much has been written.
+    :ivar float volume_wait_timeout: The number of seconds after which to
+        give up waiting for a volume to be handed off to this node, or
+        ``None`` to wait forever.
+    :ivar NodeStateCache node_state_cache: If not ``None``, the current state
+        of the node is taken from this cache while it is running, rather
+        than discovered from scratch.
+    :ivar reactor: The ``IReactorTime`` provider used to time the changes,
+        which also provides ``IReactorProcess`` to connect to other nodes.
+        Default is the global reactor.
+    :ivar dict limiters: Map each kind of operation (``u"send"``,
+        ``u"network"`` or ``u"docker"``) to the ``PriorityLimiter`` bounding
+        how many of them run at once.
+    :ivar Compression compression: How to compress volumes pushed to other
+        nodes, or ``None`` to push them uncompressed.
     """
-    def __init__(self, volume_service, docker_client=None, network=None):
+    def __init__(self, volume_service, docker_client=None, network=None,
+                 handoff_threshold=DEFAULT_HANDOFF_THRESHOLD,
+                 handoff_budget=DEFAULT_HANDOFF_BUDGET,
+                 volume_wait_timeout=None, node_state_cache=None,
+                 reactor=None, concurrency=DEFAULT_CONCURRENCY,
+                 compression=None):
+        """
+        :param dict concurrency: Map each kind of operation to how many of
+            them may run at once.  Default is ``DEFAULT_CONCURRENCY``.
+
+        See the instance variables for the other parameters.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.limiters = {kind: PriorityLimiter(limit)
+                         for kind, limit in concurrency.items()}
+        self.node_state_cache = node_state_cache
+        self.handoff_threshold = handoff_threshold
+        self.handoff_budget = handoff_budget
+        self.volume_wait_timeout = volume_wait_timeout
+        self.compression = compression
         if docker_client is None:
-            docker_client = DockerClient()
+            docker_client = AsyncDockerClient()
         self.docker_client = docker_client
         if network is None:
             network = make_host_network()
         self.network = network
         self.volume_service = volume_service
+        self._volume_managers = {}
+
+    def volume_manager(self, hostname):
+        """
+        :param bytes hostname: Another node.
+
+        :return: A ``NodeVolumeManager`` which talks to the volume agent on
+            that node, shared by all the pushes and handoffs to it so that
+            they use one connection.
+        """
+        if hostname not in self._volume_managers:
+            self._volume_managers[hostname] = node_volume_manager(
+                self.reactor, hostname)
+        return self._volume_managers[hostname]
 
     def discover_node_configuration(self):
         """
@@ -325,6 +638,10 @@ class Deployer(object):
         :returns: A ``Deferred`` which fires with a ``NodeState``
             instance.
         """
+        snapshot = self._cached_state()
+        if snapshot is not None:
+            return succeed(snapshot.node_state)
+
         # Add real namespace support in
         # https://github.com/ClusterHQ/flocker/issues/737; for now we just
         # strip the namespace since there will only ever be one.
@@ -341,75 +658,43 @@ class Deployer(object):
 
         def applications_from_units(result):
             units, available_volumes = result
-            running = []
-            not_running = []
-            for unit in units:
-                image = DockerImage.from_string(unit.container_image)
-                if unit.name in available_volumes:
-                    # XXX we only support one volume per container at this time
-                    # https://github.com/ClusterHQ/flocker/issues/49
-                    volume = AttachedVolume.from_unit(unit).pop()
-                    volume.maximum_size = available_volumes[unit.name]
-                else:
-                    volume = None
-                ports = []
-                for portmap in unit.ports:
-                    ports.append(Port(
-                        internal_port=portmap.internal_port,
-                        external_port=portmap.external_port
-                    ))
-                links = []
-                if unit.environment:
-                    environment_dict = unit.environment.to_dict()
-                    for label, value in environment_dict.items():
-                        # <ALIAS>_PORT_<PORTNUM>_TCP_PORT=<value>
-                        parts = label.rsplit(b"_", 4)
-                        try:
-                            alias, pad_a, port, pad_b, pad_c = parts
-                            local_port = int(port)
-                        except ValueError:
-                            continue
-                        if (pad_a, pad_b, pad_c) == (b"PORT", b"TCP", b"PORT"):
-                            links.append(Link(
-                                local_port=local_port,
-                                remote_port=int(value),
-                                alias=alias,
-                            ))
-                application = Application(
-                    name=unit.name,
-                    image=image,
-                    ports=frozenset(ports),
-                    volume=volume,
-                    links=frozenset(links),
-                    restart_policy=unit.restart_policy,
-                )
-                if unit.activation_state == u"active":
-                    running.append(application)
-                else:
-                    not_running.append(application)
-            return NodeState(
-                running=running,
-                not_running=not_running,
-                used_ports=self.network.enumerate_used_ports()
-            )
+            return node_state_from_units(
+                units, available_volumes,
+                self.network.enumerate_used_ports())
         d.addCallback(applications_from_units)
         return d
 
+    def _cached_state(self):
+        """
+        :return: The current ``NodeStateSnapshot`` from the
+            ``node_state_cache``, or ``None`` if there is no running cache.
+        """
+        cache = self.node_state_cache
+        if cache is None or not cache.running:
+            return None
+        return cache.snapshot()
+
     def calculate_necessary_state_changes(self, desired_state,
                                           current_cluster_state, hostname):
         """
         Work out which changes need to happen to the local state to match
         the given desired state.
 
-        Currently this involves the following phases:
-
-        1. Change proxies to point to new addresses (should really be
-           last, see https://github.com/ClusterHQ/flocker/issues/380)
-        2. Stop all relevant containers.
-        3. Handoff volumes.
-        4. Wait for volumes.
-        5. Create volumes.
-        6. Start and restart any relevant containers.
+        The changes are run in dependency order, so each application's
+        changes only wait for what they need:
+
+        * Proxies are changed to point to new addresses (should really be
+          last, see https://github.com/ClusterHQ/flocker/issues/380).
+        * Volumes are resized before anything else is done with them.
+        * Volumes going to another node are pushed there, then the
+          applications using them are stopped, then they are handed off.
+        * Applications which aren't wanted here any more are stopped.
+        * The images of applications to be started are pulled.
+        * Volumes coming to this node are waited for and then resized, and
+          new volumes are created.
+        * Applications are started, or restarted, once their image and
+          volume are ready and any application being stopped which used the
+          same external ports has stopped.
 
         :param Deployment desired_state: The intended configuration of all
             nodes.
@@ -423,7 +708,12 @@ class Deployer(object):
         :return: A ``Deferred`` which fires with a ``IStateChange``
             provider.
         """
-        phases = []
+        steps = {}
+        snapshot = self._cached_state()
+        if snapshot is None:
+            current_proxies = set(self.network.enumerate_proxies())
+        else:
+            current_proxies = snapshot.proxies
 
         desired_proxies = set()
         desired_node_applications = []
@@ -437,10 +727,14 @@ class Deployer(object):
                         # https://github.com/ClusterHQ/flocker/issues/322
                         desired_proxies.add(Proxy(ip=node.hostname,
                                                   port=port.external_port))
-        if desired_proxies != set(self.network.enumerate_proxies()):
-            phases.append(SetProxies(ports=desired_proxies))
+        if desired_proxies != current_proxies:
+            steps[(u"proxies",)] = Step(
+                change=SetProxies(ports=desired_proxies))
 
-        d = self.discover_node_configuration()
+        if snapshot is None:
+            d = self.discover_node_configuration()
+        else:
+            d = succeed(snapshot.node_state)
 
         def find_differences(current_node_state):
             current_node_applications = current_node_state.running
@@ -506,49 +800,109 @@ class Deployer(object):
             volumes = find_volume_changes(hostname, current_cluster_state,
                                           desired_state)
 
-            if volumes.resizing:
-                phases.append(InParallel(changes=[
-                    ResizeVolume(volume=volume)
-                    for volume in volumes.resizing]))
+            def volume_steps(volume_name):
+                """
+                :return: The keys of the steps which make the named volume
+                    ready for use on this node.
+                """
+                return {key for key in [(u"resize", volume_name),
+                                        (u"wait", volume_name),
+                                        (u"create", volume_name)]
+                        if key in steps}
+
+            for volume in volumes.resizing:
+                steps[(u"resize", volume.name)] = Step(
+                    change=ResizeVolume(volume=volume))
 
             # Do an initial push of all volumes that are going to move, so
             # that the final push which happens during handoff is a quick
             # incremental push. This should significantly reduces the
             # application downtime caused by the time it takes to copy
             # data.
-            if volumes.going:
-                phases.append(InParallel(changes=[
-                    PushVolume(volume=handoff.volume,
-                               hostname=handoff.hostname)
-                    for handoff in volumes.going]))
-
-            if stop_containers:
-                phases.append(InParallel(changes=stop_containers))
-            if volumes.going:
-                phases.append(InParallel(changes=[
-                    HandoffVolume(volume=handoff.volume,
-                                  hostname=handoff.hostname)
-                    for handoff in volumes.going]))
+            pushes = {}
+            for handoff in volumes.going:
+                pushes.setdefault(handoff.hostname, set()).add(
+                    handoff.volume)
+            for destination, pushed in pushes.items():
+                after = set()
+                for volume in pushed:
+                    after |= volume_steps(volume.name)
+                steps[(u"push", destination)] = Step(
+                    change=PushVolumes(volumes=frozenset(pushed),
+                                       hostname=destination),
+                    after=frozenset(after))
+
+            # The applications using volumes which are going are stopped
+            # once the initial push is done, then the volumes are handed
+            # off.  A volume is named after the application using it, which
+            # may not know about the volume if it isn't running.
+            going = {handoff.volume.name: handoff
+                     for handoff in volumes.going}
+            for change in stop_containers:
+                name = change.application.name
+                after = frozenset()
+                if name in going:
+                    after = frozenset([(u"push", going[name].hostname)])
+                steps[(u"stop", name)] = Step(change=change, after=after)
+            for handoff in volumes.going:
+                name = handoff.volume.name
+                # The handoff receives into the same filesystem as the
+                # initial push, so it must wait for the push even when there
+                # is no application to stop first:
+                after = {(u"push", handoff.hostname)}
+                if (u"stop", name) in steps:
+                    after.add((u"stop", name))
+                steps[(u"handoff", name)] = Step(
+                    change=HandoffVolume(volume=handoff.volume,
+                                         hostname=handoff.hostname),
+                    after=frozenset(after))
+
             # any volumes coming to this node should also be
             # resized to the appropriate quota max size once they
             # have been received
-            if volumes.coming:
-                phases.append(InParallel(changes=[
-                    WaitForVolume(volume=volume)
-                    for volume in volumes.coming]))
-                phases.append(InParallel(changes=[
-                    ResizeVolume(volume=volume)
-                    for volume in volumes.coming]))
-            if volumes.creating:
-                phases.append(InParallel(changes=[
-                    CreateVolume(volume=volume)
-                    for volume in volumes.creating]))
-            start_restart = start_containers + restart_containers
-            if start_restart:
-                phases.append(InParallel(changes=start_restart))
+            for volume in volumes.coming:
+                steps[(u"wait", volume.name)] = Step(
+                    change=WaitForVolume(volume=volume))
+                steps[(u"resize", volume.name)] = Step(
+                    change=ResizeVolume(volume=volume),
+                    after=frozenset([(u"wait", volume.name)]))
+            for volume in volumes.creating:
+                steps[(u"create", volume.name)] = Step(
+                    change=CreateVolume(volume=volume))
+
+            def start_steps(application):
+                """
+                :return: The keys of the steps which must be done before the
+                    given application is started.
+                """
+                after = {(u"pull", application.image.full_name)}
+                if application.volume is not None:
+                    after |= volume_steps(application.volume.name)
+                ports = {port.external_port for port in application.ports}
+                for change in stop_containers:
+                    stopped = change.application
+                    if ports & {port.external_port for port in stopped.ports}:
+                        after.add((u"stop", stopped.name))
+                return frozenset(after)
+
+            # Pull the images of the applications about to be started while
+            # everything is still running, so that downloading them doesn't
+            # add to the downtime.
+            for change in start_containers + [
+                    restart.changes[-1] for restart in restart_containers]:
+                image = change.application.image
+                steps[(u"pull", image.full_name)] = Step(
+                    change=PullImages(images=frozenset([image])))
+            for change in start_containers:
+                steps[(u"start", change.application.name)] = Step(
+                    change=change, after=start_steps(change.application))
+            for restart in restart_containers:
+                application = restart.changes[-1].application
+                steps[(u"restart", application.name)] = Step(
+                    change=restart, after=start_steps(application))
 
         d.addCallback(find_differences)
-        d.addCallback(lambda _: Sequentially(changes=phases))
+        d.addCallback(lambda _: InDependencyOrder(steps=steps))
         return d
 
     def change_node_state(self, desired_state,
@@ -7,20 +7,37 @@ Docker API client.
 
 from __future__ import absolute_import
 
-from time import sleep
+import json
+import re
+from io import BytesIO
+from threading import Thread
+from time import time, sleep
+from urllib import quote, urlencode
 
 from zope.interface import Interface, implementer
 
-from docker import Client
+from docker import Client, auth
 from docker.errors import APIError
+from docker.utils import parse_repository_tag
 
 from characteristic import attributes, Attribute
 
+from eliot import Logger, MessageType, Field
+
 from twisted.python.components import proxyForInterface
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, gatherResults, succeed, fail, maybeDeferred)
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 from twisted.internet.threads import deferToThread
-from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.protocol import Protocol
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, FileBodyProducer, ResponseDone,
+    PotentialDataLoss, readBody)
+from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR, CONFLICT
+from twisted.web.http_headers import Headers
 
 from flocker.node._model import RestartNever, RestartAlways, RestartOnFailure
 
@@ -171,6 +188,17 @@ class IDockerClient(Interface):
 
         """
 
+    def pull(image_name):
+        """
+        Make sure an image is present, pulling it from its registry if it
+        isn't.
+
+        :param unicode image_name: The Docker image to pull.
+
+        :return: ``Deferred`` that fires with the number of bytes
+            downloaded, which is zero if the image was already present.
+        """
+
     def exists(unit_name):
         """
         Check whether the unit exists.
@@ -201,6 +229,20 @@ class IDockerClient(Interface):
         :return: ``Deferred`` firing with ``set`` of :class:`Unit`.
         """
 
+    def watch(callback):
+        """
+        Follow changes to units as they happen.
+
+        :param callback: A callable which is called with the name of a unit
+            and the ``Unit`` as it now is, or ``None`` if it has been
+            removed, whenever a unit changes.  It may also be called for
+            units which have not changed.
+
+        :return: ``Deferred`` that fires when changes are no longer being
+            followed, e.g. because the connection to Docker was lost.
+            Cancel it to stop following changes.
+        """
+
 
 @implementer(IDockerClient)
 class FakeDockerClient(object):
@@ -209,6 +251,8 @@ class FakeDockerClient(object):
     The state the the simulated units is stored in memory.
 
     :ivar dict _units: See ``units`` of ``__init__``\ .
+    :ivar list _pulled_images: The names of the images ``pull`` was called
+        for, in order.
     """
 
     def __init__(self, units=None):
@@ -221,13 +265,15 @@ class FakeDockerClient(object):
         if units is None:
             units = {}
         self._units = units
+        self._watchers = []
+        self._pulled_images = []
 
     def add(self, unit_name, image_name, ports=frozenset(), environment=None,
             volumes=frozenset(), mem_limit=None, cpu_shares=None,
             restart_policy=RestartNever()):
         if unit_name in self._units:
             return fail(AlreadyExists(unit_name))
-        self._units[unit_name] = Unit(
+        unit = self._units[unit_name] = Unit(
             name=unit_name,
             container_name=unit_name,
             container_image=image_name,
@@ -239,20 +285,40 @@ class FakeDockerClient(object):
             cpu_shares=cpu_shares,
             restart_policy=restart_policy,
         )
+        self._changed(unit_name, unit)
         return succeed(None)
 
+    def pull(self, image_name):
+        self._pulled_images.append(image_name)
+        return succeed(0)
+
     def exists(self, unit_name):
         return succeed(unit_name in self._units)
 
     def remove(self, unit_name):
         if unit_name in self._units:
             del self._units[unit_name]
+            self._changed(unit_name, None)
         return succeed(None)
 
     def list(self):
         units = set(self._units.values())
         return succeed(units)
 
+    def watch(self, callback):
+        self._watchers.append(callback)
+        return Deferred(lambda _: self._watchers.remove(callback))
+
+    def _changed(self, unit_name, unit):
+        """
+        Tell the watchers about a changed unit.
+
+        :param unicode unit_name: The name of the unit.
+        :param Unit unit: The unit, or ``None`` if it has been removed.
+        """
+        for callback in self._watchers[:]:
+            callback(unit_name, unit)
+
 
 @attributes(['internal_port', 'external_port'])
 class PortMap(object):
@@ -269,23 +335,198 @@ class PortMap(object):
 BASE_NAMESPACE = u"flocker--"
 BASE_DOCKER_API_URL = u'unix://var/run/docker.sock'
 
+DOCKER_SOCKET_PATH = FilePath(b"/var/run/docker.sock")
+DOCKER_API_VERSION = b"1.15"
 
-@implementer(IDockerClient)
-class DockerClient(object):
+# How many containers ``DockerClient.list`` inspects at once.  The threads
+# come from the reactor's thread pool, so this leaves some for other uses:
+INSPECT_CONCURRENCY = 5
+
+
+class WaitTimeout(Exception):
+    """
+    Docker did not reach the state being waited for in time.
     """
-    Talk to the real Docker server directly.
 
-    Some operations can take a while (e.g. stopping a container), so we
-    use a thread pool. See https://github.com/ClusterHQ/flocker/issues/718
-    for using a custom thread pool.
+
+@attributes(["initial", "maximum", "timeout"])
+class Backoff(object):
+    """
+    How often to poll Docker while waiting for it to catch up.
+
+    The delay before the second poll is ``initial`` seconds, and each
+    later delay is twice the one before, up to ``maximum`` seconds.  Once
+    ``timeout`` seconds have passed since the first poll there are no more
+    polls.
+
+    :ivar float initial: The first delay.
+    :ivar float maximum: The longest delay.
+    :ivar float timeout: The longest time to wait.
+    """
+    def delay(self, polls, elapsed):
+        """
+        :param int polls: How many polls have been done.
+        :param float elapsed: Seconds since the first poll.
+
+        :return: The ``float`` number of seconds to wait before polling
+            again, or ``None`` if it's time to give up.
+        """
+        remaining = self.timeout - elapsed
+        if remaining <= 0:
+            return None
+        return min(self.initial * 2 ** min(polls - 1, 32), self.maximum,
+                   remaining)
+
+
+DEFAULT_BACKOFF = Backoff(initial=0.01, maximum=1.0, timeout=60.0)
+
+
+WAITED = MessageType(
+    u"flocker:node:docker:waited",
+    [Field.forTypes(u"condition", [unicode],
+                    u"The state of Docker which was waited for."),
+     Field.forTypes(u"polls", [int], u"How many times Docker was polled."),
+     Field.forTypes(u"duration", [float], u"Seconds spent waiting."),
+     Field.forTypes(u"succeeded", [bool],
+                    u"Whether Docker reached the state in time.")],
+    u"Waited for Docker to reach some state.")
+
+
+IMAGE_PULLED = MessageType(
+    u"flocker:node:docker:image_pulled",
+    [Field.forTypes(u"image", [unicode], u"The name of the image."),
+     Field.forTypes(u"bytes", [int, long], u"How many bytes were downloaded."),
+     Field.forTypes(u"duration", [float],
+                    u"Seconds spent pulling the image.")],
+    u"Made sure an image is present, pulling it if it wasn't.")
+
+
+class _PullProgress(object):
+    """
+    Follow the progress documents Docker sends while pulling an image.
+
+    :ivar error: The last error Docker reported, or ``None``.
+    """
+    def __init__(self):
+        # Map layer IDs to the bytes of each downloaded so far:
+        self._layers = {}
+        self.error = None
+
+    def received(self, progress):
+        """
+        :param dict progress: A progress document.
+        """
+        if u"error" in progress:
+            self.error = progress[u"error"]
+        elif progress.get(u"status") == u"Downloading":
+            detail = progress.get(u"progressDetail") or {}
+            self._layers[progress.get(u"id")] = detail.get(u"current", 0)
+
+    @property
+    def bytes(self):
+        """
+        The number of bytes downloaded so far.
+        """
+        return sum(self._layers.values())
+
+
+def _blocking_wait(logger, condition, poll, backoff):
+    """
+    Poll Docker, sleeping for longer and longer between polls, until it is
+    in the expected state.
+
+    :param Logger logger: The logger to record the wait with.
+    :param unicode condition: A description of the expected state.
+    :param poll: A callable which returns ``True`` if Docker is in the
+        expected state and ``False`` if not yet.
+    :param Backoff backoff: How often to poll and when to give up.
+
+    :raise WaitTimeout: If Docker is not in the expected state before the
+        timeout.
+    """
+    started = time()
+    polls = 0
+    while True:
+        polls += 1
+        done = poll()
+        elapsed = time() - started
+        delay = None if done else backoff.delay(polls, elapsed)
+        if delay is None:
+            WAITED(condition=condition, polls=polls, duration=elapsed,
+                   succeeded=done).write(logger)
+            if not done:
+                raise WaitTimeout(condition)
+            return
+        sleep(delay)
+
+
+def _wait(logger, condition, poll, backoff, reactor):
+    """
+    Like ``_blocking_wait``, but without blocking.
+
+    :param poll: A callable which returns a ``Deferred`` that fires with
+        ``True`` if Docker is in the expected state and ``False`` if not
+        yet.
+    :param reactor: A ``IReactorTime`` provider.
+
+    :return: ``Deferred`` that fires once Docker is in the expected state,
+        or errbacks with ``WaitTimeout``.
+    """
+    started = reactor.seconds()
+    polls = []
+
+    def attempt():
+        polls.append(None)
+        d = maybeDeferred(poll)
+        d.addCallback(polled)
+        return d
+
+    def polled(done):
+        elapsed = reactor.seconds() - started
+        delay = None if done else backoff.delay(len(polls), elapsed)
+        if delay is not None:
+            return deferLater(reactor, delay, attempt)
+        WAITED(condition=condition, polls=len(polls), duration=elapsed,
+               succeeded=done).write(logger)
+        if not done:
+            raise WaitTimeout(condition)
+    return attempt()
+
+
+def _status_state(status):
+    """
+    Extract the state of a container from the status Docker lists it with,
+    leaving out how long it has been in that state.
+
+    :param unicode status: The ``Status`` of a container listed by Docker,
+        e.g. ``u"Up 5 minutes (Paused)"`` or ``u"Exited (0) 2 hours ago"``.
+
+    :return: A ``tuple`` of ``unicode`` which only changes when the state
+        does, e.g. ``(u"Up", u"(Paused)")`` or ``(u"Exited", u"(0)")``.
+    """
+    words = status.split(None, 1)
+    return tuple(words[:1] + re.findall(r"\([^)]*\)", status))
+
+
+class _ContainerModel(object):
+    """
+    Conversion between units and Docker's representation of containers,
+    shared by the Docker clients.
 
     :ivar unicode namespace: A namespace prefix to add to container names
         so we don't clobber other applications interacting with Docker.
+    :ivar dict _inspected: Map the IDs of containers in the namespace to the
+        state (see ``_status_state``) they had when last inspected, and the
+        resulting ``Unit``.
+    :ivar Backoff _backoff: How to poll Docker while waiting for it to
+        catch up.
     """
-    def __init__(self, namespace=BASE_NAMESPACE,
-                 base_url=BASE_DOCKER_API_URL):
+    logger = Logger()
+
+    def __init__(self, namespace, backoff):
         self.namespace = namespace
-        self._client = Client(version="1.15", base_url=base_url)
+        self._backoff = backoff
+        self._inspected = {}
 
     def _to_container_name(self, unit_name):
         """
@@ -386,6 +627,169 @@ class DockerClient(object):
         except KeyError:
             raise ValueError("Unknown restart policy: %r" % (restart_policy,))
 
+    def _host_config(self, ports, volumes, restart_policy):
+        """
+        Create the host configuration of a container, in the format expected
+        by the Docker API.
+
+        :param ports: The ``PortMap``\ s of the container.
+        :param volumes: The ``Volume``\ s of the container.
+        :param IRestartPolicy restart_policy: The restart policy of the
+            container.
+
+        :return: A ``dict`` suitable to pass to Docker as ``HostConfig``.
+        """
+        binds = [
+            u'{}:{}'.format(volume.node_path.path,
+                            volume.container_path.path)
+            for volume in volumes
+        ]
+        port_bindings = {}
+        for p in ports:
+            key = u'%s/tcp' % (p.internal_port,)
+            port_bindings[key] = [
+                {u"HostPort": unicode(p.external_port)},
+            ]
+        return {
+            u'Binds': binds,
+            u'PortBindings': port_bindings,
+            u'RestartPolicy': self._serialize_restart_policy(restart_policy),
+        }
+
+    def _to_unit(self, data):
+        """
+        Convert the result of inspecting a container into a ``Unit``.
+
+        :param dict data: The container's state and configuration, as
+            returned by ``self._client.inspect_container``.
+
+        :return: The ``Unit``, or ``None`` if the container is not in this
+            client's namespace.
+        """
+        state = (u"active" if data[u"State"][u"Running"]
+                 else u"inactive")
+        name = data[u"Name"]
+        image = data[u"Config"][u"Image"]
+        port_bindings = data[u"HostConfig"][u"PortBindings"]
+        if port_bindings is not None:
+            ports = self._parse_container_ports(port_bindings)
+        else:
+            ports = list()
+        volumes = []
+        binds = data[u"HostConfig"]['Binds']
+        if binds is not None:
+            for bind_config in binds:
+                parts = bind_config.split(':', 2)
+                node_path, container_path = parts[:2]
+                volumes.append(
+                    Volume(container_path=FilePath(container_path),
+                           node_path=FilePath(node_path))
+                )
+        if name.startswith(u"/" + self.namespace):
+            name = name[1 + len(self.namespace):]
+        else:
+            return None
+        # Our Unit model counts None as the value for cpu_shares and
+        # mem_limit in containers without specified limits, however
+        # Docker returns the values in these cases as zero, so we
+        # manually convert.
+        cpu_shares = data[u"Config"][u"CpuShares"]
+        cpu_shares = None if cpu_shares == 0 else cpu_shares
+        mem_limit = data[u"Config"][u"Memory"]
+        mem_limit = None if mem_limit == 0 else mem_limit
+        restart_policy = self._parse_restart_policy(
+            data[U"HostConfig"][u"RestartPolicy"])
+        return Unit(
+            name=name,
+            container_name=self._to_container_name(name),
+            activation_state=state,
+            container_image=image,
+            ports=frozenset(ports),
+            volumes=frozenset(volumes),
+            mem_limit=mem_limit,
+            cpu_shares=cpu_shares,
+            restart_policy=restart_policy)
+
+    def _unit_name(self, container_names):
+        """
+        Find the name of the unit running in a container.
+
+        :param container_names: The names of a container, as listed by
+            ``self._client.containers``, e.g. ``[u"/flocker--foo"]``.
+
+        :return: The ``unicode`` unit name, or ``None`` if the container is
+            not in this client's namespace.
+        """
+        prefix = u"/" + self.namespace
+        for name in container_names or ():
+            # Other containers' links to this one are listed as names like
+            # "/other/alias", which can't be in the namespace.
+            if name.startswith(prefix) and u"/" not in name[len(prefix):]:
+                return name[len(prefix):]
+        return None
+
+    def _list_units(self, containers, inspect):
+        """
+        Pick out the containers in this client's namespace by name and
+        inspect them, a few at a time.
+
+        The configuration of a container can't change, only whether it is
+        running, so a container is only inspected again once its state in
+        the listing changes.  The listed status also says how long the
+        container has been in that state, which changes all the time, so
+        that is ignored.
+
+        :param list containers: The containers, as listed by Docker's
+            ``/containers/json``.
+        :param inspect: A callable taking a container ID and returning a
+            ``Deferred`` that fires with the ``Unit`` in the container, or
+            ``None`` if there is none.
+
+        :return: ``Deferred`` firing with ``set`` of :class:`Unit`.
+        """
+        states = {
+            container[u"Id"]: _status_state(container[u"Status"])
+            for container in containers
+            if self._unit_name(container.get(u"Names")) is not None}
+        # Forget containers which no longer exist:
+        for container_id in set(self._inspected) - set(states):
+            del self._inspected[container_id]
+        semaphore = DeferredSemaphore(INSPECT_CONCURRENCY)
+        inspecting = []
+        for container_id, state in states.items():
+            cached = self._inspected.get(container_id)
+            if cached is not None and cached[0] == state:
+                inspecting.append(succeed(cached[1]))
+                continue
+            d = semaphore.run(inspect, container_id)
+
+            def inspected(unit, container_id=container_id, state=state):
+                if unit is not None:
+                    self._inspected[container_id] = (state, unit)
+                return unit
+            d.addCallback(inspected)
+            inspecting.append(d)
+        d = gatherResults(inspecting, consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        d.addCallback(
+            lambda units: {unit for unit in units if unit is not None})
+        return d
+
+
+@implementer(IDockerClient)
+class DockerClient(_ContainerModel):
+    """
+    Talk to the real Docker server directly.
+
+    Some operations can take a while (e.g. stopping a container), so we
+    use a thread pool. See https://github.com/ClusterHQ/flocker/issues/718
+    for using a custom thread pool.
+    """
+    def __init__(self, namespace=BASE_NAMESPACE,
+                 base_url=BASE_DOCKER_API_URL, backoff=DEFAULT_BACKOFF):
+        _ContainerModel.__init__(self, namespace, backoff)
+        self._client = Client(version=DOCKER_API_VERSION, base_url=base_url)
+
     def add(self, unit_name, image_name, ports=None, environment=None,
             volumes=(), mem_limit=None, cpu_shares=None,
             restart_policy=RestartNever()):
@@ -407,22 +811,8 @@ class DockerClient(object):
                 mem_limit=mem_limit,
                 cpu_shares=cpu_shares,
             )
-            binds = [
-                u'{}:{}'.format(volume.node_path.path,
-                                volume.container_path.path)
-                for volume in volumes
-            ]
-            port_bindings = {}
-            for p in ports:
-                key = u'%s/tcp' % (p.internal_port,)
-                port_bindings[key] = [
-                    {u"HostPort": unicode(p.external_port)},
-                ]
-            config[u'HostConfig'] = {
-                u'Binds': binds,
-                u'PortBindings': port_bindings,
-                u'RestartPolicy': restart_policy_dict,
-            }
+            config[u'HostConfig'] = self._host_config(
+                ports, volumes, restart_policy)
             self._client.create_container_from_config(
                 config=config, name=container_name)
 
@@ -441,9 +831,10 @@ class DockerClient(object):
             # stop on this container Docker might well complain it knows
             # not the container of which we speak. To prevent this we poll
             # until it does exist.
-            while not self._blocking_exists(container_name):
-                sleep(0.001)
-                continue
+            _blocking_wait(
+                self.logger, u"container %s exists" % (container_name,),
+                lambda: self._blocking_exists(container_name),
+                self._backoff)
             self._client.start(container_name,
                                binds={volume.node_path.path:
                                       {u"bind": volume.container_path.path,
@@ -463,6 +854,26 @@ class DockerClient(object):
         d.addErrback(_extract_error)
         return d
 
+    def pull(self, image_name):
+        def _pull():
+            started = time()
+            progress = _PullProgress()
+            try:
+                self._client.inspect_image(image_name)
+            except APIError as e:
+                if e.response.status_code != NOT_FOUND:
+                    raise
+                for line in self._client.pull(image_name, stream=True):
+                    if line.strip():
+                        progress.received(json.loads(line))
+                if progress.error is not None:
+                    raise DockerAPIError(
+                        INTERNAL_SERVER_ERROR, progress.error.encode("utf-8"))
+            IMAGE_PULLED(image=image_name, bytes=progress.bytes,
+                         duration=time() - started).write(self.logger)
+            return progress.bytes
+        return deferToThread(_pull)
+
     def _blocking_exists(self, container_name):
         """
         Blocking API to check if container exists.
@@ -485,30 +896,31 @@ class DockerClient(object):
     def remove(self, unit_name):
         container_name = self._to_container_name(unit_name)
 
-        def _remove():
-            while True:
-                # There is a race condition between a process dying and
-                # docker noticing that fact.
-                # https://github.com/docker/docker/issues/5165#issuecomment-65753753  # noqa
-                # We loop here to let docker notice that the process is dead.
-                # Docker will return NOT_MODIFIED (which isn't an error) in
-                # that case.
-                try:
-                    self._client.stop(container_name)
-                except APIError as e:
-                    if e.response.status_code == NOT_FOUND:
-                        # If the container doesn't exist, we swallow the error,
-                        # since this method is supposed to be idempotent.
-                        break
-                    elif e.response.status_code == INTERNAL_SERVER_ERROR:
-                        # Docker returns this if the process had died, but
-                        # hasn't noticed it yet.
-                        continue
-                    else:
-                        raise
-                else:
-                    break
+        def _stop():
+            # There is a race condition between a process dying and
+            # docker noticing that fact.
+            # https://github.com/docker/docker/issues/5165#issuecomment-65753753  # noqa
+            # We retry to let docker notice that the process is dead.
+            # Docker will return NOT_MODIFIED (which isn't an error) in
+            # that case.
+            try:
+                self._client.stop(container_name)
+            except APIError as e:
+                if e.response.status_code == NOT_FOUND:
+                    # If the container doesn't exist, we swallow the error,
+                    # since this method is supposed to be idempotent.
+                    return True
+                elif e.response.status_code == INTERNAL_SERVER_ERROR:
+                    # Docker returns this if the process had died, but
+                    # hasn't noticed it yet.
+                    return False
+                raise
+            return True
 
+        def _remove():
+            _blocking_wait(
+                self.logger, u"container %s stopped" % (container_name,),
+                _stop, self._backoff)
             try:
                 self._client.remove_container(container_name)
             except APIError as e:
@@ -522,67 +934,522 @@ class DockerClient(object):
         d = deferToThread(_remove)
         return d
 
+    def _blocking_inspect(self, container_id):
+        """
+        Blocking API to inspect a container.
+
+        :param unicode container_id: The ID of the container.
+
+        :return: The ``Unit`` running in the container, or ``None`` if the
+            container no longer exists or is not in this client's namespace.
+        """
+        try:
+            data = self._client.inspect_container(container_id)
+        except APIError as e:
+            # The container may have been removed since it was listed.
+            if e.response.status_code == NOT_FOUND:
+                return None
+            raise
+        return self._to_unit(data)
+
     def list(self):
-        def _list():
-            result = set()
-            ids = [d[u"Id"] for d in
-                   self._client.containers(quiet=True, all=True)]
-            for i in ids:
+        listing = deferToThread(self._client.containers, all=True)
+        listing.addCallback(
+            self._list_units,
+            lambda container_id: deferToThread(
+                self._blocking_inspect, container_id))
+        return listing
+
+    def watch(self, callback):
+        """
+        Follow Docker's ``/events`` stream in a thread of its own, since it
+        never finishes, and inspect each container it mentions.
 
+        The thread notices it has been cancelled when the next event
+        arrives.
+        """
+        from twisted.internet import reactor
+        stopped = []
+        watching = Deferred(lambda _: stopped.append(True))
+
+        def finished(result):
+            if not watching.called:
+                watching.callback(result)
+
+        def changed(unit_name, unit):
+            if not stopped:
+                callback(unit_name, unit)
+
+        def _watch():
+            # Map the IDs of containers in our namespace to unit names, so
+            # that removed containers, which can't be inspected, can be
+            # recognised:
+            names = {}
+            events = self._client.events()
+            for container in self._client.containers(all=True):
+                unit_name = self._unit_name(container.get(u"Names"))
+                if unit_name is not None:
+                    names[container[u"Id"]] = unit_name
+            for line in events:
+                if stopped:
+                    return
+                container_id = json.loads(line).get(u"id")
+                if container_id is None:
+                    continue
                 try:
-                    data = self._client.inspect_container(i)
+                    data = self._client.inspect_container(container_id)
                 except APIError as e:
-                    # The container ID returned by the list API call above, may
-                    # have been removed in another thread.
-                    if e.response.status_code == NOT_FOUND:
-                        continue
-
-                state = (u"active" if data[u"State"][u"Running"]
-                         else u"inactive")
-                name = data[u"Name"]
-                image = data[u"Config"][u"Image"]
-                port_bindings = data[u"HostConfig"][u"PortBindings"]
-                if port_bindings is not None:
-                    ports = self._parse_container_ports(port_bindings)
-                else:
-                    ports = list()
-                volumes = []
-                binds = data[u"HostConfig"]['Binds']
-                if binds is not None:
-                    for bind_config in binds:
-                        parts = bind_config.split(':', 2)
-                        node_path, container_path = parts[:2]
-                        volumes.append(
-                            Volume(container_path=FilePath(container_path),
-                                   node_path=FilePath(node_path))
-                        )
-                if name.startswith(u"/" + self.namespace):
-                    name = name[1 + len(self.namespace):]
-                else:
+                    if e.response.status_code != NOT_FOUND:
+                        raise
+                    unit_name = names.pop(container_id, None)
+                    if unit_name is not None:
+                        reactor.callFromThread(changed, unit_name, None)
                     continue
-                # Our Unit model counts None as the value for cpu_shares and
-                # mem_limit in containers without specified limits, however
-                # Docker returns the values in these cases as zero, so we
-                # manually convert.
-                cpu_shares = data[u"Config"][u"CpuShares"]
-                cpu_shares = None if cpu_shares == 0 else cpu_shares
-                mem_limit = data[u"Config"][u"Memory"]
-                mem_limit = None if mem_limit == 0 else mem_limit
-                restart_policy = self._parse_restart_policy(
-                    data[U"HostConfig"][u"RestartPolicy"])
-                result.add(Unit(
-                    name=name,
-                    container_name=self._to_container_name(name),
-                    activation_state=state,
-                    container_image=image,
-                    ports=frozenset(ports),
-                    volumes=frozenset(volumes),
-                    mem_limit=mem_limit,
-                    cpu_shares=cpu_shares,
-                    restart_policy=restart_policy)
-                )
-            return result
-        return deferToThread(_list)
+                unit = self._to_unit(data)
+                if unit is not None:
+                    names[data[u"Id"]] = unit.name
+                    reactor.callFromThread(changed, unit.name, unit)
+
+        def run():
+            try:
+                _watch()
+            except Exception:
+                result = Failure()
+            else:
+                result = None
+            reactor.callFromThread(finished, result)
+
+        # The reactor's thread pool waits for its threads when it stops, so
+        # a thread that may block forever must be a separate daemon thread:
+        thread = Thread(target=run, name=b"docker-events")
+        thread.daemon = True
+        thread.start()
+        return watching
+
+
+class DockerAPIError(Exception):
+    """
+    The Docker API responded with an error.
+
+    :ivar int code: The HTTP status code of the response.
+    :ivar bytes message: The body of the response.
+    """
+    def __init__(self, code, message):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+class _UNIXAgent(Agent):
+    """
+    An ``Agent`` which connects to a unix socket, whatever the host in the
+    URL.
+    """
+    def __init__(self, reactor, path, pool):
+        """
+        :param reactor: A ``IReactorUNIX`` provider.
+        :param FilePath path: The socket to connect to.
+        :param HTTPConnectionPool pool: The pool of connections to use.
+        """
+        Agent.__init__(self, reactor, pool=pool)
+        self._path = path
+
+    def _getEndpoint(self, scheme, host, port):
+        return UNIXClientEndpoint(self._reactor, self._path.path)
+
+
+class _JSONStream(Protocol):
+    """
+    Decode a response body made of JSON documents one after the other, as
+    Docker streams events and the progress of pulls.
+
+    :ivar Deferred finished: Fires when the whole body has been received.
+    """
+    def __init__(self, received):
+        """
+        :param received: A callable which is called with each decoded
+            document.
+        """
+        self._received = received
+        self._buffer = b""
+        self._decoder = json.JSONDecoder()
+        self.finished = Deferred()
+
+    def dataReceived(self, data):
+        self._buffer += data
+        while True:
+            self._buffer = self._buffer.lstrip()
+            if not self._buffer:
+                return
+            try:
+                document, end = self._decoder.raw_decode(self._buffer)
+            except ValueError:
+                # The rest of the document hasn't arrived yet:
+                return
+            self._buffer = self._buffer[end:]
+            self._received(document)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
+@implementer(IDockerClient)
+class AsyncDockerClient(_ContainerModel):
+    """
+    Talk to the real Docker server over its unix socket using Twisted's HTTP
+    client, without threads.
+
+    Connections are kept open and reused between requests, and the
+    responses to pulls and to the event stream are processed as they
+    arrive.
+    """
+    def __init__(self, namespace=BASE_NAMESPACE,
+                 socket_path=DOCKER_SOCKET_PATH, reactor=None,
+                 backoff=DEFAULT_BACKOFF):
+        """
+        :param unicode namespace: See ``_ContainerModel.namespace``.
+        :param FilePath socket_path: The Docker server's socket.
+        :param reactor: A ``IReactorUNIX`` and ``IReactorTime`` provider, or
+            ``None`` to use the global reactor.
+        :param Backoff backoff: See ``_ContainerModel._backoff``.
+        """
+        _ContainerModel.__init__(self, namespace, backoff)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._agent = _UNIXAgent(reactor, socket_path, self._pool)
+
+    def _request(self, method, path, params=None, data=None, headers=None):
+        """
+        Send a request to the Docker API.
+
+        :param bytes method: The HTTP method.
+        :param bytes path: The path of the API endpoint, e.g.
+            ``b"/containers/json"``.
+        :param dict params: The query parameters, if any.
+        :param data: An object to send as the JSON body of the request, or
+            ``None`` for no body.
+        :param dict headers: Map extra header names to values.
+
+        :return: ``Deferred`` firing with the ``IResponse``.
+        """
+        url = b"http://docker/v" + DOCKER_API_VERSION + path
+        if params:
+            url += b"?" + urlencode(params)
+        request_headers = Headers()
+        for name, value in (headers or {}).items():
+            request_headers.addRawHeader(name, value)
+        body = None
+        if data is not None:
+            request_headers.addRawHeader(b"content-type", b"application/json")
+            body = FileBodyProducer(BytesIO(json.dumps(data)))
+        return self._agent.request(method, url, request_headers, body)
+
+    def _call(self, method, path, params=None, data=None):
+        """
+        Send a request to the Docker API and read the whole response.
+
+        See ``_request`` for the parameters.
+
+        :return: ``Deferred`` firing with the ``bytes`` body of the
+            response, or errbacking with ``DockerAPIError`` if Docker
+            responded with an error.
+        """
+        d = self._request(method, path, params, data)
+
+        def got_response(response):
+            reading = readBody(response)
+
+            def got_body(body):
+                if response.code >= 400:
+                    raise DockerAPIError(response.code, body)
+                return body
+            reading.addCallback(got_body)
+            return reading
+        d.addCallback(got_response)
+        return d
+
+    def _container_path(self, container, action=b""):
+        """
+        :param unicode container: The name or ID of a container.
+        :param bytes action: The action to take on the container, if any.
+
+        :return: The ``bytes`` path of the API endpoint for the container.
+        """
+        return (b"/containers/" + quote(container.encode("utf-8"), safe=b"")
+                + action)
+
+    def _pull(self, image_name):
+        """
+        Pull an image from its registry, authenticating with the credentials
+        configured for the Docker command line client, if any.
+
+        :param unicode image_name: The name of the image.
+
+        :return: ``Deferred`` that fires with the number of bytes downloaded
+            once the image has been pulled.
+        """
+        repository, tag = parse_repository_tag(image_name)
+        registry, _ = auth.resolve_repository_name(repository)
+        headers = {}
+        authconfig = auth.resolve_authconfig(auth.load_config(), registry)
+        if authconfig:
+            headers[b"X-Registry-Auth"] = auth.encode_header(authconfig)
+        params = {b"fromImage": repository.encode("utf-8")}
+        if tag:
+            params[b"tag"] = tag.encode("utf-8")
+        d = self._request(b"POST", b"/images/create", params,
+                          headers=headers)
+        progress = _PullProgress()
+
+        def got_response(response):
+            if response.code >= 400:
+                reading = readBody(response)
+
+                def got_body(body):
+                    raise DockerAPIError(response.code, body)
+                return reading.addCallback(got_body)
+            stream = _JSONStream(progress.received)
+            response.deliverBody(stream)
+            return stream.finished
+        d.addCallback(got_response)
+
+        def pulled(_):
+            if progress.error is not None:
+                raise DockerAPIError(
+                    INTERNAL_SERVER_ERROR, progress.error.encode("utf-8"))
+            return progress.bytes
+        d.addCallback(pulled)
+        return d
+
+    def pull(self, image_name):
+        started = self._reactor.seconds()
+        d = self._call(b"GET", b"/images/" + quote(
+            image_name.encode("utf-8"), safe=b"/:") + b"/json")
+        d.addCallback(lambda _: 0)
+
+        def not_found(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == NOT_FOUND:
+                return self._pull(image_name)
+            return failure
+        d.addErrback(not_found)
+
+        def pulled(downloaded):
+            duration = self._reactor.seconds() - started
+            IMAGE_PULLED(image=image_name, bytes=downloaded,
+                         duration=duration).write(self.logger)
+            return downloaded
+        d.addCallback(pulled)
+        return d
+
+    def add(self, unit_name, image_name, ports=None, environment=None,
+            volumes=(), mem_limit=None, cpu_shares=None,
+            restart_policy=RestartNever()):
+        container_name = self._to_container_name(unit_name)
+        if ports is None:
+            ports = []
+        host_config = self._host_config(ports, volumes, restart_policy)
+        config = {
+            u"Image": image_name,
+            u"ExposedPorts": {
+                u"%d/tcp" % (p.internal_port,): {} for p in ports},
+            # Docker counts zero as no limit:
+            u"Memory": mem_limit or 0,
+            u"CpuShares": cpu_shares or 0,
+            u"HostConfig": host_config,
+        }
+        if environment is not None:
+            config[u"Env"] = [
+                u"%s=%s" % variable
+                for variable in sorted(environment.to_dict().items())]
+
+        def create():
+            return self._call(
+                b"POST", b"/containers/create",
+                {b"name": container_name.encode("utf-8")}, config)
+
+        def create_failed(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == NOT_FOUND:
+                # Image was not found, so we need to pull it first:
+                pulling = self._pull(image_name)
+                pulling.addCallback(lambda _: create())
+                return pulling
+            return failure
+
+        def already_exists(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == CONFLICT:
+                raise AlreadyExists(unit_name)
+            return failure
+        d = create()
+        d.addErrback(create_failed)
+        d.addCallback(lambda _: self._call(
+            b"POST", self._container_path(container_name, b"/start"),
+            data=host_config))
+        d.addErrback(already_exists)
+        d.addCallback(lambda _: None)
+        return d
+
+    def _inspect(self, container):
+        """
+        Inspect a container.
+
+        :param unicode container: The name or ID of the container.
+
+        :return: ``Deferred`` firing with the ``Unit`` running in the
+            container, or ``None`` if the container does not exist or is not
+            in this client's namespace.
+        """
+        d = self._call(b"GET", self._container_path(container, b"/json"))
+        d.addCallback(lambda body: self._to_unit(json.loads(body)))
+
+        def not_found(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == NOT_FOUND:
+                return None
+            return failure
+        d.addErrback(not_found)
+        return d
+
+    def exists(self, unit_name):
+        d = self._call(b"GET", self._container_path(
+            self._to_container_name(unit_name), b"/json"))
+        d.addCallback(lambda _: True)
+
+        def not_found(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == NOT_FOUND:
+                return False
+            return failure
+        d.addErrback(not_found)
+        return d
+
+    def remove(self, unit_name):
+        container_name = self._to_container_name(unit_name)
+
+        def stop():
+            d = self._call(
+                b"POST", self._container_path(container_name, b"/stop"))
+
+            d.addCallback(lambda _: True)
+
+            def stop_failed(failure):
+                failure.trap(DockerAPIError)
+                if failure.value.code == NOT_FOUND:
+                    # If the container doesn't exist, we swallow the error,
+                    # since this method is supposed to be idempotent.
+                    return True
+                elif failure.value.code == INTERNAL_SERVER_ERROR:
+                    # Docker returns this if the process had died, but
+                    # hasn't noticed it yet.
+                    return False
+                return failure
+            d.addErrback(stop_failed)
+            return d
+
+        def delete(_):
+            d = self._call(b"DELETE", self._container_path(container_name))
+
+            def delete_failed(failure):
+                failure.trap(DockerAPIError)
+                if failure.value.code == NOT_FOUND:
+                    return None
+                return failure
+            d.addErrback(delete_failed)
+            return d
+        d = _wait(self.logger, u"container %s stopped" % (container_name,),
+                  stop, self._backoff, self._reactor)
+        d.addCallback(delete)
+        d.addCallback(lambda _: None)
+        return d
+
+    def list(self):
+        d = self._call(b"GET", b"/containers/json", {b"all": b"1"})
+        d.addCallback(json.loads)
+        d.addCallback(self._list_units, self._inspect)
+        return d
+
+    def watch(self, callback):
+        """
+        Follow Docker's ``/events`` stream, inspecting each container it
+        mentions.  Events are handled one at a time, in order.
+        """
+        streams = []
+
+        def stop_streams():
+            for stream in streams:
+                if not stream.finished.called:
+                    stream.transport.stopProducing()
+        watching = Deferred(lambda _: stop_streams())
+
+        def finished(result):
+            if not watching.called:
+                stop_streams()
+                watching.callback(result)
+
+        # Map the IDs of containers in our namespace to unit names, so that
+        # removed containers, which can't be inspected, can be recognised:
+        names = {}
+
+        def handle(event):
+            container_id = event.get(u"id")
+            if container_id is None or watching.called:
+                return None
+            d = self._inspect(container_id)
+
+            def inspected(unit):
+                if watching.called:
+                    return
+                if unit is None:
+                    unit_name = names.pop(container_id, None)
+                    if unit_name is not None:
+                        callback(unit_name, None)
+                else:
+                    names[container_id] = unit.name
+                    callback(unit.name, unit)
+            d.addCallback(inspected)
+            return d
+
+        # Events are handled in turn, once the containers have been listed:
+        handling = []
+
+        def received(event):
+            handling[0].addCallback(lambda _: handle(event))
+            handling[0].addErrback(finished)
+
+        def got_response(response):
+            if response.code >= 400:
+                reading = readBody(response)
+
+                def got_body(body):
+                    raise DockerAPIError(response.code, body)
+                return reading.addCallback(got_body)
+            stream = _JSONStream(received)
+            streams.append(stream)
+            listing = self._call(b"GET", b"/containers/json", {b"all": b"1"})
+
+            def listed(body):
+                for container in json.loads(body):
+                    unit_name = self._unit_name(container.get(u"Names"))
+                    if unit_name is not None:
+                        names[container[u"Id"]] = unit_name
+            listing.addCallback(listed)
+            listing.addErrback(finished)
+            handling.append(listing)
+            response.deliverBody(stream)
+            if watching.called:
+                stop_streams()
+            return stream.finished
+        d = self._request(b"GET", b"/events")
+        d.addCallback(got_response)
+        d.addBoth(finished)
+        return watching
 
 
 class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
@@ -0,0 +1,213 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_state -*-
+
+"""
+A cache of the current state of the local node.
+
+Discovering the state of a node from scratch means listing every container
+and inspecting each of them, listing the storage pool and looking at the
+kernel's sockets and firewall rules.  A long-running process can instead
+keep the state up to date as it changes: Docker reports changes to
+containers on its event stream, the volume manager records the changes it
+makes, and the proxies only change when they are set.  Everything is still
+rediscovered from scratch now and then, to catch anything that was missed.
+"""
+
+from characteristic import attributes
+
+from eliot import Logger, writeFailure
+
+from twisted.application.service import Service
+from twisted.internet.defer import (
+    CancelledError, gatherResults, maybeDeferred)
+from twisted.internet.task import LoopingCall
+
+from ._deploy import node_state_from_units
+
+
+# Seconds between full rediscoveries of the node's state:
+DEFAULT_RECONCILE_INTERVAL = 60.0
+
+
+@attributes(["version", "node_state", "proxies"])
+class NodeStateSnapshot(object):
+    """
+    The state of the local node at some point in time.
+
+    :ivar int version: A number which increases whenever the state changes.
+    :ivar NodeState node_state: The applications on the node and the ports
+        in use.
+    :ivar frozenset proxies: The ``Proxy`` instances forwarding ports to
+        other nodes.
+    """
+
+
+class NodeStateCache(Service):
+    """
+    Keep the state of the local node up to date while running.
+
+    The applications are updated as Docker reports changes to their
+    containers and the volumes as the volume manager changes them.  The
+    proxies are updated when ``proxies_changed`` is called.  The ports in
+    use are only updated when everything is rediscovered, every
+    ``reconcile_interval`` seconds.
+    """
+    logger = Logger()
+
+    def __init__(self, volume_service, docker_client, network, reactor,
+                 reconcile_interval=DEFAULT_RECONCILE_INTERVAL):
+        """
+        :param VolumeService volume_service: The volume manager for this
+            node.
+        :param IDockerClient docker_client: The Docker client for this node.
+        :param INetwork network: The network routing API for this node.
+        :param reactor: A ``IReactorTime`` provider.
+        :param float reconcile_interval: Seconds between rediscoveries of
+            the whole state.
+        """
+        self.volume_service = volume_service
+        self.docker_client = docker_client
+        self.network = network
+        self._reactor = reactor
+        self._reconcile_interval = reconcile_interval
+        self._loop = None
+        self._watching = None
+        # Map unit names to Unit:
+        self._units = {}
+        # The names of the units changed while a rediscovery is in progress,
+        # or None if there is none in progress:
+        self._changed_units = None
+        self._used_ports = frozenset()
+        self._proxies = frozenset()
+        self._version = 0
+        self._volumes_version = None
+        self._snapshot = None
+
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self.reconcile)
+        self._loop.clock = self._reactor
+        self._loop.start(self._reconcile_interval, now=True)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+        if self._watching is not None:
+            self._watching.cancel()
+
+    def _changed(self):
+        """
+        Record that the state has changed.
+        """
+        self._version += 1
+        self._snapshot = None
+
+    def _watch(self):
+        """
+        Start following changes reported by Docker.  Once they are no longer
+        being followed the next rediscovery starts following them again.
+        """
+        watching = self._watching = self.docker_client.watch(
+            self._unit_changed)
+
+        def stopped(result):
+            self._watching = None
+            return result
+        watching.addBoth(stopped)
+        watching.addErrback(lambda reason: reason.trap(CancelledError))
+        watching.addErrback(writeFailure, self.logger, u"flocker:node:state")
+
+    def _unit_changed(self, unit_name, unit):
+        """
+        Update a unit which Docker reported as changed.
+
+        :param unicode unit_name: The name of the unit.
+        :param Unit unit: The unit as it now is, or ``None`` if it has been
+            removed.
+        """
+        if self._changed_units is not None:
+            self._changed_units.add(unit_name)
+        if self._units.get(unit_name) == unit:
+            return
+        if unit is None:
+            del self._units[unit_name]
+        else:
+            self._units[unit_name] = unit
+        self._changed()
+
+    def reconcile(self):
+        """
+        Rediscover the whole state of the node.
+
+        :return: ``Deferred`` that fires when the state has been updated.
+            It never errbacks, so that a failure does not stop later
+            rediscoveries.
+        """
+        if self._watching is None:
+            self._watch()
+        self._changed_units = set()
+        # An exception raised here would stop the rediscoveries altogether,
+        # so it is logged like any other failure:
+        d = maybeDeferred(lambda: gatherResults(
+            [self.docker_client.list(), self.volume_service.enumerate()]))
+
+        def discovered(result):
+            units = {unit.name: unit for unit in result[0]}
+            # What Docker reported while the listing was retrieved may be
+            # newer than the listing:
+            for unit_name in self._changed_units:
+                if unit_name in self._units:
+                    units[unit_name] = self._units[unit_name]
+                else:
+                    units.pop(unit_name, None)
+            used_ports = frozenset(self.network.enumerate_used_ports())
+            proxies = frozenset(self.network.enumerate_proxies())
+            if (units, used_ports, proxies) != (
+                    self._units, self._used_ports, self._proxies):
+                self._units = units
+                self._used_ports = used_ports
+                self._proxies = proxies
+                self._changed()
+
+        def finished(result):
+            self._changed_units = None
+            return result
+        d.addCallback(discovered)
+        d.addBoth(finished)
+        d.addErrback(writeFailure, self.logger, u"flocker:node:state")
+        return d
+
+    def proxies_changed(self):
+        """
+        Update the proxies after they have been changed.
+        """
+        proxies = frozenset(self.network.enumerate_proxies())
+        if proxies != self._proxies:
+            self._proxies = proxies
+            self._changed()
+
+    def snapshot(self):
+        """
+        :return: A ``NodeStateSnapshot`` of the current state.  Unless the
+            state has changed since the last call, the same one is returned
+            again.
+        """
+        volumes_version = self.volume_service.volumes_version
+        if volumes_version != self._volumes_version:
+            self._volumes_version = volumes_version
+            self._changed()
+        if self._snapshot is None:
+            uuid = self.volume_service.uuid
+            available_volumes = {
+                volume.name.id: volume.size.maximum_size
+                for volume
+                in self.volume_service.volumes_in_namespace(u"default")
+                if volume.uuid == uuid}
+            self._snapshot = NodeStateSnapshot(
+                version=self._version,
+                node_state=node_state_from_units(
+                    self._units.values(), available_volumes,
+                    self._used_ports),
+                proxies=self._proxies)
+        return self._snapshot
@@ -49,3 +49,9 @@ class FlockerServeTests(make_script_tests(b"flocker-serve")):
     """
     Tests for ``flocker-serve``.
     """
+
+
+class FlockerNodeAgentTests(make_script_tests(b"flocker-node-agent")):
+    """
+    Tests for ``flocker-node-agent``.
+    """
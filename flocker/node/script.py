@@ -2,14 +2,16 @@
 # -*- test-case-name: flocker.node.test.test_script -*-
 
 """
-The command-line ``flocker-changestate`` and ``flocker-reportstate``
-tools.
+The command-line ``flocker-changestate``, ``flocker-reportstate``,
+``flocker-serve`` and ``flocker-node-agent`` tools.
 """
 
 import sys
 
 from twisted.python.usage import Options, UsageError
 from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.python.filepath import FilePath
 
 from yaml import safe_load, safe_dump
 from yaml.error import YAMLError
@@ -19,17 +21,49 @@ from zope.interface import implementer
 from ._config import marshal_configuration
 
 from ..volume.service import (
-    ICommandLineVolumeScript, VolumeScript)
+    ICommandLineVolumeScript, VolumeScript, VolumeName)
+from ..volume._ipc import SSH_CONNECTIONS
 from ..volume.script import flocker_volume_options
+from ..volume._compression import ALGORITHMS, Compression
+from ..volume._agent import (
+    VolumeAgentFactory, node_volume_manager, DEFAULT_AGENT_SOCKET)
+from ..volume._retention import (
+    SnapshotRetentionService, DEFAULT_KEEP, DEFAULT_INTERVAL)
+from ..common import listen_private_unix, relay_stdio
 from ..common.script import (
-    flocker_standard_options, FlockerScriptRunner)
+    flocker_standard_options, FlockerScriptRunner, ICommandLineScript)
 from . import (ConfigurationError, model_from_configuration, Deployer,
-               FlockerConfiguration, current_from_configuration)
+               FlockerConfiguration, current_from_configuration,
+               NodeStateCache)
+from ._deploy import DEFAULT_HANDOFF_THRESHOLD, DEFAULT_HANDOFF_BUDGET
+from ._agent import (
+    ConvergenceAgent, ConvergenceAgentFactory, DEFAULT_CONVERGENCE_SOCKET)
 
 __all__ = [
     "flocker_changestate_main",
     "flocker_reportstate_main",
     "flocker_serve_main",
+    "flocker_node_agent_main",
+]
+
+
+# The options for how the Deployer changes the node's state:
+_DEPLOYER_PARAMETERS = [
+    ["handoff-threshold", None, DEFAULT_HANDOFF_THRESHOLD,
+     "Before handing off a volume, keep pushing it while its "
+     "application runs until fewer than this many bytes have changed "
+     "since the last push.", int],
+    ["handoff-budget", None, DEFAULT_HANDOFF_BUDGET,
+     "The maximum number of seconds to spend pushing a volume while its "
+     "application runs before handing it off.", float],
+    ["volume-wait-timeout", None, None,
+     "The maximum number of seconds to wait for a volume to be handed "
+     "off to this node.  By default there is no limit.", float],
+    ["compression", None, None,
+     "Compress volumes pushed to other nodes, as <algorithm>[:<level>].  "
+     "Supported algorithms: " + ", ".join(ALGORITHMS) + ".  Volumes are "
+     "pushed uncompressed if either node lacks the algorithm.  By default "
+     "nothing is compressed.", Compression.from_bytes],
 ]
 
 
@@ -41,8 +75,8 @@ class ChangeStateOptions(Options):
     """
 
     longdesc = """\
-    flocker-changestate is called by flocker-deploy to set the configuration of
-    a node.
+    flocker-changestate sets the configuration of a node, as the convergence
+    agent run by flocker-serve does when asked by flocker-deploy.
 
     * deployment_configuration: The YAML string describing the desired
         deployment configuration.
@@ -56,6 +90,8 @@ class ChangeStateOptions(Options):
     * hostname: The hostname of this node. Used by the node to identify which
         applications from deployment_configuration should be running.
     """
+    optParameters = _DEPLOYER_PARAMETERS
+
     synopsis = ("Usage: flocker-changestate [OPTIONS] "
                 "<deployment configuration> <application configuration> "
                 "<cluster configuration> <hostname>")
@@ -141,7 +177,12 @@ class ChangeStateScript(object):
         self._docker_client = docker_client
 
     def main(self, reactor, options, volume_service):
-        deployer = Deployer(volume_service, self._docker_client)
+        deployer = Deployer(volume_service, self._docker_client,
+                            handoff_threshold=options['handoff-threshold'],
+                            handoff_budget=options['handoff-budget'],
+                            volume_wait_timeout=options[
+                                'volume-wait-timeout'],
+                            compression=options['compression'])
         return deployer.change_node_state(
             desired_state=options['deployment'],
             current_cluster_state=options['current'],
@@ -164,8 +205,8 @@ class ReportStateOptions(Options):
     """
 
     longdesc = """\
-    flocker-reportstate is called by flocker-deploy to get the configuration of
-    a node.
+    flocker-reportstate gets the configuration of a node, as the convergence
+    agent run by flocker-serve does when asked by flocker-deploy.
     """
     synopsis = ("Usage: flocker-reportstate [OPTIONS]")
 
@@ -254,17 +295,120 @@ class ServeOptions(Options):
     """
     Command line options for ``flocker-serve`` cluster management process.
     """
-    # Maybe options for things like what port to listen on or perhaps where to
-    # find certificate material to use for TLS.
+    optParameters = [
+        ["snapshot-retention", None, DEFAULT_KEEP,
+         "The number of the newest push snapshots of each volume to keep in "
+         "addition to those needed for pushing to other nodes.", int],
+        ["snapshot-retention-interval", None, DEFAULT_INTERVAL,
+         "Seconds between removals of snapshots which are no longer "
+         "needed.", float],
+        ["replication-interval", None, 10.0,
+         "Seconds between the pushes of each replicated volume.", float],
+        ["replication-rate", None, None,
+         "The maximum rate, in bytes per second, at which to push each "
+         "replicated volume.  Unlimited by default.", int],
+        ["agent-socket", None, DEFAULT_AGENT_SOCKET.path,
+         "The UNIX socket, which only root can connect to, on which to "
+         "answer volume requests from other nodes.  They connect to it by "
+         "running flocker-volume agent over SSH."],
+        ["convergence-socket", None, DEFAULT_CONVERGENCE_SOCKET.path,
+         "The UNIX socket, which only root can connect to, on which to "
+         "answer requests to report the node's state or change it to a "
+         "new configuration.  flocker-deploy connects to it by running "
+         "flocker-node-agent over SSH."],
+    ] + _DEPLOYER_PARAMETERS
+
+    def __init__(self):
+        Options.__init__(self)
+        self["replicate"] = []
+
+    def opt_replicate(self, value):
+        """
+        Continuously push a volume to a standby node, given as
+        VOLUME:HOSTNAME, e.g. "default.mydata:192.0.2.2".  May be repeated.
+        """
+        name, sep, hostname = value.partition(b":")
+        if not (name and sep and hostname):
+            raise UsageError(
+                "--replicate must be given as VOLUME:HOSTNAME, not %r" % (
+                    value,))
+        try:
+            name = VolumeName.from_bytes(name)
+        except ValueError:
+            raise UsageError("Invalid volume name: %r" % (name,))
+        self["replicate"].append((name, hostname))
 
 
 @implementer(ICommandLineVolumeScript)
 class ServeScript(object):
     """
     A command to start a long-running process to manage volumes on one node of
-    a Flocker cluster.
+    a Flocker cluster, and converge the node on the configurations it is
+    given.
+
+    :ivar DockerClient _docker_client: See the ``docker_client`` parameter to
+        ``__init__``.
+    :ivar INetwork _network: See the ``network`` parameter to ``__init__``.
     """
+    def __init__(self, docker_client=None, network=None):
+        """
+        :param DockerClient docker_client: The object to use to talk to the
+            Docker server.
+
+        :param INetwork network: The object to use to interact with the node's
+            network configuration.
+        """
+        self._docker_client = docker_client
+        self._network = network
+
+    def _serve_convergence(self, reactor, options, volume_service):
+        """
+        Keep the node's state up to date and answer requests to report or
+        change it.
+        """
+        deployer = Deployer(volume_service, self._docker_client,
+                            self._network,
+                            handoff_threshold=options['handoff-threshold'],
+                            handoff_budget=options['handoff-budget'],
+                            volume_wait_timeout=options[
+                                'volume-wait-timeout'],
+                            compression=options['compression'],
+                            reactor=reactor)
+        cache = NodeStateCache(volume_service, deployer.docker_client,
+                               deployer.network, reactor)
+        deployer.node_state_cache = cache
+        cache.startService()
+        reactor.addSystemEventTrigger("before", "shutdown", cache.stopService)
+        convergence = listen_private_unix(
+            reactor, FilePath(options["convergence-socket"]),
+            ConvergenceAgentFactory(ConvergenceAgent(deployer)))
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", convergence.stopListening)
+
     def main(self, reactor, options, volume_service):
+        retention = SnapshotRetentionService(
+            volume_service, reactor, keep=options["snapshot-retention"],
+            interval=options["snapshot-retention-interval"])
+        retention.startService()
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", retention.stopService)
+        agent = listen_private_unix(
+            reactor, FilePath(options["agent-socket"]),
+            VolumeAgentFactory(volume_service))
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", agent.stopListening)
+        self._serve_convergence(reactor, options, volume_service)
+        for name, hostname in options["replicate"]:
+            destination = node_volume_manager(reactor, hostname)
+            volume_service.replicate(
+                name, destination,
+                peer=hostname, interval=options["replication-interval"],
+                compression=options["compression"],
+                rate_limit=options["replication-rate"])
+        # Replication keeps SSH connections to the standby nodes open; close
+        # them once it has stopped rather than leaving them to time out:
+        reactor.addSystemEventTrigger(
+            "after", "shutdown", SSH_CONNECTIONS.close)
         return _main_for_service(reactor, volume_service)
 
 
@@ -273,3 +417,39 @@ def flocker_serve_main():
         script=VolumeScript(ServeScript()),
         options=ServeOptions()
     ).main()
+
+
+@flocker_standard_options
+class NodeAgentOptions(Options):
+    """
+    Command line options for ``flocker-node-agent``.
+    """
+
+    longdesc = """\
+    flocker-node-agent is called by flocker-deploy over SSH to talk to the
+    convergence agent run by flocker-serve on this node.  It relays standard
+    in to the agent and the agent's answers to standard out.
+    """
+    synopsis = ("Usage: flocker-node-agent [OPTIONS]")
+
+    optParameters = [
+        ["socket", None, DEFAULT_CONVERGENCE_SOCKET.path,
+         "The path of the UNIX socket the convergence agent listens on."],
+    ]
+
+
+@implementer(ICommandLineScript)
+class NodeAgentScript(object):
+    """
+    A command to relay a connection to the node's convergence agent.
+    """
+    def main(self, reactor, options):
+        return relay_stdio(
+            reactor, UNIXClientEndpoint(reactor, options["socket"]))
+
+
+def flocker_node_agent_main():
+    return FlockerScriptRunner(
+        script=NodeAgentScript(),
+        options=NodeAgentOptions()
+    ).main()
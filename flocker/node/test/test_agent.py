@@ -0,0 +1,334 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.node._agent`.
+"""
+
+from yaml import safe_dump, safe_load
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.protocols.amp import AMP
+from twisted.test.iosim import connect, makeFakeClient, makeFakeServer
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._agent import (
+    ConvergenceAgent, ConvergenceProtocol, ConvergenceAgentFactory,
+    ReportState, ChangeState, parse_configuration, BigString,
+    MAX_VALUE_LENGTH)
+from .._config import ConfigurationError, marshal_configuration
+from .._deploy import Deployer
+from .._docker import FakeDockerClient, Unit
+from .._model import Application, Deployment, DockerImage, Node
+from ...route import make_memory_network
+from ...volume.testtools import create_volume_service
+
+
+APPLICATION = Application(
+    name=u"site-example.com",
+    image=DockerImage.from_string(u"clusterhq/wordpress:latest"))
+
+APPLICATION_CONFIGURATION = safe_dump({
+    u"version": 1,
+    u"applications": {
+        u"site-example.com": {u"image": u"clusterhq/wordpress:latest"}}})
+
+DEPLOYMENT_CONFIGURATION = safe_dump({
+    u"version": 1,
+    u"nodes": {u"node1.example.com": [u"site-example.com"]}})
+
+CLUSTER_CONFIGURATION = safe_dump({})
+
+DEPLOYMENT = Deployment(nodes=frozenset([
+    Node(hostname=u"node1.example.com",
+         applications=frozenset([APPLICATION]))]))
+
+EMPTY = Deployment(nodes=frozenset())
+
+
+def make_deployer(test, docker_client=None):
+    """
+    :param test: The ``TestCase`` the deployer is for.
+    :param IDockerClient docker_client: The Docker client, by default a new
+        ``FakeDockerClient``.
+
+    :return: A ``Deployer`` which changes the state of a node in memory.
+    """
+    if docker_client is None:
+        docker_client = FakeDockerClient()
+    return Deployer(create_volume_service(test), docker_client,
+                    make_memory_network(), reactor=Clock())
+
+
+class ConvergenceAgentTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceAgent``.
+    """
+    def setUp(self):
+        self.deployer = make_deployer(self)
+        self.agent = ConvergenceAgent(self.deployer)
+        self.calls = []
+
+    def record_calls(self):
+        """
+        Replace ``Deployer.change_node_state`` with a function which records
+        its arguments and returns a ``Deferred`` which fires when the test
+        fires it.
+        """
+        def change_node_state(desired_state, current_cluster_state,
+                              hostname):
+            d = Deferred()
+            self.calls.append(
+                ((desired_state, current_cluster_state, hostname), d))
+            return d
+        self.patch(self.deployer, "change_node_state", change_node_state)
+
+    def test_change_state(self):
+        """
+        ``ConvergenceAgent.change_state`` changes the state of the node to
+        match the given configuration.
+        """
+        self.successResultOf(self.agent.change_state(
+            DEPLOYMENT, EMPTY, u"node1.example.com"))
+        self.assertTrue(self.successResultOf(
+            self.deployer.docker_client.exists(APPLICATION.name)))
+
+    def test_report_state(self):
+        """
+        ``ConvergenceAgent.report_state`` returns the state of the node as
+        discovered by the ``Deployer``.
+        """
+        expected = self.successResultOf(
+            self.deployer.discover_node_configuration())
+        self.assertEqual(self.successResultOf(self.agent.report_state()),
+                         expected)
+
+    def test_one_at_a_time(self):
+        """
+        A configuration given while a convergence is running is only applied
+        once that has finished.
+        """
+        self.record_calls()
+        first = self.agent.change_state(DEPLOYMENT, EMPTY, u"node1")
+        self.agent.change_state(EMPTY, EMPTY, u"node1")
+        before = len(self.calls)
+        self.calls[0][1].callback(None)
+        self.successResultOf(first)
+        self.assertEqual(
+            (before, [arguments for arguments, _ in self.calls]),
+            (1, [(DEPLOYMENT, EMPTY, u"node1"), (EMPTY, EMPTY, u"node1")]))
+
+    def test_newest_only(self):
+        """
+        If several configurations are given while a convergence is running,
+        only the newest is applied once it has finished, and the results
+        for all of them fire once that has been applied.
+        """
+        self.record_calls()
+        self.agent.change_state(EMPTY, EMPTY, u"node1")
+        second = self.agent.change_state(DEPLOYMENT, EMPTY, u"node1")
+        third = self.agent.change_state(DEPLOYMENT, DEPLOYMENT, u"node1")
+        self.calls[0][1].callback(None)
+        waiting = [second.called, third.called]
+        self.calls[1][1].callback(u"done")
+        self.assertEqual(
+            (waiting, [arguments for arguments, _ in self.calls],
+             self.successResultOf(second), self.successResultOf(third)),
+            ([False, False],
+             [(EMPTY, EMPTY, u"node1"), (DEPLOYMENT, DEPLOYMENT, u"node1")],
+             u"done", u"done"))
+
+    def test_failure(self):
+        """
+        If a convergence fails, the result of ``change_state`` is the failure
+        and later configurations are still applied.
+        """
+        results = [fail(ZeroDivisionError()), succeed(None)]
+        self.patch(self.deployer, "change_node_state",
+                   lambda *args: results.pop(0))
+        failed = self.agent.change_state(DEPLOYMENT, EMPTY, u"node1")
+        self.failureResultOf(failed, ZeroDivisionError)
+        self.successResultOf(
+            self.agent.change_state(DEPLOYMENT, EMPTY, u"node1"))
+
+
+class ParseConfigurationTests(SynchronousTestCase):
+    """
+    Tests for ``parse_configuration``.
+    """
+    def test_parsed(self):
+        """
+        The desired and current configuration are parsed into
+        ``Deployment``\ s.
+        """
+        self.assertEqual(
+            parse_configuration(DEPLOYMENT_CONFIGURATION,
+                                APPLICATION_CONFIGURATION,
+                                CLUSTER_CONFIGURATION),
+            (DEPLOYMENT, EMPTY))
+
+    def test_bad_yaml(self):
+        """
+        A ``ConfigurationError`` is raised if the configuration is not YAML.
+        """
+        self.assertRaises(
+            ConfigurationError, parse_configuration, b"{", b"{}", b"{}")
+
+
+class BigStringTests(SynchronousTestCase):
+    """
+    Tests for ``BigString``.
+    """
+    def round_trip(self, value):
+        """
+        Encode a value as an AMP box and decode it again.
+
+        :return: ``tuple`` of the encoded box and the decoded value.
+        """
+        strings = {}
+        BigString().toBox(b"value", strings, {b"value": value}, None)
+        box = dict(strings)
+        objects = {}
+        BigString().fromBox(b"value", strings, objects, None)
+        return box, objects[b"value"]
+
+    def test_small(self):
+        """
+        A value which fits in a single AMP value is sent as one part.
+        """
+        self.assertEqual(self.round_trip(b"abc"),
+                         ({b"value": b"1", b"value.0": b"abc"}, b"abc"))
+
+    def test_empty(self):
+        """
+        An empty value is sent as no parts.
+        """
+        self.assertEqual(self.round_trip(b""), ({b"value": b"0"}, b""))
+
+    def test_large(self):
+        """
+        A value longer than AMP allows is split into parts which each fit,
+        and is put back together when decoded.
+        """
+        value = b"x" * (MAX_VALUE_LENGTH * 2) + b"y"
+        box, decoded = self.round_trip(value)
+        self.assertEqual(
+            (decoded == value, box[b"value"],
+             max(len(part) for part in box.values())),
+            (True, b"3", MAX_VALUE_LENGTH))
+
+
+class ConvergenceProtocolTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceProtocol``.
+    """
+    def setUp(self):
+        self.docker_client = FakeDockerClient(units={APPLICATION.name: Unit(
+            name=APPLICATION.name, container_name=APPLICATION.name,
+            container_image=APPLICATION.image.full_name,
+            activation_state=u"active")})
+        self.agent = ConvergenceAgent(make_deployer(self, self.docker_client))
+        server = ConvergenceProtocol(self.agent)
+        self.client = AMP()
+        self.pump = connect(server, makeFakeServer(server),
+                            self.client, makeFakeClient(self.client))
+
+    def call(self, command, **arguments):
+        """
+        Send a request to the agent and deliver the response.
+
+        :return: A ``Deferred`` with the response.
+        """
+        # AMP logs an error response as unhandled unless something is
+        # already waiting for it:
+        response = Deferred()
+        self.client.callRemote(command, **arguments).chainDeferred(response)
+        self.pump.flush()
+        return response
+
+    def test_report_state(self):
+        """
+        ``ReportState`` is answered with the state of the node as YAML, in
+        the same format as the output of ``flocker-reportstate``.
+        """
+        expected = marshal_configuration(
+            self.successResultOf(self.agent.report_state()))
+        response = self.successResultOf(self.call(ReportState))
+        self.assertEqual(safe_load(response["state"]), expected)
+
+    def test_change_state(self):
+        """
+        ``ChangeState`` is answered once the node has converged on the
+        given configuration.
+        """
+        self.successResultOf(self.call(
+            ChangeState, deployment_configuration=safe_dump(
+                {u"version": 1, u"nodes": {u"node1.example.com": []}}),
+            application_configuration=APPLICATION_CONFIGURATION,
+            cluster_configuration=CLUSTER_CONFIGURATION,
+            hostname=u"node1.example.com"))
+        self.assertFalse(self.successResultOf(
+            self.docker_client.exists(APPLICATION.name)))
+
+    def test_report_state_large(self):
+        """
+        ``ReportState`` is answered even when the state is too large for a
+        single AMP value.
+        """
+        for index in range(2000):
+            name = u"app%d.example.com" % (index,)
+            self.successResultOf(self.agent.deployer.docker_client.add(
+                name, u"clusterhq/wordpress:latest"))
+        response = self.successResultOf(self.call(ReportState))
+        self.assertEqual(
+            (len(response["state"]) > MAX_VALUE_LENGTH,
+             len(safe_load(response["state"])[u"applications"])),
+            (True, 2001))
+
+    def test_change_state_large(self):
+        """
+        ``ChangeState`` accepts configurations too large for a single AMP
+        value.
+        """
+        names = [u"app%d.example.com" % (index,) for index in range(2000)]
+        application_configuration = safe_dump({
+            u"version": 1,
+            u"applications": {
+                name: {u"image": u"clusterhq/wordpress:latest"}
+                for name in names}})
+        self.assertTrue(len(application_configuration) > MAX_VALUE_LENGTH)
+        self.successResultOf(self.call(
+            ChangeState, deployment_configuration=safe_dump(
+                {u"version": 1, u"nodes": {u"node1.example.com": names}}),
+            application_configuration=application_configuration,
+            cluster_configuration=CLUSTER_CONFIGURATION,
+            hostname=u"node1.example.com"))
+        self.assertTrue(self.successResultOf(
+            self.docker_client.exists(names[-1])))
+
+    def test_configuration_error(self):
+        """
+        ``ChangeState`` fails with a ``ConfigurationError`` if the
+        configuration is invalid.
+        """
+        self.failureResultOf(self.call(
+            ChangeState, deployment_configuration=safe_dump(
+                {u"version": 1, u"nodes": {u"node1": [u"unknown"]}}),
+            application_configuration=APPLICATION_CONFIGURATION,
+            cluster_configuration=CLUSTER_CONFIGURATION,
+            hostname=u"node1"), ConfigurationError)
+
+
+class ConvergenceAgentFactoryTests(SynchronousTestCase):
+    """
+    Tests for ``ConvergenceAgentFactory``.
+    """
+    def test_protocol(self):
+        """
+        ``ConvergenceAgentFactory.buildProtocol`` creates a
+        ``ConvergenceProtocol`` which uses the factory's agent.
+        """
+        agent = ConvergenceAgent(make_deployer(self))
+        protocol = ConvergenceAgentFactory(agent).buildProtocol(None)
+        self.assertEqual((protocol.__class__, protocol._agent),
+                         (ConvergenceProtocol, agent))
@@ -6,10 +6,17 @@ Tests for ``flocker.node._deploy``.
 
 from uuid import uuid4
 
+from ipaddr import IPAddress
+
 from zope.interface.verify import verifyObject
 from zope.interface import implementer
 
+from characteristic import attributes
+
+from eliot.testing import validateLogging, assertHasMessage
+
 from twisted.internet.defer import fail, FirstError, succeed, Deferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
@@ -17,19 +24,26 @@ from .. import (
     Deployer, Application, DockerImage, Deployment, Node, Port, Link,
     NodeState)
 from .._deploy import (
-    IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
-    CreateVolume, WaitForVolume, HandoffVolume, SetProxies, PushVolume,
-    ResizeVolume, _link_environment, _to_volume_name)
+    IStateChange, Sequentially, InParallel, InDependencyOrder, Step,
+    GRAPH_FINISHED,
+    StartApplication, StopApplication,
+    CreateVolume, WaitForVolume, HandoffVolume, SetProxies, PushVolumes,
+    ResizeVolume, PullImages, DEFAULT_CONCURRENCY, _link_environment,
+    _to_volume_name)
 from .._model import AttachedVolume
 from .._docker import (
     FakeDockerClient, AlreadyExists, Unit, PortMap, Environment,
-    DockerClient, Volume as DockerVolume)
+    AsyncDockerClient, Volume as DockerVolume)
 from ...route import Proxy, make_memory_network
 from ...route._iptables import HostNetwork
 from ...volume.service import Volume, VolumeName
 from ...volume._model import VolumeSize
 from ...volume.testtools import create_volume_service
-from ...volume._ipc import RemoteVolumeManager, standard_node
+from ...testtools import FakeProcessReactor
+from ...volume._agent import AgentVolumeManager, agent_endpoint
+from ...volume._ipc import standard_node
+from ...common import IDescriptorConsumer, MemoryConsumer
+from ...volume._compression import Compression
 
 
 class DeployerAttributesTests(SynchronousTestCase):
@@ -38,13 +52,30 @@ class DeployerAttributesTests(SynchronousTestCase):
     """
     def test_docker_client_default(self):
         """
-        ``Deployer.docker_client`` is a ``DockerClient`` by default.
+        ``Deployer.docker_client`` is an ``AsyncDockerClient`` by default.
         """
         self.assertIsInstance(
             Deployer(None).docker_client,
-            DockerClient
+            AsyncDockerClient
         )
 
+    def test_reactor_default(self):
+        """
+        ``Deployer.reactor`` is the global reactor by default.
+        """
+        from twisted.internet import reactor
+        self.assertIs(Deployer(None).reactor, reactor)
+
+    def test_limiters_default(self):
+        """
+        ``Deployer.limiters`` bound each kind of operation to
+        ``DEFAULT_CONCURRENCY``.
+        """
+        limiters = Deployer(None).limiters
+        self.assertEqual(
+            {kind: limiter.limit for kind, limiter in limiters.items()},
+            DEFAULT_CONCURRENCY)
+
     def test_docker_override(self):
         """
         ``Deployer.docker_client`` can be overridden in the constructor.
@@ -129,9 +160,14 @@ CreateVolumeIStateChangeTests = make_istatechange_tests(
 HandoffVolumeIStateChangeTests = make_istatechange_tests(
     HandoffVolume, dict(volume=1, hostname=b"123"),
     dict(volume=2, hostname=b"123"))
-PushVolumeIStateChangeTests = make_istatechange_tests(
-    PushVolume, dict(volume=1, hostname=b"123"),
-    dict(volume=2, hostname=b"123"))
+PushVolumesIStateChangeTests = make_istatechange_tests(
+    PushVolumes, dict(volumes=1, hostname=b"123"),
+    dict(volumes=2, hostname=b"123"))
+PullImagesIStateChangeTests = make_istatechange_tests(
+    PullImages, dict(images=1), dict(images=2))
+InDependencyOrderIStateChangeTests = make_istatechange_tests(
+    InDependencyOrder, dict(steps={(u"a",): Step(change=1)}),
+    dict(steps={(u"a",): Step(change=2)}))
 
 
 NOT_CALLED = object()
@@ -315,6 +351,142 @@ class InParallelTests(SynchronousTestCase):
         )
 
 
+@attributes(["reactor"])
+class FakeDeployer(object):
+    """
+    Just enough of a ``Deployer`` for ``InDependencyOrder.run``.
+    """
+
+
+class InDependencyOrderTests(SynchronousTestCase):
+    """
+    Tests for ``InDependencyOrder``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.deployer = FakeDeployer(reactor=self.clock)
+
+    def test_subchanges_get_deployer(self):
+        """
+        ``InDependencyOrder.run`` runs the changes with the given deployer.
+        """
+        first, second = FakeChange(succeed(None)), FakeChange(succeed(None))
+        change = InDependencyOrder(steps={
+            (u"first",): Step(change=first),
+            (u"second",): Step(change=second, after=frozenset([(u"first",)])),
+        })
+        self.successResultOf(change.run(self.deployer))
+        self.assertEqual([first.deployer, second.deployer],
+                         [self.deployer, self.deployer])
+
+    def test_after_prerequisites(self):
+        """
+        A change is only run once the changes it comes after have succeeded,
+        and the result fires once every change is done.
+        """
+        not_done1, not_done2 = Deferred(), Deferred()
+        first, second = FakeChange(not_done1), FakeChange(not_done2)
+        third = FakeChange(succeed(None))
+        change = InDependencyOrder(steps={
+            (u"first",): Step(change=first),
+            (u"second",): Step(change=second),
+            (u"third",): Step(change=third, after=frozenset(
+                [(u"first",), (u"second",)])),
+        })
+        result = change.run(self.deployer)
+        called = [third.was_run_called()]
+        not_done1.callback(None)
+        called.append(third.was_run_called())
+        not_done2.callback(None)
+        called.append(third.was_run_called())
+        self.successResultOf(result)
+        self.assertEqual(called, [False, False, True])
+
+    def test_independent_not_blocked(self):
+        """
+        Changes which don't depend on a slow change are run without waiting
+        for it.
+        """
+        slow = FakeChange(Deferred())
+        after_slow = FakeChange(succeed(None))
+        independent = FakeChange(succeed(None))
+        after_independent = FakeChange(succeed(None))
+        change = InDependencyOrder(steps={
+            (u"slow",): Step(change=slow),
+            (u"after-slow",): Step(change=after_slow,
+                                   after=frozenset([(u"slow",)])),
+            (u"independent",): Step(change=independent),
+            (u"after-independent",): Step(
+                change=after_independent,
+                after=frozenset([(u"independent",)])),
+        })
+        result = change.run(self.deployer)
+        self.assertNoResult(result)
+        self.assertEqual(
+            [after_slow.was_run_called(), after_independent.was_run_called()],
+            [False, True])
+
+    @validateLogging(None)
+    def test_failure(self, logger):
+        """
+        If a change fails the changes after it are not run but the others
+        are, the failure is logged and the result is the failure.
+        """
+        self.patch(InDependencyOrder, "logger", logger)
+        exception = ZeroDivisionError()
+        after_failed = FakeChange(succeed(None))
+        independent = FakeChange(succeed(None))
+        change = InDependencyOrder(steps={
+            (u"failed",): Step(change=FakeChange(fail(exception))),
+            (u"after-failed",): Step(change=after_failed,
+                                     after=frozenset([(u"failed",)])),
+            (u"independent",): Step(change=independent),
+        })
+        result = change.run(self.deployer)
+        self.assertEqual(
+            (self.failureResultOf(result).value,
+             after_failed.was_run_called(), independent.was_run_called(),
+             len(logger.flushTracebacks(ZeroDivisionError))),
+            (exception, False, True, 1))
+
+    def test_cycle(self):
+        """
+        Changes which come after each other result in a ``ValueError``.
+        """
+        change = InDependencyOrder(steps={
+            (u"a",): Step(change=FakeChange(succeed(None)),
+                          after=frozenset([(u"b",)])),
+            (u"b",): Step(change=FakeChange(succeed(None)),
+                          after=frozenset([(u"a",)])),
+        })
+        self.assertRaises(ValueError, change.run, self.deployer)
+
+    @validateLogging(assertHasMessage, GRAPH_FINISHED, {
+        u"critical_path": [u"pull image", u"start app"],
+        u"duration": 5.0})
+    def test_critical_path_logged(self, logger):
+        """
+        Once all the changes are done, the chain of changes which finished
+        last is logged along with how long they all took.
+        """
+        self.patch(InDependencyOrder, "logger", logger)
+        pulling, starting = Deferred(), Deferred()
+        change = InDependencyOrder(steps={
+            (u"proxies",): Step(change=FakeChange(succeed(None))),
+            (u"pull", u"image"): Step(change=FakeChange(pulling)),
+            (u"volume",): Step(change=FakeChange(succeed(None))),
+            (u"start", u"app"): Step(
+                change=FakeChange(starting),
+                after=frozenset([(u"pull", u"image"), (u"volume",)])),
+        })
+        result = change.run(self.deployer)
+        self.clock.advance(3)
+        pulling.callback(None)
+        self.clock.advance(2)
+        starting.callback(None)
+        self.successResultOf(result)
+
+
 class StartApplicationTests(SynchronousTestCase):
     """
     Tests for ``StartApplication``.
@@ -637,6 +809,33 @@ class StopApplicationTests(SynchronousTestCase):
              self.successResultOf(exists_result))
         )
 
+    def test_before_start(self):
+        """
+        While the ``Deployer``'s limit on Docker operations is reached,
+        waiting ``StopApplication`` changes go ahead of waiting
+        ``StartApplication`` changes, since they free up ports and volumes.
+        """
+        fake_docker = FakeDockerClient()
+        api = Deployer(create_volume_service(self), docker_client=fake_docker,
+                       concurrency={u"docker": 1})
+        old = Application(name=u"old",
+                          image=DockerImage.from_string(u"busybox"))
+        new = Application(name=u"new",
+                          image=DockerImage.from_string(u"busybox"))
+        busy = Deferred()
+        api.limiters[u"docker"].run(0, lambda: busy)
+        order = []
+        self.patch(fake_docker, "add",
+                   lambda unit_name, *args, **kwargs: order.append(
+                       (u"add", unit_name)))
+        self.patch(fake_docker, "remove",
+                   lambda unit_name: order.append((u"remove", unit_name)))
+        StartApplication(
+            application=new, hostname=u"node1.example.com").run(api)
+        StopApplication(application=old).run(api)
+        busy.callback(None)
+        self.assertEqual(order, [(u"remove", u"old"), (u"add", u"new")])
+
     def test_does_not_exist(self):
         """
         ``StopApplication.run()`` does not errback if the application does
@@ -1089,7 +1288,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(steps={})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_proxy_needs_creating(self):
@@ -1126,7 +1325,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node2.example.com')
         proxy = Proxy(ip=expected_destination_host,
                       port=expected_destination_port)
-        expected = Sequentially(changes=[SetProxies(ports=frozenset([proxy]))])
+        expected = InDependencyOrder(steps={
+            (u"proxies",): Step(change=SetProxies(ports=frozenset([proxy])))})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_proxy_empty(self):
@@ -1145,7 +1345,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(
             desired_state=desired, current_cluster_state=EMPTY,
             hostname=u'node2.example.com')
-        expected = Sequentially(changes=[SetProxies(ports=frozenset())])
+        expected = InDependencyOrder(steps={
+            (u"proxies",): Step(change=SetProxies(ports=frozenset()))})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_application_needs_stopping(self):
@@ -1168,7 +1369,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         to_stop = StopApplication(application=Application(
             name=unit.name, image=DockerImage.from_string(
                 unit.container_image)))
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(steps={
+            (u"stop", unit.name): Step(change=to_stop)})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_application_needs_starting(self):
@@ -1197,9 +1399,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[InParallel(
-            changes=[StartApplication(application=application,
-                                      hostname="node.example.com")])])
+        expected = InDependencyOrder(steps={
+            (u"pull", u"clusterhq/flocker:release-14.0"): Step(
+                change=PullImages(images=frozenset([application.image]))),
+            (u"start", application.name): Step(
+                change=StartApplication(application=application,
+                                        hostname="node.example.com"),
+                after=frozenset(
+                    [(u"pull", u"clusterhq/flocker:release-14.0")]))})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_only_this_node(self):
@@ -1228,7 +1435,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(steps={})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_no_change_needed(self):
@@ -1264,7 +1471,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         d = api.calculate_necessary_state_changes(desired_state=desired,
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'node.example.com')
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(steps={})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_node_not_described(self):
@@ -1291,7 +1498,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                 image=DockerImage.from_string(unit.container_image)
             )
         )
-        expected = Sequentially(changes=[InParallel(changes=[to_stop])])
+        expected = InDependencyOrder(steps={
+            (u"stop", unit.name): Step(change=to_stop)})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_volume_created(self):
@@ -1340,11 +1548,17 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=APPLICATION_WITH_VOLUME_NAME,
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[CreateVolume(volume=volume)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME,
-                hostname="node1.example.com")])])
+        pull = (u"pull", APPLICATION_WITH_VOLUME.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME.image]))),
+            (u"create", volume.name): Step(
+                change=CreateVolume(volume=volume)),
+            (u"start", APPLICATION_WITH_VOLUME_NAME): Step(
+                change=StartApplication(
+                    application=APPLICATION_WITH_VOLUME,
+                    hostname="node1.example.com"),
+                after=frozenset([pull, (u"create", volume.name)]))})
         self.assertEqual(expected, changes)
 
     def test_volume_wait(self):
@@ -1393,12 +1607,21 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=APPLICATION_WITH_VOLUME_NAME,
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForVolume(volume=volume)]),
-            InParallel(changes=[ResizeVolume(volume=volume)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME,
-                hostname="node1.example.com")])])
+        pull = (u"pull", APPLICATION_WITH_VOLUME.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME.image]))),
+            (u"wait", volume.name): Step(
+                change=WaitForVolume(volume=volume)),
+            (u"resize", volume.name): Step(
+                change=ResizeVolume(volume=volume),
+                after=frozenset([(u"wait", volume.name)])),
+            (u"start", APPLICATION_WITH_VOLUME_NAME): Step(
+                change=StartApplication(
+                    application=APPLICATION_WITH_VOLUME,
+                    hostname="node1.example.com"),
+                after=frozenset([pull, (u"wait", volume.name),
+                                 (u"resize", volume.name)]))})
         self.assertEqual(expected, changes)
 
     def test_volume_handoff(self):
@@ -1454,19 +1677,135 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            unit.container_image
-                                        )),)]),
-            InParallel(changes=[HandoffVolume(
-                volume=volume, hostname=another_node.hostname)]),
-        ])
+        push = (u"push", another_node.hostname)
+        stop = (u"stop", APPLICATION_WITH_VOLUME_NAME)
+        expected = InDependencyOrder(steps={
+            push: Step(change=PushVolumes(
+                volumes=frozenset([volume]),
+                hostname=another_node.hostname)),
+            stop: Step(
+                change=StopApplication(
+                    application=Application(
+                        name=APPLICATION_WITH_VOLUME_NAME,
+                        image=DockerImage.from_string(
+                            unit.container_image))),
+                after=frozenset([push])),
+            (u"handoff", volume.name): Step(
+                change=HandoffVolume(
+                    volume=volume, hostname=another_node.hostname),
+                after=frozenset([push, stop])),
+        })
+        self.assertEqual(expected, changes)
+
+    def test_volume_handoff_not_running(self):
+        """
+        ``Deployer.calculate_necessary_state_changes`` specifies that the
+        handoff of a volume waits for the initial push of it even if there
+        is no application to stop on this node, since both receive into the
+        same filesystem on the other node.
+        """
+        # The application is no longer running here:
+        docker = FakeDockerClient(units={})
+
+        node = Node(
+            hostname=u"node1.example.com",
+            applications=frozenset({DISCOVERED_APPLICATION_WITH_VOLUME}),
+        )
+        another_node = Node(
+            hostname=u"node2.example.com",
+            applications=frozenset(),
+        )
+        current = Deployment(nodes=frozenset([node, another_node]))
+
+        api = Deployer(
+            create_volume_service(self), docker_client=docker,
+            network=make_memory_network()
+        )
+
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=node.hostname,
+                 applications=frozenset()),
+            Node(hostname=another_node.hostname,
+                 applications=frozenset({APPLICATION_WITH_VOLUME})),
+        }))
+
+        changes = self.successResultOf(api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=current,
+            hostname=node.hostname,
+        ))
+
+        volume = AttachedVolume(
+            name=APPLICATION_WITH_VOLUME_NAME,
+            mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
+        )
+        push = (u"push", another_node.hostname)
+        expected = InDependencyOrder(steps={
+            push: Step(change=PushVolumes(
+                volumes=frozenset([volume]),
+                hostname=another_node.hostname)),
+            (u"handoff", volume.name): Step(
+                change=HandoffVolume(
+                    volume=volume, hostname=another_node.hostname),
+                after=frozenset([push])),
+        })
         self.assertEqual(expected, changes)
 
+    def test_volume_handoffs_same_node(self):
+        """
+        ``Deployer.calculate_necessary_state_changes`` specifies that all the
+        volumes moving to the same node are pushed to it together.
+        """
+        other_application = Application(
+            name=b"mysql-clusterhq",
+            image=DockerImage.from_string(b"clusterhq/mysql"),
+            volume=AttachedVolume(
+                name=b"mysql-clusterhq", mountpoint=FilePath(b"/var/mysql")),
+            links=frozenset(),
+        )
+        docker = FakeDockerClient(units={
+            application.name: Unit(
+                name=application.name, container_name=application.name,
+                container_image=application.image.full_name,
+                activation_state=u'active')
+            for application in [APPLICATION_WITH_VOLUME, other_application]})
+
+        node = Node(
+            hostname=u"node1.example.com",
+            applications=frozenset({APPLICATION_WITH_VOLUME,
+                                    other_application}),
+        )
+        another_node = Node(
+            hostname=u"node2.example.com",
+            applications=frozenset(),
+        )
+        current = Deployment(nodes=frozenset([node, another_node]))
+        desired = Deployment(nodes=frozenset({
+            Node(hostname=node.hostname,
+                 applications=frozenset()),
+            Node(hostname=another_node.hostname,
+                 applications=frozenset({APPLICATION_WITH_VOLUME,
+                                         other_application})),
+        }))
+
+        api = Deployer(
+            create_volume_service(self), docker_client=docker,
+            network=make_memory_network()
+        )
+        calculating = api.calculate_necessary_state_changes(
+            desired_state=desired,
+            current_cluster_state=current,
+            hostname=node.hostname,
+        )
+
+        changes = self.successResultOf(calculating)
+        self.assertEqual(
+            changes.steps[(u"push", another_node.hostname)],
+            Step(change=PushVolumes(
+                volumes=frozenset([APPLICATION_WITH_VOLUME.volume,
+                                   other_application.volume]),
+                hostname=another_node.hostname)))
+
     def test_no_volume_changes(self):
         """
         ``Deployer.calculate_necessary_state_changes`` specifies no work for
@@ -1523,7 +1862,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         changes = self.successResultOf(calculating)
 
-        expected = Sequentially(changes=[])
+        expected = InDependencyOrder(steps={})
         self.assertEqual(expected, changes)
 
     def test_volume_resize(self):
@@ -1594,23 +1933,24 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         )
 
         changes = self.successResultOf(calculating)
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeVolume(
-                    volume=AttachedVolume(name='psql-clusterhq',
-                                          mountpoint='/var/lib/postgresql',
-                                          maximum_size=104857600)
-                    )]
-            ),
-            InParallel(
-                changes=[Sequentially(
+        resize = (u"resize", 'psql-clusterhq')
+        pull = (u"pull", APPLICATION_WITH_VOLUME_SIZE.image.full_name)
+        expected = InDependencyOrder(steps={
+            resize: Step(change=ResizeVolume(
+                volume=AttachedVolume(name='psql-clusterhq',
+                                      mountpoint='/var/lib/postgresql',
+                                      maximum_size=104857600))),
+            pull: Step(change=PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME_SIZE.image]))),
+            (u"restart", APPLICATION_WITH_VOLUME_NAME): Step(
+                change=Sequentially(
                     changes=[
                         StopApplication(application=APPLICATION_WITH_VOLUME),
                         StartApplication(
                             application=APPLICATION_WITH_VOLUME_SIZE,
                             hostname=u'node1.example.com')
-                    ])]
-            )])
+                    ]),
+                after=frozenset([resize, pull]))})
         self.assertEqual(expected, changes)
 
     def test_volume_resized_before_move(self):
@@ -1690,33 +2030,25 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
 
         changes = self.successResultOf(calculating)
         # expected is: resize volume, push, stop application, handoff
-        expected = Sequentially(changes=[
-            InParallel(
-                changes=[ResizeVolume(
-                    volume=AttachedVolume(name='psql-clusterhq',
-                                          mountpoint='/var/lib/postgresql',
-                                          maximum_size=104857600)
-                    )]
-            ),
-            InParallel(
-                changes=[PushVolume(
-                    volume=AttachedVolume(name='psql-clusterhq',
-                                          mountpoint='/var/lib/postgresql',
-                                          maximum_size=104857600),
-                    hostname=u'node2.example.com')]
-            ),
-            InParallel(
-                changes=[
-                    StopApplication(application=APPLICATION_WITH_VOLUME)
-                ]
-            ),
-            InParallel(
-                changes=[HandoffVolume(
-                    volume=AttachedVolume(name='psql-clusterhq',
-                                          mountpoint='/var/lib/postgresql',
-                                          maximum_size=104857600),
-                    hostname=u'node2.example.com')]
-            )])
+        volume = AttachedVolume(name='psql-clusterhq',
+                                mountpoint='/var/lib/postgresql',
+                                maximum_size=104857600)
+        resize = (u"resize", volume.name)
+        push = (u"push", u'node2.example.com')
+        stop = (u"stop", APPLICATION_WITH_VOLUME_NAME)
+        expected = InDependencyOrder(steps={
+            resize: Step(change=ResizeVolume(volume=volume)),
+            push: Step(
+                change=PushVolumes(volumes=frozenset([volume]),
+                                   hostname=u'node2.example.com'),
+                after=frozenset([resize])),
+            stop: Step(
+                change=StopApplication(application=APPLICATION_WITH_VOLUME),
+                after=frozenset([push])),
+            (u"handoff", volume.name): Step(
+                change=HandoffVolume(volume=volume,
+                                     hostname=u'node2.example.com'),
+                after=frozenset([push, stop]))})
         self.assertEqual(expected, changes)
 
     def test_volume_max_size_preserved_after_move(self):
@@ -1776,12 +2108,21 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             mountpoint=APPLICATION_WITH_VOLUME_MOUNTPOINT,
             maximum_size=1024 * 1024 * 100
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[WaitForVolume(volume=volume)]),
-            InParallel(changes=[ResizeVolume(volume=volume)]),
-            InParallel(changes=[StartApplication(
-                application=APPLICATION_WITH_VOLUME_SIZE,
-                hostname="node1.example.com")])])
+        pull = (u"pull", APPLICATION_WITH_VOLUME_SIZE.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME_SIZE.image]))),
+            (u"wait", volume.name): Step(
+                change=WaitForVolume(volume=volume)),
+            (u"resize", volume.name): Step(
+                change=ResizeVolume(volume=volume),
+                after=frozenset([(u"wait", volume.name)])),
+            (u"start", APPLICATION_WITH_VOLUME_NAME): Step(
+                change=StartApplication(
+                    application=APPLICATION_WITH_VOLUME_SIZE,
+                    hostname="node1.example.com"),
+                after=frozenset([pull, (u"wait", volume.name),
+                                 (u"resize", volume.name)]))})
         self.assertEqual(expected, changes)
 
     def test_local_not_running_applications_restarted(self):
@@ -1813,11 +2154,17 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
                                                   current_cluster_state=EMPTY,
                                                   hostname=u'n.example.com')
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[StopApplication(application=application),
-                                  StartApplication(application=application,
-                                                   hostname="n.example.com")]),
-        ])])
+        pull = (u"pull", application.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([application.image]))),
+            (u"restart", application.name): Step(
+                change=Sequentially(changes=[
+                    StopApplication(application=application),
+                    StartApplication(application=application,
+                                     hostname="n.example.com")]),
+                after=frozenset([pull])),
+        })
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_not_local_not_running_applications_stopped(self):
@@ -1842,13 +2189,14 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=unit.name,
             image=DockerImage.from_string(unit.container_image)
         )
-        expected = Sequentially(changes=[InParallel(changes=[
-            StopApplication(application=to_stop)])])
+        expected = InDependencyOrder(steps={
+            (u"stop", unit.name): Step(
+                change=StopApplication(application=to_stop))})
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_handoff_precedes_wait(self):
         """
-        Volume handoffs happen before volume waits, to prevent deadlocks
+        Volume handoffs don't wait for volume waits, to prevent deadlocks
         between two nodes that are swapping volumes.
         """
         # The application is running here.
@@ -1926,21 +2274,36 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             name=u"another",
             mountpoint=FilePath(b"/blah"),
         )
-        expected = Sequentially(changes=[
-            InParallel(changes=[PushVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[StopApplication(
-                application=Application(name=APPLICATION_WITH_VOLUME_NAME,
-                                        image=DockerImage.from_string(
-                                            u'clusterhq/postgresql:9.1'),),)]),
-            InParallel(changes=[HandoffVolume(
-                volume=volume, hostname=another_node.hostname)]),
-            InParallel(changes=[WaitForVolume(volume=volume2)]),
-            InParallel(changes=[ResizeVolume(volume=volume2)]),
-            InParallel(changes=[
-                StartApplication(application=another_application,
-                                 hostname="node1.example.com")]),
-        ])
+        push = (u"push", another_node.hostname)
+        stop = (u"stop", APPLICATION_WITH_VOLUME_NAME)
+        pull = (u"pull", another_application.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([another_application.image]))),
+            push: Step(change=PushVolumes(volumes=frozenset([volume]),
+                                          hostname=another_node.hostname)),
+            stop: Step(
+                change=StopApplication(
+                    application=Application(
+                        name=APPLICATION_WITH_VOLUME_NAME,
+                        image=DockerImage.from_string(
+                            u'clusterhq/postgresql:9.1'))),
+                after=frozenset([push])),
+            (u"handoff", volume.name): Step(
+                change=HandoffVolume(volume=volume,
+                                     hostname=another_node.hostname),
+                after=frozenset([push, stop])),
+            (u"wait", volume2.name): Step(
+                change=WaitForVolume(volume=volume2)),
+            (u"resize", volume2.name): Step(
+                change=ResizeVolume(volume=volume2),
+                after=frozenset([(u"wait", volume2.name)])),
+            (u"start", another_application.name): Step(
+                change=StartApplication(application=another_application,
+                                        hostname="node1.example.com"),
+                after=frozenset([pull, (u"wait", volume2.name),
+                                 (u"resize", volume2.name)])),
+        })
         self.assertEqual(expected, changes)
 
     def test_restart_application_once_only(self):
@@ -1990,20 +2353,21 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[
-            InParallel(changes=[
-                CreateVolume(volume=AttachedVolume(
-                    name='postgres-example', mountpoint='/var/lib/data')
-                )]
-            ),
-            InParallel(changes=[
-                Sequentially(changes=[
+        pull = (u"pull", new_postgres_app.image.full_name)
+        create = (u"create", 'postgres-example')
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([new_postgres_app.image]))),
+            create: Step(change=CreateVolume(volume=AttachedVolume(
+                name='postgres-example', mountpoint='/var/lib/data'))),
+            (u"restart", new_postgres_app.name): Step(
+                change=Sequentially(changes=[
                     StopApplication(application=new_postgres_app),
                     StartApplication(application=new_postgres_app,
                                      hostname=u'node1.example.com')
-                ])
-            ])
-        ])
+                ]),
+                after=frozenset([pull, create])),
+        })
         self.assertEqual(expected, self.successResultOf(d))
 
     def test_app_with_changed_image_restarted(self):
@@ -2052,13 +2416,18 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
+        pull = (u"pull", new_postgres_app.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([new_postgres_app.image]))),
+            (u"restart", new_postgres_app.name): Step(
+                change=Sequentially(changes=[
+                    StopApplication(application=old_postgres_app),
+                    StartApplication(application=new_postgres_app,
+                                     hostname="node1.example.com")
                 ]),
-        ])])
+                after=frozenset([pull])),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
@@ -2121,13 +2490,18 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
+        pull = (u"pull", new_postgres_app.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([new_postgres_app.image]))),
+            (u"restart", new_postgres_app.name): Step(
+                change=Sequentially(changes=[
+                    StopApplication(application=old_postgres_app),
+                    StartApplication(application=new_postgres_app,
+                                     hostname="node1.example.com")
                 ]),
-        ])])
+                after=frozenset([pull])),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
@@ -2188,13 +2562,18 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             hostname=u'node1.example.com'
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_wordpress_app),
-                StartApplication(application=new_wordpress_app,
-                                 hostname="node1.example.com")
+        pull = (u"pull", new_wordpress_app.image.full_name)
+        expected = InDependencyOrder(steps={
+            pull: Step(change=PullImages(
+                images=frozenset([new_wordpress_app.image]))),
+            (u"restart", new_wordpress_app.name): Step(
+                change=Sequentially(changes=[
+                    StopApplication(application=old_wordpress_app),
+                    StartApplication(application=new_wordpress_app,
+                                     hostname="node1.example.com")
                 ]),
-        ])])
+                after=frozenset([pull])),
+        })
 
         self.assertEqual(expected, self.successResultOf(d))
 
@@ -2264,6 +2643,66 @@ class SetProxiesTests(SynchronousTestCase):
             set(fake_network.enumerate_proxies())
         )
 
+    def record_changes(self, network):
+        """
+        Record the proxies created and deleted on a network.
+
+        :param MemoryNetwork network: The network to record changes to.
+
+        :return: A ``list`` to which ``(u"create", proxy)`` and
+            ``(u"delete", proxy)`` are appended.
+        """
+        changes = []
+        create_proxy_to = network.create_proxy_to
+        delete_proxy = network.delete_proxy
+
+        def create(ip, port):
+            proxy = create_proxy_to(ip, port)
+            changes.append((u"create", proxy))
+            return proxy
+
+        def delete(proxy):
+            changes.append((u"delete", proxy))
+            return delete_proxy(proxy)
+        self.patch(network, "create_proxy_to", create)
+        self.patch(network, "delete_proxy", delete)
+        return changes
+
+    def test_only_differences_changed(self):
+        """
+        Only the proxies which are no longer required are deleted and only
+        the ones which don't exist yet are created.
+        """
+        fake_network = make_memory_network()
+        removed = fake_network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        kept = fake_network.create_proxy_to(ip=u'192.0.2.101', port=8080)
+        added = Proxy(ip=u'192.0.2.102', port=5432)
+        changes = self.record_changes(fake_network)
+        api = Deployer(
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=fake_network)
+
+        self.successResultOf(SetProxies(ports=[kept, added]).run(api))
+        self.assertEqual(
+            (sorted(changes), set(fake_network.enumerate_proxies())),
+            ([(u"create", added), (u"delete", removed)], {kept, added}))
+
+    def test_address_compared_as_text(self):
+        """
+        An existing proxy whose address is an ``IPAddress`` is the same as a
+        required proxy whose address is the same text, so it is left alone.
+        """
+        fake_network = make_memory_network()
+        fake_network.create_proxy_to(ip=IPAddress(u'192.0.2.100'), port=3306)
+        changes = self.record_changes(fake_network)
+        api = Deployer(
+            create_volume_service(self), docker_client=FakeDockerClient(),
+            network=fake_network)
+
+        self.successResultOf(SetProxies(
+            ports=[Proxy(ip=u'192.0.2.100', port=3306)]).run(api))
+        self.assertEqual(changes, [])
+
     def test_delete_proxy_errors_as_errbacks(self):
         """
         Exceptions raised in `delete_proxy` operations are reported as
@@ -2518,23 +2957,26 @@ class WaitForVolumeTests(SynchronousTestCase):
     """
     def test_waits(self):
         """
-        ``WaitForVolume.run()`` waits for the named volume.
+        ``WaitForVolume.run()`` waits for the named volume, for as long as
+        the ``Deployer`` is configured to.
         """
         volume_service = create_volume_service(self)
         result = []
 
-        def wait(name):
-            result.append(name)
+        def wait(name, timeout):
+            result.append((name, timeout))
         self.patch(volume_service, "wait_for_volume", wait)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
-                            network=make_memory_network())
+                            network=make_memory_network(),
+                            volume_wait_timeout=30.0)
         wait = WaitForVolume(
             volume=AttachedVolume(name=u"myvol",
                                   mountpoint=FilePath(u"/var")))
         wait.run(deployer)
         self.assertEqual(result,
-                         [VolumeName(namespace=u"default", id=u"myvol")])
+                         [(VolumeName(namespace=u"default", id=u"myvol"),
+                           30.0)])
 
     def test_return(self):
         """
@@ -2543,7 +2985,8 @@ class WaitForVolumeTests(SynchronousTestCase):
         """
         result = Deferred()
         volume_service = create_volume_service(self)
-        self.patch(volume_service, "wait_for_volume", lambda name: result)
+        self.patch(volume_service, "wait_for_volume",
+                   lambda name, timeout: result)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
                             network=make_memory_network())
@@ -2554,26 +2997,103 @@ class WaitForVolumeTests(SynchronousTestCase):
         self.assertIs(wait_result, result)
 
 
+class DeployerVolumeManagerTests(SynchronousTestCase):
+    """
+    Tests for ``Deployer.volume_manager``.
+    """
+    def test_agent(self):
+        """
+        ``Deployer.volume_manager`` returns a manager which sends requests
+        through an ``AgentVolumeManager`` connecting to the volume agent on
+        the given node using the ``Deployer``'s reactor.
+        """
+        reactor = FakeProcessReactor()
+        deployer = Deployer(create_volume_service(self),
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network(), reactor=reactor)
+        agent = deployer.volume_manager(b"dest.example.com")._agent
+        expected = agent_endpoint(reactor, b"dest.example.com")
+        self.assertEqual(
+            (type(agent), agent._endpoint._reactor, agent._endpoint._args),
+            (AgentVolumeManager, reactor, expected._args))
+
+    def test_push_streams_over_ssh(self):
+        """
+        Volume data pushed to the manager ``Deployer.volume_manager`` returns
+        is written to ``flocker-volume receive`` run on the node over SSH,
+        through a consumer the volume's data can be spliced into.
+        """
+        @implementer(IDescriptorConsumer)
+        class DescriptorConsumer(MemoryConsumer):
+            def consumeDescriptor(self, fd):
+                pass
+
+        commands = []
+
+        def run_stream(node, command):
+            commands.append((node, command))
+            return DescriptorConsumer()
+        node = standard_node(b"dest.example.com")
+        self.patch(node.__class__, "run_stream", run_stream)
+        deployer = Deployer(create_volume_service(self),
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        volume = deployer.volume_service.get(
+            VolumeName(namespace=u"default", id=u"myvol"))
+        consumer = self.successResultOf(
+            deployer.volume_manager(
+                b"dest.example.com").receive_and_acquire_stream(volume))
+        [(used_node, command)] = commands
+        self.assertEqual(
+            (used_node, command[3:5],
+             IDescriptorConsumer.providedBy(consumer)),
+            (node, [b"receive", b"--acquire"], True))
+
+    def test_shared(self):
+        """
+        ``Deployer.volume_manager`` returns the same manager each time it is
+        called for a node, so operations on that node share a connection.
+        """
+        deployer = Deployer(create_volume_service(self),
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        self.assertIs(deployer.volume_manager(b"dest.example.com"),
+                      deployer.volume_manager(b"dest.example.com"))
+
+    def test_per_node(self):
+        """
+        ``Deployer.volume_manager`` returns a different manager for each
+        node.
+        """
+        deployer = Deployer(create_volume_service(self),
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network())
+        self.assertIsNot(deployer.volume_manager(b"node1.example.com"),
+                         deployer.volume_manager(b"node2.example.com"))
+
+
 class HandoffVolumeTests(SynchronousTestCase):
     """
     Tests for ``HandoffVolume``.
     """
     def test_handoff(self):
         """
-        ``HandoffVolume.run()`` hands off the named volume to the given
-        destination nodex.
+        ``HandoffVolume.run()`` hands off the named volume to the volume
+        agent of the given destination node, identifying the destination by
+        its hostname.
         """
         volume_service = create_volume_service(self)
         hostname = b"dest.example.com"
 
         result = []
 
-        def _handoff(volume, destination):
-            result.extend([volume, destination])
+        def _handoff(volume, destination, peer, compression):
+            result.extend([volume, destination, peer, compression])
         self.patch(volume_service, "handoff", _handoff)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
-                            network=make_memory_network())
+                            network=make_memory_network(),
+                            compression=Compression.from_bytes(b"lz4"))
         handoff = HandoffVolume(
             volume=AttachedVolume(name=u"myvol",
                                   mountpoint=FilePath(u"/var/blah")),
@@ -2582,17 +3102,18 @@ class HandoffVolumeTests(SynchronousTestCase):
         self.assertEqual(
             result,
             [volume_service.get(_to_volume_name(u"myvol")),
-             RemoteVolumeManager(standard_node(hostname))])
+             deployer.volume_manager(hostname),
+             hostname, Compression.from_bytes(b"lz4")])
 
     def test_return(self):
         """
-        ``HandoffVolume.run()`` returns the result of
-        ``VolumeService.handoff``.
+        ``HandoffVolume.run()`` returns a ``Deferred`` that fires with the
+        result of ``VolumeService.handoff``.
         """
         result = Deferred()
         volume_service = create_volume_service(self)
         self.patch(volume_service, "handoff",
-                   lambda volume, destination: result)
+                   lambda volume, destination, peer, compression: result)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
                             network=make_memory_network())
@@ -2601,54 +3122,248 @@ class HandoffVolumeTests(SynchronousTestCase):
                                   mountpoint=FilePath(u"/var")),
             hostname=b"dest.example.com")
         handoff_result = handoff.run(deployer)
-        self.assertIs(handoff_result, result)
+        self.assertNoResult(handoff_result)
+        result.callback(u"handed off")
+        self.assertEqual(self.successResultOf(handoff_result), u"handed off")
 
+    def test_limited(self):
+        """
+        ``HandoffVolume.run()`` only starts the handoff once the
+        ``Deployer``'s limit on sending volumes allows it.
+        """
+        volume_service = create_volume_service(self)
+        handoffs = []
+        self.patch(volume_service, "handoff",
+                   lambda volume, destination, peer, compression:
+                   handoffs.append(volume))
+        deployer = Deployer(volume_service,
+                            docker_client=FakeDockerClient(),
+                            network=make_memory_network(),
+                            concurrency={u"send": 1})
+        sending = Deferred()
+        deployer.limiters[u"send"].run(0, lambda: sending)
+        handoff = HandoffVolume(
+            volume=AttachedVolume(name=u"myvol",
+                                  mountpoint=FilePath(u"/var")),
+            hostname=b"dest.example.com")
+        handoff.run(deployer)
+        before = handoffs[:]
+        sending.callback(None)
+        self.assertEqual((before, len(handoffs)), ([], 1))
 
-class PushVolumeTests(SynchronousTestCase):
+
+class PushVolumesTests(SynchronousTestCase):
     """
-    Tests for ``PushVolume``.
+    Tests for ``PushVolumes``.
     """
     def test_push(self):
         """
-        ``PushVolume.run()`` pushes the named volume to the given destination
-        node.
+        ``PushVolumes.run()`` pre-copies the named volumes to the volume
+        agent of the given destination node, identifying the destination by
+        its hostname, using
+        the ``Deployer``'s handoff threshold, time budget and limit on
+        sending volumes.
         """
         volume_service = create_volume_service(self)
         hostname = b"dest.example.com"
 
         result = []
 
-        def _push(volume, destination):
-            result.extend([volume, destination])
-        self.patch(volume_service, "push", _push)
+        def _precopy_many(volumes, destination, threshold, budget, peer,
+                          limiter, compression):
+            result.extend([set(volumes), destination, threshold, budget,
+                           peer, limiter, compression])
+        self.patch(volume_service, "precopy_many", _precopy_many)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
-                            network=make_memory_network())
-        push = PushVolume(
-            volume=AttachedVolume(name=u"myvol",
-                                  mountpoint=FilePath(u"/var/blah")),
+                            network=make_memory_network(),
+                            handoff_threshold=1024,
+                            handoff_budget=60.0,
+                            compression=Compression.from_bytes(b"lz4"))
+        push = PushVolumes(
+            volumes=frozenset([
+                AttachedVolume(name=u"myvol",
+                               mountpoint=FilePath(u"/var/blah")),
+                AttachedVolume(name=u"myvol2",
+                               mountpoint=FilePath(u"/var/blah2"))]),
             hostname=hostname)
         push.run(deployer)
         self.assertEqual(
             result,
-            [volume_service.get(_to_volume_name(u"myvol")),
-             RemoteVolumeManager(standard_node(hostname))])
+            [{volume_service.get(_to_volume_name(u"myvol")),
+              volume_service.get(_to_volume_name(u"myvol2"))},
+             deployer.volume_manager(hostname),
+             1024, 60.0, hostname, deployer.limiters[u"send"],
+             Compression.from_bytes(b"lz4")])
 
     def test_return(self):
         """
-        ``PushVolume.run()`` returns the result of
-        ``VolumeService.push``.
+        ``PushVolumes.run()`` returns the result of
+        ``VolumeService.precopy_many``.
         """
         result = Deferred()
         volume_service = create_volume_service(self)
-        self.patch(volume_service, "push",
-                   lambda volume, destination: result)
+        self.patch(volume_service, "precopy_many",
+                   lambda volumes, destination, threshold, budget, peer,
+                   limiter, compression: result)
         deployer = Deployer(volume_service,
                             docker_client=FakeDockerClient(),
                             network=make_memory_network())
-        push = PushVolume(
-            volume=AttachedVolume(name=u"myvol",
-                                  mountpoint=FilePath(u"/var")),
+        push = PushVolumes(
+            volumes=frozenset([AttachedVolume(name=u"myvol",
+                                              mountpoint=FilePath(u"/var"))]),
             hostname=b"dest.example.com")
         push_result = push.run(deployer)
         self.assertIs(push_result, result)
+
+
+class PullImagesTests(SynchronousTestCase):
+    """
+    Tests for ``PullImages``.
+    """
+    def test_pulls(self):
+        """
+        ``PullImages.run()`` pulls each of the images with the
+        ``Deployer``'s Docker client.
+        """
+        docker = FakeDockerClient()
+        deployer = Deployer(create_volume_service(self), docker_client=docker,
+                            network=make_memory_network())
+        pull = PullImages(images=frozenset([
+            DockerImage.from_string(u"clusterhq/flocker:1.0"),
+            DockerImage.from_string(u"busybox")]))
+        self.successResultOf(pull.run(deployer))
+        self.assertEqual(sorted(docker._pulled_images),
+                         [u"busybox:latest", u"clusterhq/flocker:1.0"])
+
+    def test_limited(self):
+        """
+        ``PullImages.run()`` pulls no more images at once than the
+        ``Deployer``'s limit on downloads allows.
+        """
+        docker = FakeDockerClient()
+        pulling = []
+
+        def pull(image_name):
+            pulling.append(Deferred())
+            return pulling[-1]
+        self.patch(docker, "pull", pull)
+        deployer = Deployer(create_volume_service(self), docker_client=docker,
+                            network=make_memory_network(),
+                            concurrency={u"network": 1})
+        pull_images = PullImages(images=frozenset([
+            DockerImage.from_string(u"clusterhq/flocker:1.0"),
+            DockerImage.from_string(u"busybox")]))
+        d = pull_images.run(deployer)
+        before = len(pulling)
+        pulling[0].callback(0)
+        after = len(pulling)
+        pulling[1].callback(0)
+        self.successResultOf(d)
+        self.assertEqual((before, after), (1, 2))
+
+    @validateLogging(None)
+    def test_failure_ignored(self, logger):
+        """
+        ``PullImages.run()`` succeeds even if pulling an image fails, once
+        the other pulls are done, and logs the failure.
+        """
+        self.patch(PullImages, "logger", logger)
+        docker = FakeDockerClient()
+        pulling = Deferred()
+        results = {u"busybox:latest": pulling,
+                   u"clusterhq/flocker:1.0": fail(ZeroDivisionError())}
+        self.patch(docker, "pull", results.get)
+        deployer = Deployer(create_volume_service(self), docker_client=docker,
+                            network=make_memory_network())
+        pull = PullImages(images=frozenset([
+            DockerImage.from_string(u"clusterhq/flocker:1.0"),
+            DockerImage.from_string(u"busybox")]))
+        d = pull.run(deployer)
+        self.assertNoResult(d)
+        pulling.callback(0)
+        self.successResultOf(d)
+        self.assertEqual(len(logger.flushTracebacks(ZeroDivisionError)), 1)
+
+
+class PullImagesCalculateTests(SynchronousTestCase):
+    """
+    Tests for the ``PullImages`` steps calculated by
+    ``Deployer.calculate_necessary_state_changes``.
+    """
+    def test_deduplicated(self):
+        """
+        Applications with the same image only result in it being pulled
+        once.
+        """
+        image = DockerImage.from_string(u"clusterhq/flocker:1.0")
+        applications = frozenset([Application(name=u"one", image=image),
+                                  Application(name=u"two", image=image)])
+        api = Deployer(create_volume_service(self),
+                       docker_client=FakeDockerClient(),
+                       network=make_memory_network())
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u"node.example.com", applications=applications)]))
+        d = api.calculate_necessary_state_changes(
+            desired_state=desired, current_cluster_state=EMPTY,
+            hostname=u"node.example.com")
+        self.assertEqual(
+            [key for key in self.successResultOf(d).steps
+             if key[0] == u"pull"],
+            [(u"pull", image.full_name)])
+
+
+class PortConflictCalculateTests(SynchronousTestCase):
+    """
+    Tests for the ordering of starts and stops calculated by
+    ``Deployer.calculate_necessary_state_changes``.
+    """
+    def calculate(self, application):
+        """
+        Calculate the changes to replace a running application using port
+        8080 with the given one.
+
+        :param Application application: The application to start.
+
+        :return: The calculated ``InDependencyOrder``.
+        """
+        docker = FakeDockerClient(units={u"old": Unit(
+            name=u"old", container_name=u"old",
+            container_image=u"clusterhq/flocker:1.0",
+            ports=frozenset([PortMap(internal_port=80, external_port=8080)]),
+            activation_state=u"active")})
+        api = Deployer(create_volume_service(self), docker_client=docker,
+                       network=make_memory_network())
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u"node.example.com",
+                 applications=frozenset([application]))]))
+        return self.successResultOf(api.calculate_necessary_state_changes(
+            desired_state=desired, current_cluster_state=EMPTY,
+            hostname=u"node.example.com"))
+
+    def test_same_port(self):
+        """
+        An application is started once an application being stopped which
+        used the same external port has stopped.
+        """
+        application = Application(
+            name=u"new", image=DockerImage.from_string(u"busybox"),
+            ports=frozenset([Port(internal_port=80, external_port=8080)]))
+        changes = self.calculate(application)
+        self.assertEqual(
+            changes.steps[(u"start", u"new")].after,
+            frozenset([(u"pull", application.image.full_name),
+                       (u"stop", u"old")]))
+
+    def test_different_port(self):
+        """
+        An application is started without waiting for applications being
+        stopped which used other external ports.
+        """
+        application = Application(
+            name=u"new", image=DockerImage.from_string(u"busybox"),
+            ports=frozenset([Port(internal_port=80, external_port=8081)]))
+        changes = self.calculate(application)
+        self.assertEqual(
+            changes.steps[(u"start", u"new")].after,
+            frozenset([(u"pull", application.image.full_name)]))
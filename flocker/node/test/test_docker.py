@@ -2,15 +2,34 @@
 
 """Tests for :module:`flocker.node._docker`."""
 
+import json
+from itertools import count
+from tempfile import mkdtemp
+
 from zope.interface.verify import verifyObject
 
-from twisted.trial.unittest import TestCase
+from eliot.testing import validateLogging, assertHasMessage
+
+from docker.errors import APIError
+from requests import Response
+
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
+from twisted.web.http import (
+    OK, CREATED, NO_CONTENT, NOT_MODIFIED, NOT_FOUND, CONFLICT,
+    INTERNAL_SERVER_ERROR)
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
 
-from ...testtools import random_name, make_with_init_tests
+from ...testtools import random_name, make_with_init_tests, loop_until
 from .._docker import (
     IDockerClient, FakeDockerClient, AlreadyExists, PortMap, Unit,
-    Environment, Volume)
+    Environment, Volume, DockerClient, AsyncDockerClient, DockerAPIError,
+    Backoff, WaitTimeout, WAITED, IMAGE_PULLED, _blocking_wait, _wait,
+    _PullProgress, _status_state)
 
 from .._model import RestartAlways, RestartNever, RestartOnFailure
 
@@ -70,6 +89,16 @@ def make_idockerclient_tests(fixture):
             d.addCallback(lambda _: client.remove(name))
             return d
 
+        def test_pull(self):
+            """
+            ``pull`` of an image which is already present fires with zero
+            bytes downloaded.
+            """
+            client = fixture(self)
+            d = client.pull(u"busybox")
+            d.addCallback(self.assertEqual, 0)
+            return d
+
         def test_unknown_does_not_exist(self):
             """A unit that was never added does not exist."""
             client = fixture(self)
@@ -227,6 +256,53 @@ def make_idockerclient_tests(fixture):
             return self.assert_restart_policy_round_trips(
                 RestartOnFailure(maximum_retry_count=5))
 
+        def watch(self, client):
+            """
+            Follow the changes reported by ``client.watch`` until the test
+            finishes.
+
+            :return: A ``list`` to which each change is appended as a tuple
+                of the unit name and ``Unit`` or ``None``.
+            """
+            changes = []
+            watching = client.watch(lambda *change: changes.append(change))
+            watching.addErrback(lambda reason: reason.trap(CancelledError))
+            self.addCleanup(watching.cancel)
+            return changes
+
+        def test_watch_added(self):
+            """
+            ``watch`` reports a unit which is added, with its image.
+            """
+            client = fixture(self)
+            name = random_name()
+            changes = self.watch(client)
+            self.addCleanup(client.remove, name)
+            d = client.add(name, u"busybox")
+            d.addCallback(lambda _: loop_until(lambda: [
+                unit for unit_name, unit in changes
+                if unit_name == name and unit is not None]))
+            d.addCallback(lambda units: self.assertEqual(
+                units[-1].container_image, u"busybox"))
+            return d
+
+        def test_watch_removed(self):
+            """
+            ``watch`` reports a unit which is removed as ``None``.
+            """
+            client = fixture(self)
+            name = random_name()
+            changes = self.watch(client)
+            # Once the addition has been reported changes are certainly
+            # being followed:
+            d = client.add(name, u"busybox")
+            d.addCallback(lambda _: loop_until(
+                lambda: [change for change in changes if change[0] == name]))
+            d.addCallback(lambda _: client.remove(name))
+            d.addCallback(
+                lambda _: loop_until(lambda: (name, None) in changes))
+            return d
+
     return IDockerClientTests
 
 
@@ -256,6 +332,767 @@ class FakeDockerClientImplementationTests(TestCase):
                               container_image=u'flocker/flocker:v1.0.0')}
         self.assertEqual(units, FakeDockerClient(units=units)._units)
 
+    def test_watch_cancel(self):
+        """
+        Once the ``Deferred`` returned by ``FakeDockerClient.watch`` is
+        cancelled, changes are no longer reported.
+        """
+        client = FakeDockerClient()
+        changes = []
+        watching = client.watch(lambda *change: changes.append(change))
+        watching.cancel()
+        self.failureResultOf(watching, CancelledError)
+        client.add(u"foo", u"busybox")
+        self.assertEqual(changes, [])
+
+
+def _image_key(image_name):
+    """
+    :param unicode image_name: The name of a Docker image.
+
+    :return: The name with the tag Docker assumes if it has none.
+    """
+    if u":" not in image_name.rsplit(u"/", 1)[-1]:
+        image_name += u":latest"
+    return image_name
+
+
+# How many bytes pulling any image downloads from ``FakeDockerServer``:
+PULLED_BYTES = 1000
+
+
+class FakeDockerServer(Resource):
+    """
+    An in-memory imitation of enough of the Docker HTTP API for the
+    Docker clients, to be served over a unix socket.
+
+    Pulling an image always succeeds, downloading ``PULLED_BYTES``.
+    Containers run as soon as they are started and until they are stopped.
+
+    :ivar dict containers: Map container IDs to the ``dict`` describing
+        each container, as returned by inspecting it.
+    :ivar set images: The names of the images which have been pulled.
+    :ivar list requests: ``(method, path)`` tuples, with the API version
+        removed from the path, for each request received.
+    :ivar int stop_failures: How many more times stopping a container fails
+        with ``INTERNAL_SERVER_ERROR``, as when Docker hasn't yet noticed
+        the container's process died.
+    """
+    isLeaf = True
+
+    def __init__(self, images=()):
+        """
+        :param images: The names of the images which have already been
+            pulled.
+        """
+        Resource.__init__(self)
+        self.containers = {}
+        self.images = {_image_key(image) for image in images}
+        self.requests = []
+        self.stop_failures = 0
+        self._ids = count(1)
+        self._event_requests = []
+
+    def _event(self, status, container):
+        """
+        Send an event to everything following the event stream.
+        """
+        event = json.dumps({u"status": status, u"id": container[u"Id"],
+                            u"from": container[u"Config"][u"Image"],
+                            u"time": 0})
+        for request in self._event_requests:
+            request.write(event)
+
+    def _find(self, reference):
+        """
+        :param unicode reference: The ID or name of a container.
+
+        :return: The container's ``dict``, or ``None`` if there is none.
+        """
+        if reference in self.containers:
+            return self.containers[reference]
+        for container in self.containers.values():
+            if container[u"Name"] == u"/" + reference:
+                return container
+        return None
+
+    def _respond(self, request, code, body=None):
+        """
+        Finish a request.
+
+        :param code: The HTTP status code.
+        :param body: An object to send as JSON, or ``None`` for no body.
+        """
+        request.setResponseCode(code)
+        if body is None:
+            return b""
+        request.setHeader(b"content-type", b"application/json")
+        return json.dumps(body)
+
+    def render(self, request):
+        # Remove the API version:
+        path = request.postpath[1:]
+        self.requests.append((request.method, b"/" + b"/".join(path)))
+        body = request.content.read()
+        data = json.loads(body) if body else None
+        if path == [b"events"]:
+            self._event_requests.append(request)
+            request.notifyFinish().addBoth(
+                lambda _: self._event_requests.remove(request))
+            # Make sure the response starts, so the client knows it is
+            # following events:
+            request.write(b"")
+            return NOT_DONE_YET
+        if path == [b"images", b"create"]:
+            image = request.args[b"fromImage"][0].decode("utf-8")
+            if b"tag" in request.args:
+                image += u":" + request.args[b"tag"][0].decode("utf-8")
+            self.images.add(_image_key(image))
+            request.setHeader(b"content-type", b"application/json")
+            return b"".join(json.dumps(progress) for progress in [
+                {u"status": u"Pulling fs layer", u"id": u"abc"},
+                {u"status": u"Downloading", u"id": u"abc",
+                 u"progressDetail": {u"current": PULLED_BYTES // 2,
+                                     u"total": PULLED_BYTES}},
+                {u"status": u"Downloading", u"id": u"abc",
+                 u"progressDetail": {u"current": PULLED_BYTES,
+                                     u"total": PULLED_BYTES}},
+                {u"status": u"Download complete", u"id": u"abc"}])
+        if path[:1] == [b"images"] and path[-1:] == [b"json"]:
+            image = b"/".join(path[1:-1]).decode("utf-8")
+            if _image_key(image) not in self.images:
+                return self._respond(request, NOT_FOUND)
+            return self._respond(request, OK, {u"Id": u"abc"})
+        if path == [b"containers", b"json"]:
+            return self._respond(request, OK, [
+                {u"Id": container[u"Id"], u"Names": [container[u"Name"]],
+                 u"Image": container[u"Config"][u"Image"],
+                 u"Status": (u"Up 1 seconds"
+                             if container[u"State"][u"Running"]
+                             else u"Exited (0) 1 seconds ago")}
+                for container in self.containers.values()])
+        if path == [b"containers", b"create"]:
+            return self._create(request, data)
+        container = self._find(path[1].decode("utf-8"))
+        if container is None:
+            return self._respond(request, NOT_FOUND)
+        action = path[2] if len(path) > 2 else None
+        if request.method == b"DELETE":
+            del self.containers[container[u"Id"]]
+            self._event(u"destroy", container)
+            return self._respond(request, NO_CONTENT)
+        if action == b"json":
+            return self._respond(request, OK, container)
+        if action == b"start":
+            if data is not None:
+                container[u"HostConfig"] = data
+            container[u"State"][u"Running"] = True
+            self._event(u"start", container)
+            return self._respond(request, NO_CONTENT)
+        if action == b"stop":
+            if self.stop_failures:
+                self.stop_failures -= 1
+                return self._respond(request, INTERNAL_SERVER_ERROR)
+            if not container[u"State"][u"Running"]:
+                return self._respond(request, NOT_MODIFIED)
+            container[u"State"][u"Running"] = False
+            self._event(u"die", container)
+            return self._respond(request, NO_CONTENT)
+        return self._respond(request, NOT_FOUND)
+
+    def _create(self, request, config):
+        """
+        Create a container.
+        """
+        name = request.args[b"name"][0].decode("utf-8")
+        if _image_key(config[u"Image"]) not in self.images:
+            return self._respond(request, NOT_FOUND)
+        if self._find(name) is not None:
+            return self._respond(request, CONFLICT)
+        container_id = u"%064x" % (next(self._ids),)
+        host_config = {u"Binds": None, u"PortBindings": None,
+                       u"RestartPolicy": {u"Name": u"",
+                                          u"MaximumRetryCount": 0}}
+        host_config.update(config.get(u"HostConfig") or {})
+        container = self.containers[container_id] = {
+            u"Id": container_id,
+            u"Name": u"/" + name,
+            u"Config": {u"Image": config[u"Image"],
+                        u"Env": config.get(u"Env"),
+                        u"Memory": config.get(u"Memory", 0),
+                        u"CpuShares": config.get(u"CpuShares", 0)},
+            u"HostConfig": host_config,
+            u"State": {u"Running": False},
+        }
+        self._event(u"create", container)
+        return self._respond(request, CREATED, {u"Id": container_id})
+
+
+class _CountingSite(Site):
+    """
+    A ``Site`` which counts the connections made to it.
+    """
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Site.buildProtocol(self, addr)
+
+
+def serve_fake_docker(test):
+    """
+    Serve a new ``FakeDockerServer`` on a unix socket until the test
+    finishes.
+
+    :param TestCase test: The test.
+
+    :return: A ``tuple`` of the ``FakeDockerServer``, the ``_CountingSite``
+        serving it and the ``FilePath`` of the socket.
+    """
+    # Trial's temporary paths can be too long for a unix socket:
+    directory = FilePath(mkdtemp())
+    test.addCleanup(directory.remove)
+    path = directory.child(b"docker.sock")
+    server = FakeDockerServer(images=[u"busybox"])
+    site = _CountingSite(server)
+    port = reactor.listenUNIX(path.path, site)
+    test.addCleanup(port.stopListening)
+    return server, site, path
+
+
+def async_docker_client(test, socket_path):
+    """
+    Create an ``AsyncDockerClient`` whose connections are closed when the
+    test finishes.
+
+    :param TestCase test: The test.
+    :param FilePath socket_path: The Docker server's socket.
+
+    :return: The ``AsyncDockerClient``.
+    """
+    client = AsyncDockerClient(namespace=random_name() + u"--",
+                               socket_path=socket_path)
+    test.addCleanup(client._pool.closeCachedConnections)
+    return client
+
+
+def fake_async_docker_client(test):
+    """
+    Create an ``AsyncDockerClient`` talking to a new ``FakeDockerServer``.
+
+    :param TestCase test: The test.
+
+    :return: The ``AsyncDockerClient``.
+    """
+    server, site, path = serve_fake_docker(test)
+    return async_docker_client(test, path)
+
+
+class AsyncIDockerClientTests(
+        make_idockerclient_tests(fake_async_docker_client)):
+    """
+    ``IDockerClient`` tests for ``AsyncDockerClient`` talking to a
+    ``FakeDockerServer``.
+    """
+
+
+class AsyncDockerClientTests(TestCase):
+    """
+    Tests for how ``AsyncDockerClient`` talks to Docker.
+    """
+    def setUp(self):
+        self.server, self.site, path = serve_fake_docker(self)
+        self.client = async_docker_client(self, path)
+
+    def test_pull(self):
+        """
+        If the image is not present, ``AsyncDockerClient.add`` pulls it and
+        then creates the container.
+        """
+        name = random_name()
+        self.addCleanup(self.client.remove, name)
+        d = self.client.add(name, u"clusterhq/flocker:1.0")
+
+        def added(_):
+            self.assertEqual(
+                ([path for method, path in self.server.requests
+                  if method == b"POST"][:3],
+                 u"clusterhq/flocker:1.0" in self.server.images),
+                ([b"/containers/create", b"/images/create",
+                  b"/containers/create"], True))
+        d.addCallback(added)
+        return d
+
+    @validateLogging(assertHasMessage, IMAGE_PULLED,
+                     {u"image": u"clusterhq/flocker:1.0",
+                      u"bytes": PULLED_BYTES})
+    def test_pull_missing(self, logger):
+        """
+        ``AsyncDockerClient.pull`` pulls an image which isn't present and
+        fires with, and logs, the number of bytes downloaded.
+        """
+        self.client.logger = logger
+        d = self.client.pull(u"clusterhq/flocker:1.0")
+        d.addCallback(lambda downloaded: self.assertEqual(
+            (downloaded, u"clusterhq/flocker:1.0" in self.server.images),
+            (PULLED_BYTES, True)))
+        return d
+
+    @validateLogging(assertHasMessage, IMAGE_PULLED,
+                     {u"image": u"busybox", u"bytes": 0})
+    def test_pull_present(self, logger):
+        """
+        ``AsyncDockerClient.pull`` does not pull an image which is already
+        present.
+        """
+        self.client.logger = logger
+        d = self.client.pull(u"busybox")
+        d.addCallback(lambda _: self.assertNotIn(
+            (b"POST", b"/images/create"), self.server.requests))
+        return d
+
+    def test_api_error(self):
+        """
+        Unexpected error responses from Docker result in ``DockerAPIError``.
+        """
+        self.server.render = lambda request: (
+            request.setResponseCode(418) or b"teapot")
+        d = self.client.list()
+        d = self.assertFailure(d, DockerAPIError)
+        d.addCallback(lambda error: self.assertEqual(
+            (error.code, error.message), (418, b"teapot")))
+        return d
+
+    def test_persistent_connection(self):
+        """
+        Requests one after another share a connection.
+        """
+        d = self.client.exists(u"foo")
+        d.addCallback(lambda _: self.client.exists(u"bar"))
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda _: self.assertEqual(self.site.connections, 1))
+        return d
+
+    def test_stop_retried(self):
+        """
+        If Docker fails to stop a container with ``INTERNAL_SERVER_ERROR``,
+        ``AsyncDockerClient.remove`` tries again after a delay and then
+        removes the container.
+        """
+        self.client._backoff = Backoff(initial=0.001, maximum=0.001,
+                                       timeout=10.0)
+        name = random_name()
+        d = self.client.add(name, u"busybox")
+
+        def added(_):
+            self.server.stop_failures = 2
+            return self.client.remove(name)
+        d.addCallback(added)
+        d.addCallback(lambda _: self.assertEqual(
+            (len([path for method, path in self.server.requests
+                  if path.endswith(b"/stop")]),
+             self.server.containers),
+            (3, {})))
+        return d
+
+    def test_stop_timeout(self):
+        """
+        If Docker keeps failing to stop a container,
+        ``AsyncDockerClient.remove`` fails with ``WaitTimeout`` once the
+        backoff's timeout has passed.
+        """
+        self.client._backoff = Backoff(initial=0.001, maximum=0.001,
+                                       timeout=0.05)
+        name = random_name()
+        d = self.client.add(name, u"busybox")
+
+        def added(_):
+            self.server.stop_failures = 1000000
+            return self.client.remove(name)
+        d.addCallback(added)
+        return self.assertFailure(d, WaitTimeout)
+
+    def test_watch_finished(self):
+        """
+        The ``Deferred`` returned by ``AsyncDockerClient.watch`` fires once
+        Docker finishes the event stream.
+        """
+        watching = self.client.watch(lambda *change: None)
+
+        def started():
+            if self.server._event_requests:
+                return self.server._event_requests[0]
+        d = loop_until(started)
+        d.addCallback(lambda request: request.finish())
+        d.addCallback(lambda _: watching)
+        return d
+
+
+class FakeDockerAPI(object):
+    """
+    Just enough of ``docker.Client`` for ``DockerClient.list`` and
+    ``DockerClient.remove``.
+
+    :ivar dict containers_data: Map container IDs to a ``tuple`` of their
+        names and status, as listed.
+    :ivar list inspected: The IDs of the containers inspected, in order.
+    :ivar list stopped: The names of the containers stop was called for, in
+        order.
+    :ivar list stop_errors: ``APIError``\ s for the next calls to stop to
+        raise.
+    """
+    def __init__(self):
+        self.containers_data = {}
+        self.inspected = []
+        self.stopped = []
+        self.stop_errors = []
+
+    def _find(self, name):
+        """
+        :return: The ID of the container with the given name.
+        """
+        for container_id, (names, status) in self.containers_data.items():
+            if names[0] == u"/" + name:
+                return container_id
+        raise api_error(NOT_FOUND)
+
+    def stop(self, name):
+        self.stopped.append(name)
+        if self.stop_errors:
+            raise self.stop_errors.pop()
+        self._find(name)
+
+    def remove_container(self, name):
+        del self.containers_data[self._find(name)]
+
+    def add(self, container_id, name, status=u"Up 2 seconds"):
+        """
+        Pretend a container exists.
+        """
+        self.containers_data[container_id] = ([u"/" + name], status)
+
+    def containers(self, all=False):
+        return [{u"Id": container_id, u"Names": names, u"Status": status}
+                for container_id, (names, status)
+                in self.containers_data.items()]
+
+    def inspect_container(self, container_id):
+        self.inspected.append(container_id)
+        names, status = self.containers_data[container_id]
+        return {
+            u"Id": container_id,
+            u"Name": names[0],
+            u"State": {u"Running": status.startswith(u"Up")},
+            u"Config": {u"Image": u"busybox", u"CpuShares": 0,
+                        u"Memory": 0},
+            u"HostConfig": {u"PortBindings": None, u"Binds": None,
+                            u"RestartPolicy": {u"Name": u"",
+                                               u"MaximumRetryCount": 0}},
+        }
+
+
+class StatusStateTests(SynchronousTestCase):
+    """
+    Tests for ``_status_state``.
+    """
+    def test_uptime_ignored(self):
+        """
+        How long a container has been in a state is left out.
+        """
+        self.assertEqual(
+            [_status_state(u"Up 5 minutes"),
+             _status_state(u"Up About an hour"),
+             _status_state(u"Exited (0) 2 hours ago"),
+             _status_state(u"Exited (0) 3 seconds ago")],
+            [(u"Up",), (u"Up",), (u"Exited", u"(0)"), (u"Exited", u"(0)")])
+
+    def test_details_kept(self):
+        """
+        Details of the state, e.g. that the container is paused or its exit
+        code, are kept.
+        """
+        self.assertEqual(
+            [_status_state(u"Up 5 minutes (Paused)"),
+             _status_state(u"Exited (137) 2 hours ago"),
+             _status_state(u"")],
+            [(u"Up", u"(Paused)"), (u"Exited", u"(137)"), ()])
+
+
+class PullProgressTests(SynchronousTestCase):
+    """
+    Tests for ``_PullProgress``.
+    """
+    def test_bytes(self):
+        """
+        ``_PullProgress.bytes`` is the total downloaded so far of all the
+        layers.
+        """
+        progress = _PullProgress()
+        for layer, current in [(u"a", 10), (u"b", 5), (u"a", 20)]:
+            progress.received({u"status": u"Downloading", u"id": layer,
+                               u"progressDetail": {u"current": current}})
+        progress.received({u"status": u"Download complete", u"id": u"b"})
+        self.assertEqual((progress.bytes, progress.error), (25, None))
+
+    def test_error(self):
+        """
+        ``_PullProgress.error`` is the error Docker reported.
+        """
+        progress = _PullProgress()
+        progress.received({u"error": u"Not found"})
+        self.assertEqual(progress.error, u"Not found")
+
+
+class BackoffTests(SynchronousTestCase):
+    """
+    Tests for ``Backoff``.
+    """
+    backoff = Backoff(initial=0.5, maximum=3.0, timeout=10.0)
+
+    def test_doubled(self):
+        """
+        Each delay is twice the one before.
+        """
+        self.assertEqual(
+            [self.backoff.delay(polls, 0.0) for polls in (1, 2, 3)],
+            [0.5, 1.0, 2.0])
+
+    def test_maximum(self):
+        """
+        Delays are no longer than the maximum.
+        """
+        self.assertEqual(self.backoff.delay(100, 0.0), 3.0)
+
+    def test_deadline(self):
+        """
+        The last delay ends at the timeout.
+        """
+        self.assertEqual(self.backoff.delay(10, 9.0), 1.0)
+
+    def test_timeout(self):
+        """
+        Once the timeout has passed, ``Backoff.delay`` returns ``None``.
+        """
+        self.assertIs(self.backoff.delay(1, 10.0), None)
+
+
+class WaitTests(SynchronousTestCase):
+    """
+    Tests for ``_wait``.
+    """
+    backoff = Backoff(initial=1.0, maximum=2.0, timeout=6.0)
+
+    @validateLogging(assertHasMessage, WAITED,
+                     {u"condition": u"ready", u"polls": 4,
+                      u"duration": 5.0, u"succeeded": True})
+    def test_polls(self, logger):
+        """
+        ``_wait`` polls with the delays given by the ``Backoff`` until the
+        poll returns ``True``, and logs how many polls it took and how long
+        it lasted.
+        """
+        clock = Clock()
+        results = [False, False, False, True]
+        d = _wait(logger, u"ready", lambda: results.pop(0), self.backoff,
+                  clock)
+        clock.pump([1.0, 2.0, 2.0])
+        self.successResultOf(d)
+
+    @validateLogging(assertHasMessage, WAITED,
+                     {u"condition": u"ready", u"polls": 5,
+                      u"duration": 6.0, u"succeeded": False})
+    def test_timeout(self, logger):
+        """
+        If the poll never returns ``True``, ``_wait`` fails with
+        ``WaitTimeout`` once the timeout has passed.
+        """
+        clock = Clock()
+        d = _wait(logger, u"ready", lambda: False, self.backoff, clock)
+        clock.pump([1.0, 2.0, 2.0, 1.0])
+        self.failureResultOf(d, WaitTimeout)
+
+    def test_poll_error(self):
+        """
+        If a poll fails, ``_wait`` fails the same way.
+        """
+        d = _wait(None, u"ready", lambda: 1 / 0, self.backoff, Clock())
+        self.failureResultOf(d, ZeroDivisionError)
+
+
+class BlockingWaitTests(SynchronousTestCase):
+    """
+    Tests for ``_blocking_wait``.
+    """
+    @validateLogging(assertHasMessage, WAITED,
+                     {u"condition": u"ready", u"polls": 3,
+                      u"succeeded": True})
+    def test_polls(self, logger):
+        """
+        ``_blocking_wait`` polls until the poll returns ``True``, and logs
+        how many polls it took.
+        """
+        results = [False, False, True]
+        _blocking_wait(logger, u"ready", lambda: results.pop(0),
+                       Backoff(initial=0.001, maximum=0.001, timeout=10.0))
+        self.assertEqual(results, [])
+
+    @validateLogging(assertHasMessage, WAITED,
+                     {u"condition": u"ready", u"polls": 1,
+                      u"succeeded": False})
+    def test_timeout(self, logger):
+        """
+        If the poll doesn't return ``True`` before the timeout,
+        ``_blocking_wait`` raises ``WaitTimeout``.
+        """
+        self.assertRaises(
+            WaitTimeout, _blocking_wait, logger, u"ready", lambda: False,
+            Backoff(initial=0.001, maximum=0.001, timeout=0.0))
+
+
+def api_error(code):
+    """
+    :param int code: An HTTP status code.
+
+    :return: An ``APIError`` as raised by ``docker.Client`` for a response
+        with that code.
+    """
+    response = Response()
+    response.status_code = code
+    return APIError("Error", response)
+
+
+class DockerClientRemoveTests(TestCase):
+    """
+    Tests for how ``DockerClient.remove`` talks to Docker.
+    """
+    def setUp(self):
+        self.api = FakeDockerAPI()
+        self.client = DockerClient(
+            namespace=u"ns--",
+            backoff=Backoff(initial=0.001, maximum=0.001, timeout=0.1))
+        self.client._client = self.api
+
+    def test_stop_retried(self):
+        """
+        If Docker fails to stop a container with ``INTERNAL_SERVER_ERROR``,
+        ``DockerClient.remove`` tries again and then removes the container.
+        """
+        self.api.add(u"1", u"ns--foo")
+        self.api.stop_errors = [api_error(INTERNAL_SERVER_ERROR)] * 2
+        d = self.client.remove(u"foo")
+        d.addCallback(lambda _: self.assertEqual(
+            (self.api.stopped, self.api.containers_data),
+            ([u"ns--foo"] * 3, {})))
+        return d
+
+    def test_stop_timeout(self):
+        """
+        If Docker keeps failing to stop a container, ``DockerClient.remove``
+        fails with ``WaitTimeout`` once the backoff's timeout has passed.
+        """
+        self.api.add(u"1", u"ns--foo")
+        self.api.stop_errors = [api_error(INTERNAL_SERVER_ERROR)] * 1000000
+        return self.assertFailure(self.client.remove(u"foo"), WaitTimeout)
+
+
+class DockerClientListTests(TestCase):
+    """
+    Tests for how ``DockerClient.list`` talks to Docker.
+    """
+    def setUp(self):
+        self.api = FakeDockerAPI()
+        self.client = DockerClient(namespace=u"ns--")
+        self.client._client = self.api
+
+    def test_other_namespaces_not_inspected(self):
+        """
+        Containers whose names are not in the client's namespace are not
+        inspected.
+        """
+        self.api.add(u"1", u"ns--foo")
+        self.api.add(u"2", u"other--bar")
+        self.api.add(u"3", u"ns--foo/linked")
+        d = self.client.list()
+
+        def listed(units):
+            self.assertEqual(
+                ([unit.name for unit in units], self.api.inspected),
+                ([u"foo"], [u"1"]))
+        d.addCallback(listed)
+        return d
+
+    def test_unchanged_not_inspected_again(self):
+        """
+        A container whose status has not changed since the last listing is
+        not inspected again.
+        """
+        self.api.add(u"1", u"ns--foo")
+        d = self.client.list()
+        d.addCallback(lambda _: self.client.list())
+
+        def listed(units):
+            self.assertEqual(
+                ([unit.name for unit in units], self.api.inspected),
+                ([u"foo"], [u"1"]))
+        d.addCallback(listed)
+        return d
+
+    def test_uptime_not_inspected_again(self):
+        """
+        A container whose listed status only differs in how long it has been
+        in the same state is not inspected again.
+        """
+        self.api.add(u"1", u"ns--foo", status=u"Up 5 minutes")
+        d = self.client.list()
+
+        def later(_):
+            self.api.add(u"1", u"ns--foo", status=u"Up About an hour")
+            return self.client.list()
+        d.addCallback(later)
+
+        def listed(units):
+            self.assertEqual(
+                ([unit.activation_state for unit in units],
+                 self.api.inspected),
+                ([u"active"], [u"1"]))
+        d.addCallback(listed)
+        return d
+
+    def test_changed_inspected_again(self):
+        """
+        A container whose status has changed since the last listing is
+        inspected again.
+        """
+        self.api.add(u"1", u"ns--foo")
+        d = self.client.list()
+
+        def stopped(_):
+            self.api.add(u"1", u"ns--foo", status=u"Exited (0) 1 second ago")
+            return self.client.list()
+        d.addCallback(stopped)
+
+        def listed(units):
+            self.assertEqual(
+                ([unit.activation_state for unit in units],
+                 self.api.inspected),
+                ([u"inactive"], [u"1", u"1"]))
+        d.addCallback(listed)
+        return d
+
+    def test_removed_during_listing(self):
+        """
+        A container which is removed between being listed and inspected is
+        left out.
+        """
+        self.api.add(u"1", u"ns--foo")
+
+        def removed(container_id):
+            raise api_error(NOT_FOUND)
+        self.api.inspect_container = removed
+        d = self.client.list()
+        d.addCallback(self.assertEqual, set())
+        return d
+
 
 class PortMapInitTests(
         make_with_init_tests(
@@ -5,11 +5,14 @@ Tests for :module:`flocker.node.script`.
 """
 
 from StringIO import StringIO
+from uuid import uuid4
 
 from zope.interface import implementer
 
 from twisted.internet.interfaces import IReactorCore
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactor
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.usage import UsageError
 from twisted.python.filepath import FilePath
@@ -20,15 +23,25 @@ from ...testtools import StandardOptionsTestsMixin
 from ...volume.testtools import make_volume_options_tests
 from ...route import make_memory_network
 
+from .. import script as script_module
 from ..script import (
     ServeOptions, ServeScript,
     ChangeStateOptions, ChangeStateScript,
-    ReportStateOptions, ReportStateScript)
+    ReportStateOptions, ReportStateScript, NodeAgentOptions,
+    NodeAgentScript)
 from .._docker import FakeDockerClient, Unit
-from .._deploy import Deployer
+from .._deploy import (
+    Deployer, DEFAULT_HANDOFF_THRESHOLD, DEFAULT_HANDOFF_BUDGET)
+from .._agent import ConvergenceAgentFactory, DEFAULT_CONVERGENCE_SOCKET
+from .._state import NodeStateCache
 from .._model import Application, Deployment, DockerImage, Node, AttachedVolume
 
 from ...volume.testtools import create_volume_service
+from ...volume.service import VolumeName
+from ...volume._compression import Compression
+from ...volume._agent import (
+    NodeVolumeManager, VolumeAgentFactory, node_volume_manager,
+    DEFAULT_AGENT_SOCKET)
 
 
 class ChangeStateScriptTests(SynchronousTestCase):
@@ -71,9 +84,13 @@ class ChangeStateScriptMainTests(SynchronousTestCase):
         expected_deployment = object()
         expected_current = object()
         expected_hostname = b'node1.example.com'
-        options = dict(deployment=expected_deployment,
-                       current=expected_current,
-                       hostname=expected_hostname)
+        options = {"deployment": expected_deployment,
+                   "current": expected_current,
+                   "hostname": expected_hostname,
+                   "handoff-threshold": 1024,
+                   "handoff-budget": 60.0,
+                   "volume-wait-timeout": None,
+                   "compression": None}
         script.main(
             reactor=object(), options=options, volume_service=Service())
 
@@ -82,6 +99,36 @@ class ChangeStateScriptMainTests(SynchronousTestCase):
             change_node_state_calls
         )
 
+    def test_handoff_options(self):
+        """
+        ``ChangeStateScript.main`` configures the ``Deployer`` with the
+        pre-copy threshold and time budget, the volume wait timeout and the
+        compression supplied on the command line.
+        """
+        script = ChangeStateScript()
+        deployers = []
+
+        def spy_change_node_state(self, desired_state, current_cluster_state,
+                                  hostname):
+            deployers.append(self)
+
+        self.patch(
+            Deployer, 'change_node_state', spy_change_node_state)
+        options = {"deployment": object(),
+                   "current": object(),
+                   "hostname": b'node1.example.com',
+                   "handoff-threshold": 1024,
+                   "handoff-budget": 60.0,
+                   "volume-wait-timeout": 30.0,
+                   "compression": Compression.from_bytes(b"lz4")}
+        script.main(
+            reactor=object(), options=options, volume_service=Service())
+        self.assertEqual(
+            [(deployer.handoff_threshold, deployer.handoff_budget,
+              deployer.volume_wait_timeout, deployer.compression)
+             for deployer in deployers],
+            [(1024, 60.0, 30.0, Compression.from_bytes(b"lz4"))])
+
 
 class StandardChangeStateOptionsTests(
         make_volume_options_tests(
@@ -293,6 +340,104 @@ class ChangeStateOptionsTests(StandardOptionsTestsMixin, SynchronousTestCase):
             (options['hostname'], type(options['hostname']))
         )
 
+    def test_handoff_defaults(self):
+        """
+        By default volumes are handed off once less than 64MiB has changed
+        since the last push, or after five minutes of pushing.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(
+            (options['handoff-threshold'], options['handoff-budget']),
+            (64 * 1024 * 1024, 300.0))
+
+    def test_handoff_options(self):
+        """
+        ``--handoff-threshold`` and ``--handoff-budget`` set the amount of
+        change and the time after which volumes are handed off.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'--handoff-threshold', b'1024',
+             b'--handoff-budget', b'2.5',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(
+            (options['handoff-threshold'], options['handoff-budget']),
+            (1024, 2.5))
+
+    def test_volume_wait_timeout_default(self):
+        """
+        By default there is no limit on how long to wait for a volume.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertIs(options['volume-wait-timeout'], None)
+
+    def test_volume_wait_timeout(self):
+        """
+        ``--volume-wait-timeout`` sets the number of seconds after which to
+        give up waiting for a volume.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'--volume-wait-timeout', b'30',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(options['volume-wait-timeout'], 30.0)
+
+    def test_compression_default(self):
+        """
+        By default volumes are pushed uncompressed.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertIs(options['compression'], None)
+
+    def test_compression(self):
+        """
+        ``--compression`` sets how volumes pushed to other nodes are
+        compressed.
+        """
+        options = self.options()
+        options.parseOptions(
+            [b'--compression', b'zstd:3',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+        self.assertEqual(options['compression'],
+                         Compression.from_bytes(b'zstd:3'))
+
+    def test_compression_unsupported(self):
+        """
+        ``--compression`` with an unsupported algorithm is a usage error.
+        """
+        options = self.options()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b'--compression', b'rar',
+             b'{nodes: {}, version: 1}',
+             b'{applications: {}, version: 1}',
+             b'{}',
+             b'node1.example.com'])
+
     def test_nonascii_hostname(self):
         """
         A ``UsageError`` is raised if the supplied hostname is not ASCII
@@ -405,12 +550,14 @@ from twisted.internet.base import _ThreePhaseEvent
 
 
 @implementer(IReactorCore)
-class MemoryCoreReactor(object):
+class MemoryCoreReactor(MemoryReactor, Clock):
     """
     Just enough of an implementation of IReactorCore to pass to
     ``_main_for_service`` in the unit tests.
     """
     def __init__(self):
+        MemoryReactor.__init__(self)
+        Clock.__init__(self)
         self._triggers = {}
 
     def addSystemEventTrigger(self, phase, eventType, callable, *args, **kw):
@@ -425,6 +572,10 @@ class MemoryCoreReactor(object):
         if event is not None:
             event.fireEvent()
 
+    def spawnProcess(self, *args, **kwargs):
+        # Processes are never actually started by the unit tests.
+        raise NotImplementedError()
+
 
 class AsyncStopService(Service):
     """
@@ -450,10 +601,21 @@ class ServeScriptMainTests(SynchronousTestCase):
     def setUp(self):
         self.reactor = MemoryCoreReactor()
         self.service = Service()
-        self.script = ServeScript()
-
-    def main(self, reactor, service):
-        return self.script.main(reactor, {}, service)
+        self.docker_client = FakeDockerClient()
+        self.network = make_memory_network()
+        self.script = ServeScript(self.docker_client, self.network)
+        sockets = FilePath(self.mktemp())
+        self.agent_socket = sockets.child(b"volume.sock")
+        self.convergence_socket = sockets.child(b"convergence.sock")
+
+    def main(self, reactor, service, arguments=()):
+        options = ServeOptions()
+        # Keep the sockets out of the real /var/run/flocker:
+        options.parseOptions(
+            [b"--agent-socket", self.agent_socket.path,
+             b"--convergence-socket", self.convergence_socket.path] +
+            list(arguments))
+        return self.script.main(reactor, options, service)
 
     def _shutdown_reactor(self, reactor):
         """
@@ -518,9 +680,314 @@ class ServeScriptMainTests(SynchronousTestCase):
         async.callback(None)
         self.assertIs(None, self.successResultOf(result))
 
+    def _snapshotted_volume(self, service, count):
+        """
+        Create a volume and take some push snapshots of it.
+
+        :param VolumeService service: The service to create the volume with.
+        :param int count: The number of snapshots to take.
+
+        :return: The volume's ``IFilesystem``.
+        """
+        volume = self.successResultOf(
+            service.create(service.get(
+                VolumeName(namespace=u"default", id=u"myvol"))))
+        filesystem = volume.get_filesystem()
+        for i in range(count):
+            filesystem.snapshot(bytes(uuid4()))
+        return filesystem
+
+    def test_prunes_snapshots(self):
+        """
+        ``ServeScript.main`` starts a ``SnapshotRetentionService`` which
+        destroys unneeded snapshots after the configured interval, keeping
+        the configured number of the newest snapshots.
+        """
+        service = create_volume_service(self)
+        filesystem = self._snapshotted_volume(service, 3)
+        self.main(self.reactor, service,
+                  [b"--snapshot-retention", b"1",
+                   b"--snapshot-retention-interval", b"10"])
+        self.reactor.advance(10)
+        self.assertEqual(
+            len(self.successResultOf(filesystem.snapshots())), 1)
+
+    def test_stops_pruning(self):
+        """
+        When the reactor is stopped, ``ServeScript.main`` stops destroying
+        snapshots.
+        """
+        service = create_volume_service(self)
+        filesystem = self._snapshotted_volume(service, 3)
+        self.main(self.reactor, service,
+                  [b"--snapshot-retention", b"1",
+                   b"--snapshot-retention-interval", b"10"])
+        self._shutdown_reactor(self.reactor)
+        self.reactor.advance(10)
+        self.assertEqual(
+            len(self.successResultOf(filesystem.snapshots())), 3)
+
+    def test_replicates(self):
+        """
+        ``ServeScript.main`` starts replicating each volume given with
+        ``--replicate`` to the given node, with the configured interval,
+        rate and compression.
+        """
+        service = create_volume_service(self)
+        self.patch(service, "push", lambda *args, **kwargs: Deferred())
+        self.main(self.reactor, service,
+                  [b"--replicate", b"default.myvol:192.0.2.2",
+                   b"--replication-interval", b"5",
+                   b"--replication-rate", b"1000",
+                   b"--compression", b"lz4"])
+        name = VolumeName(namespace=u"default", id=u"myvol")
+        replication = service.replications[(name, b"192.0.2.2")]
+        destination = replication.destination
+        expected = node_volume_manager(self.reactor, b"192.0.2.2")
+        self.assertEqual(
+            (type(destination), destination._agent._endpoint._args,
+             destination._remote, replication.interval,
+             replication._rate_limit, replication._compression),
+            (NodeVolumeManager, expected._agent._endpoint._args,
+             expected._remote, 5, 1000, Compression.from_bytes(b"lz4")))
+
+    def test_agent(self):
+        """
+        ``ServeScript.main`` answers volume requests from other nodes on the
+        agent socket, which only root can connect to.
+        """
+        service = create_volume_service(self)
+        self.main(self.reactor, service)
+        [(factory, mode)] = [
+            (factory, mode)
+            for (path, factory, _, mode, _) in self.reactor.unixServers
+            if path == self.agent_socket.path]
+        self.assertEqual(
+            (factory.__class__, factory._service, mode),
+            (VolumeAgentFactory, service, 0o600))
+
+    def _convergence_agent(self, service, arguments=()):
+        """
+        Run the script and find the convergence agent it answers requests
+        with on the convergence socket.
+
+        :param VolumeService service: The volume service to run with.
+        :param arguments: Extra command line arguments.
+
+        :return: A ``tuple`` of the ``ConvergenceAgent`` and the mode of the
+            socket it is listening on.
+        """
+        self.main(self.reactor, service, arguments)
+        [(factory, mode)] = [
+            (factory, mode)
+            for (path, factory, _, mode, _) in self.reactor.unixServers
+            if path == self.convergence_socket.path]
+        self.assertIsInstance(factory, ConvergenceAgentFactory)
+        return factory._agent, mode
+
+    def test_convergence_agent(self):
+        """
+        ``ServeScript.main`` answers requests to report or change the node's
+        state on the convergence socket, which only root can connect to,
+        using a ``Deployer`` with the script's Docker client and network and
+        the deployment options given on the command line.
+        """
+        service = create_volume_service(self)
+        agent, mode = self._convergence_agent(
+            service, [b"--handoff-threshold", b"1024",
+                      b"--handoff-budget", b"60",
+                      b"--volume-wait-timeout", b"30",
+                      b"--compression", b"lz4"])
+        deployer = agent.deployer
+        self.assertEqual(
+            (mode, deployer.volume_service, deployer.docker_client,
+             deployer.network, deployer.reactor, deployer.handoff_threshold,
+             deployer.handoff_budget, deployer.volume_wait_timeout,
+             deployer.compression),
+            (0o600, service, self.docker_client, self.network,
+             self.reactor, 1024, 60.0, 30.0, Compression.from_bytes(b"lz4")))
+
+    def test_node_state_cache(self):
+        """
+        The convergence agent's ``Deployer`` takes the node's state from a
+        ``NodeStateCache`` which runs until the reactor is stopped.
+        """
+        agent, _ = self._convergence_agent(create_volume_service(self))
+        cache = agent.deployer.node_state_cache
+        running = cache.running
+        self._shutdown_reactor(self.reactor)
+        self.assertEqual(
+            (cache.__class__, cache.docker_client, running, cache.running),
+            (NodeStateCache, self.docker_client, True, False))
+
+    def test_closes_ssh_connections(self):
+        """
+        When the reactor has stopped, ``ServeScript.main`` closes the shared
+        SSH connections to other nodes.
+        """
+        closed = []
+        self.patch(script_module.SSH_CONNECTIONS, "close",
+                   lambda: closed.append(True))
+        self.main(self.reactor, create_volume_service(self))
+        self._shutdown_reactor(self.reactor)
+        self.assertEqual(closed, [True])
+
+
+class ServeOptionsTests(SynchronousTestCase):
+    """
+    Tests for the snapshot retention, replication and convergence arguments
+    of ``ServeOptions``.
+    """
+    def test_convergence_defaults(self):
+        """
+        By default the convergence agent listens on the socket which
+        ``flocker-node-agent`` relays to and volumes are handed off as by
+        ``flocker-changestate``.
+        """
+        options = ServeOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (options["convergence-socket"], options["handoff-threshold"],
+             options["handoff-budget"], options["volume-wait-timeout"]),
+            (DEFAULT_CONVERGENCE_SOCKET.path, DEFAULT_HANDOFF_THRESHOLD,
+             DEFAULT_HANDOFF_BUDGET, None))
+
+    def test_agent_socket_default(self):
+        """
+        By default the volume agent listens on the socket which
+        ``flocker-volume agent`` relays to.
+        """
+        options = ServeOptions()
+        options.parseOptions([])
+        self.assertEqual(options["agent-socket"], DEFAULT_AGENT_SOCKET.path)
+
+    def test_retention_defaults(self):
+        """
+        By default five snapshots are kept and snapshots are pruned hourly.
+        """
+        options = ServeOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (options["snapshot-retention"],
+             options["snapshot-retention-interval"]),
+            (5, 3600))
+
+    def test_retention(self):
+        """
+        ``--snapshot-retention`` and ``--snapshot-retention-interval`` set
+        the number of snapshots kept and the interval between prunings.
+        """
+        options = ServeOptions()
+        options.parseOptions([b"--snapshot-retention", b"2",
+                              b"--snapshot-retention-interval", b"1.5"])
+        self.assertEqual(
+            (options["snapshot-retention"],
+             options["snapshot-retention-interval"]),
+            (2, 1.5))
+
+    def test_retention_not_integer(self):
+        """
+        A ``UsageError`` is raised if ``--snapshot-retention`` is not an
+        integer.
+        """
+        options = ServeOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--snapshot-retention", b"lots"])
+
+    def test_replication_defaults(self):
+        """
+        By default no volumes are replicated, replicated volumes are pushed
+        every 10 seconds and the rate is unlimited.
+        """
+        options = ServeOptions()
+        options.parseOptions([])
+        self.assertEqual(
+            (options["replicate"], options["replication-interval"],
+             options["replication-rate"]),
+            ([], 10, None))
+
+    def test_replicate(self):
+        """
+        ``--replicate`` may be given several times, each naming a volume and
+        the node to replicate it to.
+        """
+        options = ServeOptions()
+        options.parseOptions([b"--replicate", b"default.a:node1",
+                              b"--replicate", b"default.b:node2"])
+        self.assertEqual(
+            options["replicate"],
+            [(VolumeName(namespace=u"default", id=u"a"), b"node1"),
+             (VolumeName(namespace=u"default", id=u"b"), b"node2")])
+
+    def test_replicate_no_hostname(self):
+        """
+        A ``UsageError`` is raised if ``--replicate`` does not include a
+        hostname.
+        """
+        options = ServeOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--replicate", b"default.a"])
+
+    def test_replicate_bad_volume(self):
+        """
+        A ``UsageError`` is raised if the volume name given to
+        ``--replicate`` is invalid.
+        """
+        options = ServeOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          [b"--replicate", b"nonamespace:node1"])
+
 
 class StandardServeOptionsTests(
         make_volume_options_tests(ServeOptions)):
     """
     Tests for the volume configuration arguments of ``ServeOptions``.
     """
+
+
+class NodeAgentOptionsTests(StandardOptionsTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``NodeAgentOptions``.
+    """
+    options = NodeAgentOptions
+
+    def test_default_socket(self):
+        """
+        By default ``flocker-node-agent`` relays to the socket the
+        convergence agent listens on by default.
+        """
+        options = self.options()
+        options.parseOptions([])
+        self.assertEqual(options["socket"], DEFAULT_CONVERGENCE_SOCKET.path)
+
+    def test_socket(self):
+        """
+        ``--socket`` sets the path of the socket relayed to.
+        """
+        options = self.options()
+        options.parseOptions([b"--socket", b"/tmp/convergence.sock"])
+        self.assertEqual(options["socket"], b"/tmp/convergence.sock")
+
+
+class NodeAgentScriptTests(SynchronousTestCase):
+    """
+    Tests for ``NodeAgentScript``.
+    """
+    def test_relays(self):
+        """
+        ``NodeAgentScript.main`` relays standard in and out to the given
+        socket, and finishes when the relay does.
+        """
+        relays = []
+        relayed = Deferred()
+
+        def relay_stdio(reactor, endpoint):
+            relays.append((reactor, endpoint._path))
+            return relayed
+        self.patch(script_module, "relay_stdio", relay_stdio)
+        reactor = MemoryReactor()
+        options = NodeAgentOptions()
+        options.parseOptions([b"--socket", b"/tmp/convergence.sock"])
+        result = NodeAgentScript().main(reactor, options)
+        self.assertEqual(relays, [(reactor, b"/tmp/convergence.sock")])
+        self.assertIs(result, relayed)
@@ -0,0 +1,304 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.node._state`.
+"""
+
+from zope.interface.verify import verifyObject
+
+from twisted.application.service import IService
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._state import NodeStateCache, DEFAULT_RECONCILE_INTERVAL
+from .._deploy import Deployer, SetProxies, _to_volume_name
+from .._docker import FakeDockerClient, Unit, Volume as DockerVolume
+from .._model import Application, AttachedVolume, DockerImage, NodeState
+from ...route import Proxy, make_memory_network
+from ...volume.testtools import create_volume_service
+
+
+def make_unit(name, activation_state=u"active"):
+    """
+    :return: A ``Unit`` with the given name.
+    """
+    return Unit(name=name, container_name=name,
+                container_image=u"clusterhq/wordpress:latest",
+                activation_state=activation_state)
+
+
+def make_application(unit):
+    """
+    :return: The ``Application`` discovered from a ``Unit`` made by
+        ``make_unit``.
+    """
+    return Application(name=unit.name,
+                       image=DockerImage.from_string(unit.container_image))
+
+
+class NodeStateCacheTests(SynchronousTestCase):
+    """
+    Tests for ``NodeStateCache``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.volume_service = create_volume_service(self)
+        self.docker_client = FakeDockerClient()
+        self.network = make_memory_network(used_ports=frozenset([22]))
+
+    def start_cache(self):
+        """
+        Start a ``NodeStateCache`` for the test's node.
+
+        :return: The started ``NodeStateCache``.
+        """
+        cache = NodeStateCache(self.volume_service, self.docker_client,
+                               self.network, self.clock)
+        cache.startService()
+        self.addCleanup(cache.stopService)
+        return cache
+
+    def test_interface(self):
+        """
+        ``NodeStateCache`` provides ``IService``.
+        """
+        self.assertTrue(verifyObject(IService, NodeStateCache(
+            self.volume_service, self.docker_client, self.network,
+            self.clock)))
+
+    def test_discovered_at_start(self):
+        """
+        The state of the node is discovered when the cache starts, the same
+        as by ``Deployer.discover_node_configuration``.
+        """
+        unit = make_unit(u"site-example.com")
+        self.docker_client._units[unit.name] = unit
+        self.network.create_proxy_to(u"192.0.2.1", 80)
+        deployer = Deployer(self.volume_service, self.docker_client,
+                            self.network)
+        expected = self.successResultOf(
+            deployer.discover_node_configuration())
+        snapshot = self.start_cache().snapshot()
+        self.assertEqual(
+            (snapshot.node_state, snapshot.proxies),
+            (expected, frozenset([Proxy(ip=u"192.0.2.1", port=80)])))
+
+    def test_same_snapshot(self):
+        """
+        ``NodeStateCache.snapshot`` returns the same snapshot again, without
+        rediscovering anything, while the state has not changed.
+        """
+        cache = self.start_cache()
+        first = cache.snapshot()
+        self.patch(self.docker_client, "list", lambda: self.fail("Listed"))
+        self.assertIs(cache.snapshot(), first)
+
+    def test_unit_added(self):
+        """
+        A unit added to Docker is in the next snapshot, which has a higher
+        version.
+        """
+        cache = self.start_cache()
+        before = cache.snapshot()
+        unit = make_unit(u"site-example.com")
+        self.docker_client.add(unit.name, unit.container_image)
+        after = cache.snapshot()
+        self.assertEqual(
+            (after.node_state.running, after.version > before.version),
+            ([make_application(unit)], True))
+
+    def test_unit_removed(self):
+        """
+        A unit removed from Docker is not in the next snapshot.
+        """
+        unit = make_unit(u"site-example.com")
+        self.docker_client._units[unit.name] = unit
+        cache = self.start_cache()
+        self.docker_client.remove(unit.name)
+        self.assertEqual(cache.snapshot().node_state,
+                         NodeState(running=[], not_running=[],
+                                   used_ports=frozenset([22])))
+
+    def test_volume_changed(self):
+        """
+        A volume created by the volume manager is in the next snapshot.
+        """
+        unit = Unit(name=u"site-example.com",
+                    container_name=u"site-example.com",
+                    container_image=u"clusterhq/wordpress:latest",
+                    volumes=frozenset([DockerVolume(
+                        node_path=FilePath(b"/tmp/volume1"),
+                        container_path=FilePath(b"/var/lib/data"))]),
+                    activation_state=u"active")
+        self.docker_client._units[unit.name] = unit
+        cache = self.start_cache()
+        before = cache.snapshot()
+        self.successResultOf(self.volume_service.create(
+            self.volume_service.get(_to_volume_name(unit.name))))
+        after = cache.snapshot()
+        self.assertEqual(
+            ([app.volume for app in before.node_state.running],
+             [app.volume for app in after.node_state.running],
+             after.version > before.version),
+            ([None],
+             [AttachedVolume(name=unit.name,
+                             mountpoint=FilePath(b"/var/lib/data"))],
+             True))
+
+    def test_proxies_changed(self):
+        """
+        After ``NodeStateCache.proxies_changed`` is called the snapshot has
+        the new proxies.
+        """
+        cache = self.start_cache()
+        proxy = self.network.create_proxy_to(u"192.0.2.1", 80)
+        before = cache.snapshot().proxies
+        cache.proxies_changed()
+        self.assertEqual((before, cache.snapshot().proxies),
+                         (frozenset(), frozenset([proxy])))
+
+    def test_reconcile(self):
+        """
+        Changes which were not reported are found when the whole state is
+        rediscovered, after ``DEFAULT_RECONCILE_INTERVAL``.
+        """
+        cache = self.start_cache()
+        unit = make_unit(u"site-example.com")
+        self.docker_client._units[unit.name] = unit
+        self.network._used_ports = frozenset([22, 80])
+        before = cache.snapshot().node_state
+        self.clock.advance(DEFAULT_RECONCILE_INTERVAL)
+        self.assertEqual(
+            (before, cache.snapshot().node_state),
+            (NodeState(running=[], not_running=[],
+                       used_ports=frozenset([22])),
+             NodeState(running=[make_application(unit)], not_running=[],
+                       used_ports=frozenset([22, 80]))))
+
+    def test_reconcile_unchanged(self):
+        """
+        Rediscovering the same state does not change the version.
+        """
+        cache = self.start_cache()
+        before = cache.snapshot()
+        self.clock.advance(DEFAULT_RECONCILE_INTERVAL)
+        self.assertIs(cache.snapshot(), before)
+
+    def test_change_during_reconcile(self):
+        """
+        A change reported while the whole state is being rediscovered is not
+        undone by the older listing.
+        """
+        cache = self.start_cache()
+        listing = Deferred()
+        self.patch(self.docker_client, "list", lambda: listing)
+        self.clock.advance(DEFAULT_RECONCILE_INTERVAL)
+        unit = make_unit(u"site-example.com")
+        self.docker_client.add(unit.name, unit.container_image)
+        listing.callback(set())
+        self.assertEqual(cache.snapshot().node_state.running,
+                         [make_application(unit)])
+
+    def test_stop(self):
+        """
+        Once the cache is stopped, changes are no longer followed.
+        """
+        cache = self.start_cache()
+        cache.stopService()
+        self.docker_client.add(u"site-example.com", u"busybox")
+        self.assertEqual(cache.snapshot().node_state.running, [])
+
+    def test_reconcile_exception(self):
+        """
+        If rediscovering the state raises an exception, later rediscoveries
+        still happen.
+        """
+        self.patch(self.docker_client, "list", lambda: 1 / 0)
+        cache = self.start_cache()
+        unit = make_unit(u"site-example.com")
+        self.docker_client._units[unit.name] = unit
+        self.patch(self.docker_client, "list",
+                   lambda: succeed({unit}))
+        self.clock.advance(DEFAULT_RECONCILE_INTERVAL)
+        self.assertEqual(cache.snapshot().node_state.running,
+                         [make_application(unit)])
+
+    def test_watch_restarted(self):
+        """
+        If Docker stops reporting changes, they are followed again from the
+        next rediscovery.
+        """
+        watches = []
+
+        def watch(callback):
+            watches.append(callback)
+            return succeed(None)
+        self.patch(self.docker_client, "watch", watch)
+        self.start_cache()
+        self.clock.advance(DEFAULT_RECONCILE_INTERVAL)
+        self.assertEqual(len(watches), 2)
+
+
+class DeployerNodeStateCacheTests(SynchronousTestCase):
+    """
+    Tests for ``Deployer`` with a ``NodeStateCache``.
+    """
+    def setUp(self):
+        self.volume_service = create_volume_service(self)
+        self.docker_client = FakeDockerClient()
+        self.network = make_memory_network()
+        self.cache = NodeStateCache(self.volume_service, self.docker_client,
+                                    self.network, Clock())
+        self.deployer = Deployer(self.volume_service, self.docker_client,
+                                 self.network, node_state_cache=self.cache)
+
+    def test_discover_from_cache(self):
+        """
+        While the cache is running, ``Deployer.discover_node_configuration``
+        returns its ``NodeState`` without listing the containers.
+        """
+        self.cache.startService()
+        self.addCleanup(self.cache.stopService)
+        self.patch(self.docker_client, "list", lambda: self.fail("Listed"))
+        self.assertIs(
+            self.successResultOf(self.deployer.discover_node_configuration()),
+            self.cache.snapshot().node_state)
+
+    def test_discover_not_running(self):
+        """
+        While the cache is not running,
+        ``Deployer.discover_node_configuration`` discovers the state from
+        scratch.
+        """
+        unit = make_unit(u"site-example.com")
+        self.docker_client._units[unit.name] = unit
+        self.assertEqual(
+            self.successResultOf(self.deployer.discover_node_configuration()),
+            NodeState(running=[make_application(unit)], not_running=[]))
+
+    def test_set_proxies(self):
+        """
+        ``SetProxies`` tells the cache the proxies have changed.
+        """
+        self.cache.startService()
+        self.addCleanup(self.cache.stopService)
+        proxy = Proxy(ip=u"192.0.2.1", port=80)
+        self.successResultOf(SetProxies(ports=[proxy]).run(self.deployer))
+        self.assertEqual(self.cache.snapshot().proxies, frozenset([proxy]))
+
+    def test_set_proxies_cached(self):
+        """
+        While the cache is running, ``SetProxies`` compares the required
+        proxies with the cached ones rather than listing them again.
+        """
+        self.cache.startService()
+        self.addCleanup(self.cache.stopService)
+        proxy = Proxy(ip=u"192.0.2.1", port=80)
+        self.successResultOf(SetProxies(ports=[proxy]).run(self.deployer))
+        self.patch(self.network, "enumerate_proxies",
+                   lambda: self.fail("Listed"))
+        self.patch(self.network, "create_proxy_to",
+                   lambda ip, port: self.fail("Created"))
+        self.successResultOf(SetProxies(ports=[proxy]).run(self.deployer))
@@ -49,17 +49,44 @@ from .common.script import (
 @implementer(IProcessTransport)
 class FakeProcessTransport(object):
     """
-    Mock process transport to observe signals sent to a process.
+    Mock process transport to observe signals sent to a process and the
+    process's standard input.
 
     @ivar signals: L{list} of signals sent to process.
+    @ivar written: L{list} of L{bytes} written to the process.
+    @ivar stdin_closed: Whether the process's standard input was closed.
+    @ivar producer: The producer registered with the transport, or L{None}.
+    @ivar paused: Whether reading from the process is paused.
     """
 
     def __init__(self):
         self.signals = []
+        self.written = []
+        self.stdin_closed = False
+        self.producer = None
+        self.paused = False
 
     def signalProcess(self, signal):
         self.signals.append(signal)
 
+    def write(self, data):
+        self.written.append(data)
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
 
 class SpawnProcessArguments(namedtuple(
                             'ProcessData',
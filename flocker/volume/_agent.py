@@ -0,0 +1,621 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_agent -*-
+
+"""
+A resident volume manager agent, and a client for it.
+
+``RemoteVolumeManager`` starts a new ``flocker-volume`` process for every
+operation, which pays for starting Python and the volume service each time.
+The agent instead runs inside ``flocker-serve`` and answers AMP requests for
+the same operations over a single long-lived connection.  Volume data is
+sent as a sequence of chunk requests so that several operations can share
+the connection.
+
+The agent only listens on a UNIX socket which only root can connect to,
+since whoever can talk to it can overwrite or take ownership of volumes.
+Other nodes reach it by running ``flocker-volume agent`` over SSH, which
+relays the connection to the socket, so they are authenticated the same way
+as for ``RemoteVolumeManager``.
+
+Cutting volume data into chunk requests costs more than running
+``flocker-volume receive`` directly, which a push can splice its stream into
+without copying it through Python.  ``NodeVolumeManager`` therefore sends
+requests to the agent but volume data over SSH.
+"""
+
+from itertools import count
+
+from zope.interface import implementer
+
+from twisted.internet.defer import Deferred, succeed, gatherResults
+from twisted.internet.endpoints import connectProtocol
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.amp import (
+    AMP, Argument, Boolean, Command, Integer, ListOf, String, Unicode,
+)
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+
+from ..common import IStreamConsumer, FinishingConsumer
+from ._compression import Compression, available_algorithms
+from ._ipc import (
+    IRemoteVolumeManager, RemoteVolumeManager, ReceiveState,
+    query_receive_state, standard_node,
+)
+from .filesystems.zfs import Snapshot
+from .service import Volume, VolumeName
+
+
+# The socket the agent listens on:
+DEFAULT_AGENT_SOCKET = FilePath(b"/var/run/flocker/volume-agent.sock")
+
+# Volume data is sent in chunks that fit in a single AMP value.
+CHUNK_SIZE = 60 * 1024
+
+# The number of chunks a client sends before waiting for the agent to have
+# written the earliest one to the volume.
+WINDOW = 16
+
+
+class _VolumeNameArgument(Argument):
+    """
+    An AMP argument for a ``VolumeName``.
+    """
+    def toString(self, name):
+        return name.to_bytes()
+
+    def fromString(self, data):
+        return VolumeName.from_bytes(data)
+
+
+class _SnapshotArgument(Argument):
+    """
+    An AMP argument for a ``Snapshot``.
+    """
+    def toString(self, snapshot):
+        return snapshot.to_bytes()
+
+    def fromString(self, data):
+        return Snapshot.from_bytes(data)
+
+
+class _CompressionArgument(Argument):
+    """
+    An AMP argument for a ``Compression``.
+    """
+    def toString(self, compression):
+        return compression.to_bytes()
+
+    def fromString(self, data):
+        return Compression.from_bytes(data)
+
+
+class Snapshots(Command):
+    """
+    Get the snapshots of a volume, oldest first.
+    """
+    arguments = [(b"uuid", Unicode()), (b"name", _VolumeNameArgument())]
+    response = [(b"snapshots", ListOf(_SnapshotArgument()))]
+
+
+class GetReceiveState(Command):
+    """
+    Get the snapshots of a volume, oldest first, and the token for resuming
+    an interrupted receive of it.
+    """
+    arguments = [(b"uuid", Unicode()), (b"name", _VolumeNameArgument())]
+    response = [(b"snapshots", ListOf(_SnapshotArgument())),
+                (b"resume_token", String(optional=True))]
+
+
+class StartReceive(Command):
+    """
+    Start receiving a volume's data, sent by ``ReceiveChunk`` requests.  If
+    ``acquire`` is true the volume is acquired once it has been updated.
+    """
+    arguments = [(b"uuid", Unicode()), (b"name", _VolumeNameArgument()),
+                 (b"compression", _CompressionArgument(optional=True)),
+                 (b"acquire", Boolean(optional=True))]
+    response = [(b"stream", Integer())]
+    errors = {ValueError: b"VALUE_ERROR"}
+
+
+class ReceiveChunk(Command):
+    """
+    Write part of a volume's data.  The answer is sent once the agent is
+    ready for more data.
+    """
+    arguments = [(b"stream", Integer()), (b"data", String())]
+    response = []
+
+
+class FinishReceive(Command):
+    """
+    Indicate that all of a volume's data has been sent.  The answer is sent
+    once the volume has been updated, and acquired if that was asked for, in
+    which case it includes the agent's UUID.
+    """
+    arguments = [(b"stream", Integer())]
+    response = [(b"uuid", Unicode(optional=True))]
+    errors = {IOError: b"IO_ERROR"}
+
+
+class Acquire(Command):
+    """
+    Take ownership of a volume.
+    """
+    arguments = [(b"uuid", Unicode()), (b"name", _VolumeNameArgument())]
+    response = [(b"uuid", Unicode())]
+    errors = {ValueError: b"VALUE_ERROR"}
+
+
+class CloneTo(Command):
+    """
+    Clone a volume to a new volume.
+    """
+    arguments = [(b"uuid", Unicode()), (b"name", _VolumeNameArgument()),
+                 (b"clone", _VolumeNameArgument())]
+    response = []
+
+
+class Compressions(Command):
+    """
+    Get the compression algorithms the agent can decompress.
+    """
+    arguments = []
+    response = [(b"algorithms", ListOf(String()))]
+
+
+@implementer(IPushProducer)
+class _IncomingStream(object):
+    """
+    Write the data sent by ``ReceiveChunk`` requests to a consumer, delaying
+    the answers while the consumer is paused.
+
+    :ivar IStreamConsumer consumer: The consumer the data is written to.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self._waiting = None
+        consumer.registerProducer(self, True)
+
+    def pauseProducing(self):
+        if self._waiting is None:
+            self._waiting = []
+
+    def resumeProducing(self):
+        waiting, self._waiting = self._waiting, None
+        for d in waiting or ():
+            d.callback(None)
+
+    def stopProducing(self):
+        pass
+
+    def write(self, data):
+        """
+        :return: ``Deferred`` that fires once the consumer is ready for more
+            data.
+        """
+        self.consumer.write(data)
+        if self._waiting is None:
+            return succeed(None)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def finish(self):
+        """
+        :return: The result of finishing the consumer.
+        """
+        self.resumeProducing()
+        self.consumer.unregisterProducer()
+        return self.consumer.finish()
+
+
+class VolumeAgent(AMP):
+    """
+    Answer requests from other nodes' ``AgentVolumeManager``\\ s using a
+    ``VolumeService``.
+    """
+    def __init__(self, volume_service):
+        """
+        :param VolumeService volume_service: The service to manage volumes
+            with.
+        """
+        AMP.__init__(self)
+        self._service = volume_service
+        self._streams = {}
+        self._stream_ids = count()
+
+    def _volume(self, uuid, name):
+        return Volume(uuid=uuid, name=name, service=self._service)
+
+    @Snapshots.responder
+    def snapshots(self, uuid, name):
+        d = self._volume(uuid, name).get_filesystem().snapshots()
+        d.addCallback(lambda snapshots: {"snapshots": snapshots})
+        return d
+
+    @GetReceiveState.responder
+    def receive_state(self, uuid, name):
+        d = query_receive_state(self._volume(uuid, name).get_filesystem())
+        d.addCallback(lambda state: {"snapshots": state.snapshots,
+                                     "resume_token": state.resume_token})
+        return d
+
+    @StartReceive.responder
+    def start_receive(self, uuid, name, compression, acquire):
+        if acquire:
+            d = self._service.receive_and_acquire_stream(
+                uuid, name, compression)
+        else:
+            d = self._service.receive_stream(uuid, name, compression)
+            # Only an acquiring stream has a UUID to answer with:
+            d.addCallback(
+                lambda consumer: FinishingConsumer(consumer, lambda _: None))
+
+        def receiving(consumer):
+            stream = next(self._stream_ids)
+            self._streams[stream] = _IncomingStream(consumer)
+            return {"stream": stream}
+        d.addCallback(receiving)
+        return d
+
+    @ReceiveChunk.responder
+    def receive_chunk(self, stream, data):
+        d = self._streams[stream].write(data)
+        d.addCallback(lambda _: {})
+        return d
+
+    @FinishReceive.responder
+    def finish_receive(self, stream):
+        d = self._streams.pop(stream).finish()
+
+        def failed(reason):
+            raise IOError("Receive failed", reason.getErrorMessage())
+        d.addCallbacks(lambda uuid: {"uuid": uuid}, failed)
+        return d
+
+    @Compressions.responder
+    def compressions(self):
+        return {"algorithms": available_algorithms()}
+
+    @Acquire.responder
+    def acquire(self, uuid, name):
+        d = self._service.acquire(uuid, name)
+        d.addCallback(lambda _: {"uuid": self._service.uuid})
+        return d
+
+    @CloneTo.responder
+    def clone_to(self, uuid, name, clone):
+        d = self._service.clone_to(self._volume(uuid, name), clone)
+        d.addCallback(lambda _: {})
+        return d
+
+    def connectionLost(self, reason):
+        # Let anything still receiving data know that there is no more, so
+        # that, for example, ``zfs receive`` saves a resume token and exits.
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.finish().addErrback(lambda _: None)
+        AMP.connectionLost(self, reason)
+
+
+class VolumeAgentFactory(ServerFactory):
+    """
+    Create a ``VolumeAgent`` for each connection.
+    """
+    def __init__(self, volume_service):
+        """
+        :param VolumeService volume_service: See ``VolumeAgent.__init__``.
+        """
+        self._service = volume_service
+
+    def buildProtocol(self, addr):
+        return VolumeAgent(self._service)
+
+
+@implementer(IStreamConsumer)
+class _OutgoingStream(object):
+    """
+    Send a volume's data to an agent as ``ReceiveChunk`` requests.
+
+    At most ``WINDOW`` requests are outstanding at once; beyond that the
+    producer is paused until the agent catches up.
+    """
+    def __init__(self, protocol, stream):
+        """
+        :param AMP protocol: The connection to the agent.
+        :param int stream: The identifier the agent gave the stream.
+        """
+        self._protocol = protocol
+        self._stream = stream
+        self._producer = None
+        self._paused = False
+        self._outstanding = 0
+        self._idle = []
+        self._failure = None
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def write(self, data):
+        for offset in range(0, len(data), CHUNK_SIZE):
+            self._send(data[offset:offset + CHUNK_SIZE])
+
+    def _send(self, chunk):
+        self._outstanding += 1
+        d = self._protocol.callRemote(
+            ReceiveChunk, stream=self._stream, data=chunk)
+        d.addErrback(self._failed)
+        d.addCallback(self._sent)
+        if (self._outstanding >= WINDOW and not self._paused and
+                self._producer is not None):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def _failed(self, reason):
+        if self._failure is None:
+            self._failure = reason
+
+    def _sent(self, _):
+        self._outstanding -= 1
+        if self._paused and self._outstanding < WINDOW:
+            self._paused = False
+            if self._producer is not None:
+                self._producer.resumeProducing()
+        if self._outstanding == 0:
+            idle, self._idle = self._idle, []
+            for d in idle:
+                d.callback(None)
+
+    def finish(self):
+        """
+        Wait for all the data to be written, then tell the agent the stream
+        is complete.
+
+        :return: ``Deferred`` that fires when the remote volume has been
+            updated, with the agent's UUID if it was also to acquire the
+            volume and otherwise ``None``, or errbacks if sending the data or
+            updating the volume failed.
+        """
+        if self._outstanding == 0:
+            d = succeed(None)
+        else:
+            d = Deferred()
+            self._idle.append(d)
+        d.addCallback(lambda _: self._protocol.callRemote(
+            FinishReceive, stream=self._stream))
+
+        def finished(result):
+            if self._failure is not None:
+                return self._failure
+            return result
+        d.addBoth(finished)
+        d.addCallback(lambda response: response.get("uuid"))
+        return d
+
+
+class _AgentClient(AMP):
+    """
+    The client end of a connection to a ``VolumeAgent``, which tells its
+    ``AgentVolumeManager`` when the connection is lost.
+    """
+    def __init__(self, manager):
+        AMP.__init__(self)
+        self._manager = manager
+
+    def connectionLost(self, reason):
+        self._manager._disconnected(self)
+        AMP.connectionLost(self, reason)
+
+
+@implementer(IRemoteVolumeManager)
+class AgentVolumeManager(object):
+    """
+    Communicate with a remote volume manager's ``VolumeAgent``.
+
+    A single connection is made when first needed and used for all
+    operations, including several at once.  If it is lost, the next
+    operation makes a new one.
+    """
+    def __init__(self, endpoint):
+        """
+        :param IStreamClientEndpoint endpoint: Connects to the agent.
+        """
+        self._endpoint = endpoint
+        self._protocol = None
+        self._connecting = None
+        self._compressions = None
+
+    def _connect(self):
+        """
+        :return: ``Deferred`` that fires with the ``AMP`` connection to the
+            agent.
+        """
+        if self._protocol is not None:
+            return succeed(self._protocol)
+        waiter = Deferred()
+        if self._connecting is not None:
+            self._connecting.append(waiter)
+            return waiter
+        self._connecting = [waiter]
+
+        def done(result):
+            waiting, self._connecting = self._connecting, None
+            if isinstance(result, Failure):
+                for waiter in waiting:
+                    waiter.errback(result)
+                return
+            self._protocol = result
+            for waiter in waiting:
+                waiter.callback(result)
+        connectProtocol(self._endpoint, _AgentClient(self)).addBoth(done)
+        return waiter
+
+    def _disconnected(self, protocol):
+        """
+        Forget a lost connection.
+        """
+        if self._protocol is protocol:
+            self._protocol = None
+
+    def _call(self, command, **arguments):
+        """
+        Send a request to the agent, connecting first if necessary.
+
+        :return: ``Deferred`` that fires with the response.
+        """
+        d = self._connect()
+        d.addCallback(
+            lambda protocol: protocol.callRemote(command, **arguments))
+        return d
+
+    def disconnect(self):
+        """
+        Close the connection to the agent, if there is one.
+        """
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+    def snapshots(self, volume):
+        d = self._call(Snapshots, uuid=volume.uuid, name=volume.name)
+        d.addCallback(lambda response: response["snapshots"])
+        return d
+
+    def receive_state(self, volume):
+        d = self._call(GetReceiveState, uuid=volume.uuid, name=volume.name)
+        d.addCallback(lambda response: ReceiveState(
+            snapshots=response["snapshots"],
+            resume_token=response["resume_token"]))
+        return d
+
+    def receive_state_many(self, volumes):
+        """
+        Ask for the state of all the volumes at once.  The requests are all
+        sent before any answer is needed, so this takes one round trip over
+        the shared connection.
+        """
+        volumes = list(volumes)
+        d = gatherResults([self.receive_state(volume) for volume in volumes])
+        d.addCallback(lambda states: dict(zip(volumes, states)))
+        return d
+
+    def compressions(self):
+        """
+        Ask the agent the first time, and remember the answer.
+        """
+        if self._compressions is not None:
+            return succeed(self._compressions)
+        d = self._call(Compressions)
+
+        def got_algorithms(response):
+            self._compressions = response["algorithms"]
+            return self._compressions
+        d.addCallback(got_algorithms)
+        return d
+
+    def receive_stream(self, volume, compression=None, acquire=False):
+        d = self._connect()
+
+        def connected(protocol):
+            starting = protocol.callRemote(
+                StartReceive, uuid=volume.uuid, name=volume.name,
+                compression=compression, acquire=acquire)
+            starting.addCallback(
+                lambda response: _OutgoingStream(
+                    protocol, response["stream"]))
+            return starting
+        d.addCallback(connected)
+        return d
+
+    def receive_and_acquire_stream(self, volume, compression=None):
+        return self.receive_stream(volume, compression, acquire=True)
+
+    def acquire(self, volume):
+        d = self._call(Acquire, uuid=volume.uuid, name=volume.name)
+        d.addCallback(lambda response: response["uuid"])
+        return d
+
+    def clone_to(self, parent, name):
+        d = self._call(CloneTo, uuid=parent.uuid, name=parent.name,
+                       clone=name)
+        d.addCallback(lambda _: None)
+        return d
+
+
+def agent_endpoint(reactor, hostname):
+    """
+    Create an endpoint which connects to the agent on another node by
+    running ``flocker-volume agent`` there, through the SSH connection shared
+    by ``standard_node``.
+
+    :param reactor: The ``IReactorProcess`` provider to run SSH with.
+    :param bytes hostname: The node to connect to.
+
+    :return: An ``IStreamClientEndpoint`` provider.
+    """
+    return standard_node(hostname).endpoint(
+        reactor, [b"flocker-volume", b"agent"])
+
+
+@implementer(IRemoteVolumeManager)
+class NodeVolumeManager(object):
+    """
+    Communicate with another node's volume manager, sending requests to its
+    agent and volume data to ``flocker-volume receive`` run over SSH.
+
+    The state of all the volumes is also asked for over SSH, since
+    ``flocker-volume snapshots --all`` answers in one run rather than one
+    request per volume.
+    """
+    def __init__(self, agent, remote):
+        """
+        :param AgentVolumeManager agent: Sends requests to the agent.
+        :param RemoteVolumeManager remote: Runs ``flocker-volume`` on the
+            node.
+        """
+        self._agent = agent
+        self._remote = remote
+
+    def snapshots(self, volume):
+        return self._agent.snapshots(volume)
+
+    def receive_state(self, volume):
+        return self._agent.receive_state(volume)
+
+    def receive_state_many(self, volumes):
+        return self._remote.receive_state_many(volumes)
+
+    def compressions(self):
+        return self._agent.compressions()
+
+    def receive_stream(self, volume, compression=None):
+        return self._remote.receive_stream(volume, compression)
+
+    def receive_and_acquire_stream(self, volume, compression=None):
+        return self._remote.receive_and_acquire_stream(volume, compression)
+
+    def acquire(self, volume):
+        return self._agent.acquire(volume)
+
+    def clone_to(self, parent, name):
+        return self._agent.clone_to(parent, name)
+
+
+def node_volume_manager(reactor, hostname):
+    """
+    Create the production ``IRemoteVolumeManager`` for another node.
+
+    :param reactor: The ``IReactorProcess`` provider to run SSH with.
+    :param bytes hostname: The node to communicate with.
+
+    :return: A ``NodeVolumeManager``.
+    """
+    return NodeVolumeManager(
+        AgentVolumeManager(agent_endpoint(reactor, hostname)),
+        RemoteVolumeManager(standard_node(hostname)))
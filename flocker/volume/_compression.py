@@ -0,0 +1,124 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_compression -*-
+
+"""
+Compression of volume data while it is being pushed between nodes.
+"""
+
+from subprocess import Popen, PIPE
+from contextlib import contextmanager
+
+from characteristic import attributes
+
+from twisted.python.procutils import which
+
+
+# Algorithm name -> (compress command, decompress command, levels, default
+# level).  ``zlib`` is implemented by ``gzip``, which uses zlib's deflate.
+_ALGORITHMS = {
+    b"zlib": ([b"gzip", b"--stdout"], [b"gzip", b"--decompress", b"--stdout"],
+              range(1, 10), 6),
+    b"lz4": ([b"lz4", b"-c"], [b"lz4", b"-d", b"-c"], range(1, 10), 1),
+    b"zstd": ([b"zstd", b"-c", b"-q"], [b"zstd", b"-d", b"-c", b"-q"],
+              range(1, 20), 3),
+}
+
+ALGORITHMS = sorted(_ALGORITHMS)
+
+
+def available_algorithms():
+    """
+    :return: ``list`` of the ``ALGORITHMS`` whose program is installed on
+        this node, so that data can be both compressed and decompressed
+        with them here.
+    """
+    return [algorithm for algorithm in ALGORITHMS
+            if which(_ALGORITHMS[algorithm][0][0])]
+
+
+@attributes(["algorithm", "level"], apply_immutable=True)
+class Compression(object):
+    """
+    A compression algorithm and level applied to volume data while it is
+    pushed.
+
+    Compression and decompression are done by external programs so that the
+    data need not pass through the Python process.
+
+    :ivar bytes algorithm: One of ``ALGORITHMS``.
+    :ivar int level: The compression level; higher levels trade CPU time for
+        smaller output.
+    """
+    def compress_command(self):
+        """
+        :return: ``list`` of ``bytes``, a command which compresses its
+            standard input to its standard output.
+        """
+        compress = _ALGORITHMS[self.algorithm][0]
+        return compress + [b"-%d" % (self.level,)]
+
+    def decompress_command(self):
+        """
+        :return: ``list`` of ``bytes``, a command which decompresses its
+            standard input to its standard output.
+        """
+        return list(_ALGORITHMS[self.algorithm][1])
+
+    def to_bytes(self):
+        """
+        Serialize to ``bytes``, e.g. ``b"zstd:3"``.
+
+        :return: ``bytes`` which can be parsed by ``from_bytes``.
+        """
+        return b"%s:%d" % (self.algorithm, self.level)
+
+    @classmethod
+    def from_bytes(cls, description):
+        """
+        Parse ``bytes`` produced by ``to_bytes``.  The level may be omitted,
+        in which case the algorithm's default level is used.
+
+        :param bytes description: E.g. ``b"lz4"`` or ``b"zstd:3"``.
+
+        :raises ValueError: If the algorithm or level is not supported.
+
+        :return: A ``Compression`` instance.
+        """
+        algorithm, _, level = description.partition(b":")
+        if algorithm not in _ALGORITHMS:
+            raise ValueError(
+                "Unsupported compression algorithm: %r" % (algorithm,))
+        levels, default = _ALGORITHMS[algorithm][2:]
+        if level:
+            level = int(level)
+            if level not in levels:
+                raise ValueError(
+                    "Unsupported %s compression level: %d" % (
+                        algorithm, level))
+        else:
+            level = default
+        return cls(algorithm=algorithm, level=level)
+
+
+@contextmanager
+def decompressing(compression, input_file):
+    """
+    Context manager that decompresses data read from a file.
+
+    :param Compression compression: How the data was compressed.
+    :param input_file: A file-like object with a file descriptor, typically
+        ``sys.stdin``, from which to read the compressed data.
+
+    :raises IOError: If decompression fails.
+
+    :return: A file-like object from which the decompressed data can be read.
+    """
+    command = compression.decompress_command()
+    process = Popen(command, stdin=input_file, stdout=PIPE)
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise IOError("Bad exit", command, returncode)
@@ -10,19 +10,18 @@ well-specified communication protocol between daemon processes using
 Twisted's event loop (https://github.com/ClusterHQ/flocker/issues/154).
 """
 
-from contextlib import contextmanager
-from io import BytesIO
-
-from characteristic import with_cmp
+from characteristic import attributes, with_cmp, Attribute
 
 from zope.interface import Interface, implementer
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, gatherResults
 from twisted.python.filepath import FilePath
 
-from ..common._ipc import ProcessNode
+from ..common import FinishingConsumer
+from ..common._ipc import SSHConnectionPool
 from .service import DEFAULT_CONFIG_PATH
 from .filesystems.zfs import Snapshot
+from ._compression import available_algorithms
 
 
 # Path to SSH private key available on nodes and used to communicate
@@ -31,18 +30,51 @@ from .filesystems.zfs import Snapshot
 # https://github.com/ClusterHQ/flocker/issues/390
 SSH_PRIVATE_KEY_PATH = FilePath(b"/etc/flocker/id_rsa_flocker")
 
+# Connections to other nodes are shared by all the commands run on them, and
+# kept open for a while between commands, so that a push or handoff doesn't
+# need a new SSH handshake for each step.
+SSH_CONNECTIONS = SSHConnectionPool(FilePath(b"/var/run/flocker/ssh"))
+
 
 def standard_node(hostname):
     """
     Create the default production ``INode`` for the given hostname.
 
     That is, a node that SSHes as root to port 22 on the given hostname
-    and authenticates using the cluster private key.
+    and authenticates using the cluster private key, sharing one connection
+    with all other such nodes for the same host.
 
     :param bytes hostname: The host to connect to.
     :return: A ``INode`` that can connect to the given hostname using SSH.
     """
-    return ProcessNode.using_ssh(hostname, 22, b"root", SSH_PRIVATE_KEY_PATH)
+    return SSH_CONNECTIONS.node(hostname, 22, b"root", SSH_PRIVATE_KEY_PATH)
+
+
+@attributes(["snapshots", Attribute("resume_token", default_value=None)])
+class ReceiveState(object):
+    """
+    What a volume manager has of a volume which is pushed to it.
+
+    :ivar list snapshots: The ``Snapshot`` instances of the volume, ordered
+        from oldest to newest.
+    :ivar bytes resume_token: The token to pass to
+        ``IFilesystem.reader_stream`` to send only the rest of an
+        interrupted push, or ``None`` if there is nothing to resume.
+    """
+
+
+def query_receive_state(filesystem):
+    """
+    Interrogate a local filesystem for its ``ReceiveState``.
+
+    :param IFilesystem filesystem: The filesystem of a volume.
+
+    :return: ``Deferred`` that fires with a ``ReceiveState``.
+    """
+    d = gatherResults([filesystem.snapshots(), filesystem.resume_token()])
+    d.addCallback(lambda results: ReceiveState(
+        snapshots=results[0], resume_token=results[1]))
+    return d
 
 
 class IRemoteVolumeManager(Interface):
@@ -60,16 +92,73 @@ class IRemoteVolumeManager(Interface):
             ordered from oldest to newest.
         """
 
-    def receive(volume):
+    def receive_state(volume):
+        """
+        Retrieve the snapshots which exist for the given volume together with
+        the token for resuming an interrupted push of it, in one query.
+
+        :param Volume volume: The volume being pushed.
+
+        :return: A ``Deferred`` that fires with a ``ReceiveState``.
+        """
+
+    def receive_state_many(volumes):
         """
-        Context manager that returns a file-like object to which a volume's
-        contents can be written.
+        Retrieve the ``ReceiveState`` of each of several volumes, more
+        cheaply than calling ``receive_state`` for each of them.
+
+        :param volumes: The ``Volume`` instances being pushed.
+
+        :return: A ``Deferred`` that fires with a ``dict`` mapping each of
+            the given volumes to a ``ReceiveState``, with no snapshots for a
+            volume the remote volume manager does not have.
+        """
+
+    def compressions():
+        """
+        Find out which compression algorithms the remote volume manager can
+        decompress, so that it is only sent data compressed with one of
+        them.
+
+        :return: A ``Deferred`` that fires with a ``list`` of algorithm names
+            (see ``flocker.volume._compression.ALGORITHMS``).
+        """
+
+    def receive_stream(volume, compression=None):
+        """
+        Get a consumer to which a volume's contents can be written, updating
+        the volume on the remote volume manager.
 
         :param Volume volume: The volume which will be pushed to the
             remote volume manager.
 
-        :return: A file-like object that can be written to, which will
-             update the volume on the remote volume manager.
+        :param Compression compression: How the data which will be written
+            is compressed, or ``None`` if it is not compressed.  The remote
+            volume manager decompresses it before applying it.
+
+        :return: ``Deferred`` that fires with a
+            ``flocker.common.IStreamConsumer`` provider.  Once the volume's
+            contents have been written to it, the ``Deferred`` returned by its
+            ``finish`` method fires when the remote volume has been updated.
+        """
+
+    def receive_and_acquire_stream(volume, compression=None):
+        """
+        Like ``receive_stream``, but once the remote volume has been updated
+        the remote volume manager also acquires it, as part of the same
+        operation.
+
+        :param Volume volume: The volume which will be pushed to and then
+            acquired by the remote volume manager.
+
+        :param Compression compression: See ``receive_stream``.
+
+        :return: ``Deferred`` that fires with a
+            ``flocker.common.IStreamConsumer`` provider.  Once the volume's
+            contents have been written to it, the ``Deferred`` returned by its
+            ``finish`` method fires with the UUID of the remote volume manager
+            (as ``unicode``) when the remote volume has been updated and
+            acquired.
         """
 
     def acquire(volume):
@@ -79,7 +168,8 @@ class IRemoteVolumeManager(Interface):
         :param Volume volume: The volume which will be acquired by the
             remote volume manager.
 
-        :return: The UUID of the remote volume manager (as ``unicode``).
+        :return: The UUID of the remote volume manager (as ``unicode``), or
+            a ``Deferred`` that fires with it.
         """
 
     def clone_to(parent, name):
@@ -109,6 +199,7 @@ class RemoteVolumeManager(object):
         """
         self._destination = destination
         self._config_path = config_path
+        self._compressions = None
 
     def snapshots(self, volume):
         """
@@ -123,17 +214,102 @@ class RemoteVolumeManager(object):
              volume.name.to_bytes()]
         )
         return succeed([
-            Snapshot(name=name)
-            for name
+            Snapshot.from_bytes(line)
+            for line
             in data.splitlines()
         ])
 
-    def receive(self, volume):
-        return self._destination.run([b"flocker-volume",
-                                      b"--config", self._config_path.path,
-                                      b"receive",
-                                      volume.uuid.encode(b"ascii"),
-                                      volume.name.to_bytes()])
+    def receive_state(self, volume):
+        """
+        Run ``flocker-volume snapshots --resume-token`` on the destination,
+        whose first line of output is the resume token (or is empty) and
+        whose other lines are the snapshots.
+        """
+        data = self._destination.get_output(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"snapshots", b"--resume-token",
+             volume.uuid.encode("ascii"),
+             volume.name.to_bytes()]
+        )
+        lines = data.splitlines() or [b""]
+        return succeed(ReceiveState(
+            snapshots=[Snapshot.from_bytes(line) for line in lines[1:]],
+            resume_token=lines[0] or None))
+
+    def receive_state_many(self, volumes):
+        """
+        Run ``flocker-volume snapshots --all --resume-token`` on the
+        destination once and pick out the snapshots and resume token of each
+        of the volumes.  Lines with an empty snapshot field give resume
+        tokens.
+        """
+        data = self._destination.get_output(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"snapshots", b"--all", b"--resume-token"]
+        )
+        snapshots = {}
+        tokens = {}
+        for line in data.splitlines():
+            uuid, name, rest = line.split(b"\t", 2)
+            key = (uuid.decode("ascii"), name)
+            if rest.startswith(b"\t"):
+                tokens[key] = rest[1:]
+            else:
+                snapshots.setdefault(key, []).append(
+                    Snapshot.from_bytes(rest))
+        result = {}
+        for volume in volumes:
+            key = (volume.uuid, volume.name.to_bytes())
+            result[volume] = ReceiveState(
+                snapshots=snapshots.get(key, []),
+                resume_token=tokens.get(key))
+        return succeed(result)
+
+    def compressions(self):
+        """
+        Run ``flocker-volume compressions`` on the destination the first
+        time, and remember the answer.
+        """
+        if self._compressions is None:
+            data = self._destination.get_output(
+                [b"flocker-volume",
+                 b"--config", self._config_path.path,
+                 b"compressions"]
+            )
+            self._compressions = data.split()
+        return succeed(self._compressions)
+
+    def receive_stream(self, volume, compression=None):
+        if compression is None:
+            options = []
+        else:
+            options = [b"--compression", compression.to_bytes()]
+        return succeed(self._destination.run_stream(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"receive"] + options +
+            [volume.uuid.encode(b"ascii"),
+             volume.name.to_bytes()]))
+
+    def receive_and_acquire_stream(self, volume, compression=None):
+        """
+        Run ``flocker-volume receive --acquire`` on the destination, which
+        writes its UUID to stdout once it has acquired the volume.
+        """
+        if compression is None:
+            options = []
+        else:
+            options = [b"--compression", compression.to_bytes()]
+        consumer = self._destination.run_stream(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"receive", b"--acquire"] + options +
+            [volume.uuid.encode(b"ascii"),
+             volume.name.to_bytes()])
+        return succeed(FinishingConsumer(
+            consumer, lambda output: output.decode("ascii")))
 
     def acquire(self, volume):
         return self._destination.get_output(
@@ -171,12 +347,39 @@ class LocalVolumeManager(object):
         """
         return volume.get_filesystem().snapshots()
 
-    @contextmanager
-    def receive(self, volume):
-        input_file = BytesIO()
-        yield input_file
-        input_file.seek(0, 0)
-        self._service.receive(volume.uuid, volume.name, input_file)
+    def receive_state(self, volume):
+        """
+        Interrogate the volume's filesystem for its snapshots and resume
+        token.
+        """
+        return query_receive_state(volume.get_filesystem())
+
+    def receive_state_many(self, volumes):
+        """
+        Interrogate the filesystem of each volume for its snapshots and
+        resume token.
+        """
+        volumes = list(volumes)
+        d = gatherResults([
+            query_receive_state(volume.get_filesystem())
+            for volume in volumes])
+        d.addCallback(lambda states: dict(zip(volumes, states)))
+        return d
+
+    def compressions(self):
+        """
+        The service runs on this node, so it can decompress whatever is
+        installed here.
+        """
+        return succeed(available_algorithms())
+
+    def receive_stream(self, volume, compression=None):
+        return self._service.receive_stream(
+            volume.uuid, volume.name, compression)
+
+    def receive_and_acquire_stream(self, volume, compression=None):
+        return self._service.receive_and_acquire_stream(
+            volume.uuid, volume.name, compression)
 
     def acquire(self, volume):
         self._service.acquire(volume.uuid, volume.name)
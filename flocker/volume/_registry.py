@@ -0,0 +1,96 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_registry -*-
+
+"""
+An in-memory index of the volumes a volume manager knows about.
+
+Listing a storage pool means parsing every filesystem's name back into a
+volume.  The registry keeps the result, indexed so that a particular volume,
+or the volumes in a namespace, can be found without scanning them all.
+"""
+
+
+class VolumeRegistry(object):
+    """
+    The ``Volume``\ s in a storage pool, indexed by owner UUID and name, and
+    by namespace.
+
+    At most one volume is kept for each owner UUID and name; adding another
+    replaces it.
+
+    :ivar int version: A number which is incremented whenever the volumes
+        change, so that information derived from them can be cached.
+    """
+    def __init__(self):
+        # Map (uuid, VolumeName) to Volume:
+        self._volumes = {}
+        # Map namespace to the set of (uuid, VolumeName) keys in it:
+        self._namespaces = {}
+        self.version = 0
+
+    def add(self, volume):
+        """
+        Add a volume, replacing any with the same owner and name.
+
+        :param Volume volume: The volume.
+        """
+        key = (volume.uuid, volume.name)
+        if self._volumes.get(key) != volume:
+            self.version += 1
+        self._volumes[key] = volume
+        self._namespaces.setdefault(volume.name.namespace, set()).add(key)
+
+    def remove(self, volume):
+        """
+        Remove the volume with the same owner and name as the given one, if
+        there is one.
+
+        :param Volume volume: The volume.
+        """
+        key = (volume.uuid, volume.name)
+        if self._volumes.pop(key, None) is None:
+            return
+        self.version += 1
+        keys = self._namespaces[volume.name.namespace]
+        keys.discard(key)
+        if not keys:
+            del self._namespaces[volume.name.namespace]
+
+    def reset(self, volumes):
+        """
+        Replace all the volumes.
+
+        :param volumes: An iterable of the ``Volume``\ s now in the pool.
+        """
+        volumes = {(volume.uuid, volume.name): volume for volume in volumes}
+        if volumes == self._volumes:
+            return
+        self._volumes = {}
+        self._namespaces = {}
+        for volume in volumes.values():
+            self.add(volume)
+
+    def get(self, uuid, name):
+        """
+        :param unicode uuid: The UUID of the volume's owner.
+        :param VolumeName name: The volume's name.
+
+        :return: The ``Volume``, or ``None`` if there is none.
+        """
+        return self._volumes.get((uuid, name))
+
+    def in_namespace(self, namespace):
+        """
+        :param unicode namespace: A namespace.
+
+        :return: A ``list`` of the ``Volume``\ s in the namespace, whoever
+            owns them.
+        """
+        return [self._volumes[key]
+                for key in self._namespaces.get(namespace, ())]
+
+    def all(self):
+        """
+        :return: A ``list`` of all the ``Volume``\ s.
+        """
+        return list(self._volumes.values())
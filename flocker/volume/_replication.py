@@ -0,0 +1,166 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_replication -*-
+
+"""
+Continuous replication of volumes to standby nodes.
+
+Pushing a volume to a standby node every few seconds keeps the amount of
+data a later handoff has to send, and so the time the volume is
+unavailable, small.
+"""
+
+from eliot import Logger, MessageType, Field
+
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+
+
+VOLUME = Field.forTypes(
+    u"volume", [unicode], u"The name of the replicated volume.")
+PEER = Field.forTypes(
+    u"peer", [unicode, bytes], u"The node the volume is replicated to.")
+
+REPLICATED = MessageType(
+    u"flocker:volume:replication:pushed",
+    [VOLUME, PEER,
+     Field.forTypes(u"duration", [float],
+                    u"Seconds the push took.")],
+    u"A replicated volume was pushed to a standby node.")
+
+REPLICATION_FAILED = MessageType(
+    u"flocker:volume:replication:failed",
+    [VOLUME, PEER,
+     Field.forTypes(u"reason", [unicode, bytes],
+                    u"Why the push failed.")],
+    u"Pushing a replicated volume to a standby node failed.")
+
+
+class Replication(object):
+    """
+    Periodically push a volume to a standby node.
+
+    Only one push is in progress at a time; if a push takes longer than the
+    interval the next one starts as soon as it finishes.  Nothing is pushed
+    while the volume is not owned by this node, or while another process
+    holds its lock, e.g. to hand it off.
+
+    :ivar int pushes: The number of successful pushes.
+    :ivar int failures: The number of failed pushes.
+    :ivar last_synced: The time at which the most recent successful push
+        started, i.e. how current the standby's copy is, or ``None``.
+    :ivar last_duration: Seconds the most recent successful push took, or
+        ``None``.
+    """
+    logger = Logger()
+
+    def __init__(self, service, name, destination, peer, interval,
+                 compression=None, rate_limit=None):
+        """
+        :param VolumeService service: The service which owns the volume.
+        :param VolumeName name: The name of the volume to replicate.
+        :param IRemoteVolumeManager destination: The standby node's volume
+            manager.
+        :param unicode peer: Identifies the standby node, e.g. its hostname.
+        :param float interval: Seconds between the starts of pushes.
+        :param Compression compression: See ``VolumeService.push``.
+        :param int rate_limit: See ``VolumeService.push``.
+        """
+        self._service = service
+        self.name = name
+        self.destination = destination
+        self.peer = peer
+        self.interval = interval
+        self._compression = compression
+        self._rate_limit = rate_limit
+        self._loop = None
+        self._stopped = None
+        self.pushes = 0
+        self.failures = 0
+        self.last_synced = None
+        self.last_duration = None
+
+    def lag(self):
+        """
+        :return: Seconds by which the standby's copy of the volume is behind,
+            or ``None`` if it has never been pushed.
+        """
+        if self.last_synced is None:
+            return None
+        return self._service._reactor.seconds() - self.last_synced
+
+    def start(self):
+        """
+        Start pushing, beginning immediately.
+        """
+        self._loop = LoopingCall(self._push)
+        self._loop.clock = self._service._reactor
+        self._stopped = self._loop.start(self.interval, now=True)
+
+    def stop(self):
+        """
+        Stop pushing.
+
+        :return: ``Deferred`` that fires once any push in progress has
+            finished.
+        """
+        if self._loop is None:
+            return succeed(None)
+        if self._loop.running:
+            self._loop.stop()
+        return self._stopped
+
+    def _push(self):
+        """
+        Push the volume if it is owned by this node and no other process
+        holds its lock.
+
+        :return: ``Deferred`` that fires when the push has finished.  It
+            never errbacks, so that a failed push does not stop replication.
+        """
+        reactor = self._service._reactor
+        started = reactor.seconds()
+        d = maybeDeferred(self._service._volume_lock, self.name)
+
+        def got_volumes(_):
+            volume = self._service.lookup(self.name)
+            if volume is None:
+                return False
+            return self._service.push(
+                volume, self.destination, self._compression,
+                self.peer, self._rate_limit).addCallback(lambda _: True)
+
+        def got_lock(lock):
+            if not lock.lock():
+                return False
+            # Ownership is only checked once the lock is held, since a
+            # handoff holding it changes the owner, possibly in another
+            # process whose changes the pool's cache would not show:
+            self._service.pool.invalidate()
+            pushing = self._service.enumerate()
+            pushing.addCallback(got_volumes)
+
+            def unlock(result):
+                lock.unlock()
+                return result
+            pushing.addBoth(unlock)
+            return pushing
+        d.addCallback(got_lock)
+
+        def pushed(pushed):
+            if pushed:
+                self.pushes += 1
+                self.last_synced = started
+                self.last_duration = reactor.seconds() - started
+                REPLICATED(
+                    volume=self.name.to_bytes().decode("ascii"),
+                    peer=self.peer,
+                    duration=float(self.last_duration)).write(self.logger)
+
+        def failed(reason):
+            self.failures += 1
+            REPLICATION_FAILED(
+                volume=self.name.to_bytes().decode("ascii"),
+                peer=self.peer,
+                reason=reason.getErrorMessage()).write(self.logger)
+        d.addCallbacks(pushed, failed)
+        return d
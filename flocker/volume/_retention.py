@@ -0,0 +1,287 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_retention -*-
+
+"""
+Retention of the snapshots taken when volumes are pushed.
+
+Every push takes a new snapshot.  Only the newest snapshot each peer has
+received is needed, as the base for the next incremental push to that
+peer.  Other snapshots can be destroyed, apart from a configurable number
+of the newest ones.
+"""
+
+import json
+from contextlib import contextmanager
+from time import sleep
+from uuid import UUID
+
+from eliot import Logger, MessageType, Field, writeFailure
+
+from twisted.application.service import Service
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python.lockfile import FilesystemLock
+
+
+DEFAULT_KEEP = 5
+DEFAULT_INTERVAL = 60 * 60
+
+# Pinning waits this long between attempts to take the pins file's lock,
+# which is only ever held for as long as it takes to rewrite the file:
+PINS_LOCK_INTERVAL = 0.01
+
+
+def _volume_key(volume):
+    """
+    :param Volume volume: A volume.
+
+    :return: ``unicode`` identifying the volume in ``SnapshotPins``.
+    """
+    return u"%s.%s" % (volume.uuid, volume.name.to_bytes().decode("ascii"))
+
+
+class SnapshotPins(object):
+    """
+    A record of the newest snapshot of each volume which each peer is known
+    to have, so that it is kept as the base for the next push.
+
+    The record is stored in a JSON file so it is shared between the
+    processes which push volumes and the one which prunes snapshots.  It is
+    changed holding a lock file next to it, so that pins made by several
+    processes at once are not lost, and replaced atomically, so that it can
+    be read without the lock.
+    """
+    def __init__(self, path):
+        """
+        :param FilePath path: The file in which pins are stored.
+        """
+        self._path = path
+
+    def _load(self):
+        """
+        :return: ``dict`` mapping volume keys to ``dict`` mapping peers to
+            snapshot names.
+        """
+        if not self._path.exists():
+            return {}
+        return json.loads(self._path.getContent())
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the pins file's lock, waiting for another process holding it to
+        release it.
+        """
+        lock = FilesystemLock(self._path.path + b".lock")
+        while not lock.lock():
+            sleep(PINS_LOCK_INTERVAL)
+        try:
+            yield
+        finally:
+            lock.unlock()
+
+    def pin(self, volume, peer, snapshot):
+        """
+        Record the newest snapshot a peer has of a volume, replacing the
+        snapshot previously recorded for that peer.
+
+        :param Volume volume: The volume.
+        :param unicode peer: Identifies the peer, e.g. its hostname.
+        :param Snapshot snapshot: The snapshot.
+        """
+        with self._locked():
+            pins = self._load()
+            pins.setdefault(_volume_key(volume), {})[peer] = (
+                snapshot.name.decode("ascii"))
+            self._path.setContent(json.dumps(pins))
+
+    def pinned(self, volume):
+        """
+        :param Volume volume: The volume.
+
+        :return: ``set`` of ``bytes``, the names of the volume's snapshots
+            which peers need.
+        """
+        return set(name.encode("ascii") for name in
+                   self._load().get(_volume_key(volume), {}).values())
+
+
+def _is_push_snapshot(snapshot):
+    """
+    :param Snapshot snapshot: A snapshot.
+
+    :return: ``True`` if the snapshot was taken for a push, i.e. is named
+        with a UUID, otherwise ``False``.
+    """
+    try:
+        UUID(snapshot.name)
+    except ValueError:
+        return False
+    return True
+
+
+def prunable(snapshots, pinned, keep):
+    """
+    Choose which snapshots of a filesystem to destroy.
+
+    :param list snapshots: ``Snapshot`` instances, ordered from oldest to
+        newest.
+    :param set pinned: Names of snapshots which must be kept.
+    :param int keep: The number of newest snapshots to keep regardless.
+
+    :return: ``list`` of the ``Snapshot`` instances to destroy, oldest
+        first.  Only snapshots taken for pushes are ever included.
+    """
+    if keep > 0:
+        snapshots = snapshots[:-keep]
+    return [snapshot for snapshot in snapshots
+            if snapshot.name not in pinned and _is_push_snapshot(snapshot)]
+
+
+_SYSTEM = u"flocker:volume:retention"
+
+
+PRUNE_SNAPSHOTS = MessageType(
+    u"flocker:volume:retention:prune",
+    [Field.forTypes(u"snapshots", [int],
+                    u"The number of snapshots destroyed."),
+     Field.forTypes(u"bytes", [int],
+                    u"The approximate number of bytes freed.")],
+    u"Snapshots which were no longer needed were destroyed.")
+
+
+class SnapshotRetentionService(Service):
+    """
+    Periodically destroy the snapshots of locally owned volumes which are no
+    longer needed.
+
+    :ivar int pruned_snapshots: The number of snapshots destroyed since the
+        service started.
+    :ivar int pruned_bytes: The approximate number of bytes freed by
+        destroying them.
+    """
+    logger = Logger()
+
+    def __init__(self, volume_service, reactor, keep=DEFAULT_KEEP,
+                 interval=DEFAULT_INTERVAL):
+        """
+        :param VolumeService volume_service: The service whose volumes'
+            snapshots are pruned.
+        :param reactor: A ``IReactorTime`` provider.
+        :param int keep: The number of newest snapshots of each volume to
+            keep in addition to those peers need.
+        :param float interval: Seconds between prunings.
+        """
+        self._volume_service = volume_service
+        self._reactor = reactor
+        self._keep = keep
+        self._interval = interval
+        self._loop = None
+        self.pruned_snapshots = 0
+        self.pruned_bytes = 0
+
+    def startService(self):
+        Service.startService(self)
+        self._loop = LoopingCall(self._prune_logged)
+        self._loop.clock = self._reactor
+        # The first pruning waits for an interval, so as not to slow down
+        # starting up:
+        self._loop.start(self._interval, now=False)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+
+    def _prune_logged(self):
+        """
+        Prune, logging rather than returning any failure, since a failure
+        would stop the ``LoopingCall`` and no later pruning would happen.
+
+        :return: ``Deferred`` that fires when pruning is complete.
+        """
+        d = maybeDeferred(self.prune)
+        d.addErrback(writeFailure, self.logger, _SYSTEM)
+        return d
+
+    def prune(self):
+        """
+        Destroy the unneeded snapshots of every locally owned volume.
+
+        A snapshot which can't be destroyed, e.g. because a clone depends on
+        it, is logged and skipped, and the others are still destroyed.
+
+        :return: ``Deferred`` that fires when pruning is complete.
+        """
+        before = (self.pruned_snapshots, self.pruned_bytes)
+        d = self._volume_service.enumerate()
+
+        def got_volumes(volumes):
+            pruning = succeed(None)
+            # A remotely owned volume's snapshots are the bases its owner
+            # pushes against, so they are left alone:
+            for volume in (v for v in volumes if v.locally_owned()):
+                pruning.addCallback(
+                    lambda _, volume=volume: self._prune_volume(volume))
+                # Nor does a failure with one volume stop the others being
+                # pruned:
+                pruning.addErrback(writeFailure, self.logger, _SYSTEM)
+            return pruning
+        d.addCallback(got_volumes)
+
+        def pruned(_):
+            PRUNE_SNAPSHOTS(
+                snapshots=self.pruned_snapshots - before[0],
+                bytes=self.pruned_bytes - before[1]).write(self.logger)
+        d.addCallback(pruned)
+        return d
+
+    def _prune_volume(self, volume):
+        """
+        Destroy the unneeded snapshots of one volume.
+
+        This is done holding the volume's lock, so that it does not happen
+        while the volume is being pushed, and so that whoever takes the lock
+        next, perhaps in another process, sees the change.  If another
+        pusher holds it the volume is left for the next pruning.
+
+        :param Volume volume: The volume.
+
+        :return: ``Deferred`` that fires when pruning is complete.
+        """
+        lock = self._volume_service._volume_lock(volume.name)
+        if not lock.lock():
+            return succeed(None)
+        self._volume_service.pool.invalidate()
+        # Pins are read with the lock held, so that a push which finished
+        # just before has recorded its snapshot:
+        pinned = self._volume_service.pins.pinned(volume)
+        filesystem = volume.get_filesystem()
+        d = filesystem.snapshots()
+
+        def got_snapshots(snapshots):
+            destroying = succeed(None)
+            for snapshot in prunable(snapshots, pinned, self._keep):
+                destroying.addCallback(
+                    lambda _, snapshot=snapshot:
+                    filesystem.destroy_snapshot(snapshot))
+                destroying.addCallbacks(
+                    self._destroyed, writeFailure,
+                    errbackArgs=(self.logger, _SYSTEM))
+            return destroying
+        d.addCallback(got_snapshots)
+
+        def unlock(result):
+            lock.unlock()
+            return result
+        d.addBoth(unlock)
+        return d
+
+    def _destroyed(self, freed):
+        """
+        Count a destroyed snapshot.
+
+        :param int freed: The number of bytes destroying it freed.
+        """
+        self.pruned_snapshots += 1
+        self.pruned_bytes += freed
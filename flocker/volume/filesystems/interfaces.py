@@ -70,7 +70,40 @@ class IFilesystem(Interface):
             which exist of this filesystem.
         """
 
-    def reader(remote_snapshots=None):
+    def destroy_snapshot(snapshot):
+        """
+        Destroy one of this filesystem's snapshots.
+
+        :param Snapshot snapshot: The snapshot to destroy.
+
+        :return: A ``Deferred`` that fires with the approximate number of
+            bytes freed as an ``int`` once the snapshot has been destroyed.
+        """
+
+    def written_since(snapshot):
+        """
+        Estimate how much data an incremental stream based on one of this
+        filesystem's snapshots would contain.
+
+        :param Snapshot snapshot: The snapshot the stream would be based on.
+
+        :return: A ``Deferred`` that fires with the approximate number of
+            bytes written to the filesystem since the snapshot was taken, as
+            an ``int``.
+        """
+
+    def resume_token():
+        """
+        Find out whether an interrupted write to this filesystem can be
+        resumed.
+
+        :return: A ``Deferred`` that fires with ``bytes`` which can be passed
+            to :meth:`IFilesystem.reader` on the sending side to send only
+            the rest of the interrupted stream, or ``None`` if there is
+            nothing to resume.
+        """
+
+    def reader(remote_snapshots=None, resume_token=None):
         """
         Context manager that allows reading the contents of the filesystem.
 
@@ -84,6 +117,11 @@ class IFilesystem(Interface):
             possible.  If no value is passed then a complete data stream will
             be generated.
 
+        :param bytes resume_token: The result of
+            :meth:`IFilesystem.resume_token` on the writer.  If given, the
+            remainder of the interrupted stream is generated instead and
+            ``remote_snapshots`` is ignored.
+
         :return: A file-like object from whom the filesystem's data can be
             read as ``bytes``.
         """
@@ -106,6 +144,28 @@ class IFilesystem(Interface):
             filesystem.
         """
 
+    def reader_stream(remote_snapshots=None, resume_token=None):
+        """
+        Non-blocking equivalent of ``reader``.
+
+        :param remote_snapshots: See ``reader``.
+        :param resume_token: See ``reader``.
+
+        :return: A ``flocker.common.IStreamProducer`` provider which writes
+            the same data ``reader`` would.
+        """
+
+    def writer_stream():
+        """
+        Non-blocking equivalent of ``writer``.
+
+        :return: ``Deferred`` that fires with a
+            ``flocker.common.IStreamConsumer`` provider.  Once output of
+            :meth:`IFilesystem.reader_stream` has been written to it, the
+            ``Deferred`` returned by its ``finish`` method fires when the
+            volume's filesystem has been populated.
+        """
+
     def __eq__(other):
         """True if and only if underlying OS filesystem is the same."""
 
@@ -193,3 +253,9 @@ class IStoragePool(Interface):
         :return: A ``Deferred`` that fires with a :class:`list` of
             :class:`IFilesystem` providers.
         """
+
+    def invalidate():
+        """
+        Forget anything cached about the pool, so that the next query sees
+        changes made by other processes.
+        """
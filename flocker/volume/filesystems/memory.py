@@ -20,6 +20,7 @@ from .interfaces import (
     IFilesystemSnapshots, IStoragePool, IFilesystem,
     FilesystemAlreadyExists)
 from .zfs import Snapshot
+from ...common import IStreamProducer, MemoryConsumer
 
 from .._model import VolumeSize
 
@@ -100,8 +101,32 @@ class DirectoryFilesystem(object):
                 snapshot.name for snapshot in self._snapshots()] + [name])
         )
 
+    def destroy_snapshot(self, snapshot):
+        """
+        Forget a pretend snapshot.  No space is freed.
+        """
+        self.get_path().child(b".snapshots").setContent(
+            b"\n".join([
+                existing.name for existing in self._snapshots()
+                if existing != snapshot])
+        )
+        return succeed(0)
+
+    def written_since(self, snapshot):
+        """
+        Pretend snapshots record no state, so nothing is ever known to have
+        been written since one.
+        """
+        return succeed(0)
+
+    def resume_token(self):
+        """
+        Writes to directories are never interrupted part way.
+        """
+        return succeed(None)
+
     @contextmanager
-    def reader(self, remote_snapshots=None):
+    def reader(self, remote_snapshots=None, resume_token=None):
         """
         Package up filesystem contents as a tarball.
         """
@@ -125,14 +150,33 @@ class DirectoryFilesystem(object):
         result.seek(0, 0)
         yield result
 
+    def reader_stream(self, remote_snapshots=None, resume_token=None):
+        """
+        Package up filesystem contents as a tarball and write it all at once.
+        """
+        with self.reader(remote_snapshots, resume_token) as reader:
+            return _BytesProducer(reader.read())
+
     @contextmanager
     def writer(self):
         """Expect written bytes to be a tarball."""
         result = BytesIO()
         yield result
         result.seek(0, 0)
+        self._extract(result)
+
+    def writer_stream(self):
+        """Expect written bytes to be a tarball."""
+        return succeed(_TarballConsumer(self))
+
+    def _extract(self, tarball_file):
+        """
+        Replace the contents of the filesystem with those of a tarball.
+
+        :param tarball_file: A file-like object containing the tarball.
+        """
         try:
-            tarball = TarFile(fileobj=result, mode="r")
+            tarball = TarFile(fileobj=tarball_file, mode="r")
             if self.path.exists():
                 self.path.remove()
             self.path.createDirectory()
@@ -143,6 +187,45 @@ class DirectoryFilesystem(object):
             pass
 
 
+@implementer(IStreamProducer)
+class _BytesProducer(object):
+    """
+    Write some ``bytes`` to a consumer all at once.
+    """
+    def __init__(self, data):
+        self._data = data
+
+    def startProducing(self, consumer):
+        consumer.registerProducer(self, True)
+        consumer.write(self._data)
+        consumer.unregisterProducer()
+        return succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class _TarballConsumer(MemoryConsumer):
+    """
+    Accumulate a tarball and extract it into a ``DirectoryFilesystem`` when
+    finished.
+    """
+    def __init__(self, filesystem):
+        MemoryConsumer.__init__(self)
+        self._filesystem = filesystem
+
+    def finish(self):
+        d = MemoryConsumer.finish(self)
+        d.addCallback(lambda _: self._filesystem._extract(self.output))
+        return d
+
+
 @implementer(IStoragePool)
 class FilesystemStoragePool(Service):
     """
@@ -226,3 +309,7 @@ class FilesystemStoragePool(Service):
                     )
                 )
         return succeed(filesystems)
+
+    def invalidate(self):
+        # Nothing is cached; every query looks at the directories.
+        pass
@@ -13,7 +13,7 @@ from subprocess import (
     CalledProcessError, STDOUT, PIPE, Popen, check_call, check_output
 )
 
-from characteristic import attributes, with_cmp, with_repr
+from characteristic import attributes, with_cmp, with_repr, Attribute
 
 from zope.interface import implementer
 
@@ -25,6 +25,7 @@ from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
 from twisted.internet.protocol import Protocol
 from twisted.internet.defer import Deferred, succeed
 from twisted.internet.error import ConnectionDone, ProcessTerminated
+from twisted.internet.task import TaskStopped
 from twisted.application.service import Service
 
 from .errors import MaximumSizeTooSmall
@@ -33,6 +34,19 @@ from .interfaces import (
     FilesystemAlreadyExists)
 
 from .._model import VolumeSize
+from ...common import (
+    IDescriptorProducer, ProcessProducer, ProcessConsumer,
+)
+
+# How long, in seconds, a listing of a pool may be reused before it is
+# considered too old.  Changes made by this process invalidate the listing
+# immediately; this bound exists for changes made by other processes (for
+# example a ``flocker-volume receive`` run over SSH).  Code which needs to
+# see those straight away calls ``StoragePool.invalidate`` first:
+# ``VolumeService.wait_for_volume`` does, and so does whatever takes a
+# volume's lock, which other processes hold while they push, hand off or
+# prune the snapshots of that volume.
+POOL_STATE_MAX_AGE = 1.0
 
 
 def random_name():
@@ -66,15 +80,28 @@ class _AccumulatingProtocol(Protocol):
     def connectionLost(self, reason):
         if reason.check(ConnectionDone):
             self._result.callback(self._data)
-        elif reason.check(ProcessTerminated) and reason.value.exitCode == 1:
-            self._result.errback(CommandFailed())
-        elif reason.check(ProcessTerminated) and reason.value.exitCode == 2:
-            self._result.errback(BadArguments())
         else:
-            self._result.errback(reason)
+            self._result.errback(_zfs_failure(reason))
         del self._result
 
 
+def _zfs_failure(reason):
+    """
+    Translate the way a ``zfs`` process exited into the exception
+    ``zfs_command`` reports.
+
+    :param Failure reason: The reason the process ended.
+
+    :return: A ``Failure`` wrapping :class:`CommandFailed` or
+        :class:`BadArguments` for exit codes 1 and 2, otherwise ``reason``.
+    """
+    if reason.check(ProcessTerminated) and reason.value.exitCode == 1:
+        return Failure(CommandFailed())
+    elif reason.check(ProcessTerminated) and reason.value.exitCode == 2:
+        return Failure(BadArguments())
+    return reason
+
+
 def zfs_command(reactor, arguments):
     """
     Asynchronously run the ``zfs`` command-line tool with the given arguments.
@@ -88,13 +115,116 @@ def zfs_command(reactor, arguments):
         exit code 0), or errbacking with :class:`CommandFailed` or
         :class:`BadArguments` depending on the exit code (1 or 2).
     """
-    endpoint = ProcessEndpoint(reactor, b"zfs", [b"zfs"] + arguments,
+    return _command(reactor, b"zfs", arguments)
+
+
+def _zpool_command(reactor, arguments):
+    """
+    Asynchronously run the ``zpool`` command-line tool with the given
+    arguments.
+
+    :see: ``zfs_command``
+    """
+    return _command(reactor, b"zpool", arguments)
+
+
+def _command(reactor, executable, arguments):
+    """
+    Asynchronously run ``zfs`` or ``zpool`` with the given arguments.
+
+    :see: ``zfs_command``
+    """
+    endpoint = ProcessEndpoint(reactor, executable, [executable] + arguments,
                                os.environ)
     d = connectProtocol(endpoint, _AccumulatingProtocol())
     d.addCallback(lambda protocol: protocol._result)
     return d
 
 
+# Whether ``zfs receive -s`` can be used with each pool, by pool name.  This
+# is only found out once per process: it depends on the version of ZFS and
+# the pool's features, neither of which change while a node is running.
+_RESUMABLE_RECEIVE = {}
+
+
+def _resumable_receive_arguments(pool):
+    """
+    :param bytes pool: The name of a pool.
+
+    :return: A ``tuple`` of the arguments to ``zfs`` and to ``zpool`` (each
+        a ``list`` of ``bytes``) which both succeed if ``zfs receive -s`` can
+        be used with the pool.  The ``zfs`` command fails if this version of
+        ZFS knows nothing about resuming; the output of the ``zpool``
+        command is the state of the pool's ``extensible_dataset`` feature,
+        which resuming needs.
+    """
+    return ([b"get", b"-H", b"-o", b"value", b"receive_resume_token", pool],
+            [b"get", b"-H", b"feature@extensible_dataset", pool])
+
+
+def _parse_feature_state(data):
+    """
+    Parse the output of ``zpool get -H feature@<name> <pool>``.
+
+    :param bytes data: The output.
+
+    :return: ``True`` if the feature is enabled or active, otherwise
+        ``False``.
+    """
+    fields = data.strip().split(b"\t")
+    return len(fields) > 2 and fields[2] in (b"enabled", b"active")
+
+
+def resumable_receive(reactor, pool):
+    """
+    Find out whether an interrupted ``zfs receive`` into a pool can be
+    resumed, i.e. whether ``zfs receive -s`` and ``zfs send -t`` work.
+
+    :param reactor: A ``IReactorProcess`` provider.
+    :param bytes pool: The name of the pool.
+
+    :return: ``Deferred`` that fires with ``True`` or ``False``.
+    """
+    if pool in _RESUMABLE_RECEIVE:
+        return succeed(_RESUMABLE_RECEIVE[pool])
+    zfs_get, zpool_get = _resumable_receive_arguments(pool)
+    d = zfs_command(reactor, zfs_get)
+    d.addCallback(lambda _: _zpool_command(reactor, zpool_get))
+    d.addCallback(_parse_feature_state)
+
+    def unsupported(reason):
+        reason.trap(CommandFailed, BadArguments)
+        return False
+    d.addErrback(unsupported)
+
+    def found(resumable):
+        _RESUMABLE_RECEIVE[pool] = resumable
+        return resumable
+    d.addCallback(found)
+    return d
+
+
+def _resumable_receive_sync(pool):
+    """
+    Blocking equivalent of ``resumable_receive``.
+
+    :param bytes pool: The name of the pool.
+
+    :return: ``True`` or ``False``.
+    """
+    if pool not in _RESUMABLE_RECEIVE:
+        zfs_get, zpool_get = _resumable_receive_arguments(pool)
+        try:
+            check_output([b"zfs"] + zfs_get, stderr=STDOUT)
+            feature = check_output([b"zpool"] + zpool_get, stderr=STDOUT)
+        except (CalledProcessError, OSError):
+            resumable = False
+        else:
+            resumable = _parse_feature_state(feature)
+        _RESUMABLE_RECEIVE[pool] = resumable
+    return _RESUMABLE_RECEIVE[pool]
+
+
 _ZFS_COMMAND = Field.forTypes(
     "zfs_command", [bytes], u"The command which was run.")
 _OUTPUT = Field.forTypes(
@@ -135,39 +265,176 @@ def _sync_command_error_squashed(arguments, logger):
         message.write(logger)
 
 
-@attributes(["name"])
+@attributes(["name",
+             Attribute("guid", default_value=None),
+             Attribute("createtxg", default_value=None)])
 class Snapshot(object):
     """
     A snapshot of a ZFS filesystem.
 
     :ivar bytes name: The name of the snapshot.
+    :ivar int guid: The snapshot's ZFS ``guid`` property, or ``None`` if
+        unknown.  Unlike the name this identifies the snapshot's contents: it
+        is kept when the snapshot is renamed or sent to another pool.
+    :ivar int createtxg: The snapshot's ZFS ``createtxg`` property, the
+        transaction group in which it was created, or ``None`` if unknown.
     """
     # TODO: The name should probably be a structured object of some sort,
     # not just a wrapper for bytes.
     # https://github.com/ClusterHQ/flocker/issues/668
 
+    def to_bytes(self):
+        """
+        Serialize to ``bytes``, e.g. ``b"name\t1234\t56"``, or just the
+        name if the ``guid`` is unknown.
+
+        :return: ``bytes`` which can be parsed by ``from_bytes``.
+        """
+        if self.guid is None:
+            return self.name
+        return b"%s\t%d\t%d" % (self.name, self.guid, self.createtxg)
+
+    @classmethod
+    def from_bytes(cls, description):
+        """
+        Parse ``bytes`` produced by ``to_bytes``.
+
+        :param bytes description: A serialized snapshot.
+
+        :return: A ``Snapshot`` instance.
+        """
+        fields = description.split(b"\t")
+        if len(fields) == 1:
+            return cls(name=fields[0])
+        name, guid, createtxg = fields
+        return cls(name=name, guid=int(guid), createtxg=int(createtxg))
+
 
 def _latest_common_snapshot(some, others):
     """
     Pick the most recent snapshot that is common to two snapshot lists.
 
+    Snapshots with known ``guid``\ s are matched by ``guid``, so a snapshot
+    which was renamed on one side is still found.  Snapshots whose ``guid``
+    is unknown on either side are matched by name.
+
     :param list some: One ``list`` of ``Snapshot`` instances to consider,
         ordered from oldest to newest.
 
     :param list others: Another ``list`` of ``Snapshot`` instances to consider,
         ordered from oldest to newest.
 
-    :return: The ``Snapshot`` instance which occurs closest to the end of both
-        ``some`` and ``others`` If no ``Snapshot`` appears in both, ``None`` is
-        returned.
+    :return: The ``Snapshot`` instance from ``others`` which matches the
+        snapshot closest to the end of ``some``.  If no snapshot appears in
+        both, ``None`` is returned.
     """
-    others_set = set(others)
+    by_guid = {}
+    by_name = {}
+    for snapshot in others:
+        if snapshot.guid is not None:
+            by_guid[snapshot.guid] = snapshot
+        by_name[snapshot.name] = snapshot
     for snapshot in reversed(some):
-        if snapshot in others_set:
-            return snapshot
+        if snapshot.guid is not None and snapshot.guid in by_guid:
+            return by_guid[snapshot.guid]
+        match = by_name.get(snapshot.name)
+        if match is not None and None in (snapshot.guid, match.guid):
+            return match
     return None
 
 
+def _send_identifier(filesystem, snapshot, local_snapshots,
+                     remote_snapshots):
+    """
+    Choose the arguments to ``zfs send`` which generate a stream up to a new
+    snapshot, incremental if possible.
+
+    :param Filesystem filesystem: The filesystem being sent.
+    :param bytes snapshot: The full name of the snapshot to send.
+    :param list local_snapshots: ``Snapshot`` instances which exist locally,
+        ordered from oldest to newest.
+    :param list remote_snapshots: ``Snapshot`` instances which exist on the
+        writer, ordered from oldest to newest, or ``None``.
+
+    :return list: Arguments (``bytes``) to follow ``zfs send``.
+    """
+    if remote_snapshots is None:
+        remote_snapshots = []
+
+    latest_common_snapshot = _latest_common_snapshot(
+        remote_snapshots, local_snapshots)
+
+    if latest_common_snapshot is None:
+        return [snapshot]
+    return [
+        b"-i",
+        u"{}@{}".format(
+            filesystem.name, latest_common_snapshot.name).encode("ascii"),
+        snapshot,
+    ]
+
+
+def _receive_arguments(filesystem, exists, resumable):
+    """
+    Choose the ``zfs receive`` command which applies a stream to a
+    filesystem.
+
+    :param Filesystem filesystem: The filesystem being written.
+    :param bool exists: Whether the filesystem already exists.
+    :param bool resumable: Whether the receive can be made resumable (see
+        ``resumable_receive``).
+
+    :return list: The command to run, as a ``list`` of ``bytes``.
+    """
+    if resumable:
+        # -s means that if the stream is interrupted the data received so
+        # far is kept, and a receive_resume_token property is set which
+        # lets the sender continue where it left off (see
+        # Filesystem.resume_token).  The same arguments receive the resumed
+        # stream.
+        receive = [b"zfs", b"receive", b"-s"]
+    else:
+        receive = [b"zfs", b"receive"]
+    if exists:
+        # If the filesystem already exists then this should be an
+        # incremental data stream to up date it to a more recent snapshot.
+        # If that's not the case then we're about to screw up - but that's
+        # all we can handle for now.  Using existence of the filesystem to
+        # determine whether the stream is incremental or not is definitely
+        # a hack.  When we replace this mechanism with a proper API we
+        # should make it include that information.
+        #
+        # -e means "if the stream says it is for foo/bar/baz then receive
+        # into baz".  I don't know why filesystem.name is also required,
+        # then. XXX try -d filesystem.pool instead. XXX it works without -e
+        # w/ filesystem.name too. XXX Delete this paragraph if we go ahead
+        # with just `-F` in the implementation.
+        #
+        # -F means force.  If the stream is based on not-quite-the-latest
+        # snapshot then we have to throw away all the snapshots newer than
+        # it in order to receive the stream.  To do that you have to
+        # force.
+        return receive + [b"-F", filesystem.name]
+    else:
+        # If the filesystem doesn't already exist then this is a complete
+        # data stream.
+        return receive + [filesystem.name]
+
+
+def _parse_resume_token(data):
+    """
+    Parse the output of ``zfs get -H -o value receive_resume_token``.
+
+    :param bytes data: The output.
+
+    :return: The token as ``bytes``, or ``None`` if there is none.
+    """
+    token = data.strip()
+    if token in (b"", b"-"):
+        return None
+    return token
+
+
 @implementer(IFilesystem)
 @with_cmp(["pool", "dataset"])
 @with_repr(["pool", "dataset"])
@@ -179,7 +446,7 @@ class Filesystem(object):
     implementation over time.
     """
     def __init__(self, pool, dataset, mountpoint=None, size=None,
-                 reactor=None):
+                 reactor=None, pool_state=None):
         """
         :param pool: The filesystem's pool name, e.g. ``b"hpool"``.
 
@@ -190,6 +457,9 @@ class Filesystem(object):
             filesystem is mounted.
 
         :param VolumeSize size: The capacity information for this filesystem.
+
+        :param PoolState pool_state: The cached state of the pool this
+            filesystem belongs to, or ``None`` to query ``zfs`` directly.
         """
         self.pool = pool
         self.dataset = dataset
@@ -198,14 +468,22 @@ class Filesystem(object):
         if reactor is None:
             from twisted.internet import reactor
         self._reactor = reactor
+        self._pool_state = pool_state
 
     def _exists(self):
         """
         Determine whether this filesystem exists locally.
 
+        If a fresh listing of the pool is cached it is used to answer,
+        otherwise ``zfs`` is run.
+
         :return: ``True`` if there is a filesystem with this name, ``False``
             otherwise.
         """
+        if self._pool_state is not None:
+            listing = self._pool_state.cached()
+            if listing is not None:
+                return self.name in listing.names
         try:
             check_output([b"zfs", b"list", self.name], stderr=STDOUT)
         except CalledProcessError:
@@ -213,12 +491,14 @@ class Filesystem(object):
         return True
 
     def snapshots(self):
+        if self._pool_state is not None:
+            d = self._pool_state.get()
+            d.addCallback(
+                lambda listing: list(listing.snapshots.get(self.name, [])))
+            return d
         if self._exists():
-            zfs_snapshots = ZFSSnapshots(self._reactor, self)
-            d = zfs_snapshots.list()
-            d.addCallback(lambda snapshots:
-                          [Snapshot(name=name)
-                           for name in snapshots])
+            d = zfs_command(self._reactor, _list_snapshots_command(self))
+            d.addCallback(_parse_snapshot_records, self)
             return d
         return succeed([])
 
@@ -232,8 +512,74 @@ class Filesystem(object):
     def get_path(self):
         return self._mountpoint
 
+    def destroy_snapshot(self, snapshot):
+        """
+        Destroy one of this filesystem's snapshots.
+
+        :param Snapshot snapshot: The snapshot to destroy.
+
+        :return: ``Deferred`` that fires with the snapshot's ``used``
+            property, the space only it referred to, as an ``int``.  This is
+            about how much space destroying it frees.
+        """
+        name = b"%s@%s" % (self.name, snapshot.name)
+        d = zfs_command(
+            self._reactor, [b"get", b"-H", b"-p", b"-o", b"value", b"used",
+                            name])
+        d.addCallback(lambda used: int(used.strip()))
+
+        def destroy(used):
+            destroying = zfs_command(self._reactor, [b"destroy", name])
+            _invalidating(destroying, self._pool_state)
+            destroying.addCallback(lambda _: used)
+            return destroying
+        d.addCallback(destroy)
+        return d
+
+    def written_since(self, snapshot):
+        """
+        Estimate the size of an incremental stream from the filesystem's
+        ``written@<snapshot>`` property.
+
+        Unlike ``zfs send -nv`` this needs no new snapshot to compare
+        against, so it can be polled while the filesystem is in use.
+
+        :param Snapshot snapshot: The snapshot the stream would be based on.
+
+        :return: ``Deferred`` that fires with the number of bytes written
+            since the snapshot as an ``int``.
+        """
+        d = zfs_command(
+            self._reactor,
+            [b"get", b"-H", b"-p", b"-o", b"value",
+             b"written@" + snapshot.name, self.name])
+        d.addCallback(lambda written: int(written.strip()))
+        return d
+
+    def resume_token(self):
+        """
+        Find out whether an interrupted receive into this filesystem can be
+        resumed.
+
+        :return: ``Deferred`` that fires with the filesystem's
+            ``receive_resume_token`` as ``bytes``, or ``None`` if there is no
+            interrupted receive, the filesystem does not exist or ``zfs`` does
+            not support resuming.
+        """
+        d = zfs_command(
+            self._reactor,
+            [b"get", b"-H", b"-o", b"value", b"receive_resume_token",
+             self.name])
+        d.addCallback(_parse_resume_token)
+
+        def no_token(reason):
+            reason.trap(CommandFailed, BadArguments)
+            return None
+        d.addErrback(no_token)
+        return d
+
     @contextmanager
-    def reader(self, remote_snapshots=None):
+    def reader(self, remote_snapshots=None, resume_token=None):
         """
         Send zfs stream of contents.
 
@@ -241,7 +587,21 @@ class Filesystem(object):
             oldest to newest, which are available on the writer.  The reader
             may generate a partial stream which relies on one of these
             snapshots in order to minimize the data to be transferred.
+
+        :param bytes resume_token: The writer's ``resume_token``.  If given,
+            the rest of an interrupted stream is sent instead of a new
+            snapshot.
         """
+        if resume_token is not None:
+            process = Popen([b"zfs", b"send", b"-t", resume_token],
+                            stdout=PIPE)
+            try:
+                yield process.stdout
+            finally:
+                process.stdout.close()
+                process.wait()
+            return
+
         # The existing snapshot code uses Twisted, so we're not using it
         # in this iteration.  What's worse, though, is that it's not clear
         # if the current snapshot naming scheme makes any sense, and
@@ -250,31 +610,15 @@ class Filesystem(object):
         # clearer as we iterate.
         snapshot = b"%s@%s" % (self.name, uuid4())
         check_call([b"zfs", b"snapshot", snapshot])
+        self._invalidate()
 
         # Determine whether there is a shared snapshot which can be used as the
         # basis for an incremental send.
-        local_snapshots = list(
-            Snapshot(name=name) for name in
-            _parse_snapshots(
-                check_output([b"zfs"] + _list_snapshots_command(self)),
-                self
-            ))
-
-        if remote_snapshots is None:
-            remote_snapshots = []
-
-        latest_common_snapshot = _latest_common_snapshot(
-            remote_snapshots, local_snapshots)
+        local_snapshots = _parse_snapshot_records(
+            check_output([b"zfs"] + _list_snapshots_command(self)), self)
 
-        if latest_common_snapshot is None:
-            identifier = [snapshot]
-        else:
-            identifier = [
-                b"-i",
-                u"{}@{}".format(
-                    self.name, latest_common_snapshot.name).encode("ascii"),
-                snapshot,
-            ]
+        identifier = _send_identifier(
+            self, snapshot, local_snapshots, remote_snapshots)
 
         process = Popen([b"zfs", b"send"] + identifier, stdout=PIPE)
         try:
@@ -288,31 +632,8 @@ class Filesystem(object):
         """
         Read in zfs stream.
         """
-        if self._exists():
-            # If the filesystem already exists then this should be an
-            # incremental data stream to up date it to a more recent snapshot.
-            # If that's not the case then we're about to screw up - but that's
-            # all we can handle for now.  Using existence of the filesystem to
-            # determine whether the stream is incremental or not is definitely
-            # a hack.  When we replace this mechanism with a proper API we
-            # should make it include that information.
-            #
-            # -e means "if the stream says it is for foo/bar/baz then receive
-            # into baz".  I don't know why self.name is also required,
-            # then. XXX try -d self.pool instead. XXX it works without -e w/
-            # self.name too. XXX Delete this paragraph if we go ahead with just
-            # `-F` in the implementation.
-            #
-            # -F means force.  If the stream is based on not-quite-the-latest
-            # snapshot then we have to throw away all the snapshots newer than
-            # it in order to receive the stream.  To do that you have to
-            # force.
-            #
-            cmd = [b"zfs", b"receive", b"-F", self.name]
-        else:
-            # If the filesystem doesn't already exist then this is a complete
-            # data stream.
-            cmd = [b"zfs", b"receive", self.name]
+        cmd = _receive_arguments(
+            self, self._exists(), _resumable_receive_sync(self.pool))
         process = Popen(cmd, stdin=PIPE)
         succeeded = False
         try:
@@ -320,10 +641,185 @@ class Filesystem(object):
         finally:
             process.stdin.close()
             succeeded = not process.wait()
+            self._invalidate()
         if succeeded:
             check_call([b"zfs", b"set",
                         b"mountpoint=" + self._mountpoint.path,
                         self.name])
+            self._invalidate()
+
+    def reader_stream(self, remote_snapshots=None, resume_token=None):
+        """
+        Take a new snapshot and send a zfs stream of it without blocking.
+
+        :param list remote_snapshots: See ``reader``.
+        :param bytes resume_token: See ``reader``.
+        """
+        if resume_token is not None:
+            return _ResumeProducer(
+                self._reactor, [b"zfs", b"send", b"-t", resume_token])
+        return _SendProducer(self, remote_snapshots)
+
+    def writer_stream(self):
+        """
+        Receive a zfs stream without blocking.
+        """
+        d = self._check_exists()
+        d.addCallback(lambda exists: resumable_receive(
+            self._reactor, self.pool).addCallback(
+                lambda resumable: _ReceiveConsumer(
+                    self, _receive_arguments(self, exists, resumable))))
+        return d
+
+    def _check_exists(self):
+        """
+        Determine whether this filesystem exists locally, using the pool's
+        cached state when possible.
+
+        :return: ``Deferred`` that fires with ``True`` if there is a
+            filesystem with this name, ``False`` otherwise.
+        """
+        if self._pool_state is not None:
+            d = self._pool_state.get()
+            d.addCallback(lambda listing: self.name in listing.names)
+            return d
+        return succeed(self._exists())
+
+    def _invalidate(self):
+        """
+        Discard any cached state of the pool this filesystem belongs to,
+        since this filesystem has just been changed.
+        """
+        if self._pool_state is not None:
+            self._pool_state.invalidate()
+
+
+@implementer(IDescriptorProducer)
+class _SendProducer(object):
+    """
+    Snapshot a filesystem and write a zfs stream of the snapshot to a
+    consumer or file descriptor.
+
+    The snapshot is taken and the incremental base chosen when production
+    starts; until then pausing and resuming are only recorded.
+    """
+    def __init__(self, filesystem, remote_snapshots):
+        """
+        :param Filesystem filesystem: The filesystem to send.
+        :param list remote_snapshots: See ``Filesystem.reader``.
+        """
+        self._filesystem = filesystem
+        self._remote_snapshots = remote_snapshots
+        self._producer = None
+        self._paused = False
+        self._stopped = False
+
+    def startProducing(self, consumer):
+        return self._send(lambda producer: producer.startProducing(consumer))
+
+    def produceToDescriptor(self, fd):
+        def not_started(reason):
+            if self._producer is None:
+                os.close(fd)
+            return reason
+        sending = self._send(
+            lambda producer: producer.produceToDescriptor(fd))
+        sending.addErrback(not_started)
+        return sending
+
+    def _send(self, start):
+        """
+        Take the snapshot and then run ``zfs send``.
+
+        :param start: Callable which starts the ``ProcessProducer`` running
+            ``zfs send`` and returns a ``Deferred`` that fires when it exits.
+
+        :return: ``Deferred`` that fires when ``zfs send`` has finished.
+        """
+        filesystem = self._filesystem
+        reactor = filesystem._reactor
+        name = bytes(uuid4())
+        snapshot = b"%s@%s" % (filesystem.name, name)
+        d = ZFSSnapshots(reactor, filesystem).create(name)
+        d.addCallback(lambda _: filesystem.snapshots())
+
+        def got_snapshots(local_snapshots):
+            if self._stopped:
+                raise TaskStopped()
+            self._producer = ProcessProducer(
+                reactor, [b"zfs", b"send"] + _send_identifier(
+                    filesystem, snapshot, local_snapshots,
+                    self._remote_snapshots))
+            sending = start(self._producer)
+            if self._paused:
+                self._producer.pauseProducing()
+            sending.addErrback(_zfs_failure)
+            return sending
+        d.addCallback(got_snapshots)
+        return d
+
+    def pauseProducing(self):
+        self._paused = True
+        if self._producer is not None:
+            self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._producer is not None:
+            self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._stopped = True
+        if self._producer is not None:
+            self._producer.stopProducing()
+
+
+class _ResumeProducer(ProcessProducer):
+    """
+    Send the remainder of an interrupted zfs stream.
+    """
+    def startProducing(self, consumer):
+        d = ProcessProducer.startProducing(self, consumer)
+        d.addErrback(_zfs_failure)
+        return d
+
+    def produceToDescriptor(self, fd):
+        d = ProcessProducer.produceToDescriptor(self, fd)
+        d.addErrback(_zfs_failure)
+        return d
+
+
+class _ReceiveConsumer(ProcessConsumer):
+    """
+    Apply a zfs stream written to this consumer to a filesystem using
+    ``zfs receive``.
+    """
+    def __init__(self, filesystem, arguments):
+        """
+        :param Filesystem filesystem: The filesystem being written.
+        :param list arguments: The ``zfs receive`` command to run.
+        """
+        ProcessConsumer.__init__(self, filesystem._reactor, arguments)
+        self._filesystem = filesystem
+
+    def finish(self):
+        """
+        Wait for ``zfs receive`` to finish and then set the filesystem's
+        mountpoint.
+
+        :return: ``Deferred`` that fires with ``None`` once the filesystem is
+            ready, or errbacks with ``CommandFailed`` or ``BadArguments``.
+        """
+        filesystem = self._filesystem
+        d = ProcessConsumer.finish(self)
+        _invalidating(d, filesystem._pool_state)
+        d.addErrback(_zfs_failure)
+        d.addCallback(lambda _: _invalidating(zfs_command(
+            filesystem._reactor,
+            [b"set", b"mountpoint=" + filesystem.get_path().path,
+             filesystem.name]), filesystem._pool_state))
+        d.addCallback(lambda _: None)
+        return d
 
 
 @implementer(IFilesystemSnapshots)
@@ -337,6 +833,7 @@ class ZFSSnapshots(object):
     def create(self, name):
         encoded_name = b"%s@%s" % (self._filesystem.name, name)
         d = zfs_command(self._reactor, [b"snapshot", encoded_name])
+        _invalidating(d, self._filesystem._pool_state)
         d.addCallback(lambda _: None)
         return d
 
@@ -367,12 +864,14 @@ def _list_snapshots_command(filesystem):
         b"-r",
         # Only output datasets of type snapshot.
         b"-t", b"snapshot",
-        # Only output the name of each dataset encountered.  The name is the
-        # only thing we currently store in our snapshot model.
-        b"-o", b"name",
-        # Sort by the creation property.  This gives us the snapshots in the
-        # order they were taken.
-        b"-s", b"creation",
+        # Output exact, machine-parseable values.
+        b"-p",
+        # Only output the properties stored in our snapshot model.  The guid
+        # identifies a snapshot even if it is renamed.
+        b"-o", b"name,guid,createtxg",
+        # Sort by the transaction group each snapshot was created in.  This
+        # gives us the snapshots in the order they were taken.
+        b"-s", b"createtxg",
         # Start with this the dataset we're interested in.
         filesystem.name,
     ]
@@ -394,11 +893,29 @@ def _parse_snapshots(data, filesystem):
         names of the snapshots in the output.  The order of the list is the
         same as the order of the snapshots in the data being parsed.
     """
+    return [snapshot.name
+            for snapshot in _parse_snapshot_records(data, filesystem)]
+
+
+def _parse_snapshot_records(data, filesystem):
+    """
+    Parse the output of a ``zfs list`` command (like the one defined by
+    ``_list_snapshots_command``) into a ``list`` of ``Snapshot`` instances.
+
+    :param bytes data: The output to parse.
+    :param Filesystem filesystem: The filesystem from which to extract
+        snapshots.  Snapshots of other filesystems are excluded.
+
+    :return list: ``Snapshot`` instances in the same order as the snapshots
+        in the data being parsed.
+    """
     result = []
     for line in data.splitlines():
-        dataset, snapshot = line.split(b'@', 1)
+        name, guid, createtxg = line.split(b"\t")
+        dataset, snapshot = name.split(b'@', 1)
         if dataset == filesystem.name:
-            result.append(snapshot)
+            result.append(Snapshot(
+                name=snapshot, guid=int(guid), createtxg=int(createtxg)))
     return result
 
 
@@ -420,6 +937,23 @@ def _list_snapshots(reactor, filesystem):
     return d
 
 
+def _invalidating(result, pool_state):
+    """
+    Arrange for cached pool state to be discarded once an operation which
+    changes the pool finishes, whether it succeeds or fails.
+
+    :param Deferred result: The result of the operation.
+    :param PoolState pool_state: The state to invalidate, or ``None``.
+
+    :return: ``result``, which will fire with the same result as before.
+    """
+    def invalidate(passthrough):
+        if pool_state is not None:
+            pool_state.invalidate()
+        return passthrough
+    return result.addBoth(invalidate)
+
+
 def volume_to_dataset(volume):
     """Convert a volume to a dataset name.
 
@@ -456,6 +990,7 @@ class StoragePool(Service):
         self._reactor = reactor
         self._name = name
         self._mount_root = mount_root
+        self._state = PoolState(reactor, name)
 
     def startService(self):
         """
@@ -510,6 +1045,7 @@ class StoragePool(Service):
             ])
         d = zfs_command(self._reactor,
                         [b"create"] + properties + [filesystem.name])
+        _invalidating(d, self._state)
         d.addErrback(self._check_for_out_of_space)
         d.addCallback(lambda _: filesystem)
         return d
@@ -526,6 +1062,7 @@ class StoragePool(Service):
             properties.extend([u"refquota=none"])
         d = zfs_command(self._reactor,
                         [b"set"] + properties + [filesystem.name])
+        _invalidating(d, self._state)
         d.addErrback(self._check_for_out_of_space)
         d.addCallback(lambda _: filesystem)
         return d
@@ -534,7 +1071,9 @@ class StoragePool(Service):
         parent_filesystem = self.get(parent)
         new_filesystem = self.get(volume)
         zfs_snapshots = ZFSSnapshots(self._reactor, parent_filesystem)
-        snapshot_name = bytes(uuid4())
+        # The clone depends on this snapshot, so it must not be named like
+        # the push snapshots which are pruned once no longer needed:
+        snapshot_name = b"clone-" + bytes(uuid4())
         d = zfs_snapshots.create(snapshot_name)
         clone_command = [b"clone",
                          # Snapshot we're cloning from:
@@ -601,29 +1140,37 @@ class StoragePool(Service):
                                 new_filesystem.name]))
             return result
         result.addCallback(exists)
+        _invalidating(result, self._state)
 
     def get(self, volume):
         dataset = volume_to_dataset(volume)
         mount_path = self._mount_root.child(dataset)
         return Filesystem(
-            self._name, dataset, mount_path, volume.size)
+            self._name, dataset, mount_path, volume.size,
+            reactor=self._reactor, pool_state=self._state)
 
     def enumerate(self):
-        listing = _list_filesystems(self._reactor, self._name)
+        listing = self._state.get()
 
-        def listed(filesystems):
+        def listed(listing):
             result = set()
-            for entry in filesystems:
+            for entry in listing.filesystems:
                 filesystem = Filesystem(
                     self._name, entry.dataset, FilePath(entry.mountpoint),
-                    VolumeSize(maximum_size=entry.refquota))
+                    VolumeSize(maximum_size=entry.refquota),
+                    reactor=self._reactor, pool_state=self._state)
                 result.add(filesystem)
             return result
 
         return listing.addCallback(listed)
 
+    def invalidate(self):
+        self._state.invalidate()
+
 
-@attributes(["dataset", "mountpoint", "refquota"], apply_immutable=True)
+@attributes(["dataset", "mountpoint", "refquota",
+             Attribute("used", default_value=None)],
+            apply_immutable=True)
 class _DatasetInfo(object):
     """
     :ivar bytes dataset: The name of the ZFS dataset to which this information
@@ -632,43 +1179,174 @@ class _DatasetInfo(object):
         (where it will be auto-mounted by ZFS).
     :ivar int refquota: The value of the dataset's ``refquota`` property (the
         maximum number of bytes the dataset is allowed to have a reference to).
+    :ivar int used: The value of the dataset's ``used`` property (the number
+        of bytes consumed by the dataset and everything descended from it),
+        or ``None`` if unknown.
+    """
+
+
+@attributes(["filesystems", "names", "snapshots"])
+class _PoolListing(object):
+    """
+    Everything ZFS reported about a pool in one recursive listing.
+
+    :ivar list filesystems: ``_DatasetInfo`` instances describing the direct
+        children of the pool (the filesystems which may back volumes).
+    :ivar frozenset names: The full names (``bytes``) of all filesystems in
+        the pool, including the pool's root dataset.
+    :ivar dict snapshots: Map the full name of each filesystem with snapshots
+        to a ``list`` of its ``Snapshot`` instances, ordered from oldest to
+        newest.
+    """
+
+
+def _list_pool_command(pool):
+    """
+    Construct a ``zfs`` command which will describe every dataset and snapshot
+    in a pool.
+
+    :param bytes pool: The name of the pool.
+
+    :return list: An argument list (of ``bytes``), not including ``zfs``.
+    """
+    return [
+        b"list",
+        # Descend the whole hierarchy beneath the pool.
+        b"-r",
+        # Include filesystems, volumes and snapshots.
+        b"-t", b"all",
+        # Omit the output header
+        b"-H",
+        # Output exact, machine-parseable values (eg 65536 instead of 64K)
+        b"-p",
+        b"-o", b"name,type,mountpoint,refquota,used,createtxg,guid",
+        pool,
+    ]
+
+
+def _parse_pool_listing(data, pool):
+    """
+    Parse the output of the command constructed by ``_list_pool_command``.
+
+    :param bytes data: The output to parse.
+    :param bytes pool: The name of the pool which was listed.
+
+    :return: A ``_PoolListing``.
+    """
+    filesystems = []
+    names = set()
+    snapshots = {}
+    prefix = pool + b"/"
+    for line in data.splitlines():
+        (name, kind, mountpoint, refquota,
+         used, createtxg, guid) = line.split(b"\t")
+        if kind == b"snapshot":
+            dataset, snapshot = name.split(b"@", 1)
+            snapshots.setdefault(dataset, []).append(Snapshot(
+                name=snapshot, guid=int(guid), createtxg=int(createtxg)))
+            continue
+        names.add(name)
+        if kind != b"filesystem" or not name.startswith(prefix):
+            continue
+        dataset = name[len(prefix):]
+        if b"/" in dataset:
+            # Only direct children of the pool back volumes.
+            continue
+        refquota = int(refquota)
+        if refquota == 0:
+            refquota = None
+        filesystems.append(_DatasetInfo(
+            dataset=dataset, mountpoint=mountpoint, refquota=refquota,
+            used=int(used)))
+    # Each snapshot is created in a later transaction group than the
+    # snapshots before it:
+    for entries in snapshots.values():
+        entries.sort(key=lambda snapshot: snapshot.createtxg)
+    return _PoolListing(
+        filesystems=filesystems, names=frozenset(names), snapshots=snapshots)
+
+
+class PoolState(object):
     """
+    A cache of the datasets and snapshots in a ZFS pool.
 
+    The cache is filled by a single recursive ``zfs list`` and used to answer
+    every query about the pool until it is invalidated (which the
+    ``StoragePool`` does whenever it changes the pool) or until it is older
+    than ``max_age`` seconds.  Queries made while the cache is being filled
+    share the one ``zfs`` process.
+    """
+    def __init__(self, reactor, pool, max_age=POOL_STATE_MAX_AGE):
+        """
+        :param reactor: A ``IReactorProcess`` and ``IReactorTime`` provider.
+        :param bytes pool: The name of the pool.
+        :param float max_age: The number of seconds for which a listing may
+            be reused.
+        """
+        self._reactor = reactor
+        self._pool = pool
+        self._max_age = max_age
+        self._listing = None
+        self._listed_at = None
+        self._generation = 0
+        self._waiting = None
+
+    def invalidate(self):
+        """
+        Discard the cached listing because the pool has changed.
+
+        A listing which is being retrieved when this is called will still be
+        delivered to the callers already waiting for it, but it will not be
+        cached.
+        """
+        self._generation += 1
+        self._listing = None
+        self._waiting = None
+
+    def cached(self):
+        """
+        :return: The cached ``_PoolListing`` if it is still fresh, otherwise
+            ``None``.
+        """
+        if self._listing is None:
+            return None
+        if self._reactor.seconds() - self._listed_at > self._max_age:
+            self._listing = None
+        return self._listing
+
+    def get(self):
+        """
+        Retrieve a listing of the pool, running ``zfs`` only if no fresh
+        listing is cached.
+
+        :return: A ``Deferred`` that fires with a ``_PoolListing``.
+        """
+        listing = self.cached()
+        if listing is not None:
+            return succeed(listing)
+
+        result = Deferred()
+        if self._waiting is not None:
+            self._waiting.append(result)
+            return result
 
-def _list_filesystems(reactor, pool):
-    """Get a listing of all filesystems on a given pool.
-
-    :param pool: A `flocker.volume.filesystems.interface.IStoragePool`
-        provider.
-    :return: A ``Deferred`` that fires with an iterator, the elements
-        of which are ``tuples`` containing the name and mountpoint of each
-        filesystem.
-    """
-    listing = zfs_command(
-        reactor,
-        [b"list",
-         # Descend the hierarchy to a depth of one (ie, list the direct
-         # children of the pool)
-         b"-d", b"1",
-         # Omit the output header
-         b"-H",
-         # Output exact, machine-parseable values (eg 65536 instead of 64K)
-         b"-p",
-         # Output each dataset's name, mountpoint and refquota
-         b"-o", b"name,mountpoint,refquota",
-         # Look at this pool
-         pool])
-
-    def listed(output, pool):
-        for line in output.splitlines():
-            name, mountpoint, refquota = line.split(b'\t')
-            name = name[len(pool) + 1:]
-            if name:
-                refquota = int(refquota.decode("ascii"))
-                if refquota == 0:
-                    refquota = None
-                yield _DatasetInfo(
-                    dataset=name, mountpoint=mountpoint, refquota=refquota)
-
-    listing.addCallback(listed, pool)
-    return listing
+        waiting = self._waiting = [result]
+        generation = self._generation
+        started = self._reactor.seconds()
+        d = zfs_command(self._reactor, _list_pool_command(self._pool))
+        d.addCallback(_parse_pool_listing, self._pool)
+
+        def listed(listing):
+            if generation == self._generation:
+                self._listing = listing
+                self._listed_at = started
+            return listing
+        d.addCallback(listed)
+
+        def finished(result):
+            if self._waiting is waiting:
+                self._waiting = None
+            for waiter in waiting:
+                waiter.callback(result)
+        d.addBoth(finished)
+        return result
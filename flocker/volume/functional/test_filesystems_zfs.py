@@ -24,11 +24,12 @@ from ..test.filesystemtests import (
 )
 from ..filesystems.errors import MaximumSizeTooSmall
 from ..filesystems.zfs import (
-    Snapshot, ZFSSnapshots, Filesystem, StoragePool, volume_to_dataset,
+    ZFSSnapshots, Filesystem, StoragePool, volume_to_dataset,
     zfs_command,
 )
 from ..service import Volume, VolumeName
 from .._model import VolumeSize
+from .._retention import prunable
 from ..testtools import create_zfs_pool, service_for_pool
 
 
@@ -287,6 +288,26 @@ class StoragePoolTests(TestCase):
         d.addCallback(created_filesystems)
         return d
 
+    def test_clone_snapshot_not_prunable(self):
+        """
+        The snapshot a clone is made from is not named like a push snapshot,
+        so it is never pruned while the clone depends on it.
+        """
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        parent = service.get(MY_VOLUME2)
+        volume = service.get(MY_VOLUME)
+
+        d = pool.create(parent)
+        d.addCallback(lambda _: pool.clone_to(parent, volume))
+        d.addCallback(lambda _: pool.get(parent).snapshots())
+
+        def got_snapshots(snapshots):
+            self.assertEqual((len(snapshots), prunable(snapshots, set(), 0)),
+                             (1, []))
+        d.addCallback(got_snapshots)
+        return d
+
     def test_remotely_owned_cloned_readonly(self):
         """
         A filesystem which is cloned into a remotely owned volume is not
@@ -455,6 +476,43 @@ class IncrementalPushTests(TestCase):
         loading.addCallback(loaded)
         return loading
 
+    def test_renamed_snapshot(self):
+        """
+        An incremental stream is generated even if the snapshot shared with
+        the writer has been renamed locally, since snapshots are matched by
+        ``guid``.
+        """
+        pool = build_pool(self)
+        service = service_for_pool(self, pool)
+        volume = service.get(MY_VOLUME)
+        creating = pool.create(volume)
+
+        def created(filesystem):
+            self.filesystem = filesystem
+            filesystem.get_path().child(b"some-data").setContent(
+                b"hello world" * 1024)
+            with filesystem.reader() as reader:
+                self.complete_size = len(reader.read())
+            return filesystem.snapshots()
+        loading = creating.addCallback(created)
+
+        def loaded(snapshots):
+            [snapshot] = snapshots
+            subprocess.check_call([
+                b"zfs", b"rename",
+                b"%s@%s" % (self.filesystem.name, snapshot.name),
+                b"%s@renamed" % (self.filesystem.name,)])
+            with self.filesystem.reader(snapshots) as reader:
+                incremental_size = len(reader.read())
+            self.assertTrue(
+                incremental_size < self.complete_size,
+                "Bytes of data for incremental send ({}) was not fewer than "
+                "bytes of data for complete send ({}).".format(
+                    incremental_size, self.complete_size)
+            )
+        loading.addCallback(loaded)
+        return loading
+
 
 class FilesystemTests(TestCase):
     """
@@ -500,8 +558,9 @@ class FilesystemTests(TestCase):
 
         def loaded(snapshots):
             self.assertEqual(
-                list(Snapshot(name=name) for name in expected_names),
-                snapshots)
+                (expected_names, True),
+                ([snapshot.name for snapshot in snapshots],
+                 all(snapshot.guid is not None for snapshot in snapshots)))
 
         loading.addCallback(loaded)
         return loading
@@ -4,9 +4,14 @@
 
 from __future__ import absolute_import
 
+from twisted.internet import reactor
+from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
 
-from ..service import VolumeName
+from ..service import VolumeName, VolumeService, Volume
+from ..filesystems.memory import FilesystemStoragePool
+from .._compression import Compression
+from .._ipc import LocalVolumeManager
 from ..testtools import create_realistic_servicepair
 
 
@@ -59,3 +64,48 @@ class RealisticTests(TestCase):
                 service_pair.origin_remote)
         # If the Deferred errbacks the test will fail:
         return d
+
+
+class CompressedPushTests(TestCase):
+    """
+    Tests for pushing volumes with compression, using real compression
+    processes.
+    """
+    def create_service(self):
+        """
+        :return: A started ``VolumeService`` using the global reactor and a
+            directory-based storage pool.
+        """
+        pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        service = VolumeService(FilePath(self.mktemp()), pool, reactor)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def test_push(self):
+        """
+        A volume pushed with compression is decompressed by the destination.
+        """
+        from_service = self.create_service()
+        to_service = self.create_service()
+        name = VolumeName(namespace=u"myns", id=u"myvolume")
+
+        d = from_service.create(from_service.get(name))
+
+        def created(volume):
+            volume.get_filesystem().get_path().child(b"f").setContent(
+                b"data" * 100000)
+            return from_service.push(
+                volume, LocalVolumeManager(to_service),
+                Compression(algorithm=b"zlib", level=1))
+        d.addCallback(created)
+
+        def pushed(_):
+            received = Volume(uuid=from_service.uuid, name=name,
+                              service=to_service)
+            self.assertEqual(
+                received.get_filesystem().get_path().child(
+                    b"f").getContent(),
+                b"data" * 100000)
+        d.addCallback(pushed)
+        return d
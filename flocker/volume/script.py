@@ -4,9 +4,10 @@
 
 import sys
 
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, maybeDeferred
+from twisted.internet.defer import succeed, maybeDeferred, gatherResults
+from twisted.internet.endpoints import UNIXClientEndpoint
 
 from zope.interface import implementer
 
@@ -14,8 +15,14 @@ from .service import (
     DEFAULT_CONFIG_PATH, FLOCKER_MOUNTPOINT, FLOCKER_POOL,
     Volume, VolumeScript, ICommandLineVolumeScript, VolumeName,
     )
+from ._compression import (
+    ALGORITHMS, Compression, available_algorithms, decompressing,
+)
+from ._ipc import ReceiveState, query_receive_state
+from ._agent import DEFAULT_AGENT_SOCKET
+from ..common import relay_stdio
 from ..common.script import (
-    flocker_standard_options, FlockerScriptRunner
+    flocker_standard_options, FlockerScriptRunner, ICommandLineScript
     )
 
 
@@ -24,6 +31,7 @@ __all__ = [
     'flocker_volume_options',
     'VolumeOptions',
     'VolumeManagerScript',
+    'FlockerVolumeScript',
 ]
 
 
@@ -65,32 +73,108 @@ class _SnapshotsSubcommandOptions(Options):
     Command line options for ``flocker-volume snapshots``.
     """
 
-    longdesc = """List local snapshots of a particular volume.
+    longdesc = """List local snapshots of a particular volume, or with
+    --all of every local volume.
 
     Parameters:
 
     * owner-uuid: The UUID of the volume manager that owns the volume.
 
     * name: The name of the volume.
+
+    With --resume-token the first line is the token for resuming an
+    interrupted receive of the volume, or is empty if there is none.
+
+    With --all each line is the owner UUID, the volume name and a snapshot,
+    separated by tabs.  With --resume-token as well, each volume with an
+    interrupted receive also has a line with an empty snapshot followed by
+    the token.
     """
 
-    def parseArgs(self, uuid, name):
+    synopsis = "[--resume-token] <owner-uuid> <name> | --all [--resume-token]"
+
+    optFlags = [
+        ["all", None, "List the snapshots of every volume."],
+        ["resume-token", None,
+         "Also write the tokens for resuming interrupted receives."],
+    ]
+
+    def parseArgs(self, uuid=None, name=None):
+        if self["all"]:
+            if uuid is not None:
+                raise UsageError("--all does not take a volume.")
+            return
+        if name is None:
+            raise UsageError("Wrong number of arguments.")
         self["uuid"] = uuid.decode("ascii")
         self["name"] = name
 
     def run(self, service):
+        if self["all"]:
+            return self._run_all(service)
         volume = Volume(uuid=self["uuid"],
                         name=VolumeName.from_bytes(self["name"]),
                         service=service)
+        getting = self._receive_state(volume)
+
+        def got_state(state):
+            if self["resume-token"]:
+                sys.stdout.write((state.resume_token or b"") + b"\n")
+            for snapshot in state.snapshots:
+                sys.stdout.write(snapshot.to_bytes() + b"\n")
+
+        getting.addCallback(got_state)
+        return getting
+
+    def _receive_state(self, volume):
+        """
+        :param Volume volume: A local volume.
+
+        :return: ``Deferred`` that fires with the ``ReceiveState`` of the
+            volume, which only has a resume token if ``--resume-token`` was
+            given.
+        """
         filesystem = volume.get_filesystem()
-        snapshots = filesystem.snapshots()
+        if self["resume-token"]:
+            return query_receive_state(filesystem)
+        d = filesystem.snapshots()
+        d.addCallback(lambda snapshots: ReceiveState(snapshots=snapshots))
+        return d
+
+    def _run_all(self, service):
+        """
+        Write the snapshots, and resume tokens if asked for, of every
+        volume.
+
+        The pool is listed once to find the volumes, and the same listing
+        answers the snapshot queries for all of them.
 
-        def got_snapshots(snapshots):
-            for snapshot in snapshots:
-                sys.stdout.write(snapshot.name + b"\n")
+        :param VolumeService service: The service whose volumes to list.
 
-        snapshots.addCallback(got_snapshots)
-        return snapshots
+        :return: ``Deferred`` that fires once everything is written.
+        """
+        enumerating = service.enumerate()
+
+        def got_volumes(volumes):
+            volumes = list(volumes)
+            getting = gatherResults(
+                [self._receive_state(volume) for volume in volumes])
+            getting.addCallback(lambda states: zip(volumes, states))
+            return getting
+        enumerating.addCallback(got_volumes)
+
+        def got_states(results):
+            for volume, state in results:
+                prefix = [volume.uuid.encode("ascii"), volume.name.to_bytes()]
+                for snapshot in state.snapshots:
+                    sys.stdout.write(
+                        b"\t".join(prefix + [snapshot.to_bytes()]) + b"\n")
+                if state.resume_token is not None:
+                    sys.stdout.write(
+                        b"\t".join(prefix + [b"", state.resume_token]) +
+                        b"\n")
+        enumerating.addCallback(got_states)
+        return enumerating
 
 
 class _ReceiveSubcommandOptions(Options):
@@ -101,6 +185,9 @@ class _ReceiveSubcommandOptions(Options):
     Reads the volume in from standard in. This is typically called
     automatically over SSH.
 
+    With --acquire the volume is then acquired, as by the acquire command,
+    and this volume manager's UUID is written to standard out.
+
     Parameters:
 
     * owner-uuid: The UUID of the volume manager that owns the volume.
@@ -110,17 +197,48 @@ class _ReceiveSubcommandOptions(Options):
 
     synopsis = "<owner-uuid> <name>"
 
+    optFlags = [
+        ["acquire", None, "Take ownership of the volume once received."],
+    ]
+
+    optParameters = [
+        ["compression", None, None,
+         "How the data read from standard in is compressed, as "
+         "<algorithm>[:<level>].  Supported algorithms: " +
+         ", ".join(ALGORITHMS) + "."],
+    ]
+
     def parseArgs(self, uuid, name):
         self["uuid"] = uuid.decode("ascii")
         self["name"] = name
 
+    def postOptions(self):
+        if self["compression"] is not None:
+            try:
+                self["compression"] = Compression.from_bytes(
+                    self["compression"])
+            except ValueError as e:
+                raise UsageError(str(e))
+
     def run(self, service):
         """Run the action for this sub-command.
 
         :param VolumeService service: The volume manager service to utilize.
         """
-        service.receive(self["uuid"], VolumeName.from_bytes(self["name"]),
-                        sys.stdin)
+        name = VolumeName.from_bytes(self["name"])
+        if self["compression"] is None:
+            service.receive(self["uuid"], name, sys.stdin)
+        else:
+            with decompressing(self["compression"], sys.stdin) as input_file:
+                service.receive(self["uuid"], name, input_file)
+        if self["acquire"]:
+            d = service.acquire(self["uuid"], name)
+
+            def acquired(_):
+                sys.stdout.write(service.uuid.encode("ascii"))
+                sys.stdout.flush()
+            d.addCallback(acquired)
+            return d
 
 
 class _AcquireSubcommandOptions(Options):
@@ -162,6 +280,55 @@ class _AcquireSubcommandOptions(Options):
         return d
 
 
+class _CompressionsSubcommandOptions(Options):
+    """
+    Command line options for ``flocker-volume compressions``.
+    """
+
+    longdesc = """\
+    List the compression algorithms this volume manager can decompress, one
+    per line.  A volume may be received with --compression set to any of
+    them.
+    """
+
+    def run(self, service):
+        """
+        Run the action for this sub-command.
+
+        :param VolumeService service: The volume manager service to utilize.
+        """
+        for algorithm in available_algorithms():
+            sys.stdout.write(algorithm + b"\n")
+        return succeed(None)
+
+
+class _AgentSubcommandOptions(Options):
+    """
+    Command line options for ``flocker-volume agent``.
+    """
+
+    longdesc = """\
+    Connect to the volume agent run by flocker-serve on this node, relaying
+    standard in to it and its answers to standard out.  This is typically
+    called automatically over SSH by another node.
+    """
+
+    optParameters = [
+        ["socket", None, DEFAULT_AGENT_SOCKET.path,
+         "The path of the UNIX socket the agent listens on."],
+    ]
+
+    def run(self, reactor):
+        """
+        Run the action for this sub-command.  Unlike the others it needs no
+        ``VolumeService``.
+
+        :param reactor: The reactor to relay with.
+        """
+        return relay_stdio(
+            reactor, UNIXClientEndpoint(reactor, self["socket"]))
+
+
 class _CloneToSubcommandOptions(Options):
     """
     Command line options for ``flocker-volume clone_to``.
@@ -212,13 +379,17 @@ class VolumeOptions(Options):
 
     subCommands = [
         ["snapshots", None, _SnapshotsSubcommandOptions,
-         "List snapshots for a volume."],
+         "List snapshots for a volume, or for all volumes."],
         ["receive", None, _ReceiveSubcommandOptions,
          "Receive a remotely pushed volume."],
         ["acquire", None, _AcquireSubcommandOptions,
          "Acquire a remotely owned volume."],
         ["clone_to", None, _CloneToSubcommandOptions,
          "Clone an existing volume."],
+        ["compressions", None, _CompressionsSubcommandOptions,
+         "List the compression algorithms which can be received."],
+        ["agent", None, _AgentSubcommandOptions,
+         "Relay a connection to this node's volume agent."],
     ]
 
 
@@ -243,8 +414,36 @@ class VolumeManagerScript(object):
             return succeed(None)
 
 
+@implementer(ICommandLineScript)
+class FlockerVolumeScript(object):
+    """
+    The ``flocker-volume`` script.
+
+    ``flocker-volume agent`` only relays bytes, and is run over SSH for every
+    connection to the agent, so it is run without starting a
+    ``VolumeService``.  The other sub-commands are run by a ``VolumeScript``.
+    """
+    def __init__(self, volume_script=None):
+        """
+        :param volume_script: The ``ICommandLineScript`` which runs the
+            sub-commands that need a ``VolumeService``, by default a
+            ``VolumeScript`` wrapping a ``VolumeManagerScript``.
+        """
+        if volume_script is None:
+            volume_script = VolumeScript(VolumeManagerScript())
+        self._volume_script = volume_script
+
+    def main(self, reactor, options):
+        """
+        See :py:meth:`ICommandLineScript.main` for parameter documentation.
+        """
+        if options.subCommand == "agent":
+            return maybeDeferred(options.subOptions.run, reactor)
+        return self._volume_script.main(reactor, options)
+
+
 def flocker_volume_main():
     return FlockerScriptRunner(
-        script=VolumeScript(VolumeManagerScript()),
+        script=FlockerVolumeScript(),
         options=VolumeOptions()
     ).main()
@@ -10,15 +10,20 @@ from __future__ import absolute_import
 import sys
 import json
 import stat
+from errno import EEXIST
 from uuid import UUID, uuid4
 
 from zope.interface import Interface, implementer
 
 from characteristic import attributes
 
-from twisted.internet.defer import maybeDeferred
+from eliot import Logger, MessageType, Field, writeFailure
+
+from twisted.internet.defer import (
+    Deferred, maybeDeferred, succeed, gatherResults, FirstError)
 from twisted.internet.task import deferLater
 from twisted.python.filepath import FilePath
+from twisted.python.lockfile import FilesystemLock
 from twisted.application.service import Service
 from twisted.internet.defer import fail
 
@@ -27,19 +32,76 @@ from twisted.internet.defer import fail
 # part of https://github.com/ClusterHQ/flocker/issues/64
 from .filesystems.zfs import StoragePool
 from ._model import VolumeSize
+from ._compression import available_algorithms
+from ._retention import SnapshotPins
+from ._replication import Replication
+from ._registry import VolumeRegistry
+from ..common import (
+    IDescriptorConsumer, IDescriptorProducer, FilterConsumer, splice,
+    ThrottledConsumer, FinishingConsumer, gather_deferreds,
+)
 from ..common.script import ICommandLineScript
 
 DEFAULT_CONFIG_PATH = FilePath(b"/etc/flocker/volume.json")
+
 FLOCKER_MOUNTPOINT = FilePath(b"/flocker")
 FLOCKER_POOL = b"flocker"
 
+# Volumes being waited for are looked for this often at first, backing off
+# to the maximum while none of them turn up.  Volumes created or acquired
+# by the service itself are looked for straight away.  The maximum bounds
+# how long a volume acquired by another process, for example at the end of
+# a handoff, can go unnoticed, so it is kept short.
 WAIT_FOR_VOLUME_INTERVAL = 0.1
+WAIT_FOR_VOLUME_MAX_INTERVAL = 0.25
+
+# A handoff waiting for another process to finish pushing the same volume
+# checks whether it has finished this often, logs that it is still waiting
+# this often, and gives up after this long by default:
+VOLUME_LOCK_INTERVAL = 0.1
+VOLUME_LOCK_LOG_INTERVAL = 10.0
+VOLUME_LOCK_TIMEOUT = 300.0
+
+PRECOPY_ROUND = MessageType(
+    u"flocker:volume:service:precopy_round",
+    [Field.forTypes(u"volume", [unicode], u"The name of the volume."),
+     Field.forTypes(u"round", [int], u"How many pushes have been done."),
+     Field.forTypes(u"written", [int, long, None],
+                    u"Bytes written to the volume since the last push.")],
+    u"A volume was pushed while still in use, ahead of a handoff.")
+
+
+WAITING_FOR_VOLUME_LOCK = MessageType(
+    u"flocker:volume:service:waiting_for_lock",
+    [Field.forTypes(u"volume", [unicode], u"The name of the volume."),
+     Field.forTypes(u"waited", [float],
+                    u"Seconds spent waiting so far.")],
+    u"A volume's lock is held by another process, for example one pushing "
+    u"it to a standby node, and is being waited for.")
+
+
+COMPRESSION_UNAVAILABLE = MessageType(
+    u"flocker:volume:service:compression_unavailable",
+    [Field.forTypes(u"algorithm", [unicode],
+                    u"The compression algorithm asked for."),
+     Field.forTypes(u"where", [unicode],
+                    u"Which end lacks it, local or remote.")],
+    u"A volume was pushed uncompressed because the compression asked for "
+    u"cannot be done on one of the nodes.")
 
 
 class CreateConfigurationError(Exception):
     """Create the configuration file failed."""
 
 
+class VolumeWaitTimeout(Exception):
+    """A volume being waited for did not appear in time."""
+
+
+class VolumeLockTimeout(Exception):
+    """A volume's lock was not released by another process in time."""
+
+
 @attributes(["namespace", "id"])
 class VolumeName(object):
     """
@@ -95,7 +157,15 @@ class VolumeService(Service):
 
     :ivar unicode uuid: A unique identifier for this particular node's
         volume manager. Only available once the service has started.
+    :ivar SnapshotPins pins: The snapshots each peer is known to have.
+    :ivar dict replications: Map ``(VolumeName, peer)`` to the
+        ``Replication`` continuously pushing that volume to that peer.
+
+    The service keeps a ``VolumeRegistry`` of the volumes in its pool.  It is
+    filled when the service starts, kept up to date with the changes the
+    service makes, and reconciled with the pool by ``enumerate``.
     """
+    logger = Logger()
 
     def __init__(self, config_path, pool, reactor):
         """
@@ -103,11 +173,24 @@ class VolumeService(Service):
         :param pool: An object that is both a
             ``flocker.volume.filesystems.interface.IStoragePool`` provider
             and a ``twisted.application.service.IService`` provider.
-        :param reactor: A ``twisted.internet.interface.IReactorTime`` provider.
+        :param reactor: A ``twisted.internet.interface.IReactorTime`` provider,
+            which must also provide ``IReactorProcess`` for compressed
+            pushes.
         """
         self._config_path = config_path
         self.pool = pool
         self._reactor = reactor
+        self.pins = SnapshotPins(
+            config_path.sibling(b"snapshot-pins.json"))
+        self.replications = {}
+        self._registry = VolumeRegistry()
+        # Counts the changes made to the registry other than by enumerate:
+        self._registry_changes = 0
+        # Map (uuid, VolumeName) to the Deferreds waiting for that volume:
+        self._volume_waiters = {}
+        self._wait_interval = WAIT_FOR_VOLUME_INTERVAL
+        self._wait_call = None
+        self._looking = False
 
     def startService(self):
         Service.startService(self)
@@ -124,6 +207,9 @@ class VolumeService(Service):
         config = json.loads(self._config_path.getContent())
         self.uuid = config[u"uuid"]
         self.pool.startService()
+        loading = maybeDeferred(self.enumerate)
+        loading.addErrback(
+            writeFailure, self.logger, u"flocker:volume:service")
 
     def create(self, volume):
         """
@@ -140,6 +226,7 @@ class VolumeService(Service):
 
         def created(filesystem):
             self._make_public(filesystem)
+            self._register(volume)
             return volume
         d.addCallback(created)
         return d
@@ -156,6 +243,7 @@ class VolumeService(Service):
         d = self.pool.set_maximum_size(volume)
 
         def resized(filesystem):
+            self._register(volume)
             return volume
         d.addCallback(resized)
         return d
@@ -175,10 +263,70 @@ class VolumeService(Service):
 
         def created(filesystem):
             self._make_public(filesystem)
+            self._register(volume)
             return volume
         d.addCallback(created)
         return d
 
+    def _register(self, volume):
+        """
+        Record a volume which the service has added to its pool, or whose
+        data it has changed, and wake anything waiting for it.
+
+        :param Volume volume: The volume.
+        """
+        self._registry.add(volume)
+        self._registry_changes += 1
+        self._volumes_changed()
+
+    def _owner_changed(self, volume, new_volume):
+        """
+        Record that the owner of a volume in the pool has changed.
+
+        :param Volume volume: The volume with its old owner.
+        :param Volume new_volume: The volume with its new owner.
+        """
+        self._registry.remove(volume)
+        self._register(new_volume)
+
+    def lookup(self, name, uuid=None):
+        """
+        Find a volume in the registry, without looking at the pool.
+
+        The answer reflects the last ``enumerate`` and the changes this
+        service has made since; changes made by other processes are not seen
+        until the next ``enumerate``.
+
+        :param VolumeName name: The name of the volume.
+        :param unicode uuid: The UUID of the volume's owner, or ``None`` for
+            this service's.
+
+        :return: The ``Volume``, or ``None`` if it is not known.
+        """
+        if uuid is None:
+            uuid = self.uuid
+        return self._registry.get(uuid, name)
+
+    @property
+    def volumes_version(self):
+        """
+        A number which changes whenever the volumes known to ``lookup`` and
+        ``volumes_in_namespace`` change.
+        """
+        return self._registry.version
+
+    def volumes_in_namespace(self, namespace):
+        """
+        Find the volumes in a namespace in the registry, without looking at
+        the pool.  See ``lookup`` for how current the answer is.
+
+        :param unicode namespace: The namespace.
+
+        :return: A ``list`` of the ``Volume``\ s in the namespace, whoever
+            owns them.
+        """
+        return self._registry.in_namespace(namespace)
+
     def _make_public(self, filesystem):
         """
         Make a filesystem publically readable/writeable/executable.
@@ -210,45 +358,138 @@ class VolumeService(Service):
         """
         return Volume(uuid=self.uuid, name=name, service=self, **kwargs)
 
-    def wait_for_volume(self, name):
+    def wait_for_volume(self, name, timeout=None):
         """
         Wait for a volume by the given name, owned by thus service, to exist.
 
-        Polls the storage pool for the specified volume to appear.
+        The volume is looked for in the service's registry straight away and
+        whenever the service creates, receives or acquires a volume itself.
+        Volumes which appear some other way, e.g. acquired by another
+        process, are found by listing the storage pool, more rarely the
+        longer nothing turns up but at least every
+        ``WAIT_FOR_VOLUME_MAX_INTERVAL`` seconds.  One listing serves all the
+        volumes being waited for, and it is always made afresh rather than
+        taken from the pool's cache, which would not show the other
+        process's change.
 
         :param VolumeName name: The name of the volume.
+        :param float timeout: The number of seconds after which to give up,
+            or ``None`` to wait forever.
 
-        :return: A ``Deferred`` that fires with a :class:`Volume`.
+        :return: A ``Deferred`` that fires with a :class:`Volume`, or
+            errbacks with ``VolumeWaitTimeout`` if it did not appear in time.
+            Cancelling it stops the wait.
         """
-        def check_for_volume(uuid, name):
-            d = self.enumerate()
-            d.addCallback(compare_volumes_by_name_uuid, uuid, name)
-            return d
-
-        def compare_volumes_by_name_uuid(volumes, uuid, name):
-            """
-            Iterate the volumes managed by this service and compare the
-            UUID and the ``VolumeName`` to determine if we have found the
-            ``Volume`` instance requested by name.
-            """
-            for volume in volumes:
-                if volume.uuid == uuid and volume.name == name:
-                    return volume
-            return deferLater(
-                self._reactor, WAIT_FOR_VOLUME_INTERVAL,
-                check_for_volume, uuid, name
-            )
+        key = (self.uuid, name)
+        timeout_call = []
+
+        def cancel(waiter):
+            self._remove_volume_waiter(key, waiter)
+            if timeout_call:
+                timeout_call[0].cancel()
+        waiter = Deferred(cancel)
+        self._volume_waiters.setdefault(key, []).append(waiter)
+        if timeout is not None:
+            def timed_out():
+                del timeout_call[:]
+                self._remove_volume_waiter(key, waiter)
+                waiter.errback(VolumeWaitTimeout(name.to_bytes(), timeout))
+            timeout_call.append(self._reactor.callLater(timeout, timed_out))
+
+            def found(result):
+                if timeout_call:
+                    timeout_call.pop().cancel()
+                return result
+            waiter.addCallback(found)
+        self._volumes_changed()
+        return waiter
+
+    def _remove_volume_waiter(self, key, waiter):
+        """
+        Stop a ``Deferred`` returned by ``wait_for_volume`` waiting.
+
+        :param tuple key: The ``(uuid, VolumeName)`` it is waiting for.
+        :param Deferred waiter: The ``Deferred``.
+        """
+        waiters = self._volume_waiters.get(key, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self._volume_waiters.pop(key, None)
+        if not self._volume_waiters and self._wait_call is not None:
+            self._wait_call.cancel()
+            self._wait_call = None
+
+    def _volumes_changed(self):
+        """
+        Wake what is waiting for volumes that are now in the registry, and
+        look in the pool for the rest soon, backing off from the shortest
+        interval again.
+        """
+        self._wait_interval = WAIT_FOR_VOLUME_INTERVAL
+        self._wake_volume_waiters()
+        if self._wait_call is not None:
+            self._wait_call.cancel()
+            self._wait_call = None
+        self._schedule_look()
+
+    def _wake_volume_waiters(self):
+        """
+        Fire the ``Deferred``\ s waiting for volumes which are in the
+        registry.
+        """
+        for key in list(self._volume_waiters):
+            volume = self._registry.get(*key)
+            if volume is not None:
+                for waiter in self._volume_waiters.pop(key):
+                    waiter.callback(volume)
 
-        return check_for_volume(self.uuid, name)
+    def _schedule_look(self):
+        """
+        If volumes are still being waited for, look for them in the pool
+        after the current interval, and double the interval for next time.
+        """
+        if (self._volume_waiters and self._wait_call is None and
+                not self._looking):
+            self._wait_call = self._reactor.callLater(
+                self._wait_interval, self._look_for_volumes)
+            self._wait_interval = min(
+                self._wait_interval * 2, WAIT_FOR_VOLUME_MAX_INTERVAL)
+
+    def _look_for_volumes(self):
+        """
+        Reconcile the registry with the pool, once for all the volumes being
+        waited for, and wake what is waiting for any that turned up.
+        """
+        self._wait_call = None
+        self._looking = True
+        self.pool.invalidate()
+        enumerating = self.enumerate()
+
+        def done(result):
+            self._looking = False
+            self._wake_volume_waiters()
+            self._schedule_look()
+            return result
+        enumerating.addBoth(done)
+        enumerating.addErrback(
+            writeFailure, self.logger, u"flocker:volume:service")
 
     def enumerate(self):
         """Get a listing of all volumes managed by this service.
 
+        The registry is reconciled with the listing.  The listing may come
+        from the pool's cache, so it can miss changes made by other
+        processes in the last ``POOL_STATE_MAX_AGE`` seconds unless
+        ``self.pool.invalidate()`` is called first.
+
         :return: A ``Deferred`` that fires with an iterator of :class:`Volume`.
         """
+        changes = self._registry_changes
         enumerating = self.pool.enumerate()
 
         def enumerated(filesystems):
+            volumes = []
             for filesystem in filesystems:
                 # XXX It so happens that this works but it's kind of a
                 # fragile way to recover the information:
@@ -271,19 +512,31 @@ class VolumeService(Service):
                 # Probably shouldn't yield this volume if the uuid doesn't
                 # match this service's uuid.
 
-                yield Volume(
+                volumes.append(Volume(
                     uuid=unicode(uuid),
                     name=name,
                     service=self,
-                    size=filesystem.size)
+                    size=filesystem.size))
+            if changes == self._registry_changes:
+                self._registry.reset(volumes)
+            else:
+                # The listing may predate changes made while it was being
+                # retrieved, so it can add to the registry but not remove:
+                for volume in volumes:
+                    self._registry.add(volume)
+            return volumes
         enumerating.addCallback(enumerated)
         return enumerating
 
-    def push(self, volume, destination):
+    def push(self, volume, destination, compression=None, peer=None,
+             rate_limit=None, remote_state=None, acquire=False):
         """
         Push the latest data in the volume to a remote destination.
 
-        This is a blocking API for now.
+        The data is streamed from the volume's filesystem to the destination
+        without blocking, with the destination's ability to accept data
+        controlling how fast it is read.  If a previous push to the
+        destination was interrupted, the rest of it is sent first.
 
         Only locally owned volumes (i.e. volumes whose ``uuid`` matches
         this service's) can be pushed.
@@ -293,22 +546,266 @@ class VolumeService(Service):
         :param IRemoteVolumeManager destination: The remote volume manager
             to push to.
 
+        :param Compression compression: How to compress the data on its way
+            to the destination, or ``None`` to send it uncompressed.
+            Compression requires the service's reactor to provide
+            ``IReactorProcess``.  The data is sent uncompressed instead if
+            this node or the destination cannot handle the algorithm.
+
+        :param unicode peer: Identifies the destination, e.g. its hostname.
+            If given, the snapshot the destination now has is pinned in
+            ``pins`` so it is kept as the base for the next push.
+
+        :param int rate_limit: The maximum average rate, in bytes per second,
+            at which to send data to the destination, or ``None`` for no
+            limit.  Limited data passes through this process.
+
+        :param ReceiveState remote_state: What the destination is already
+            known to have of the volume, e.g. from
+            ``IRemoteVolumeManager.receive_state_many``, or ``None`` to ask
+            the destination.
+
+        :param bool acquire: If true, the destination also acquires the
+            volume once it has received the latest data, in the same remote
+            operation.
+
         :raises ValueError: If the uuid of the volume is different than
             our own; only locally-owned volumes can be pushed.
+
+        :return: ``Deferred`` that fires once the destination has received
+            the data, with ``None``, or if ``acquire`` is true with the
+            destination's UUID once it has also acquired the volume.
         """
         if volume.uuid != self.uuid:
             raise ValueError()
         fs = volume.get_filesystem()
-        getting_snapshots = destination.snapshots(volume)
+        pushing = self._usable_compression(destination, compression)
+        pushing.addCallback(
+            lambda compression: self._update(
+                volume, destination, compression, rate_limit, remote_state,
+                acquire))
+        if peer is not None:
+            def pin(result):
+                # The newest local snapshot is the one just sent:
+                pinning = fs.snapshots()
+                pinning.addCallback(
+                    lambda snapshots: self.pins.pin(
+                        volume, peer, snapshots[-1]) if snapshots else None)
+                pinning.addCallback(lambda _: result)
+                return pinning
+            pushing.addCallback(pin)
+        return pushing
 
-        def got_snapshots(snapshots):
-            with destination.receive(volume) as receiver:
-                with fs.reader(snapshots) as contents:
-                    for chunk in iter(lambda: contents.read(1024 * 1024), b""):
-                        receiver.write(chunk)
+    def _usable_compression(self, destination, compression):
+        """
+        Check that both this node and a destination can handle a compression
+        algorithm.
 
-        pushing = getting_snapshots.addCallback(got_snapshots)
-        return pushing
+        :param IRemoteVolumeManager destination: The remote volume manager
+            to push to.
+        :param Compression compression: The compression asked for, or
+            ``None``.
+
+        :return: ``Deferred`` that fires with ``compression`` if it can be
+            used, or otherwise ``None`` so that the data is sent
+            uncompressed.
+        """
+        if compression is None:
+            return succeed(None)
+        if compression.algorithm not in available_algorithms():
+            COMPRESSION_UNAVAILABLE(
+                algorithm=compression.algorithm.decode("ascii"),
+                where=u"local").write(self.logger)
+            return succeed(None)
+        checking = destination.compressions()
+
+        def got_algorithms(algorithms):
+            if compression.algorithm in algorithms:
+                return compression
+            COMPRESSION_UNAVAILABLE(
+                algorithm=compression.algorithm.decode("ascii"),
+                where=u"remote").write(self.logger)
+            return None
+        checking.addCallback(got_algorithms)
+        return checking
+
+    def _update(self, volume, destination, compression, rate_limit,
+                remote_state, acquire):
+        """
+        Bring a destination up to date with the latest data in a volume,
+        first finishing any interrupted push.
+
+        The parameters are those of ``push``.
+
+        :return: ``Deferred`` that fires with the result of the last
+            ``_send_stream``.
+        """
+        fs = volume.get_filesystem()
+        if remote_state is None:
+            getting_state = destination.receive_state(volume)
+        else:
+            getting_state = succeed(remote_state)
+
+        def got_state(state):
+            # If an earlier push was interrupted, finish sending that stream
+            # first so only the bytes which did not arrive are sent again.
+            # That changes what the destination has, so it has to be asked
+            # for its snapshots again afterwards:
+            if state.resume_token is not None:
+                resuming = self._send_stream(
+                    volume, destination, compression, rate_limit,
+                    lambda: fs.reader_stream(resume_token=state.resume_token))
+                resuming.addCallback(lambda _: destination.snapshots(volume))
+                return resuming
+            return state.snapshots
+        getting_state.addCallback(got_state)
+
+        # Then bring the destination up to date with the latest data:
+        getting_state.addCallback(
+            lambda snapshots: self._send_stream(
+                volume, destination, compression, rate_limit,
+                lambda: fs.reader_stream(snapshots), acquire))
+        return getting_state
+
+    def precopy(self, volume, destination, threshold, budget,
+                compression=None, peer=None, remote_state=None):
+        """
+        Push a volume repeatedly, while it is still in use, until little
+        enough data has changed since the last push that a final push will be
+        quick.
+
+        This is the first stage of a handoff with little downtime: once it
+        finishes the volume's users can be stopped and the volume handed off.
+
+        :param Volume volume: The volume to push.
+        :param IRemoteVolumeManager destination: The remote volume manager
+            to push to.
+        :param int threshold: Stop once fewer than this many bytes have been
+            written since the last push.
+        :param float budget: Stop starting new pushes once this many seconds
+            have passed, however much has been written.
+        :param Compression compression: See ``push``.
+        :param unicode peer: See ``push``.
+        :param ReceiveState remote_state: See ``push``; used for the first
+            push only.
+
+        :return: ``Deferred`` that fires with the number of bytes written
+            since the last push, or ``None`` if this is unknown, once the
+            pushing has finished.
+        """
+        started = self._reactor.seconds()
+        fs = volume.get_filesystem()
+
+        def push_again(rounds):
+            pushing = maybeDeferred(
+                self.push, volume, destination, compression, peer,
+                remote_state=remote_state if rounds == 1 else None)
+            pushing.addCallback(lambda _: fs.snapshots())
+            pushing.addCallback(
+                lambda snapshots: fs.written_since(snapshots[-1])
+                if snapshots else None)
+
+            def estimated(written):
+                PRECOPY_ROUND(
+                    volume=volume.name.to_bytes().decode("ascii"),
+                    round=rounds, written=written).write(self.logger)
+                if (written is None or written < threshold or
+                        self._reactor.seconds() - started >= budget):
+                    return written
+                return push_again(rounds + 1)
+            pushing.addCallback(estimated)
+            return pushing
+        return push_again(1)
+
+    def precopy_many(self, volumes, destination, threshold, budget,
+                     compression=None, peer=None, limiter=None):
+        """
+        Pre-copy several volumes to the same destination at once.
+
+        The destination is asked for the snapshots and resume tokens of all
+        the volumes in one query, rather than one query per volume, and then
+        each volume is pre-copied as by ``precopy`` without asking again for
+        the first push.
+
+        :param volumes: The ``Volume`` instances to push.
+        :param IRemoteVolumeManager destination: The remote volume manager
+            to push to.
+        :param int threshold: See ``precopy``.
+        :param float budget: See ``precopy``.
+        :param Compression compression: See ``push``.
+        :param unicode peer: See ``push``.
+        :param PriorityLimiter limiter: If not ``None``, each volume is
+            pre-copied through this limiter.  Volumes the destination already
+            has a snapshot of only need an incremental stream, so they are
+            given priority over volumes which must be sent in full.
+
+        :return: ``Deferred`` that fires with a ``list`` of the results of
+            ``precopy`` for each volume, in order, once all the pushing has
+            finished, or errbacks with the first failure.
+        """
+        volumes = list(volumes)
+        getting_states = destination.receive_state_many(volumes)
+
+        def got_states(remote_states):
+            # Map volumes to the priority of pre-copying them:
+            priorities = {volume: 0 if remote_states[volume].snapshots else 1
+                          for volume in volumes}
+            precopies = {}
+            for volume in sorted(volumes, key=priorities.get):
+                arguments = (volume, destination, threshold, budget,
+                             compression, peer, remote_states[volume])
+                if limiter is None:
+                    precopies[volume] = self.precopy(*arguments)
+                else:
+                    precopies[volume] = limiter.run(
+                        priorities[volume], self.precopy, *arguments)
+            return gatherResults([precopies[volume] for volume in volumes],
+                                 consumeErrors=True)
+        getting_states.addCallback(got_states)
+
+        def first_failure(reason):
+            reason.trap(FirstError)
+            return reason.value.subFailure
+        getting_states.addErrback(first_failure)
+        return getting_states
+
+    def _send_stream(self, volume, destination, compression, rate_limit,
+                     make_producer, acquire=False):
+        """
+        Send one stream of a volume's data to a remote destination.
+
+        :param Volume volume: The volume being pushed.
+        :param IRemoteVolumeManager destination: The remote volume manager
+            to push to.
+        :param Compression compression: See ``push``.
+        :param int rate_limit: See ``push``.
+        :param make_producer: Callable returning the ``IStreamProducer`` for
+            the stream, called once the destination is ready.
+        :param bool acquire: See ``push``.
+
+        :return: ``Deferred`` that fires once the destination has received
+            the stream, with ``None`` or if ``acquire`` is true with the
+            destination's UUID.
+        """
+        if acquire:
+            receiving = destination.receive_and_acquire_stream(
+                volume, compression)
+        else:
+            receiving = destination.receive_stream(volume, compression)
+        if rate_limit is not None:
+            # Limit what is sent to the destination, i.e. after compression:
+            receiving.addCallback(
+                lambda consumer: ThrottledConsumer(
+                    self._reactor, consumer, rate_limit))
+        if compression is not None:
+            receiving.addCallback(
+                lambda consumer: FilterConsumer(
+                    self._reactor, compression.compress_command(), consumer))
+        receiving.addCallback(
+            lambda consumer: _send_to(make_producer(), consumer))
+        if not acquire:
+            receiving.addCallback(lambda _: None)
+        return receiving
 
     def receive(self, volume_uuid, volume_name, input_file):
         """
@@ -333,6 +830,76 @@ class VolumeService(Service):
         with volume.get_filesystem().writer() as writer:
             for chunk in iter(lambda: input_file.read(1024 * 1024), b""):
                 writer.write(chunk)
+        self._received(volume)
+
+    def _received(self, volume):
+        """
+        Record that a remotely owned volume has been received.
+
+        :param Volume volume: The volume.
+        """
+        if self._registry.get(volume.uuid, volume.name) is None:
+            self._register(volume)
+
+    def receive_stream(self, volume_uuid, volume_name, compression=None):
+        """
+        Non-blocking equivalent of ``receive``.
+
+        :param unicode volume_uuid: The volume's UUID.
+        :param VolumeName volume_name: The volume's name.
+        :param Compression compression: How the data written to the consumer
+            is compressed, or ``None`` if it is not compressed.
+
+        :raises ValueError: If the uuid of the volume matches our own;
+            remote nodes can't overwrite locally-owned volumes.
+
+        :return: ``Deferred`` that fires with an
+            ``flocker.common.IStreamConsumer`` provider to which the volume's
+            data should be written.
+        """
+        if volume_uuid == self.uuid:
+            raise ValueError()
+        volume = Volume(uuid=volume_uuid, name=volume_name, service=self)
+
+        def received(result):
+            self._received(volume)
+            return result
+        writing = volume.get_filesystem().writer_stream()
+        writing.addCallback(
+            lambda consumer: FinishingConsumer(consumer, received))
+        if compression is not None:
+            writing.addCallback(
+                lambda consumer: FilterConsumer(
+                    self._reactor, compression.decompress_command(),
+                    consumer))
+        return writing
+
+    def receive_and_acquire_stream(self, volume_uuid, volume_name,
+                                   compression=None):
+        """
+        Receive a volume's data as by ``receive_stream``, then take ownership
+        of the volume as by ``acquire``.
+
+        :param unicode volume_uuid: The volume's UUID.
+        :param VolumeName volume_name: The volume's name.
+        :param Compression compression: See ``receive_stream``.
+
+        :raises ValueError: If the uuid of the volume matches our own.
+
+        :return: ``Deferred`` that fires with an
+            ``flocker.common.IStreamConsumer`` provider to which the volume's
+            data should be written.  Finishing it fires with this service's
+            UUID once the volume has been updated and acquired.
+        """
+        receiving = self.receive_stream(volume_uuid, volume_name, compression)
+
+        def acquire(_):
+            acquiring = self.acquire(volume_uuid, volume_name)
+            acquiring.addCallback(lambda _: self.uuid)
+            return acquiring
+        receiving.addCallback(
+            lambda consumer: FinishingConsumer(consumer, acquire))
+        return receiving
 
     def acquire(self, volume_uuid, volume_name):
         """
@@ -354,7 +921,124 @@ class VolumeService(Service):
         volume = Volume(uuid=volume_uuid, name=volume_name, service=self)
         return volume.change_owner(self.uuid)
 
-    def handoff(self, volume, destination):
+    def replicate(self, name, destination, peer, interval, compression=None,
+                  rate_limit=None):
+        """
+        Keep pushing a volume to a standby node, so that a later handoff to
+        that node only has a little data left to send.
+
+        :param VolumeName name: The name of the volume.
+        :param IRemoteVolumeManager destination: The standby node's volume
+            manager.
+        :param unicode peer: Identifies the standby node, e.g. its hostname.
+        :param float interval: Seconds between the starts of pushes.
+        :param Compression compression: See ``push``.
+        :param int rate_limit: See ``push``.
+
+        :return: The started ``Replication``, whose attributes describe how
+            far behind the standby node is.
+        """
+        key = (name, peer)
+        if key in self.replications:
+            self.replications.pop(key).stop()
+        replication = Replication(
+            self, name, destination, peer, interval, compression,
+            rate_limit)
+        self.replications[key] = replication
+        replication.start()
+        return replication
+
+    def _volume_lock(self, name):
+        """
+        Get the lock held while a volume is pushed by replication or handed
+        off.
+
+        Replications run in ``flocker-serve`` but handoffs in
+        ``flocker-changestate``, so the lock is a file next to the
+        configuration file, shared by all the services using it.
+
+        :param VolumeName name: The name of the volume.
+
+        :return: A ``FilesystemLock``.
+        """
+        locks = self._config_path.sibling(b"volume-locks")
+        try:
+            locks.makedirs()
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+        return FilesystemLock(locks.child(name.to_bytes()).path)
+
+    def _lock_volume(self, name, timeout=VOLUME_LOCK_TIMEOUT):
+        """
+        Take a volume's lock (see ``_volume_lock``), waiting for whoever holds
+        it to release it first.
+
+        A lock is only taken away from its holder once the holder's process
+        has exited, so one which has hung, for example pushing over a stuck
+        SSH connection, would otherwise be waited for forever.
+
+        :param VolumeName name: The name of the volume.
+        :param float timeout: Seconds to wait before giving up.
+
+        :return: ``Deferred`` that fires with the held ``FilesystemLock``, or
+            errbacks with ``VolumeLockTimeout`` if it was not released in
+            time.  The pool's cache has been invalidated, since the previous
+            holder may have changed the volume from another process.
+        """
+        started = self._reactor.seconds()
+        last_logged = [None]
+
+        def attempt():
+            locking = maybeDeferred(self._volume_lock, name)
+
+            def got_lock(lock):
+                if lock.lock():
+                    self.pool.invalidate()
+                    return lock
+                now = self._reactor.seconds()
+                waited = now - started
+                if waited >= timeout:
+                    raise VolumeLockTimeout(name.to_bytes(), timeout)
+                if (last_logged[0] is None or
+                        now - last_logged[0] >= VOLUME_LOCK_LOG_INTERVAL):
+                    last_logged[0] = now
+                    WAITING_FOR_VOLUME_LOCK(
+                        volume=name.to_bytes().decode("ascii"),
+                        waited=float(waited)).write(self.logger)
+                return deferLater(
+                    self._reactor, VOLUME_LOCK_INTERVAL, attempt)
+            locking.addCallback(got_lock)
+            return locking
+        return attempt()
+
+    def stop_replicating(self, name, peer=None):
+        """
+        Stop pushing a volume to standby nodes.
+
+        :param VolumeName name: The name of the volume.
+        :param unicode peer: The standby node to stop pushing to, or ``None``
+            to stop pushing to all of them.
+
+        :return: ``Deferred`` that fires once any pushes in progress have
+            finished.
+        """
+        stopping = []
+        for key in list(self.replications):
+            if key[0] == name and peer in (None, key[1]):
+                stopping.append(self.replications.pop(key).stop())
+        return gather_deferreds(stopping)
+
+    def stopService(self):
+        for name, peer in list(self.replications):
+            self.stop_replicating(name, peer)
+        if self._wait_call is not None:
+            self._wait_call.cancel()
+            self._wait_call = None
+        Service.stopService(self)
+
+    def handoff(self, volume, destination, compression=None, peer=None,
+                lock_timeout=VOLUME_LOCK_TIMEOUT):
         """
         Handoff a locally owned volume to a remote destination.
 
@@ -366,18 +1050,78 @@ class VolumeService(Service):
         :param Volume volume: The volume to handoff.
         :param IRemoteVolumeManager destination: The remote volume manager
             to handoff to.
+        :param Compression compression: See ``push``.
+        :param unicode peer: See ``push``.
+        :param float lock_timeout: Seconds to wait for another process to
+            release the volume's lock.
+
+        Replication of the volume is stopped first, since it cannot continue
+        once the volume is owned by another node.  Replications run by other
+        processes, e.g. ``flocker-serve``, are kept out by taking the
+        volume's lock, after any push they have in progress.  The destination
+        receives the final data and acquires the volume in a single
+        operation.
 
         :return: ``Deferred`` that fires when the handoff has finished, or
             errbacks on error (specifcally with a ``ValueError`` if the
-            volume is not locally owned).
+            volume is not locally owned, or ``VolumeLockTimeout`` if its lock
+            was not released in time).
         """
-        pushing = maybeDeferred(self.push, volume, destination)
+        locking = self.stop_replicating(volume.name)
+        locking.addCallback(
+            lambda _: self._lock_volume(volume.name, lock_timeout))
+
+        def locked(lock):
+            pushing = maybeDeferred(
+                self.push, volume, destination, compression, peer,
+                acquire=True)
+            pushing.addCallback(volume.change_owner)
+
+            def unlock(result):
+                lock.unlock()
+                return result
+            pushing.addBoth(unlock)
+            return pushing
+        locking.addCallback(locked)
+        return locking
+
+
+def _send_to(producer, consumer):
+    """
+    Write the whole stream from a producer to a consumer and then finish the
+    consumer.
+
+    The consumer is finished even if the producer fails, so that whatever is
+    processing the stream (for example a remote process) does not wait for
+    more data forever.
+
+    If both ends are backed by file descriptors (for example ``zfs send``
+    and an SSH process) they are spliced together with a pipe, so the data
+    never passes through this process.
+
+    :param IStreamProducer producer: Source of the stream.
+    :param IStreamConsumer consumer: Destination of the stream.
+
+    :return: ``Deferred`` that fires with the result of finishing the
+        consumer once it has processed the stream, or errbacks with the
+        producer's failure if there was one, otherwise with the consumer's
+        failure.
+    """
+    if (IDescriptorProducer.providedBy(producer) and
+            IDescriptorConsumer.providedBy(consumer)):
+        producing = maybeDeferred(splice, producer, consumer)
+    else:
+        producing = maybeDeferred(producer.startProducing, consumer)
+
+    def produced(_):
+        return consumer.finish()
 
-        def pushed(ignored):
-            remote_uuid = destination.acquire(volume)
-            return volume.change_owner(remote_uuid)
-        changing_owner = pushing.addCallback(pushed)
-        return changing_owner
+    def production_failed(reason):
+        finishing = consumer.finish()
+        finishing.addBoth(lambda _: reason)
+        return finishing
+    producing.addCallbacks(produced, production_failed)
+    return producing
 
 
 @attributes(["uuid", "name", "service", "size"],
@@ -415,6 +1159,7 @@ class Volume(object):
         d = self.service.pool.change_owner(self, new_volume)
 
         def filesystem_changed(_):
+            self.service._owner_changed(self, new_volume)
             return new_volume
         d.addCallback(filesystem_changed)
         return d
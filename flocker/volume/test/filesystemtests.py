@@ -83,6 +83,32 @@ def copy(from_volume, to_volume):
     return getting_snapshots
 
 
+def stream_copy(from_volume, to_volume):
+    """Copy contents of one volume to another using the streaming APIs.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+
+    :return: ``Deferred`` that fires when the copy is complete.
+    """
+    from_filesystem = from_volume.get_filesystem()
+    to_filesystem = to_volume.get_filesystem()
+    getting_snapshots = to_filesystem.snapshots()
+
+    def got_snapshots(snapshots):
+        writing = to_filesystem.writer_stream()
+
+        def got_consumer(consumer):
+            producing = from_filesystem.reader_stream(
+                snapshots).startProducing(consumer)
+            producing.addCallback(lambda _: consumer.finish())
+            return producing
+        writing.addCallback(got_consumer)
+        return writing
+    getting_snapshots.addCallback(got_snapshots)
+    return getting_snapshots
+
+
 @attributes(["from_volume", "to_volume"])
 class CopyVolumes(object):
     """A pair of volumes that had data copied from one to the other.
@@ -487,6 +513,29 @@ def make_istoragepool_tests(fixture):
             d.addCallback(got_volumes)
             return d
 
+        def test_stream_update_to_unchanged_filesystem(self):
+            """
+            Streaming an update of the contents of one pool's filesystem to
+            another pool's filesystem that was previously created updates its
+            contents.
+            """
+            d = create_and_copy(self, fixture)
+
+            def got_volumes(copy_volumes):
+                path = copy_volumes.from_volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello")
+                path.child(b"file").remove()
+                copying = stream_copy(
+                    copy_volumes.from_volume, copy_volumes.to_volume)
+
+                def copied(ignored):
+                    assertVolumesEqual(
+                        self, copy_volumes.from_volume, copy_volumes.to_volume)
+                copying.addCallback(copied)
+                return copying
+            d.addCallback(got_volumes)
+            return d
+
         def test_multiple_writes(self):
             """
             Writing the same contents to a filesystem twice does not result in
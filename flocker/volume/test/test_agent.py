@@ -0,0 +1,544 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._agent`.
+"""
+
+from __future__ import absolute_import
+
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.test.iosim import connect, makeFakeClient, makeFakeServer
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import _agent as agent_module
+from .._agent import (
+    VolumeAgent, VolumeAgentFactory, AgentVolumeManager, agent_endpoint,
+    NodeVolumeManager, node_volume_manager, ReceiveChunk, CHUNK_SIZE, WINDOW,
+    _IncomingStream, _OutgoingStream,
+)
+from .._ipc import (
+    IRemoteVolumeManager, RemoteVolumeManager, ReceiveState, standard_node,
+)
+from ..service import Volume, VolumeName
+from ..testtools import create_volume_service
+from ...common import MemoryConsumer
+from ...common.test.test_ipc import RecordingProducer
+
+
+MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvol")
+MY_VOLUME2 = VolumeName(namespace=u"myns", id=u"myvol2")
+
+
+@implementer(IStreamClientEndpoint)
+class MemoryAgentEndpoint(object):
+    """
+    Connect to a ``VolumeAgent`` in memory.
+
+    :ivar list pumps: The ``IOPump`` for each connection made.
+    """
+    def __init__(self, service):
+        """
+        :param VolumeService service: The service the agent uses.
+        """
+        self._service = service
+        self.pumps = []
+
+    def connect(self, factory):
+        client = factory.buildProtocol(None)
+        server = VolumeAgent(self._service)
+        self.pumps.append(connect(server, makeFakeServer(server),
+                                  client, makeFakeClient(client)))
+        return succeed(client)
+
+    def flush(self):
+        """
+        Deliver all the data sent over all connections.
+        """
+        for pump in self.pumps:
+            pump.flush()
+
+
+class AgentVolumeManagerTests(SynchronousTestCase):
+    """
+    Tests for ``AgentVolumeManager`` talking to a ``VolumeAgent``.
+    """
+    def setUp(self):
+        self.from_service = create_volume_service(self)
+        self.to_service = create_volume_service(self)
+        self.endpoint = MemoryAgentEndpoint(self.to_service)
+        self.remote = AgentVolumeManager(self.endpoint)
+
+    def result(self, d):
+        """
+        Deliver the requests and responses for an operation.
+
+        :param Deferred d: The result of the operation.
+
+        :return: The result the operation succeeded with.
+        """
+        self.endpoint.flush()
+        return self.successResultOf(d)
+
+    def create(self, name=MY_VOLUME):
+        """
+        Create a volume on the origin service.
+
+        :return: The ``Volume``.
+        """
+        return self.successResultOf(
+            self.from_service.create(self.from_service.get(name)))
+
+    def remote_volume(self, volume):
+        """
+        :return: The copy of an origin volume on the destination service.
+        """
+        return Volume(uuid=volume.uuid, name=volume.name,
+                      service=self.to_service)
+
+    def test_interface(self):
+        """
+        ``AgentVolumeManager`` provides ``IRemoteVolumeManager``.
+        """
+        self.assertTrue(verifyObject(IRemoteVolumeManager, self.remote))
+
+    def test_snapshots_no_filesystem(self):
+        """
+        If the filesystem does not exist on the remote manager, an empty list
+        of snapshots is returned.
+        """
+        volume = self.create()
+        self.assertEqual(self.result(self.remote.snapshots(volume)), [])
+
+    def test_snapshots(self):
+        """
+        ``AgentVolumeManager.snapshots`` returns the snapshots of the remote
+        copy of the volume.
+        """
+        volume = self.create()
+        self.result(self.from_service.push(volume, self.remote))
+        filesystem = self.remote_volume(volume).get_filesystem()
+        filesystem.snapshot(b"first")
+        filesystem.snapshot(b"second")
+        self.assertEqual(
+            self.result(self.remote.snapshots(volume)),
+            self.successResultOf(filesystem.snapshots()))
+
+    def test_receive_state_many(self):
+        """
+        ``AgentVolumeManager.receive_state_many`` returns the state of the
+        remote copy of each of the volumes.
+        """
+        volume = self.create()
+        other = self.create(MY_VOLUME2)
+        self.result(self.from_service.push(volume, self.remote))
+        self.remote_volume(volume).get_filesystem().snapshot(b"first")
+        self.assertEqual(
+            self.result(self.remote.receive_state_many([volume, other])),
+            {volume: ReceiveState(snapshots=self.successResultOf(
+                self.remote_volume(volume).get_filesystem().snapshots())),
+             other: ReceiveState(snapshots=[])})
+
+    def test_receive_state(self):
+        """
+        ``AgentVolumeManager.receive_state`` returns the snapshots of the
+        remote copy of the volume and, if no push of the volume was
+        interrupted, no resume token.
+        """
+        volume = self.create()
+        self.result(self.from_service.push(volume, self.remote))
+        self.remote_volume(volume).get_filesystem().snapshot(b"first")
+        self.assertEqual(
+            self.result(self.remote.receive_state(volume)),
+            ReceiveState(snapshots=self.successResultOf(
+                self.remote_volume(volume).get_filesystem().snapshots())))
+
+    def test_push(self):
+        """
+        Pushing a volume to an ``AgentVolumeManager`` recreates its files on
+        the remote manager, even when there is more data than fits in one
+        chunk.
+        """
+        volume = self.create()
+        data = b"".join(chr(i % 251) for i in range(CHUNK_SIZE * 3))
+        volume.get_filesystem().get_path().child(b"afile").setContent(data)
+        self.result(self.from_service.push(volume, self.remote))
+        self.assertEqual(
+            self.remote_volume(volume).get_filesystem().get_path().child(
+                b"afile").getContent(),
+            data)
+
+    def test_push_acquire(self):
+        """
+        Pushing a volume to an ``AgentVolumeManager`` with ``acquire`` has
+        the remote manager take ownership of its copy once received, and
+        gives the remote manager's UUID.
+        """
+        volume = self.create()
+        volume.get_filesystem().get_path().child(b"afile").setContent(b"x")
+        remote_uuid = self.result(
+            self.from_service.push(volume, self.remote, acquire=True))
+        acquired = Volume(uuid=self.to_service.uuid, name=MY_VOLUME,
+                          service=self.to_service)
+        self.assertEqual(
+            (remote_uuid,
+             acquired.get_filesystem().get_path().child(
+                 b"afile").getContent()),
+            (self.to_service.uuid, b"x"))
+
+    def test_receive_own_volume(self):
+        """
+        The ``Deferred`` returned by ``receive_stream`` errbacks with
+        ``ValueError`` if the volume is owned by the remote manager.
+        """
+        volume = self.successResultOf(
+            self.to_service.create(self.to_service.get(MY_VOLUME)))
+        d = self.remote.receive_stream(volume)
+        self.endpoint.flush()
+        self.failureResultOf(d, ValueError)
+
+    def test_compressions(self):
+        """
+        ``AgentVolumeManager.compressions`` returns the compression algorithms
+        the agent can decompress, asking it only the first time.
+        """
+        self.patch(agent_module, "available_algorithms", lambda: [b"zlib"])
+        first = self.result(self.remote.compressions())
+        self.patch(agent_module, "available_algorithms", lambda: [])
+        self.assertEqual((first, self.result(self.remote.compressions())),
+                         ([b"zlib"], [b"zlib"]))
+
+    def test_acquire(self):
+        """
+        ``AgentVolumeManager.acquire`` changes the owner of the remote copy
+        of the volume to the remote manager, and returns the remote manager's
+        UUID.
+        """
+        volume = self.create()
+        self.result(self.from_service.push(volume, self.remote))
+        remote_uuid = self.result(self.remote.acquire(volume))
+        self.assertEqual(
+            (remote_uuid, list(self.successResultOf(
+                self.to_service.enumerate()))),
+            (self.to_service.uuid,
+             [Volume(uuid=self.to_service.uuid, name=MY_VOLUME,
+                     service=self.to_service)]))
+
+    def test_acquire_own_volume(self):
+        """
+        The ``Deferred`` returned by ``acquire`` errbacks with ``ValueError``
+        if the volume is already owned by the remote manager.
+        """
+        volume = self.successResultOf(
+            self.to_service.create(self.to_service.get(MY_VOLUME)))
+        d = self.remote.acquire(volume)
+        self.endpoint.flush()
+        self.failureResultOf(d, ValueError)
+
+    def test_handoff(self):
+        """
+        A volume can be handed off to an ``AgentVolumeManager``.
+        """
+        volume = self.create()
+        self.result(self.from_service.handoff(volume, self.remote))
+        self.assertEqual(
+            [v.uuid for v in self.successResultOf(
+                self.from_service.enumerate())],
+            [self.to_service.uuid])
+
+    def test_clone_to(self):
+        """
+        ``AgentVolumeManager.clone_to`` clones a volume on the remote
+        manager.
+        """
+        parent = self.successResultOf(
+            self.to_service.create(self.to_service.get(MY_VOLUME)))
+        parent.get_filesystem().get_path().child(b"f").setContent(b"ORIG")
+        self.result(self.remote.clone_to(parent, MY_VOLUME2))
+        self.assertEqual(
+            self.to_service.get(MY_VOLUME2).get_filesystem().get_path().child(
+                b"f").getContent(),
+            b"ORIG")
+
+    def test_one_connection(self):
+        """
+        All operations, including concurrent ones, share one connection.
+        """
+        volume = self.create()
+        first = self.remote.snapshots(volume)
+        second = self.remote.receive_state(volume)
+        self.result(first)
+        self.result(second)
+        self.result(self.from_service.push(volume, self.remote))
+        self.assertEqual(len(self.endpoint.pumps), 1)
+
+    def test_reconnect(self):
+        """
+        If the connection is lost, the next operation makes a new one.
+        """
+        volume = self.create()
+        self.result(self.remote.snapshots(volume))
+        self.remote.disconnect()
+        self.endpoint.flush()
+        self.result(self.remote.snapshots(volume))
+        self.assertEqual(len(self.endpoint.pumps), 2)
+
+
+class FakeAMP(object):
+    """
+    Record ``callRemote`` calls and leave them unanswered.
+
+    :ivar list calls: Tuples of the command, its arguments and the
+        ``Deferred`` returned for each call.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, command, **arguments):
+        d = Deferred()
+        self.calls.append((command, arguments, d))
+        return d
+
+
+class OutgoingStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_OutgoingStream``.
+    """
+    def test_chunks(self):
+        """
+        Data is sent in chunks of at most ``CHUNK_SIZE`` bytes.
+        """
+        protocol = FakeAMP()
+        stream = _OutgoingStream(protocol, 3)
+        stream.write(b"x" * (CHUNK_SIZE + 1))
+        self.assertEqual(
+            [(command, arguments["stream"], len(arguments["data"]))
+             for (command, arguments, _) in protocol.calls],
+            [(ReceiveChunk, 3, CHUNK_SIZE), (ReceiveChunk, 3, 1)])
+
+    def test_window(self):
+        """
+        The producer is paused once ``WINDOW`` chunks are unanswered, and
+        resumed once fewer are.
+        """
+        protocol = FakeAMP()
+        producer = RecordingProducer()
+        stream = _OutgoingStream(protocol, 0)
+        stream.registerProducer(producer, True)
+        stream.write(b"x" * (CHUNK_SIZE * (WINDOW - 1)))
+        before = producer.paused
+        stream.write(b"x")
+        paused = producer.paused
+        protocol.calls[0][2].callback({})
+        self.assertEqual((before, paused, producer.paused),
+                         (False, True, False))
+
+    def test_finish_waits(self):
+        """
+        ``finish`` waits for all chunks to be answered before telling the
+        agent the stream is complete.
+        """
+        protocol = FakeAMP()
+        stream = _OutgoingStream(protocol, 0)
+        stream.write(b"x")
+        finishing = stream.finish()
+        before = len(protocol.calls)
+        protocol.calls[0][2].callback({})
+        protocol.calls[1][2].callback({})
+        self.successResultOf(finishing)
+        self.assertEqual((before, len(protocol.calls)), (1, 2))
+
+    def test_finish_chunk_failed(self):
+        """
+        ``finish`` errbacks with the failure to send a chunk.
+        """
+        protocol = FakeAMP()
+        stream = _OutgoingStream(protocol, 0)
+        stream.write(b"x")
+        protocol.calls[0][2].errback(IOError("lost"))
+        finishing = stream.finish()
+        protocol.calls[1][2].callback({})
+        self.failureResultOf(finishing, IOError)
+
+
+class IncomingStreamTests(SynchronousTestCase):
+    """
+    Tests for ``_IncomingStream``.
+    """
+    def test_write(self):
+        """
+        Data is written to the consumer, and ``write`` fires immediately
+        while the consumer is not paused.
+        """
+        consumer = MemoryConsumer()
+        stream = _IncomingStream(consumer)
+        self.successResultOf(stream.write(b"data"))
+        self.assertEqual(consumer.output.getvalue(), b"data")
+
+    def test_paused(self):
+        """
+        While the consumer is paused ``write`` does not fire until the
+        consumer resumes.
+        """
+        consumer = MemoryConsumer()
+        stream = _IncomingStream(consumer)
+        consumer.producer.pauseProducing()
+        writing = stream.write(b"data")
+        self.assertNoResult(writing)
+        consumer.producer.resumeProducing()
+        self.successResultOf(writing)
+
+    def test_connection_lost(self):
+        """
+        Streams still being received when the connection is lost are
+        finished.
+        """
+        service = create_volume_service(self)
+        agent = VolumeAgent(service)
+        consumer = MemoryConsumer()
+        agent._streams[0] = _IncomingStream(consumer)
+        finished = []
+        self.patch(consumer, "finish",
+                   lambda: succeed(finished.append(True)))
+        agent.makeConnection(makeFakeServer(agent))
+        agent.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual((finished, agent._streams), ([True], {}))
+
+
+class VolumeAgentFactoryTests(SynchronousTestCase):
+    """
+    Tests for ``VolumeAgentFactory``.
+    """
+    def test_protocol(self):
+        """
+        ``VolumeAgentFactory`` builds a ``VolumeAgent`` for its service.
+        """
+        service = create_volume_service(self)
+        agent = VolumeAgentFactory(service).buildProtocol(None)
+        self.assertEqual((type(agent), agent._service),
+                         (VolumeAgent, service))
+
+
+class AgentEndpointTests(SynchronousTestCase):
+    """
+    Tests for ``agent_endpoint``.
+    """
+    def test_ssh(self):
+        """
+        ``agent_endpoint`` connects to the agent on the node by running
+        ``flocker-volume agent`` through the same SSH connection as
+        ``standard_node``.
+        """
+        from twisted.internet import reactor
+        endpoint = agent_endpoint(reactor, b"node.example.com")
+        arguments = standard_node(
+            b"node.example.com").initial_command_arguments
+        self.assertEqual(
+            (endpoint._executable, endpoint._args),
+            (b"ssh", arguments + (b"flocker-volume", b"agent")))
+
+
+class RecordingVolumeManager(object):
+    """
+    Record the ``IRemoteVolumeManager`` methods called, and return the name
+    of the method.
+
+    :ivar list calls: The name and arguments of each call.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def method(*args):
+            self.calls.append((name,) + args)
+            return name
+        return method
+
+
+class NodeVolumeManagerTests(SynchronousTestCase):
+    """
+    Tests for ``NodeVolumeManager``.
+    """
+    def setUp(self):
+        self.agent = RecordingVolumeManager()
+        self.remote = RecordingVolumeManager()
+        self.manager = NodeVolumeManager(self.agent, self.remote)
+        self.volume = Volume(uuid=u"myuuid", name=MY_VOLUME, service=None)
+
+    def test_interface(self):
+        """
+        ``NodeVolumeManager`` provides ``IRemoteVolumeManager``.
+        """
+        self.assertTrue(verifyObject(IRemoteVolumeManager, self.manager))
+
+    def test_requests(self):
+        """
+        ``NodeVolumeManager`` sends requests which don't carry volume data to
+        the agent.
+        """
+        results = [
+            self.manager.snapshots(self.volume),
+            self.manager.receive_state(self.volume),
+            self.manager.compressions(),
+            self.manager.acquire(self.volume),
+            self.manager.clone_to(self.volume, MY_VOLUME2),
+        ]
+        self.assertEqual(
+            (results, self.agent.calls, self.remote.calls),
+            (["snapshots", "receive_state", "compressions", "acquire",
+              "clone_to"],
+             [("snapshots", self.volume), ("receive_state", self.volume),
+              ("compressions",), ("acquire", self.volume),
+              ("clone_to", self.volume, MY_VOLUME2)],
+             []))
+
+    def test_streams(self):
+        """
+        ``NodeVolumeManager`` writes volume data to the remote volume
+        manager, so that it can be spliced into the SSH process.
+        """
+        results = [
+            self.manager.receive_stream(self.volume, b"lz4"),
+            self.manager.receive_and_acquire_stream(self.volume, b"lz4"),
+        ]
+        self.assertEqual(
+            (results, self.remote.calls, self.agent.calls),
+            (["receive_stream", "receive_and_acquire_stream"],
+             [("receive_stream", self.volume, b"lz4"),
+              ("receive_and_acquire_stream", self.volume, b"lz4")],
+             []))
+
+    def test_receive_state_many(self):
+        """
+        ``NodeVolumeManager.receive_state_many`` asks the remote volume
+        manager, which gets the state of all the volumes at once.
+        """
+        result = self.manager.receive_state_many([self.volume])
+        self.assertEqual(
+            (result, self.remote.calls, self.agent.calls),
+            ("receive_state_many",
+             [("receive_state_many", [self.volume])], []))
+
+
+class NodeVolumeManagerFunctionTests(SynchronousTestCase):
+    """
+    Tests for ``node_volume_manager``.
+    """
+    def test_manager(self):
+        """
+        ``node_volume_manager`` sends requests to the agent on the node and
+        runs ``flocker-volume`` on it through ``standard_node``.
+        """
+        from twisted.internet import reactor
+        manager = node_volume_manager(reactor, b"node.example.com")
+        self.assertEqual(
+            (type(manager), type(manager._agent),
+             manager._agent._endpoint._args, manager._remote),
+            (NodeVolumeManager, AgentVolumeManager,
+             agent_endpoint(reactor, b"node.example.com")._args,
+             RemoteVolumeManager(standard_node(b"node.example.com"))))
@@ -0,0 +1,139 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._compression`.
+"""
+
+from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import _compression
+from .._compression import Compression, available_algorithms, decompressing
+
+
+class CompressionTests(SynchronousTestCase):
+    """
+    Tests for ``Compression``.
+    """
+    def test_to_bytes(self):
+        """
+        ``Compression.to_bytes`` includes the algorithm and the level.
+        """
+        self.assertEqual(
+            Compression(algorithm=b"zstd", level=7).to_bytes(), b"zstd:7")
+
+    def test_from_bytes(self):
+        """
+        ``Compression.from_bytes`` parses the output of
+        ``Compression.to_bytes``.
+        """
+        compression = Compression(algorithm=b"lz4", level=4)
+        self.assertEqual(
+            Compression.from_bytes(compression.to_bytes()), compression)
+
+    def test_from_bytes_default_level(self):
+        """
+        If no level is given, ``Compression.from_bytes`` uses the algorithm's
+        default level.
+        """
+        self.assertEqual(
+            [Compression.from_bytes(b"zlib"), Compression.from_bytes(b"lz4"),
+             Compression.from_bytes(b"zstd")],
+            [Compression(algorithm=b"zlib", level=6),
+             Compression(algorithm=b"lz4", level=1),
+             Compression(algorithm=b"zstd", level=3)])
+
+    def test_from_bytes_unknown_algorithm(self):
+        """
+        ``Compression.from_bytes`` raises ``ValueError`` for an unsupported
+        algorithm.
+        """
+        self.assertRaises(ValueError, Compression.from_bytes, b"rar:1")
+
+    def test_from_bytes_bad_level(self):
+        """
+        ``Compression.from_bytes`` raises ``ValueError`` for a level the
+        algorithm does not support.
+        """
+        self.assertRaises(ValueError, Compression.from_bytes, b"zlib:12")
+
+    def test_compress_command(self):
+        """
+        ``Compression.compress_command`` runs the algorithm's compressor at the
+        configured level.
+        """
+        self.assertEqual(
+            Compression(algorithm=b"zstd", level=9).compress_command(),
+            [b"zstd", b"-c", b"-q", b"-9"])
+
+    def test_decompress_command(self):
+        """
+        ``Compression.decompress_command`` runs the algorithm's decompressor.
+        """
+        self.assertEqual(
+            Compression(algorithm=b"lz4", level=9).decompress_command(),
+            [b"lz4", b"-d", b"-c"])
+
+
+def compressed_file(compression, data):
+    """
+    Compress some data into a temporary file.
+
+    :param Compression compression: How to compress the data.
+    :param bytes data: The data to compress.
+
+    :return: A file object positioned at the start of the compressed data.
+    """
+    result = TemporaryFile()
+    process = Popen(compression.compress_command(), stdin=PIPE,
+                    stdout=result)
+    process.communicate(data)
+    result.seek(0, 0)
+    return result
+
+
+class AvailableAlgorithmsTests(SynchronousTestCase):
+    """
+    Tests for ``available_algorithms``.
+    """
+    def test_installed(self):
+        """
+        Only the algorithms whose program is installed are available.
+        """
+        self.patch(_compression, "which",
+                   lambda name: [] if name == b"lz4" else [b"/bin/" + name])
+        self.assertEqual(available_algorithms(), [b"zlib", b"zstd"])
+
+
+class DecompressingTests(SynchronousTestCase):
+    """
+    Tests for ``decompressing``.
+    """
+    def test_decompresses(self):
+        """
+        ``decompressing`` returns a file from which the decompressed data can
+        be read.
+        """
+        compression = Compression(algorithm=b"zlib", level=1)
+        data = b"flocker" * 10000
+        with compressed_file(compression, data) as input_file:
+            with decompressing(compression, input_file) as output:
+                result = output.read()
+        self.assertEqual(result, data)
+
+    def test_bad_data(self):
+        """
+        ``decompressing`` raises ``IOError`` if the data cannot be
+        decompressed.
+        """
+        compression = Compression(algorithm=b"zlib", level=1)
+        with TemporaryFile() as input_file:
+            input_file.write(b"not compressed")
+            input_file.seek(0, 0)
+
+            def read():
+                with decompressing(compression, input_file) as output:
+                    output.read()
+            self.assertRaises(IOError, read)
@@ -17,6 +17,7 @@ from ..filesystems.memory import (
     CannedFilesystemSnapshots, FilesystemStoragePool,
     DirectoryFilesystem,
 )
+from ..filesystems.zfs import Snapshot
 from ...testtools import (
     assert_equal_comparison, assert_not_equal_comparison
 )
@@ -94,3 +95,34 @@ class DirectoryFilesystemTests(SynchronousTestCase):
             repr(DirectoryFilesystem(
                 path=FilePath(b"/foo/bar"), size=123))
         )
+
+    def test_destroy_snapshot(self):
+        """
+        ``DirectoryFilesystem.destroy_snapshot`` forgets the snapshot and
+        reports that no space was freed.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        filesystem = DirectoryFilesystem(path=path, size=None)
+        filesystem.snapshot(b"first")
+        filesystem.snapshot(b"second")
+        freed = filesystem.destroy_snapshot(Snapshot(name=b"first"))
+        self.assertEqual(
+            (0, [Snapshot(name=b"second")]),
+            (self.successResultOf(freed),
+             self.successResultOf(filesystem.snapshots())))
+
+    def test_written_since(self):
+        """
+        ``DirectoryFilesystem.written_since`` reports that nothing has been
+        written since a snapshot.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        filesystem = DirectoryFilesystem(path=path, size=None)
+        filesystem.snapshot(b"first")
+        path.child(b"file").setContent(b"data")
+        self.assertEqual(
+            self.successResultOf(
+                filesystem.written_since(Snapshot(name=b"first"))),
+            0)
@@ -8,6 +8,8 @@ Further coverage is provided in
 
 import os
 
+from zope.interface.verify import verifyObject
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.internet.error import ProcessDone, ProcessTerminated
 from twisted.python.failure import Failure
@@ -20,12 +22,19 @@ from ...testtools import (
     FakeProcessReactor, assert_equal_comparison, assert_not_equal_comparison
 )
 
+from ..filesystems import zfs as zfs_module
 from ..filesystems.zfs import (
-    _DatasetInfo,
+    _DatasetInfo, resumable_receive, _resumable_receive_sync,
     zfs_command, CommandFailed, BadArguments, Filesystem, ZFSSnapshots,
     _sync_command_error_squashed, _latest_common_snapshot, ZFS_ERROR,
-    Snapshot,
+    Snapshot, PoolState, StoragePool,
+)
+from ..service import VolumeName
+from ...common import (
+    IDescriptorConsumer, IDescriptorProducer, MemoryConsumer,
 )
+from .._model import VolumeSize
+from ..testtools import create_volume_service
 
 
 class FilesystemTests(SynchronousTestCase):
@@ -277,7 +286,22 @@ class ZFSSnapshotsTests(SynchronousTestCase):
         snapshots.list()
         self.assertEqual(reactor.processes[0].args,
                          [b"zfs", b"list", b"-H", b"-r", b"-t", b"snapshot",
-                          b"-o", b"name", b"-s", b"creation", b"mypool"])
+                          b"-p", b"-o", b"name,guid,createtxg",
+                          b"-s", b"createtxg", b"mypool"])
+
+    def test_filesystem_snapshots(self):
+        """
+        ``Filesystem.snapshots`` includes the ``guid`` and ``createtxg`` of
+        each snapshot.
+        """
+        reactor = FakeProcessReactor()
+        filesystem = Filesystem(b"mypool", None, reactor=reactor)
+        self.patch(filesystem, "_exists", lambda: True)
+        d = filesystem.snapshots()
+        finish_listing(reactor, 0, b"mypool@name\t1\t10\n")
+        self.assertEqual(
+            self.successResultOf(d),
+            [Snapshot(name=b"name", guid=1, createtxg=10)])
 
     def test_list_result_root_dataset(self):
         """
@@ -289,8 +313,8 @@ class ZFSSnapshotsTests(SynchronousTestCase):
 
         d = snapshots.list()
         process_protocol = reactor.processes[0].processProtocol
-        process_protocol.childDataReceived(1, b"mypool@name\n")
-        process_protocol.childDataReceived(1, b"mypool@name2\n")
+        process_protocol.childDataReceived(1, b"mypool@name\t1\t10\n")
+        process_protocol.childDataReceived(1, b"mypool@name2\t2\t11\n")
         reactor.processes[0].processProtocol.processEnded(
             Failure(ProcessDone(0)))
         self.assertEqual(self.successResultOf(d), [b"name", b"name2"])
@@ -305,8 +329,9 @@ class ZFSSnapshotsTests(SynchronousTestCase):
 
         d = snapshots.list()
         process_protocol = reactor.processes[0].processProtocol
-        process_protocol.childDataReceived(1, b"mypool/myfs@name\n")
-        process_protocol.childDataReceived(1, b"mypool/myfs@name2\n")
+        process_protocol.childDataReceived(1, b"mypool/myfs@name\t1\t10\n")
+        process_protocol.childDataReceived(
+            1, b"mypool/myfs@name2\t2\t11\n")
         reactor.processes[0].processProtocol.processEnded(
             Failure(ProcessDone(0)))
         self.assertEqual(self.successResultOf(d), [b"name", b"name2"])
@@ -323,8 +348,9 @@ class ZFSSnapshotsTests(SynchronousTestCase):
 
         d = snapshots.list()
         process_protocol = reactor.processes[0].processProtocol
-        process_protocol.childDataReceived(1, b"mypool/child@name\n")
-        process_protocol.childDataReceived(1, b"mypool@name2\n")
+        process_protocol.childDataReceived(
+            1, b"mypool/child@name\t1\t10\n")
+        process_protocol.childDataReceived(1, b"mypool@name2\t2\t11\n")
         reactor.processes[0].processProtocol.processEnded(
             Failure(ProcessDone(0)))
         self.assertEqual(self.successResultOf(d), [b"name2"])
@@ -386,6 +412,59 @@ class LatestCommonSnapshotTests(SynchronousTestCase):
         self.assertEqual(
             b, _latest_common_snapshot([a, b], [a, b]))
 
+    def test_renamed(self):
+        """
+        Snapshots with the same ``guid`` are common even if their names
+        differ, and the one from the second list is returned.
+        """
+        remote = Snapshot(name=b"a", guid=1, createtxg=10)
+        local = Snapshot(name=b"renamed", guid=1, createtxg=10)
+        self.assertEqual(
+            local, _latest_common_snapshot(
+                [remote], [Snapshot(name=b"b", guid=2, createtxg=5), local]))
+
+    def test_same_name_different_guid(self):
+        """
+        Snapshots with the same name but different ``guid``\ s are not
+        common, since their contents differ.
+        """
+        self.assertIs(
+            None,
+            _latest_common_snapshot(
+                [Snapshot(name=b"a", guid=1, createtxg=10)],
+                [Snapshot(name=b"a", guid=2, createtxg=10)]))
+
+    def test_unknown_guid(self):
+        """
+        If the ``guid`` of a snapshot is unknown it is matched by name.
+        """
+        local = Snapshot(name=b"a", guid=1, createtxg=10)
+        self.assertEqual(
+            local, _latest_common_snapshot([Snapshot(name=b"a")], [local]))
+
+
+class SnapshotTests(SynchronousTestCase):
+    """
+    Tests for ``Snapshot``.
+    """
+    def test_round_trip(self):
+        """
+        ``Snapshot.from_bytes`` parses the output of ``Snapshot.to_bytes``.
+        """
+        snapshot = Snapshot(name=b"a", guid=123, createtxg=45)
+        self.assertEqual(
+            (snapshot.to_bytes(), Snapshot.from_bytes(snapshot.to_bytes())),
+            (b"a\t123\t45", snapshot))
+
+    def test_name_only(self):
+        """
+        A ``Snapshot`` whose ``guid`` is unknown is serialized as its name.
+        """
+        snapshot = Snapshot(name=b"a")
+        self.assertEqual(
+            (snapshot.to_bytes(), Snapshot.from_bytes(b"a")),
+            (b"a", snapshot))
+
 
 class DatasetInfoTests(SynchronousTestCase):
     """
@@ -418,3 +497,687 @@ class DatasetInfoTests(SynchronousTestCase):
         """
         self.assertRaises(
             AttributeError, setattr, self.info, "refquota", 321)
+
+
+def finish_listing(reactor, index, output):
+    """
+    Deliver output to a pool listing ``zfs`` process started by
+    ``PoolState`` and make it exit successfully.
+
+    :param FakeProcessReactor reactor: The reactor the process was started
+        with.
+    :param int index: The index of the process in ``reactor.processes``.
+    :param bytes output: What the process wrote to stdout.
+    """
+    process_protocol = reactor.processes[index].processProtocol
+    process_protocol.childDataReceived(1, output)
+    process_protocol.processEnded(Failure(ProcessDone(0)))
+
+
+POOL_LISTING = (
+    b"mypool\tfilesystem\tnone\t0\t1000\t100\t1\n"
+    b"mypool/a\tfilesystem\t/flocker/a\t0\t200\t101\t2\n"
+    b"mypool/a@later\tsnapshot\t-\t-\t0\t105\t3\n"
+    b"mypool/a@earlier\tsnapshot\t-\t-\t0\t103\t4\n"
+    b"mypool/b\tfilesystem\t/flocker/b\t65536\t300\t102\t5\n"
+    b"mypool/b/child\tfilesystem\t/flocker/b/child\t0\t10\t102\t6\n"
+    b"mypool/zvol\tvolume\t-\t-\t10\t102\t7\n"
+)
+
+
+class PoolStateTests(SynchronousTestCase):
+    """
+    Tests for ``PoolState``.
+    """
+    def test_command(self):
+        """
+        ``PoolState.get`` runs one recursive ``zfs list`` describing every
+        dataset and snapshot in the pool.
+        """
+        reactor = FakeProcessReactor()
+        PoolState(reactor, b"mypool").get()
+        self.assertEqual(
+            reactor.processes[0].args,
+            [b"zfs", b"list", b"-r", b"-t", b"all", b"-H", b"-p",
+             b"-o", b"name,type,mountpoint,refquota,used,createtxg,guid",
+             b"mypool"])
+
+    def test_filesystems(self):
+        """
+        The listing's ``filesystems`` describes the filesystems which are
+        direct children of the pool.
+        """
+        reactor = FakeProcessReactor()
+        d = PoolState(reactor, b"mypool").get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            self.successResultOf(d).filesystems,
+            [_DatasetInfo(dataset=b"a", mountpoint=b"/flocker/a",
+                          refquota=None, used=200),
+             _DatasetInfo(dataset=b"b", mountpoint=b"/flocker/b",
+                          refquota=65536, used=300)])
+
+    def test_names(self):
+        """
+        The listing's ``names`` includes every filesystem and volume in the
+        pool, but no snapshots.
+        """
+        reactor = FakeProcessReactor()
+        d = PoolState(reactor, b"mypool").get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            self.successResultOf(d).names,
+            {b"mypool", b"mypool/a", b"mypool/b", b"mypool/b/child",
+             b"mypool/zvol"})
+
+    def test_snapshots(self):
+        """
+        The listing's ``snapshots`` maps each filesystem to its snapshots,
+        including their ``guid`` and ``createtxg``, ordered from oldest to
+        newest.
+        """
+        reactor = FakeProcessReactor()
+        d = PoolState(reactor, b"mypool").get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            self.successResultOf(d).snapshots,
+            {b"mypool/a": [Snapshot(name=b"earlier", guid=4, createtxg=103),
+                           Snapshot(name=b"later", guid=3, createtxg=105)]})
+
+    def test_cached(self):
+        """
+        Once a listing has been retrieved later calls to ``PoolState.get``
+        reuse it without running ``zfs`` again.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool")
+        first = state.get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        second = state.get()
+        self.assertEqual(
+            (1, self.successResultOf(first)),
+            (len(reactor.processes), self.successResultOf(second)))
+
+    def test_concurrent(self):
+        """
+        Calls to ``PoolState.get`` made while a listing is being retrieved
+        share the one ``zfs`` process.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool")
+        first = state.get()
+        second = state.get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            (1, self.successResultOf(first)),
+            (len(reactor.processes), self.successResultOf(second)))
+
+    def test_invalidate(self):
+        """
+        After ``PoolState.invalidate`` is called the next call to
+        ``PoolState.get`` runs ``zfs`` again.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool")
+        state.get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        state.invalidate()
+        state.get()
+        self.assertEqual(2, len(reactor.processes))
+
+    def test_invalidate_during_listing(self):
+        """
+        A listing which was being retrieved when ``PoolState.invalidate`` was
+        called is delivered to its callers but not cached.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool")
+        d = state.get()
+        state.invalidate()
+        finish_listing(reactor, 0, POOL_LISTING)
+        self.successResultOf(d)
+        self.assertIs(None, state.cached())
+
+    def test_expires(self):
+        """
+        A listing older than ``max_age`` seconds is not reused.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool", max_age=5)
+        state.get()
+        finish_listing(reactor, 0, POOL_LISTING)
+        reactor.advance(6)
+        state.get()
+        self.assertEqual(2, len(reactor.processes))
+
+    def test_error(self):
+        """
+        If ``zfs`` fails, every waiting caller gets the failure and nothing is
+        cached.
+        """
+        reactor = FakeProcessReactor()
+        state = PoolState(reactor, b"mypool")
+        first = state.get()
+        second = state.get()
+        reactor.processes[0].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.failureResultOf(first, CommandFailed)
+        self.failureResultOf(second, CommandFailed)
+        self.assertIs(None, state.cached())
+
+
+class StoragePoolStateTests(SynchronousTestCase):
+    """
+    Tests for the use ``StoragePool`` makes of its ``PoolState``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.pool = StoragePool(
+            self.reactor, b"mypool", FilePath(b"/flocker"))
+        self.volume = create_volume_service(self).get(
+            VolumeName(namespace=u"ns", id=u"vol"))
+
+    def test_enumerate(self):
+        """
+        ``StoragePool.enumerate`` returns a ``Filesystem`` for each direct
+        child of the pool in the listing.
+        """
+        d = self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            {(f.name, f.get_path(), f.size)
+             for f in self.successResultOf(d)},
+            {(b"mypool/a", FilePath(b"/flocker/a"),
+              VolumeSize(maximum_size=None)),
+             (b"mypool/b", FilePath(b"/flocker/b"),
+              VolumeSize(maximum_size=65536))})
+
+    def test_snapshots_and_enumerate_share_listing(self):
+        """
+        ``StoragePool.enumerate`` and ``Filesystem.snapshots`` for the pool's
+        filesystems are answered by one ``zfs`` process.
+        """
+        enumerating = self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        filesystems = self.successResultOf(enumerating)
+        snapshots = [self.successResultOf(f.snapshots())
+                     for f in sorted(filesystems, key=lambda f: f.name)]
+        self.assertEqual(
+            (1, [[Snapshot(name=b"earlier", guid=4, createtxg=103),
+                  Snapshot(name=b"later", guid=3, createtxg=105)], []]),
+            (len(self.reactor.processes), snapshots))
+
+    def test_exists_from_listing(self):
+        """
+        ``Filesystem._exists`` is answered from a cached listing.
+        """
+        self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            (True, False),
+            (Filesystem(b"mypool", b"a",
+                        pool_state=self.pool._state)._exists(),
+             Filesystem(b"mypool", b"missing",
+                        pool_state=self.pool._state)._exists()))
+
+    def test_create_invalidates(self):
+        """
+        Once ``StoragePool.create`` finishes, the next query runs ``zfs list``
+        again.
+        """
+        self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.pool.create(self.volume)
+        self.reactor.processes[1].processProtocol.processEnded(
+            Failure(ProcessDone(0)))
+        self.pool.enumerate()
+        self.assertEqual(3, len(self.reactor.processes))
+
+    def test_set_maximum_size_invalidates(self):
+        """
+        Once ``StoragePool.set_maximum_size`` finishes, the next query runs
+        ``zfs list`` again.
+        """
+        self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.pool.set_maximum_size(self.volume)
+        self.reactor.processes[1].processProtocol.processEnded(
+            Failure(ProcessDone(0)))
+        self.pool.enumerate()
+        self.assertEqual(3, len(self.reactor.processes))
+
+    def test_snapshot_invalidates(self):
+        """
+        Once ``ZFSSnapshots.create`` finishes for one of the pool's
+        filesystems, the next query runs ``zfs list`` again.
+        """
+        self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        ZFSSnapshots(self.reactor, self.pool.get(self.volume)).create(b"s")
+        self.reactor.processes[1].processProtocol.processEnded(
+            Failure(ProcessDone(0)))
+        self.pool.enumerate()
+        self.assertEqual(3, len(self.reactor.processes))
+
+    def test_invalidate(self):
+        """
+        After ``StoragePool.invalidate`` the next query runs ``zfs list``
+        again, even if the cached listing is still fresh.
+        """
+        self.pool.enumerate()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.pool.invalidate()
+        self.pool.enumerate()
+        self.assertEqual(2, len(self.reactor.processes))
+
+
+class FilesystemStreamTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.reader_stream`` and ``Filesystem.writer_stream``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.state = PoolState(self.reactor, b"mypool")
+        self.filesystem = Filesystem(
+            b"mypool", b"a", mountpoint=FilePath(b"/flocker/a"),
+            reactor=self.reactor, pool_state=self.state)
+        self.patch(zfs_module, "_RESUMABLE_RECEIVE", {b"mypool": True})
+
+    def succeed_process(self, index):
+        """
+        Make a process started via the fake reactor exit successfully.
+
+        :param int index: The index of the process in
+            ``self.reactor.processes``.
+        """
+        self.reactor.processes[index].processProtocol.processEnded(
+            Failure(ProcessDone(0)))
+
+    def start_send(self, remote_snapshots):
+        """
+        Start sending the filesystem and complete the snapshot and listing
+        steps which precede ``zfs send``.
+
+        :param remote_snapshots: Passed to ``reader_stream``.
+
+        :return: A tuple of the producer, the consumer, and the ``Deferred``
+            returned by ``startProducing``.
+        """
+        producer = self.filesystem.reader_stream(remote_snapshots)
+        consumer = MemoryConsumer()
+        producing = producer.startProducing(consumer)
+        self.succeed_process(0)
+        finish_listing(self.reactor, 1, POOL_LISTING)
+        return producer, consumer, producing
+
+    def test_reader_stream_interface(self):
+        """
+        ``Filesystem.reader_stream`` returns an ``IDescriptorProducer``
+        provider.
+        """
+        self.assertTrue(verifyObject(
+            IDescriptorProducer, self.filesystem.reader_stream()))
+
+    def test_reader_stream_snapshots(self):
+        """
+        Starting the producer takes a new snapshot of the filesystem.
+        """
+        self.filesystem.reader_stream().startProducing(MemoryConsumer())
+        self.assertEqual(
+            self.reactor.processes[0].args[:2], [b"zfs", b"snapshot"])
+
+    def test_reader_stream_incremental(self):
+        """
+        Once the snapshot has been taken, ``zfs send`` is run to generate an
+        incremental stream from the latest snapshot in common with the
+        writer.
+        """
+        self.start_send([Snapshot(name=b"earlier")])
+        snapshot = self.reactor.processes[0].args[-1]
+        self.assertEqual(
+            self.reactor.processes[2].args,
+            [b"zfs", b"send", b"-i", b"mypool/a@earlier", snapshot])
+
+    def test_reader_stream_output(self):
+        """
+        The output of ``zfs send`` is written to the consumer and the
+        ``Deferred`` returned by ``startProducing`` fires when it exits.
+        """
+        producer, consumer, producing = self.start_send(None)
+        self.reactor.processes[2].processProtocol.childDataReceived(
+            1, b"stream")
+        self.succeed_process(2)
+        self.assertEqual((self.successResultOf(producing),
+                          consumer.output.getvalue()), (None, b"stream"))
+
+    def test_reader_stream_send_fails(self):
+        """
+        If ``zfs send`` fails, the ``Deferred`` returned by ``startProducing``
+        errbacks with ``CommandFailed``.
+        """
+        producer, consumer, producing = self.start_send(None)
+        self.reactor.processes[2].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.failureResultOf(producing, CommandFailed)
+
+    def test_reader_stream_paused_early(self):
+        """
+        If the producer is paused before ``zfs send`` starts, the process is
+        paused as soon as it starts.
+        """
+        producer = self.filesystem.reader_stream()
+        producer.startProducing(MemoryConsumer())
+        producer.pauseProducing()
+        self.succeed_process(0)
+        finish_listing(self.reactor, 1, POOL_LISTING)
+        self.assertTrue(self.reactor.processes[2].transport.paused)
+
+    def test_reader_stream_to_descriptor(self):
+        """
+        ``produceToDescriptor`` runs ``zfs send`` with the given file
+        descriptor as its standard output.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.filesystem.reader_stream().produceToDescriptor(write_fd)
+        self.succeed_process(0)
+        finish_listing(self.reactor, 1, POOL_LISTING)
+        self.assertEqual(
+            (self.reactor.processes[2].args[:2],
+             self.reactor.processes[2].childFDs[1]),
+            ([b"zfs", b"send"], write_fd))
+
+    def test_reader_stream_to_descriptor_snapshot_fails(self):
+        """
+        If the snapshot cannot be taken, ``produceToDescriptor`` closes the
+        file descriptor it was given.
+        """
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        producing = self.filesystem.reader_stream().produceToDescriptor(
+            write_fd)
+        self.reactor.processes[0].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.failureResultOf(producing, CommandFailed)
+        self.assertRaises(OSError, os.fstat, write_fd)
+
+    def test_reader_stream_resume(self):
+        """
+        Given a resume token, the producer runs ``zfs send -t`` without taking
+        a new snapshot.
+        """
+        self.filesystem.reader_stream(
+            resume_token=b"1-abc").startProducing(MemoryConsumer())
+        self.assertEqual(
+            [process.args for process in self.reactor.processes],
+            [[b"zfs", b"send", b"-t", b"1-abc"]])
+
+    def test_resume_token_command(self):
+        """
+        ``Filesystem.resume_token`` reads the filesystem's
+        ``receive_resume_token`` property.
+        """
+        self.filesystem.resume_token()
+        self.assertEqual(
+            self.reactor.processes[0].args,
+            [b"zfs", b"get", b"-H", b"-o", b"value",
+             b"receive_resume_token", b"mypool/a"])
+
+    def test_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns the token if there is one.
+        """
+        d = self.filesystem.resume_token()
+        finish_listing(self.reactor, 0, b"1-abc-def\n")
+        self.assertEqual(self.successResultOf(d), b"1-abc-def")
+
+    def test_no_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns ``None`` if the property has no
+        value.
+        """
+        d = self.filesystem.resume_token()
+        finish_listing(self.reactor, 0, b"-\n")
+        self.assertIs(self.successResultOf(d), None)
+
+    def test_resume_token_unsupported(self):
+        """
+        ``Filesystem.resume_token`` returns ``None`` if ``zfs get`` fails,
+        for example because the filesystem does not exist or the property is
+        not supported.
+        """
+        d = self.filesystem.resume_token()
+        self.reactor.processes[0].processProtocol.processEnded(
+            Failure(ProcessTerminated(2)))
+        self.assertIs(self.successResultOf(d), None)
+
+    def test_destroy_snapshot_commands(self):
+        """
+        ``Filesystem.destroy_snapshot`` reads the snapshot's ``used``
+        property and then destroys it.
+        """
+        self.filesystem.destroy_snapshot(Snapshot(name=b"old"))
+        finish_listing(self.reactor, 0, b"1024\n")
+        self.assertEqual(
+            [process.args for process in self.reactor.processes],
+            [[b"zfs", b"get", b"-H", b"-p", b"-o", b"value", b"used",
+              b"mypool/a@old"],
+             [b"zfs", b"destroy", b"mypool/a@old"]])
+
+    def test_destroy_snapshot_result(self):
+        """
+        ``Filesystem.destroy_snapshot`` returns a ``Deferred`` that fires with
+        the snapshot's ``used`` property once it has been destroyed.
+        """
+        d = self.filesystem.destroy_snapshot(Snapshot(name=b"old"))
+        finish_listing(self.reactor, 0, b"1024\n")
+        self.assertNoResult(d)
+        self.succeed_process(1)
+        self.assertEqual(self.successResultOf(d), 1024)
+
+    def test_destroy_snapshot_invalidates(self):
+        """
+        Once ``Filesystem.destroy_snapshot`` finishes, the next query runs
+        ``zfs list`` again.
+        """
+        self.state.get()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.filesystem.destroy_snapshot(Snapshot(name=b"earlier"))
+        finish_listing(self.reactor, 1, b"1024\n")
+        self.succeed_process(2)
+        self.state.get()
+        self.assertEqual(4, len(self.reactor.processes))
+
+    def test_written_since_command(self):
+        """
+        ``Filesystem.written_since`` reads the filesystem's
+        ``written@<snapshot>`` property.
+        """
+        self.filesystem.written_since(Snapshot(name=b"old"))
+        self.assertEqual(
+            self.reactor.processes[0].args,
+            [b"zfs", b"get", b"-H", b"-p", b"-o", b"value", b"written@old",
+             b"mypool/a"])
+
+    def test_written_since_result(self):
+        """
+        ``Filesystem.written_since`` returns a ``Deferred`` that fires with
+        the number of bytes written since the snapshot.
+        """
+        d = self.filesystem.written_since(Snapshot(name=b"old"))
+        finish_listing(self.reactor, 0, b"4096\n")
+        self.assertEqual(self.successResultOf(d), 4096)
+
+    def test_writer_stream_existing(self):
+        """
+        ``Filesystem.writer_stream`` runs ``zfs receive -F`` if the filesystem
+        already exists.
+        """
+        writing = self.filesystem.writer_stream()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        consumer = self.successResultOf(writing)
+        consumer.write(b"stream")
+        self.assertEqual(
+            (verifyObject(IDescriptorConsumer, consumer),
+             self.reactor.processes[1].args),
+            (True, [b"zfs", b"receive", b"-s", b"-F", b"mypool/a"]))
+
+    def test_writer_stream_new(self):
+        """
+        ``Filesystem.writer_stream`` runs ``zfs receive`` without ``-F`` if
+        the filesystem does not exist.
+        """
+        filesystem = Filesystem(
+            b"mypool", b"new", reactor=self.reactor, pool_state=self.state)
+        writing = filesystem.writer_stream()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.successResultOf(writing).write(b"stream")
+        self.assertEqual(self.reactor.processes[1].args,
+                         [b"zfs", b"receive", b"-s", b"mypool/new"])
+
+    def test_writer_stream_not_resumable(self):
+        """
+        ``Filesystem.writer_stream`` runs ``zfs receive`` without ``-s`` if
+        resumable receive cannot be used with the pool.
+        """
+        self.patch(zfs_module, "_RESUMABLE_RECEIVE", {b"mypool": False})
+        writing = self.filesystem.writer_stream()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        self.successResultOf(writing).write(b"stream")
+        self.assertEqual(self.reactor.processes[1].args,
+                         [b"zfs", b"receive", b"-F", b"mypool/a"])
+
+    def test_writer_stream_finish(self):
+        """
+        Finishing the consumer closes the input to ``zfs receive`` and then
+        sets the filesystem's mountpoint.
+        """
+        writing = self.filesystem.writer_stream()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        consumer = self.successResultOf(writing)
+        consumer.write(b"stream")
+        finishing = consumer.finish()
+        self.succeed_process(1)
+        self.succeed_process(2)
+        self.assertEqual(
+            (self.reactor.processes[1].transport.written,
+             self.reactor.processes[1].transport.stdin_closed,
+             self.reactor.processes[2].args,
+             self.successResultOf(finishing)),
+            ([b"stream"], True,
+             [b"zfs", b"set", b"mountpoint=/flocker/a", b"mypool/a"], None))
+
+    def test_writer_stream_receive_fails(self):
+        """
+        If ``zfs receive`` fails, the ``Deferred`` returned by ``finish``
+        errbacks with ``CommandFailed``.
+        """
+        writing = self.filesystem.writer_stream()
+        finish_listing(self.reactor, 0, POOL_LISTING)
+        finishing = self.successResultOf(writing).finish()
+        self.reactor.processes[1].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.failureResultOf(finishing, CommandFailed)
+
+
+class ResumableReceiveTests(SynchronousTestCase):
+    """
+    Tests for ``resumable_receive`` and ``_resumable_receive_sync``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.patch(zfs_module, "_RESUMABLE_RECEIVE", {})
+
+    def test_commands(self):
+        """
+        ``resumable_receive`` reads the pool's ``receive_resume_token``
+        property and then the state of its ``extensible_dataset`` feature.
+        """
+        resumable_receive(self.reactor, b"mypool")
+        finish_listing(self.reactor, 0, b"-\n")
+        self.assertEqual(
+            [process.args for process in self.reactor.processes],
+            [[b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"mypool"],
+             [b"zpool", b"get", b"-H", b"feature@extensible_dataset",
+              b"mypool"]])
+
+    def feature_state(self, state):
+        """
+        Find out whether receive is resumable when ZFS knows about resuming
+        and the pool's ``extensible_dataset`` feature has the given state.
+
+        :param bytes state: The state ``zpool get`` reports.
+
+        :return: The result of ``resumable_receive``.
+        """
+        d = resumable_receive(self.reactor, b"mypool")
+        finish_listing(self.reactor, 0, b"-\n")
+        finish_listing(
+            self.reactor, 1,
+            b"mypool\tfeature@extensible_dataset\t%s\tlocal\n" % (state,))
+        return self.successResultOf(d)
+
+    def test_active(self):
+        """
+        Receive is resumable if the pool's ``extensible_dataset`` feature is
+        active.
+        """
+        self.assertTrue(self.feature_state(b"active"))
+
+    def test_enabled(self):
+        """
+        Receive is resumable if the pool's ``extensible_dataset`` feature is
+        enabled.
+        """
+        self.assertTrue(self.feature_state(b"enabled"))
+
+    def test_disabled(self):
+        """
+        Receive is not resumable if the pool's ``extensible_dataset`` feature
+        is disabled.
+        """
+        self.assertFalse(self.feature_state(b"disabled"))
+
+    def test_property_unsupported(self):
+        """
+        Receive is not resumable if ``zfs`` does not know the
+        ``receive_resume_token`` property, and the pool is not examined.
+        """
+        d = resumable_receive(self.reactor, b"mypool")
+        self.reactor.processes[0].processProtocol.processEnded(
+            Failure(ProcessTerminated(2)))
+        self.assertEqual(
+            (self.successResultOf(d), len(self.reactor.processes)),
+            (False, 1))
+
+    def test_feature_unsupported(self):
+        """
+        Receive is not resumable if ``zpool`` does not know the
+        ``extensible_dataset`` feature.
+        """
+        d = resumable_receive(self.reactor, b"mypool")
+        finish_listing(self.reactor, 0, b"-\n")
+        self.reactor.processes[1].processProtocol.processEnded(
+            Failure(ProcessTerminated(1)))
+        self.assertFalse(self.successResultOf(d))
+
+    def test_cached(self):
+        """
+        Once it is known whether receive is resumable for a pool, neither
+        ``resumable_receive`` nor ``_resumable_receive_sync`` runs any more
+        commands to find out again.
+        """
+        self.feature_state(b"active")
+        self.assertEqual(
+            (self.successResultOf(resumable_receive(self.reactor, b"mypool")),
+             _resumable_receive_sync(b"mypool"), len(self.reactor.processes)),
+            (True, True, 2))
+
+    def test_per_pool(self):
+        """
+        Whether receive is resumable is found out separately for each pool.
+        """
+        self.feature_state(b"active")
+        resumable_receive(self.reactor, b"otherpool")
+        self.assertEqual(self.reactor.processes[2].args[-1], b"otherpool")
@@ -14,13 +14,15 @@ from twisted.trial.unittest import TestCase
 
 from ..service import VolumeService, Volume, DEFAULT_CONFIG_PATH, VolumeName
 from ..filesystems.zfs import Snapshot
+from .._compression import Compression
 from ..filesystems.memory import FilesystemStoragePool
 from .._ipc import (
     IRemoteVolumeManager, RemoteVolumeManager, LocalVolumeManager,
-    standard_node, SSH_PRIVATE_KEY_PATH)
+    ReceiveState, standard_node, SSH_PRIVATE_KEY_PATH, SSH_CONNECTIONS)
 from ..testtools import ServicePair
+from .._compression import ALGORITHMS
 from ...common import FakeNode
-from ...common._ipc import ProcessNode
+from ...common._ipc import ProcessNode, _control_path
 
 
 MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvol")
@@ -64,36 +66,68 @@ def make_iremote_volume_manager(fixture):
             getting_snapshots.addCallback(got_snapshots)
             return getting_snapshots
 
-        def test_receive_exceptions_pass_through(self):
+        def test_receive_state_many(self):
             """
-            Exceptions raised in the ``receive()`` context manager are not
-            swallowed.
+            ``receive_state_many`` returns the ``ReceiveState`` of each of the
+            given volumes, with no snapshots for a volume the remote manager
+            does not have.
             """
             service_pair = fixture(self)
-            created = service_pair.from_service.create(
+            creating = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME))
+
+            def created(volume):
+                return service_pair.remote.receive_state_many([volume])
+            creating.addCallback(created)
+
+            def got_states(states):
+                self.assertEqual(list(states.values()),
+                                 [ReceiveState(snapshots=[])])
+            creating.addCallback(got_states)
+            return creating
+
+        def test_receive_state_nothing_interrupted(self):
+            """
+            If the remote manager does not have the volume and no push of it
+            was interrupted, ``receive_state`` returns no snapshots and no
+            resume token.
+            """
+            service_pair = fixture(self)
+            creating = service_pair.from_service.create(
                 service_pair.from_service.get(MY_VOLUME)
             )
+            creating.addCallback(service_pair.remote.receive_state)
+            creating.addCallback(
+                self.assertEqual, ReceiveState(snapshots=[]))
+            return creating
 
-            def got_volume(volume):
-                with service_pair.remote.receive(volume):
-                    raise RuntimeError()
-            created.addCallback(got_volume)
-            return self.assertFailure(created, RuntimeError)
+        def _stream(self, service_pair, volume):
+            """
+            Stream a volume's data to the remote manager.
+
+            :return: ``Deferred`` that fires when the remote volume has been
+                updated.
+            """
+            receiving = service_pair.remote.receive_stream(volume)
+
+            def got_consumer(consumer):
+                producer = volume.get_filesystem().reader_stream()
+                producing = producer.startProducing(consumer)
+                producing.addCallback(lambda _: consumer.finish())
+                return producing
+            receiving.addCallback(got_consumer)
+            return receiving
 
-        def test_receive_creates_volume(self):
+        def test_receive_stream_creates_volume(self):
             """
-            ``receive`` creates a volume.
+            ``receive_stream`` creates a volume.
             """
             service_pair = fixture(self)
             created = service_pair.from_service.create(
                 service_pair.from_service.get(MY_VOLUME)
             )
-
-            def do_push(volume):
-                with volume.get_filesystem().reader() as reader:
-                    with service_pair.remote.receive(volume) as receiver:
-                        receiver.write(reader.read())
-            created.addCallback(do_push)
+            created.addCallback(
+                lambda volume: self._stream(service_pair, volume))
 
             def pushed(_):
                 to_volume = Volume(uuid=service_pair.from_service.uuid,
@@ -109,8 +143,11 @@ def make_iremote_volume_manager(fixture):
 
             return created
 
-        def test_creates_files(self):
-            """``receive`` recreates files pushed from origin."""
+        def test_receive_stream_creates_files(self):
+            """
+            Streaming a volume's data to the consumer ``receive_stream``
+            provides recreates its files on the remote manager.
+            """
             service_pair = fixture(self)
             created = service_pair.from_service.create(
                 service_pair.from_service.get(MY_VOLUME)
@@ -119,10 +156,7 @@ def make_iremote_volume_manager(fixture):
             def do_push(volume):
                 root = volume.get_filesystem().get_path()
                 root.child(b"afile.txt").setContent(b"WORKS!")
-
-                with volume.get_filesystem().reader() as reader:
-                    with service_pair.remote.receive(volume) as receiver:
-                        receiver.write(reader.read())
+                return self._stream(service_pair, volume)
             created.addCallback(do_push)
 
             def pushed(_):
@@ -136,6 +170,44 @@ def make_iremote_volume_manager(fixture):
 
             return created
 
+        def test_receive_and_acquire_stream(self):
+            """
+            Once a volume's data has been streamed to the consumer
+            ``receive_and_acquire_stream`` provides, finishing it acquires the
+            volume on the remote manager and gives the remote manager's UUID.
+            """
+            service_pair = fixture(self)
+            to_service = service_pair.to_service
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+
+            def do_push(volume):
+                root = volume.get_filesystem().get_path()
+                root.child(b"afile.txt").setContent(b"WORKS!")
+                receiving = service_pair.remote.receive_and_acquire_stream(
+                    volume)
+
+                def got_consumer(consumer):
+                    producer = volume.get_filesystem().reader_stream()
+                    producing = producer.startProducing(consumer)
+                    producing.addCallback(lambda _: consumer.finish())
+                    return producing
+                receiving.addCallback(got_consumer)
+                return receiving
+            created.addCallback(do_push)
+
+            def pushed(uuid):
+                to_volume = Volume(uuid=to_service.uuid, name=MY_VOLUME,
+                                   service=to_service)
+                root = to_volume.get_filesystem().get_path()
+                self.assertEqual(
+                    (uuid, root.child(b"afile.txt").getContent()),
+                    (to_service.uuid, b"WORKS!"))
+            created.addCallback(pushed)
+
+            return created
+
         def remotely_owned_volume(self, service_pair):
             """
             Create a volume ``MY_VOLUME`` on the origin service and a copy
@@ -222,6 +294,22 @@ def make_iremote_volume_manager(fixture):
             created.addCallback(got_volume)
             return created
 
+        def test_compressions(self):
+            """
+            ``compressions`` returns a ``list`` of compression algorithms
+            which are all supported.
+            """
+            service_pair = fixture(self)
+            d = service_pair.remote.compressions()
+
+            def got_algorithms(algorithms):
+                self.assertEqual(
+                    (type(algorithms),
+                     set(algorithms) - set(ALGORITHMS)),
+                    (list, set()))
+            d.addCallback(got_algorithms)
+            return d
+
         def test_clone_to(self):
             """
             ``clone_to()`` clones a volume.
@@ -324,19 +412,147 @@ class RemoteVolumeManagerTests(TestCase):
         self.assertEqual(
             [Snapshot(name="abc"), Snapshot(name="def")], snapshots)
 
-    def test_receive_destination_run(self):
+    def test_snapshots_guid(self):
+        """
+        ``RemoteVolumeManager.snapshots`` parses the ``guid`` and
+        ``createtxg`` of each snapshot from the output of ``flocker-volume``.
+        """
+        node = FakeNode([b"abc\t12\t3\ndef\t45\t6\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        snapshots = self.successResultOf(remote.snapshots(self.volume))
+        self.assertEqual(
+            [Snapshot(name=b"abc", guid=12, createtxg=3),
+             Snapshot(name=b"def", guid=45, createtxg=6)], snapshots)
+
+    def test_receive_state_many_destination_run(self):
+        """
+        ``RemoteVolumeManager.receive_state_many`` calls ``flocker-volume``
+        remotely once with the ``snapshots --all --resume-token``
+        sub-command, and picks out the snapshots and resume token of each
+        volume from its output.
+        """
+        other = self.successResultOf(self.service.create(
+            self.service.get(MY_VOLUME2)))
+        uuid = self.volume.uuid.encode("ascii")
+        node = FakeNode([
+            b"%s\tmyns.myvol\tabc\t12\t3\n"
+            b"%s\tmyns.other\tdef\n"
+            b"%s\tmyns.myvol\tghi\t45\t6\n"
+            b"%s\tmyns.myvol\t\t1-abc-def\n" % (uuid, uuid, uuid, uuid)])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        states = self.successResultOf(
+            remote.receive_state_many([self.volume, other]))
+        self.assertEqual(
+            (node.remote_command, states),
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"snapshots", b"--all", b"--resume-token"],
+             {self.volume: ReceiveState(
+                 snapshots=[Snapshot(name=b"abc", guid=12, createtxg=3),
+                            Snapshot(name=b"ghi", guid=45, createtxg=6)],
+                 resume_token=b"1-abc-def"),
+              other: ReceiveState(snapshots=[])}))
+
+    def test_receive_state_destination_run(self):
+        """
+        ``RemoteVolumeManager.receive_state`` calls ``flocker-volume``
+        remotely with the ``snapshots --resume-token`` sub-command and parses
+        the token from the first line of its output and the snapshots from
+        the rest.
         """
-        Receiving calls ``flocker-volume`` remotely with ``receive`` command.
+        node = FakeNode([b"1-abc-def\nabc\t12\t3\ndef\t45\t6\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        state = self.successResultOf(remote.receive_state(self.volume))
+        self.assertEqual(
+            (node.remote_command, state),
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"snapshots", b"--resume-token",
+              self.volume.uuid.encode("ascii"), b"myns.myvol"],
+             ReceiveState(
+                 snapshots=[Snapshot(name=b"abc", guid=12, createtxg=3),
+                            Snapshot(name=b"def", guid=45, createtxg=6)],
+                 resume_token=b"1-abc-def")))
+
+    def test_compressions_destination_run(self):
+        """
+        ``RemoteVolumeManager.compressions`` calls ``flocker-volume``
+        remotely with the ``compressions`` sub-command the first time and
+        returns the algorithms it lists, and later returns the same answer
+        without asking again.
+        """
+        node = FakeNode([b"zlib\nzstd\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        first = self.successResultOf(remote.compressions())
+        self.assertEqual(
+            (node.remote_command, first,
+             self.successResultOf(remote.compressions())),
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"compressions"], [b"zlib", b"zstd"], [b"zlib", b"zstd"]))
+
+    def test_receive_state_no_token(self):
+        """
+        ``RemoteVolumeManager.receive_state`` returns no resume token if the
+        first line of the remote command's output is empty.
+        """
+        remote = RemoteVolumeManager(FakeNode([b"\nabc\n"]))
+        self.assertEqual(
+            self.successResultOf(remote.receive_state(self.volume)),
+            ReceiveState(snapshots=[Snapshot(name=b"abc")]))
+
+    def test_receive_stream_destination_run(self):
+        """
+        ``RemoteVolumeManager.receive_stream`` streams to ``flocker-volume``
+        run remotely with the ``receive`` command.
+        """
+        node = FakeNode()
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        consumer = self.successResultOf(remote.receive_stream(self.volume))
+        consumer.write(b"data")
+        self.successResultOf(consumer.finish())
+        self.assertEqual((node.remote_command, node.stdin.read()),
+                         ([b"flocker-volume", b"--config", b"/path/to/json",
+                           b"receive", self.volume.uuid.encode("ascii"),
+                           b"myns.myvol"], b"data"))
+
+    def test_receive_stream_compression(self):
+        """
+        ``RemoteVolumeManager.receive_stream`` tells the remote
+        ``flocker-volume receive`` how the stream is compressed.
         """
         node = FakeNode()
 
         remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
-        with remote.receive(self.volume):
-            pass
+        remote.receive_stream(
+            self.volume, Compression(algorithm=b"zstd", level=3))
         self.assertEqual(node.remote_command,
                          [b"flocker-volume", b"--config", b"/path/to/json",
-                          b"receive", self.volume.uuid.encode("ascii"),
-                          b"myns.myvol"])
+                          b"receive", b"--compression", b"zstd:3",
+                          self.volume.uuid.encode("ascii"), b"myns.myvol"])
+
+    def test_receive_and_acquire_stream_destination_run(self):
+        """
+        ``RemoteVolumeManager.receive_and_acquire_stream`` streams to
+        ``flocker-volume`` run remotely with the ``receive --acquire``
+        command, and finishing fires with the UUID it writes to stdout.
+        """
+        node = FakeNode(stream_output=b"remoteuuid")
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        consumer = self.successResultOf(
+            remote.receive_and_acquire_stream(
+                self.volume, Compression(algorithm=b"zstd", level=3)))
+        consumer.write(b"data")
+        uuid = self.successResultOf(consumer.finish())
+        self.assertEqual((node.remote_command, node.stdin.read(), uuid),
+                         ([b"flocker-volume", b"--config", b"/path/to/json",
+                           b"receive", b"--acquire",
+                           b"--compression", b"zstd:3",
+                           self.volume.uuid.encode("ascii"),
+                           b"myns.myvol"], b"data", u"remoteuuid"))
 
     def test_receive_default_config(self):
         """
@@ -346,8 +562,7 @@ class RemoteVolumeManagerTests(TestCase):
         node = FakeNode()
 
         remote = RemoteVolumeManager(node)
-        with remote.receive(self.volume):
-            pass
+        remote.receive_stream(self.volume)
         self.assertEqual(node.remote_command,
                          [b"flocker-volume", b"--config",
                           DEFAULT_CONFIG_PATH.path,
@@ -380,5 +595,20 @@ class StandardNodeTests(TestCase):
         using the private key for the cluster.
         """
         node = standard_node(b'example.com')
-        self.assertEqual(node, ProcessNode.using_ssh(
-            b'example.com', 22, b'root', SSH_PRIVATE_KEY_PATH))
+        self.assertEqual(
+            node.initial_command_arguments,
+            ProcessNode.using_ssh(
+                b'example.com', 22, b'root', SSH_PRIVATE_KEY_PATH,
+                control_path=_control_path(
+                    FilePath(b"/var/run/flocker/ssh"), b'example.com', 22,
+                    b'root'),
+            ).initial_command_arguments)
+
+    def test_shared(self):
+        """
+        ``standard_node`` returns the same node from the shared
+        ``SSH_CONNECTIONS`` pool each time it is called for a host.
+        """
+        self.assertIs(standard_node(b'example.com'),
+                      SSH_CONNECTIONS.node(
+                          b'example.com', 22, b'root', SSH_PRIVATE_KEY_PATH))
@@ -0,0 +1,125 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._registry`.
+"""
+
+from __future__ import absolute_import
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._registry import VolumeRegistry
+from ..service import Volume, VolumeName
+
+
+MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvolume")
+MY_VOLUME2 = VolumeName(namespace=u"myns", id=u"myvolume2")
+OTHER_VOLUME = VolumeName(namespace=u"otherns", id=u"myvolume")
+
+
+def volume(uuid, name):
+    """
+    :return: A ``Volume`` with no service.
+    """
+    return Volume(uuid=uuid, name=name, service=None)
+
+
+class VolumeRegistryTests(SynchronousTestCase):
+    """
+    Tests for ``VolumeRegistry``.
+    """
+    def test_empty(self):
+        """
+        A new registry has no volumes.
+        """
+        registry = VolumeRegistry()
+        self.assertEqual(
+            (registry.get(u"uuid", MY_VOLUME),
+             registry.in_namespace(u"myns"), registry.all()),
+            (None, [], []))
+
+    def test_get(self):
+        """
+        An added volume can be found by its owner UUID and name.
+        """
+        registry = VolumeRegistry()
+        added = volume(u"uuid", MY_VOLUME)
+        registry.add(added)
+        self.assertEqual(
+            (registry.get(u"uuid", MY_VOLUME),
+             registry.get(u"other", MY_VOLUME),
+             registry.get(u"uuid", MY_VOLUME2)),
+            (added, None, None))
+
+    def test_add_replaces(self):
+        """
+        Adding a volume with the same owner and name as one already in the
+        registry replaces it.
+        """
+        registry = VolumeRegistry()
+        registry.add(volume(u"uuid", MY_VOLUME))
+        replacement = volume(u"uuid", MY_VOLUME)
+        registry.add(replacement)
+        self.assertEqual(
+            (registry.all(), registry.in_namespace(u"myns")),
+            ([replacement], [replacement]))
+        self.assertIs(registry.get(u"uuid", MY_VOLUME), replacement)
+
+    def test_in_namespace(self):
+        """
+        ``VolumeRegistry.in_namespace`` returns the volumes in the given
+        namespace, whoever owns them.
+        """
+        registry = VolumeRegistry()
+        volumes = [volume(u"uuid", MY_VOLUME), volume(u"other", MY_VOLUME),
+                   volume(u"uuid", MY_VOLUME2)]
+        for added in volumes + [volume(u"uuid", OTHER_VOLUME)]:
+            registry.add(added)
+        self.assertItemsEqual(registry.in_namespace(u"myns"), volumes)
+
+    def test_remove(self):
+        """
+        A removed volume can no longer be found.
+        """
+        registry = VolumeRegistry()
+        registry.add(volume(u"uuid", MY_VOLUME))
+        kept = volume(u"uuid", MY_VOLUME2)
+        registry.add(kept)
+        registry.remove(volume(u"uuid", MY_VOLUME))
+        self.assertEqual(
+            (registry.get(u"uuid", MY_VOLUME),
+             registry.in_namespace(u"myns"), registry.all()),
+            (None, [kept], [kept]))
+
+    def test_remove_last_in_namespace(self):
+        """
+        Once the last volume in a namespace is removed the namespace is
+        empty.
+        """
+        registry = VolumeRegistry()
+        registry.add(volume(u"uuid", OTHER_VOLUME))
+        registry.remove(volume(u"uuid", OTHER_VOLUME))
+        self.assertEqual(registry.in_namespace(u"otherns"), [])
+
+    def test_remove_missing(self):
+        """
+        Removing a volume which is not in the registry does nothing.
+        """
+        registry = VolumeRegistry()
+        kept = volume(u"uuid", MY_VOLUME)
+        registry.add(kept)
+        registry.remove(volume(u"other", MY_VOLUME))
+        self.assertEqual(registry.all(), [kept])
+
+    def test_reset(self):
+        """
+        ``VolumeRegistry.reset`` replaces all the volumes.
+        """
+        registry = VolumeRegistry()
+        registry.add(volume(u"uuid", MY_VOLUME))
+        new = volume(u"uuid", OTHER_VOLUME)
+        registry.reset([new])
+        self.assertEqual(
+            (registry.get(u"uuid", MY_VOLUME),
+             registry.in_namespace(u"myns"), registry.all()),
+            (None, [], [new]))
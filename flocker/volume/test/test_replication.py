@@ -0,0 +1,472 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._replication`.
+"""
+
+from __future__ import absolute_import
+
+from eliot.testing import validateLogging, assertHasMessage
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._replication import Replication, REPLICATED, REPLICATION_FAILED
+from .._ipc import LocalVolumeManager
+from ..service import (
+    Volume, VolumeName, VolumeService, VolumeLockTimeout,
+    VOLUME_LOCK_INTERVAL, VOLUME_LOCK_LOG_INTERVAL, WAITING_FOR_VOLUME_LOCK,
+)
+from ..filesystems.memory import FilesystemStoragePool
+from ..testtools import create_volume_service
+
+
+MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvolume")
+
+
+class FailingVolumeManager(LocalVolumeManager):
+    """
+    A volume manager which fails to receive pushes.
+    """
+    def receive_stream(self, volume, compression=None):
+        return fail(IOError("unreachable"))
+
+
+class BlockedVolumeManager(LocalVolumeManager):
+    """
+    A volume manager which does not start receiving pushes until
+    ``unblock`` is called.
+    """
+    def __init__(self, service):
+        LocalVolumeManager.__init__(self, service)
+        self.blocked = Deferred()
+
+    def receive_stream(self, volume, compression=None):
+        self.blocked.addCallback(
+            lambda _: LocalVolumeManager.receive_stream(
+                self, volume, compression))
+        return self.blocked
+
+    def receive_and_acquire_stream(self, volume, compression=None):
+        self.blocked.addCallback(
+            lambda _: LocalVolumeManager.receive_and_acquire_stream(
+                self, volume, compression))
+        return self.blocked
+
+
+class ReplicationTests(SynchronousTestCase):
+    """
+    Tests for ``Replication``, as created by ``VolumeService.replicate``.
+    """
+    def setUp(self):
+        self.service = create_volume_service(self)
+        self.clock = self.service._reactor
+        self.standby = create_volume_service(self)
+        self.volume = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+        self.write(b"first")
+
+    def write(self, data):
+        """
+        Change the contents of the replicated volume.
+
+        :param bytes data: The new contents of a file in the volume.
+        """
+        self.volume.get_filesystem().get_path().child(b"file").setContent(
+            data)
+
+    def standby_contents(self):
+        """
+        :return: The contents of the file in the standby's copy of the
+            volume.
+        """
+        standby_volume = Volume(
+            uuid=self.service.uuid, name=MY_VOLUME, service=self.standby)
+        return standby_volume.get_filesystem().get_path().child(
+            b"file").getContent()
+
+    def replicate(self, destination=None):
+        """
+        Start replicating the volume to the standby every 10 seconds.
+
+        :param destination: The ``IRemoteVolumeManager`` to push to, by
+            default one for the standby service.
+
+        :return: The ``Replication``.
+        """
+        if destination is None:
+            destination = LocalVolumeManager(self.standby)
+        replication = self.service.replicate(
+            MY_VOLUME, destination, u"standby", 10)
+        self.addCleanup(replication.stop)
+        return replication
+
+    def test_pushes_immediately(self):
+        """
+        The volume is pushed as soon as replication starts.
+        """
+        replication = self.replicate()
+        self.assertEqual(
+            (self.standby_contents(), replication.pushes,
+             replication.last_synced),
+            (b"first", 1, 0))
+
+    def test_pushes_periodically(self):
+        """
+        The volume is pushed again after each interval.
+        """
+        replication = self.replicate()
+        self.write(b"second")
+        self.clock.advance(10)
+        self.assertEqual(
+            (self.standby_contents(), replication.pushes,
+             replication.last_synced),
+            (b"second", 2, 10))
+
+    def test_lag(self):
+        """
+        ``Replication.lag`` is the time since the most recent successful push
+        started.
+        """
+        replication = self.replicate()
+        self.clock.advance(3)
+        self.assertEqual(replication.lag(), 3)
+
+    def test_pins(self):
+        """
+        Each push pins the snapshot the standby has for the standby.
+        """
+        self.volume.get_filesystem().snapshot(b"stuff")
+        self.replicate()
+        self.assertEqual(self.service.pins.pinned(self.volume), {b"stuff"})
+
+    def test_failure(self):
+        """
+        A failed push is counted, and replication continues afterwards.
+        """
+        replication = self.replicate(FailingVolumeManager(self.standby))
+        self.clock.advance(10)
+        self.assertEqual(
+            (replication.pushes, replication.failures, replication.lag()),
+            (0, 2, None))
+
+    @validateLogging(assertHasMessage, REPLICATED,
+                     {u"volume": u"myns.myvolume", u"peer": u"standby"})
+    def test_logged(self, logger):
+        """
+        Each successful push is logged.
+        """
+        self.patch(Replication, "logger", logger)
+        self.replicate()
+
+    @validateLogging(assertHasMessage, REPLICATION_FAILED,
+                     {u"volume": u"myns.myvolume", u"peer": u"standby",
+                      u"reason": u"unreachable"})
+    def test_failure_logged(self, logger):
+        """
+        Each failed push is logged.
+        """
+        self.patch(Replication, "logger", logger)
+        self.replicate(FailingVolumeManager(self.standby))
+
+    def test_not_locally_owned(self):
+        """
+        Nothing is pushed while the volume is owned by another node.
+        """
+        self.successResultOf(self.volume.change_owner(u"other"))
+        replication = self.replicate()
+        self.assertEqual(
+            (replication.pushes, replication.failures), (0, 0))
+
+    def test_stop(self):
+        """
+        Once stopped, the volume is no longer pushed.
+        """
+        replication = self.replicate()
+        self.successResultOf(replication.stop())
+        self.clock.advance(10)
+        self.assertEqual(replication.pushes, 1)
+
+    def test_stop_waits_for_push(self):
+        """
+        ``Replication.stop`` returns a ``Deferred`` that fires once the push
+        in progress has finished.
+        """
+        destination = BlockedVolumeManager(self.standby)
+        replication = self.replicate(destination)
+        stopping = replication.stop()
+        self.assertNoResult(stopping)
+        destination.blocked.callback(None)
+        self.successResultOf(stopping)
+        self.assertEqual(replication.pushes, 1)
+
+
+class VolumeServiceReplicationTests(SynchronousTestCase):
+    """
+    Tests for the management of replications by ``VolumeService``.
+    """
+    def setUp(self):
+        self.service = create_volume_service(self)
+        self.clock = self.service._reactor
+        self.standby = LocalVolumeManager(create_volume_service(self))
+        self.volume = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+
+    def test_replications(self):
+        """
+        ``VolumeService.replications`` maps the volume name and peer to each
+        ``Replication``.
+        """
+        first = self.service.replicate(MY_VOLUME, self.standby, u"a", 10)
+        second = self.service.replicate(MY_VOLUME, self.standby, u"b", 10)
+        self.addCleanup(self.service.stop_replicating, MY_VOLUME)
+        self.assertEqual(
+            self.service.replications,
+            {(MY_VOLUME, u"a"): first, (MY_VOLUME, u"b"): second})
+
+    def test_replace(self):
+        """
+        Replicating a volume to a peer it is already replicated to replaces
+        the old ``Replication``, which is stopped.
+        """
+        first = self.service.replicate(MY_VOLUME, self.standby, u"a", 10)
+        second = self.service.replicate(MY_VOLUME, self.standby, u"a", 5)
+        self.addCleanup(self.service.stop_replicating, MY_VOLUME)
+        self.clock.advance(10)
+        self.assertEqual(
+            (self.service.replications, first.pushes, second.pushes),
+            ({(MY_VOLUME, u"a"): second}, 1, 2))
+
+    def test_stop_replicating_peer(self):
+        """
+        ``VolumeService.stop_replicating`` with a peer stops only the
+        replication to that peer.
+        """
+        self.service.replicate(MY_VOLUME, self.standby, u"a", 10)
+        second = self.service.replicate(MY_VOLUME, self.standby, u"b", 10)
+        self.addCleanup(self.service.stop_replicating, MY_VOLUME)
+        self.successResultOf(
+            self.service.stop_replicating(MY_VOLUME, u"a"))
+        self.assertEqual(
+            self.service.replications, {(MY_VOLUME, u"b"): second})
+
+    def test_stop_service(self):
+        """
+        Stopping the ``VolumeService`` stops all replications.
+        """
+        replication = self.service.replicate(
+            MY_VOLUME, self.standby, u"a", 10)
+        self.service.stopService()
+        self.clock.advance(10)
+        self.assertEqual(
+            (self.service.replications, replication.pushes), ({}, 1))
+
+    def test_stop_before_start(self):
+        """
+        Stopping a ``Replication`` which was never started does nothing.
+        """
+        replication = Replication(
+            self.service, MY_VOLUME, self.standby, u"a", 10)
+        self.assertIs(self.successResultOf(replication.stop()), None)
+
+    def test_handoff_stops_replication(self):
+        """
+        ``VolumeService.handoff`` stops replicating the volume before it is
+        handed off.
+        """
+        replication = self.service.replicate(
+            MY_VOLUME, self.standby, u"a", 10)
+        self.successResultOf(self.service.handoff(self.volume, self.standby))
+        self.clock.advance(10)
+        self.assertEqual(
+            (self.service.replications, replication.pushes), ({}, 1))
+
+
+class SeparateProcessHandoffTests(SynchronousTestCase):
+    """
+    Tests for a handoff and a replication of the same volume run by
+    different ``VolumeService`` instances sharing a configuration and pool,
+    as ``flocker-changestate`` and ``flocker-serve`` do.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        config_path = FilePath(self.mktemp())
+        pool_path = FilePath(self.mktemp())
+        self.serve = self.create_service(config_path, pool_path)
+        self.changestate = self.create_service(config_path, pool_path)
+        self.standby = create_volume_service(self)
+        self.volume = self.successResultOf(
+            self.serve.create(self.serve.get(MY_VOLUME)))
+        self.successResultOf(self.changestate.enumerate())
+
+    def create_service(self, config_path, pool_path):
+        """
+        Create and start a ``VolumeService``.
+
+        :param FilePath config_path: The service's configuration file.
+        :param FilePath pool_path: The directory of the service's pool.
+
+        :return: The started ``VolumeService``.
+        """
+        service = VolumeService(
+            config_path, FilesystemStoragePool(pool_path), reactor=self.clock)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def handoff(self, destination=None, **kwargs):
+        """
+        Hand the volume off to the standby, from the ``flocker-changestate``
+        service.
+
+        :param destination: The ``IRemoteVolumeManager`` to hand off to, by
+            default one for the standby service.
+        :param kwargs: Further arguments for ``VolumeService.handoff``.
+
+        :return: ``Deferred`` that fires when the handoff has finished.
+        """
+        if destination is None:
+            destination = LocalVolumeManager(self.standby)
+        volume = self.changestate.lookup(MY_VOLUME)
+        return self.changestate.handoff(volume, destination, **kwargs)
+
+    def record_invalidations(self, service):
+        """
+        Record whether the volume's lock is held each time a service's pool
+        cache is invalidated.
+
+        :param VolumeService service: The service.
+
+        :return: ``list`` of ``bool``, one per invalidation.
+        """
+        held = []
+        lock_path = FilePath(service._volume_lock(MY_VOLUME).name)
+        self.patch(service.pool, "invalidate",
+                   lambda: held.append(lock_path.islink()))
+        return held
+
+    def hung_replication(self):
+        """
+        Start a replication in the ``flocker-serve`` service whose push never
+        finishes.
+        """
+        replication = self.serve.replicate(
+            MY_VOLUME, BlockedVolumeManager(self.standby), u"standby", 10)
+        self.addCleanup(replication.stop)
+
+    def test_handoff_waits_for_push(self):
+        """
+        A handoff waits for a replication push in progress in another
+        process to finish before pushing itself.
+        """
+        destination = BlockedVolumeManager(self.standby)
+        replication = self.serve.replicate(
+            MY_VOLUME, destination, u"standby", 10)
+        self.addCleanup(replication.stop)
+        handing_off = self.handoff()
+        self.clock.advance(VOLUME_LOCK_INTERVAL)
+        self.assertNoResult(handing_off)
+
+        destination.blocked.callback(None)
+        self.clock.advance(VOLUME_LOCK_INTERVAL)
+        self.successResultOf(handing_off)
+        self.assertEqual(
+            (replication.pushes, replication.failures,
+             self.standby.lookup(MY_VOLUME) is not None),
+            (1, 0, True))
+
+    def test_handoff_lock_timeout(self):
+        """
+        If another process holds the volume's lock for longer than the
+        handoff's ``lock_timeout``, the handoff fails with
+        ``VolumeLockTimeout`` without pushing.
+        """
+        self.hung_replication()
+        handing_off = self.handoff(lock_timeout=1.0)
+        self.clock.pump([VOLUME_LOCK_INTERVAL] * 9)
+        self.assertNoResult(handing_off)
+        self.clock.pump([VOLUME_LOCK_INTERVAL] * 2)
+        self.failureResultOf(handing_off, VolumeLockTimeout)
+        self.assertIs(self.standby.lookup(MY_VOLUME), None)
+
+    @validateLogging(assertHasMessage, WAITING_FOR_VOLUME_LOCK,
+                     {u"volume": u"myns.myvolume", u"waited": 0.0})
+    def test_handoff_waiting_logged(self, logger):
+        """
+        A handoff logs that it is waiting for the volume's lock as soon as
+        it finds it held.
+        """
+        self.patch(self.changestate, "logger", logger)
+        self.hung_replication()
+        self.handoff()
+
+    @validateLogging(None)
+    def test_handoff_waiting_logged_periodically(self, logger):
+        """
+        A handoff which is still waiting for the volume's lock logs so again
+        every ``VOLUME_LOCK_LOG_INTERVAL`` seconds.
+        """
+        self.patch(self.changestate, "logger", logger)
+        self.hung_replication()
+        self.handoff()
+        self.clock.pump([VOLUME_LOCK_INTERVAL] * 10)
+        logged = [len(logger.messages)]
+        self.clock.advance(VOLUME_LOCK_LOG_INTERVAL)
+        logged.append(len(logger.messages))
+        self.assertEqual(logged, [1, 2])
+
+    def test_handoff_invalidates_pool_cache(self):
+        """
+        Once a handoff has the volume's lock it invalidates the pool's
+        cache, since a replication push in another process may have changed
+        the volume.
+        """
+        held = self.record_invalidations(self.changestate)
+        self.successResultOf(self.handoff())
+        self.assertEqual(held[:1], [True])
+
+    def test_replication_invalidates_pool_cache(self):
+        """
+        Once a replication has the volume's lock it invalidates the pool's
+        cache before checking who owns the volume, since a handoff in
+        another process may have changed the owner.
+        """
+        held = self.record_invalidations(self.serve)
+        replication = self.serve.replicate(
+            MY_VOLUME, LocalVolumeManager(self.standby), u"standby", 10)
+        self.addCleanup(replication.stop)
+        self.assertEqual(held[:1], [True])
+
+    def test_replication_skipped_during_handoff(self):
+        """
+        A replication does not push while another process is handing the
+        volume off.
+        """
+        destination = BlockedVolumeManager(self.standby)
+        handing_off = self.handoff(destination)
+        replication = self.serve.replicate(
+            MY_VOLUME, LocalVolumeManager(self.standby), u"standby", 10)
+        self.addCleanup(replication.stop)
+        self.assertEqual(
+            (replication.pushes, replication.failures), (0, 0))
+
+        destination.blocked.callback(None)
+        self.successResultOf(handing_off)
+        self.clock.advance(10)
+        self.assertEqual(
+            (replication.pushes, replication.failures), (0, 0))
+
+    def test_replication_after_handoff(self):
+        """
+        Once another process has handed the volume off, the replication no
+        longer pushes it, since it is no longer owned by this node.
+        """
+        replication = self.serve.replicate(
+            MY_VOLUME, LocalVolumeManager(self.standby), u"standby", 10)
+        self.addCleanup(replication.stop)
+        self.successResultOf(self.handoff())
+        self.clock.advance(10)
+        self.assertEqual(
+            (replication.pushes, replication.failures), (1, 0))
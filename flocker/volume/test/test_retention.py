@@ -0,0 +1,407 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._retention`.
+"""
+
+from __future__ import absolute_import
+
+from uuid import uuid4
+
+from eliot.testing import validateLogging, assertHasMessage
+
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from twisted.python.lockfile import FilesystemLock
+
+from .. import _retention
+from .._retention import (
+    SnapshotPins, SnapshotRetentionService, prunable, PRUNE_SNAPSHOTS,
+    PINS_LOCK_INTERVAL,
+)
+from ..filesystems.memory import DirectoryFilesystem
+from ..filesystems.zfs import Snapshot
+from ..service import Volume, VolumeName
+from ..testtools import create_volume_service
+
+
+MY_VOLUME = VolumeName(namespace=u"myns", id=u"myvolume")
+MY_VOLUME2 = VolumeName(namespace=u"myns", id=u"myvolume2")
+
+
+def push_snapshots(count):
+    """
+    :param int count: The number of snapshots.
+
+    :return: ``list`` of ``Snapshot`` instances named like the ones taken
+        when pushing.
+    """
+    return [Snapshot(name=bytes(uuid4())) for i in range(count)]
+
+
+class PrunableTests(SynchronousTestCase):
+    """
+    Tests for ``prunable``.
+    """
+    def test_keep(self):
+        """
+        All but the given number of newest snapshots are prunable.
+        """
+        snapshots = push_snapshots(5)
+        self.assertEqual(prunable(snapshots, set(), 2), snapshots[:3])
+
+    def test_keep_none(self):
+        """
+        If no snapshots are to be kept, all of them are prunable.
+        """
+        snapshots = push_snapshots(3)
+        self.assertEqual(prunable(snapshots, set(), 0), snapshots)
+
+    def test_keep_more_than_exist(self):
+        """
+        If more snapshots are to be kept than exist, none are prunable.
+        """
+        self.assertEqual(prunable(push_snapshots(3), set(), 5), [])
+
+    def test_pinned(self):
+        """
+        Pinned snapshots are not prunable.
+        """
+        snapshots = push_snapshots(4)
+        self.assertEqual(
+            prunable(snapshots, {snapshots[1].name}, 1),
+            [snapshots[0], snapshots[2]])
+
+    def test_only_push_snapshots(self):
+        """
+        Snapshots not named with a UUID were not taken by pushes and are not
+        prunable.
+        """
+        snapshots = push_snapshots(2)
+        self.assertEqual(
+            prunable([Snapshot(name=b"manual")] + snapshots, set(), 0),
+            snapshots)
+
+
+class SnapshotPinsTests(SynchronousTestCase):
+    """
+    Tests for ``SnapshotPins``.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.pins = SnapshotPins(self.path)
+        service = create_volume_service(self)
+        self.volume = service.get(MY_VOLUME)
+        self.volume2 = service.get(MY_VOLUME2)
+
+    def test_nothing_pinned(self):
+        """
+        Initially no snapshots are pinned.
+        """
+        self.assertEqual(self.pins.pinned(self.volume), set())
+
+    def test_pin(self):
+        """
+        ``SnapshotPins.pinned`` includes the snapshot pinned for each peer.
+        """
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"a"))
+        self.pins.pin(self.volume, u"node2", Snapshot(name=b"b"))
+        self.assertEqual(self.pins.pinned(self.volume), {b"a", b"b"})
+
+    def test_replace(self):
+        """
+        Pinning a snapshot for a peer unpins the one previously pinned for
+        that peer.
+        """
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"a"))
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"b"))
+        self.assertEqual(self.pins.pinned(self.volume), {b"b"})
+
+    def test_per_volume(self):
+        """
+        Snapshots are pinned separately for each volume.
+        """
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"a"))
+        self.pins.pin(self.volume2, u"node1", Snapshot(name=b"b"))
+        self.assertEqual(
+            (self.pins.pinned(self.volume), self.pins.pinned(self.volume2)),
+            ({b"a"}, {b"b"}))
+
+    def test_persisted(self):
+        """
+        Pins are stored in the file, so are seen by other ``SnapshotPins``
+        instances using it.
+        """
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"a"))
+        self.assertEqual(
+            SnapshotPins(self.path).pinned(self.volume), {b"a"})
+
+    def test_pin_waits_for_lock(self):
+        """
+        ``SnapshotPins.pin`` waits for another process holding the pins
+        file's lock, e.g. while it pins a snapshot itself, and keeps that
+        process's pin.
+        """
+        lock = FilesystemLock(self.path.path + b".lock")
+        lock.lock()
+        slept = []
+
+        def sleep(seconds):
+            # The other process pins and releases the lock:
+            slept.append(seconds)
+            self.path.setContent(
+                b'{"%s.myns.myvolume": {"node2": "b"}}'
+                % (self.volume.uuid.encode("ascii"),))
+            lock.unlock()
+        self.patch(_retention, "sleep", sleep)
+        self.pins.pin(self.volume, u"node1", Snapshot(name=b"a"))
+        self.assertEqual(
+            (slept, self.pins.pinned(self.volume),
+             FilePath(lock.name).islink()),
+            ([PINS_LOCK_INTERVAL], {b"a", b"b"}, False))
+
+
+class SnapshotRetentionServiceTests(SynchronousTestCase):
+    """
+    Tests for ``SnapshotRetentionService``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.volume_service = create_volume_service(self)
+        self.retention = SnapshotRetentionService(
+            self.volume_service, self.clock, keep=1, interval=10)
+
+    def create_volume(self, name, count):
+        """
+        Create a volume and take some push snapshots of it.
+
+        :param VolumeName name: The name of the volume.
+        :param int count: The number of snapshots.
+
+        :return: ``tuple`` of the volume and its snapshots.
+        """
+        volume = self.successResultOf(
+            self.volume_service.create(self.volume_service.get(name)))
+        snapshots = push_snapshots(count)
+        for snapshot in snapshots:
+            volume.get_filesystem().snapshot(snapshot.name)
+        return volume, snapshots
+
+    def remaining(self, volume):
+        """
+        :param Volume volume: A volume.
+
+        :return: ``list`` of the volume's ``Snapshot`` instances.
+        """
+        return self.successResultOf(volume.get_filesystem().snapshots())
+
+    def test_prune(self):
+        """
+        ``SnapshotRetentionService.prune`` destroys the unneeded snapshots of
+        every locally owned volume.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        volume2, snapshots2 = self.create_volume(MY_VOLUME2, 2)
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(
+            (self.remaining(volume), self.remaining(volume2)),
+            (snapshots[-1:], snapshots2[-1:]))
+
+    def test_prune_keeps_pinned(self):
+        """
+        ``SnapshotRetentionService.prune`` does not destroy snapshots which
+        are pinned for a peer.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        self.volume_service.pins.pin(volume, u"node1", snapshots[0])
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(
+            self.remaining(volume), [snapshots[0], snapshots[2]])
+
+    def test_prune_skips_locked(self):
+        """
+        ``SnapshotRetentionService.prune`` leaves alone a volume whose lock
+        is held, e.g. by a process pushing it.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        lock = self.volume_service._volume_lock(MY_VOLUME)
+        lock.lock()
+        self.addCleanup(lock.unlock)
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(self.remaining(volume), snapshots)
+
+    def test_prune_holds_lock(self):
+        """
+        ``SnapshotRetentionService.prune`` invalidates the pool's cache and
+        destroys snapshots while holding the volume's lock, and releases it
+        afterwards.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        lock_path = FilePath(self.volume_service._volume_lock(MY_VOLUME).name)
+        held = []
+        self.patch(self.volume_service.pool, "invalidate",
+                   lambda: held.append(lock_path.islink()))
+        destroy_snapshot = DirectoryFilesystem.destroy_snapshot
+
+        def recording_destroy(filesystem, snapshot):
+            held.append(lock_path.islink())
+            return destroy_snapshot(filesystem, snapshot)
+        self.patch(DirectoryFilesystem, "destroy_snapshot", recording_destroy)
+        self.successResultOf(self.retention.prune())
+        self.assertEqual((held, lock_path.islink()),
+                         ([True, True, True], False))
+
+    def test_prune_ignores_remote_volumes(self):
+        """
+        ``SnapshotRetentionService.prune`` does not destroy the snapshots of
+        volumes owned by other nodes.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        remote = self.successResultOf(volume.change_owner(u"other"))
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(self.remaining(remote), snapshots)
+
+    def test_counts(self):
+        """
+        ``SnapshotRetentionService`` counts the snapshots it destroys and the
+        bytes destroying them freed.
+        """
+        self.patch(DirectoryFilesystem, "destroy_snapshot",
+                   lambda filesystem, snapshot: succeed(100))
+        self.create_volume(MY_VOLUME, 3)
+        self.create_volume(MY_VOLUME2, 2)
+        self.successResultOf(self.retention.prune())
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(
+            (self.retention.pruned_snapshots, self.retention.pruned_bytes),
+            (6, 600))
+
+    @validateLogging(assertHasMessage, PRUNE_SNAPSHOTS,
+                     {u"snapshots": 2, u"bytes": 0})
+    def test_logged(self, logger):
+        """
+        ``SnapshotRetentionService.prune`` logs the number of snapshots it
+        destroyed and the bytes this freed.
+        """
+        self.retention.logger = logger
+        self.create_volume(MY_VOLUME, 3)
+        self.successResultOf(self.retention.prune())
+
+    def test_start_waits(self):
+        """
+        ``SnapshotRetentionService.startService`` does not prune immediately.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        self.retention.startService()
+        self.addCleanup(self.retention.stopService)
+        self.assertEqual(self.remaining(volume), snapshots)
+
+    def test_prunes_periodically(self):
+        """
+        Once started, ``SnapshotRetentionService`` prunes after each interval.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        self.retention.startService()
+        self.addCleanup(self.retention.stopService)
+        self.clock.advance(10)
+        more = push_snapshots(2)
+        for snapshot in more:
+            volume.get_filesystem().snapshot(snapshot.name)
+        self.clock.advance(10)
+        self.assertEqual(self.remaining(volume), more[-1:])
+
+    @validateLogging(None)
+    def test_destroy_fails(self, logger):
+        """
+        If a snapshot can't be destroyed, e.g. because a clone depends on it,
+        the failure is logged and the other snapshots are still destroyed.
+        """
+        self.retention.logger = logger
+        volume, snapshots = self.create_volume(MY_VOLUME, 4)
+        destroy_snapshot = DirectoryFilesystem.destroy_snapshot
+
+        def fail_first(filesystem, snapshot):
+            if snapshot == snapshots[0]:
+                return fail(ZeroDivisionError())
+            return destroy_snapshot(filesystem, snapshot)
+        self.patch(DirectoryFilesystem, "destroy_snapshot", fail_first)
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(
+            (self.remaining(volume),
+             len(logger.flushTracebacks(ZeroDivisionError))),
+            ([snapshots[0], snapshots[3]], 1))
+
+    @validateLogging(None)
+    def test_volume_fails(self, logger):
+        """
+        If one volume's snapshots can't be listed, the failure is logged and
+        the other volumes are still pruned.
+        """
+        self.retention.logger = logger
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        volume2, snapshots2 = self.create_volume(MY_VOLUME2, 2)
+        snapshots_method = DirectoryFilesystem.snapshots
+
+        def fail_first(filesystem):
+            if filesystem.get_path() == volume.get_filesystem().get_path():
+                return fail(ZeroDivisionError())
+            return snapshots_method(filesystem)
+        self.patch(DirectoryFilesystem, "snapshots", fail_first)
+        self.successResultOf(self.retention.prune())
+        self.assertEqual(
+            (self.successResultOf(snapshots_method(volume2.get_filesystem())),
+             len(logger.flushTracebacks(ZeroDivisionError))),
+            (snapshots2[-1:], 1))
+
+    @validateLogging(None)
+    def test_prune_fails(self, logger):
+        """
+        If pruning fails, the failure is logged and the next pruning still
+        happens after the interval.
+        """
+        self.retention.logger = logger
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        enumerate_volumes = self.volume_service.enumerate
+        results = [fail(ZeroDivisionError())]
+        self.patch(self.volume_service, "enumerate",
+                   lambda: results.pop() if results else enumerate_volumes())
+        self.retention.startService()
+        self.addCleanup(self.retention.stopService)
+        self.clock.advance(10)
+        self.clock.advance(10)
+        self.assertEqual(
+            (self.remaining(volume),
+             len(logger.flushTracebacks(ZeroDivisionError))),
+            (snapshots[-1:], 1))
+
+    def test_stop(self):
+        """
+        Once stopped, ``SnapshotRetentionService`` no longer prunes.
+        """
+        volume, snapshots = self.create_volume(MY_VOLUME, 3)
+        self.retention.startService()
+        self.retention.stopService()
+        self.clock.advance(10)
+        self.assertEqual(self.remaining(volume), snapshots)
+
+
+class VolumePinsTests(SynchronousTestCase):
+    """
+    Tests for the pins of ``VolumeService``.
+    """
+    def test_pins_path(self):
+        """
+        ``VolumeService.pins`` stores pins next to the service's
+        configuration file.
+        """
+        service = create_volume_service(self)
+        volume = Volume(uuid=service.uuid, name=MY_VOLUME, service=service)
+        service.pins.pin(volume, u"node1", Snapshot(name=b"a"))
+        self.assertEqual(
+            SnapshotPins(
+                service._config_path.sibling(b"snapshot-pins.json")
+            ).pinned(volume),
+            {b"a"})
@@ -4,20 +4,30 @@
 Tests for :module:`flocker.volume.script`.
 """
 
+import sys
+from StringIO import StringIO
+
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
+from twisted.internet.defer import succeed
+from twisted.test.proto_helpers import MemoryReactor
 
 from ...testtools import (
     StandardOptionsTestsMixin
 )
 from ..testtools import (
-    make_volume_options_tests
+    make_volume_options_tests, create_volume_service
 )
+from .. import script as script_module
 from ..script import (
-    VolumeOptions, VolumeManagerScript, flocker_volume_options
+    VolumeOptions, VolumeManagerScript, FlockerVolumeScript,
+    flocker_volume_options
 )
+from ..service import Volume, VolumeName, VolumeScript
+from .._compression import Compression
+from .._agent import DEFAULT_AGENT_SOCKET
 
 
 class VolumeManagerScriptMainTests(SynchronousTestCase):
@@ -61,3 +71,331 @@ class StandardVolumeOptionsTests(make_volume_options_tests(VolumeOptions)):
     """
     Tests for ``VolumeService`` specific arguments of ``VolumeOptions``.
     """
+
+
+class ReceiveOptionsTests(SynchronousTestCase):
+    """
+    Tests for the options of ``flocker-volume receive``.
+    """
+    def test_no_compression(self):
+        """
+        By default the received data is not compressed.
+        """
+        options = VolumeOptions()
+        options.parseOptions([b"receive", b"uuid", b"ns.name"])
+        self.assertIs(options.subOptions["compression"], None)
+
+    def test_compression(self):
+        """
+        ``--compression`` is parsed into a ``Compression``.
+        """
+        options = VolumeOptions()
+        options.parseOptions(
+            [b"receive", b"--compression", b"lz4:2", b"uuid", b"ns.name"])
+        self.assertEqual(options.subOptions["compression"],
+                         Compression(algorithm=b"lz4", level=2))
+
+    def test_bad_compression(self):
+        """
+        An unsupported ``--compression`` results in a ``UsageError``.
+        """
+        options = VolumeOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b"receive", b"--compression", b"rar", b"uuid", b"ns.name"])
+
+    def test_no_acquire(self):
+        """
+        By default the received volume is not acquired.
+        """
+        options = VolumeOptions()
+        options.parseOptions([b"receive", b"uuid", b"ns.name"])
+        self.assertFalse(options.subOptions["acquire"])
+
+
+class ReceiveAcquireTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume receive --acquire``.
+    """
+    def test_acquire(self):
+        """
+        The received volume is acquired and the service's UUID is written to
+        stdout.
+        """
+        origin = create_volume_service(self)
+        service = create_volume_service(self)
+        name = VolumeName(namespace=u"ns", id=u"name")
+        volume = self.successResultOf(origin.create(origin.get(name)))
+        volume.get_filesystem().get_path().child(b"afile").setContent(
+            b"exists")
+        with volume.get_filesystem().reader() as reader:
+            data = reader.read()
+        self.patch(sys, "stdin", StringIO(data))
+        stdout = StringIO()
+        self.patch(sys, "stdout", stdout)
+
+        options = VolumeOptions()
+        options.parseOptions(
+            [b"receive", b"--acquire", origin.uuid.encode("ascii"),
+             b"ns.name"])
+        self.successResultOf(options.subOptions.run(service))
+        acquired = Volume(uuid=service.uuid, name=name, service=service)
+        self.assertEqual(
+            (stdout.getvalue(),
+             acquired.get_filesystem().get_path().child(
+                 b"afile").getContent()),
+            (service.uuid.encode("ascii"), b"exists"))
+
+
+class SnapshotsOptionsTests(SynchronousTestCase):
+    """
+    Tests for the options of ``flocker-volume snapshots``.
+    """
+    def test_volume(self):
+        """
+        By default the snapshots of the given volume are listed.
+        """
+        options = VolumeOptions()
+        options.parseOptions([b"snapshots", b"uuid", b"ns.name"])
+        self.assertEqual(
+            (options.subOptions["all"], options.subOptions["uuid"],
+             options.subOptions["name"]),
+            (False, u"uuid", b"ns.name"))
+
+    def test_all(self):
+        """
+        ``--all`` needs no volume.
+        """
+        options = VolumeOptions()
+        options.parseOptions([b"snapshots", b"--all"])
+        self.assertTrue(options.subOptions["all"])
+
+    def test_all_with_volume(self):
+        """
+        ``--all`` with a volume results in a ``UsageError``.
+        """
+        options = VolumeOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions,
+            [b"snapshots", b"--all", b"uuid", b"ns.name"])
+
+    def test_no_volume(self):
+        """
+        Without ``--all`` a volume must be given.
+        """
+        options = VolumeOptions()
+        self.assertRaises(
+            UsageError, options.parseOptions, [b"snapshots", b"uuid"])
+
+
+class SnapshotsResumeTokenTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume snapshots --resume-token``.
+    """
+    def run_snapshots(self, token):
+        """
+        Run ``flocker-volume snapshots --resume-token`` for a volume with
+        two snapshots.
+
+        :param bytes token: The resume token of the volume's filesystem.
+
+        :return: What was written to stdout.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(
+            service.get(VolumeName(namespace=u"ns", id=u"first"))))
+        filesystem = volume.get_filesystem()
+        filesystem.snapshot(b"a")
+        filesystem.snapshot(b"b")
+        self.patch(filesystem.__class__, "resume_token",
+                   lambda self: succeed(token))
+        stdout = StringIO()
+        self.patch(sys, "stdout", stdout)
+
+        options = VolumeOptions()
+        options.parseOptions([b"snapshots", b"--resume-token",
+                              volume.uuid.encode("ascii"), b"ns.first"])
+        self.successResultOf(options.subOptions.run(service))
+        return stdout.getvalue()
+
+    def test_token(self):
+        """
+        The resume token is written on the first line, followed by the
+        snapshots.
+        """
+        self.assertEqual(self.run_snapshots(b"1-abc"), b"1-abc\na\nb\n")
+
+    def test_no_token(self):
+        """
+        If there is no resume token the first line is empty.
+        """
+        self.assertEqual(self.run_snapshots(None), b"\na\nb\n")
+
+
+class SnapshotsAllTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume snapshots --all``.
+    """
+    def test_output(self):
+        """
+        Each snapshot of every volume is written on its own line, preceded by
+        the volume's owner UUID and name.
+        """
+        service = create_volume_service(self)
+        first = self.successResultOf(service.create(
+            service.get(VolumeName(namespace=u"ns", id=u"first"))))
+        first.get_filesystem().snapshot(b"a")
+        first.get_filesystem().snapshot(b"b")
+        self.successResultOf(service.create(
+            service.get(VolumeName(namespace=u"ns", id=u"second"))))
+        stdout = StringIO()
+        self.patch(sys, "stdout", stdout)
+
+        options = VolumeOptions()
+        options.parseOptions([b"snapshots", b"--all"])
+        self.successResultOf(options.subOptions.run(service))
+        uuid = service.uuid.encode("ascii")
+        self.assertEqual(
+            stdout.getvalue(),
+            b"%s\tns.first\ta\n%s\tns.first\tb\n" % (uuid, uuid))
+
+    def test_resume_token(self):
+        """
+        With ``--resume-token`` each volume with a resume token also has a
+        line with its owner UUID, its name, an empty snapshot and the token.
+        """
+        service = create_volume_service(self)
+        first = self.successResultOf(service.create(
+            service.get(VolumeName(namespace=u"ns", id=u"first"))))
+        first.get_filesystem().snapshot(b"a")
+        self.successResultOf(service.create(
+            service.get(VolumeName(namespace=u"ns", id=u"second"))))
+        self.patch(first.get_filesystem().__class__, "resume_token",
+                   lambda self: succeed(
+                       b"1-abc" if self.get_path().basename().endswith(
+                           b"first") else None))
+        stdout = StringIO()
+        self.patch(sys, "stdout", stdout)
+
+        options = VolumeOptions()
+        options.parseOptions([b"snapshots", b"--all", b"--resume-token"])
+        self.successResultOf(options.subOptions.run(service))
+        uuid = service.uuid.encode("ascii")
+        self.assertEqual(
+            stdout.getvalue(),
+            b"%s\tns.first\ta\n%s\tns.first\t\t1-abc\n" % (uuid, uuid))
+
+
+class CompressionsTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume compressions``.
+    """
+    def test_output(self):
+        """
+        Each compression algorithm available on this node is written on its
+        own line.
+        """
+        self.patch(script_module, "available_algorithms",
+                   lambda: [b"lz4", b"zlib"])
+        stdout = StringIO()
+        self.patch(sys, "stdout", stdout)
+
+        options = VolumeOptions()
+        options.parseOptions([b"compressions"])
+        self.successResultOf(
+            options.subOptions.run(create_volume_service(self)))
+        self.assertEqual(stdout.getvalue(), b"lz4\nzlib\n")
+
+
+class AgentTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume agent``.
+    """
+    def _relay(self, arguments):
+        """
+        Run ``flocker-volume agent`` with the given arguments, recording the
+        relay it starts.
+
+        :return: ``tuple`` of the result of running the subcommand and the
+            endpoint the relay connects to.
+        """
+        relays = []
+
+        def relay_stdio(reactor, endpoint):
+            relays.append((reactor, endpoint))
+            return succeed(None)
+        self.patch(script_module, "relay_stdio", relay_stdio)
+        options = VolumeOptions()
+        options.parseOptions([b"agent"] + arguments)
+        reactor = MemoryReactor()
+        result = FlockerVolumeScript().main(reactor, options)
+        [(relay_reactor, endpoint)] = relays
+        self.assertEqual((relay_reactor, endpoint._reactor),
+                         (reactor, reactor))
+        return result, endpoint
+
+    def test_default_socket(self):
+        """
+        By default ``flocker-volume agent`` relays standard in and out to the
+        volume agent's default socket, and finishes when the relay does.
+        """
+        result, endpoint = self._relay([])
+        self.assertEqual(
+            (self.successResultOf(result), endpoint._path),
+            (None, DEFAULT_AGENT_SOCKET.path))
+
+    def test_socket(self):
+        """
+        ``--socket`` sets the path of the socket relayed to.
+        """
+        _, endpoint = self._relay([b"--socket", b"/tmp/agent.sock"])
+        self.assertEqual(endpoint._path, b"/tmp/agent.sock")
+
+
+class FlockerVolumeScriptTests(SynchronousTestCase):
+    """
+    Tests for ``FlockerVolumeScript``.
+    """
+    def test_volume_script(self):
+        """
+        ``FlockerVolumeScript.main`` runs sub-commands other than ``agent``
+        with its volume script.
+        """
+        calls = []
+
+        class RecordingScript(object):
+            def main(self, reactor, options):
+                calls.append((reactor, options))
+                return succeed(None)
+        reactor = MemoryReactor()
+        options = VolumeOptions()
+        options.parseOptions([b"compressions"])
+        FlockerVolumeScript(RecordingScript()).main(reactor, options)
+        self.assertEqual(calls, [(reactor, options)])
+
+    def test_agent_without_service(self):
+        """
+        ``FlockerVolumeScript.main`` runs ``flocker-volume agent`` without
+        starting a ``VolumeService``.
+        """
+        self.patch(script_module, "relay_stdio",
+                   lambda reactor, endpoint: succeed(None))
+
+        class FailingScript(object):
+            def main(self, reactor, options):
+                raise AssertionError("Volume script should not be run.")
+        options = VolumeOptions()
+        options.parseOptions([b"agent"])
+        result = FlockerVolumeScript(FailingScript()).main(
+            MemoryReactor(), options)
+        self.assertIs(self.successResultOf(result), None)
+
+    def test_default_volume_script(self):
+        """
+        By default ``FlockerVolumeScript`` runs sub-commands with a
+        ``VolumeScript`` wrapping a ``VolumeManagerScript``.
+        """
+        script = FlockerVolumeScript()._volume_script
+        self.assertEqual(
+            (type(script), type(script._volume_script)),
+            (VolumeScript, VolumeManagerScript))
@@ -4,10 +4,9 @@
 
 from __future__ import absolute_import
 
-from io import BytesIO
+import os
 import sys
 import json
-from contextlib import contextmanager
 
 from uuid import uuid4
 from StringIO import StringIO
@@ -15,23 +14,32 @@ from StringIO import StringIO
 from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
+from eliot.testing import validateLogging, LoggedMessage
+
 from twisted.application.service import IService, Service
+from twisted.internet.defer import Deferred, fail, succeed
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath, Permissions
 from twisted.trial.unittest import SynchronousTestCase, TestCase
 
 from ..service import (
     VolumeService, CreateConfigurationError, Volume, VolumeName,
-    WAIT_FOR_VOLUME_INTERVAL, VolumeScript, ICommandLineVolumeScript,
-    VolumeSize,
+    WAIT_FOR_VOLUME_INTERVAL, WAIT_FOR_VOLUME_MAX_INTERVAL, VolumeScript,
+    ICommandLineVolumeScript, VolumeSize, PRECOPY_ROUND, VolumeWaitTimeout,
+    COMPRESSION_UNAVAILABLE,
     )
+from .. import service as service_module
 from ..script import VolumeOptions
 
-from ..filesystems.memory import FilesystemStoragePool
-from ..filesystems.zfs import StoragePool
-from .._ipc import RemoteVolumeManager, LocalVolumeManager
+from ..filesystems.memory import FilesystemStoragePool, DirectoryFilesystem
+from ..filesystems.zfs import StoragePool, Snapshot
+from .._ipc import RemoteVolumeManager, LocalVolumeManager, ReceiveState
+from .._compression import ALGORITHMS, Compression
 from ..testtools import create_volume_service
-from ...common import FakeNode
+from ...common import (
+    FakeNode, MemoryConsumer, IDescriptorConsumer, IDescriptorProducer,
+    ThrottledConsumer, PriorityLimiter,
+)
 from ...testtools import (
     skip_on_broken_permissions, attempt_effective_uid, make_with_init_tests,
     assert_equal_comparison, assert_not_equal_comparison,
@@ -436,9 +444,9 @@ class VolumeServiceAPITests(TestCase):
         with filesystem.reader() as reader:
             data = reader.read()
         node = FakeNode([
-            # Hard-code the knowledge that first `flocker-volume snapshots` is
-            # run.  It doesn't need to produce any particular output for this
-            # test, it just needs to not fail.
+            # Hard-code the knowledge that `flocker-volume snapshots
+            # --resume-token` is run first.  It doesn't need to produce any
+            # particular output for this test, it just needs to not fail.
             b"",
         ])
 
@@ -457,14 +465,16 @@ class VolumeServiceAPITests(TestCase):
             def __init__(self):
                 self.written = []
 
-            def snapshots(self, volume):
-                return volume.get_filesystem().snapshots()
+            def receive_state(self, volume):
+                d = volume.get_filesystem().snapshots()
+                d.addCallback(
+                    lambda snapshots: ReceiveState(snapshots=snapshots))
+                return d
 
-            @contextmanager
-            def receive(self, volume):
-                writer = BytesIO()
-                yield writer
-                self.written.append(writer)
+            def receive_stream(self, volume, compression=None):
+                consumer = MemoryConsumer()
+                self.written.append(consumer.output)
+                return succeed(consumer)
 
         pool = FilesystemStoragePool(FilePath(self.mktemp()))
         service = VolumeService(FilePath(self.mktemp()), pool, reactor=Clock())
@@ -482,6 +492,515 @@ class VolumeServiceAPITests(TestCase):
             [b"incremental stream based on", b"stuff"],
             writer.getvalue().splitlines()[-2:])
 
+    def test_push_rate_limit(self):
+        """
+        Pushing with a ``rate_limit`` writes the data to the destination
+        through a ``ThrottledConsumer``.
+        """
+        class RecordingConsumer(MemoryConsumer):
+            def __init__(self):
+                MemoryConsumer.__init__(self)
+                self.producers = []
+
+            def registerProducer(self, producer, streaming):
+                self.producers.append(producer)
+                MemoryConsumer.registerProducer(self, producer, streaming)
+
+        consumer = RecordingConsumer()
+
+        class FakeVolumeManager(object):
+            def receive_state(self, volume):
+                return succeed(ReceiveState(snapshots=[]))
+
+            def receive_stream(self, volume, compression=None):
+                return succeed(consumer)
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"foo").setContent(b"blah")
+        with volume.get_filesystem().reader() as reader:
+            data = reader.read()
+
+        self.successResultOf(
+            service.push(volume, FakeVolumeManager(), rate_limit=1000))
+        self.assertEqual(
+            ([type(producer) for producer in consumer.producers],
+             consumer.output.read()),
+            ([ThrottledConsumer], data))
+
+    def test_push_pins_snapshot(self):
+        """
+        Pushing a volume with a ``peer`` pins the newest snapshot of the
+        volume for that peer once the push has finished.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        filesystem = volume.get_filesystem()
+        filesystem.snapshot(b"older")
+        filesystem.snapshot(b"newer")
+        destination_service = create_volume_service(self)
+
+        self.successResultOf(service.push(
+            volume, LocalVolumeManager(destination_service),
+            peer=u"dest.example.com"))
+        self.assertEqual(service.pins.pinned(volume), {b"newer"})
+
+    def test_push_without_peer(self):
+        """
+        Pushing a volume without a ``peer`` pins no snapshots.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().snapshot(b"stuff")
+        destination_service = create_volume_service(self)
+
+        self.successResultOf(service.push(
+            volume, LocalVolumeManager(destination_service)))
+        self.assertEqual(service.pins.pinned(volume), set())
+
+    def precopy(self, written, threshold=100, budget=60, seconds=1):
+        """
+        Pre-copy a volume which has a snapshot to another volume service.
+
+        :param list written: The numbers of bytes the volume's filesystem
+            will report as written since its snapshot, one for each push.
+        :param int threshold: See ``VolumeService.precopy``.
+        :param float budget: See ``VolumeService.precopy``.
+        :param float seconds: How long each push appears to take.
+
+        :return: A ``tuple`` of the result of the pre-copy, the number of
+            pushes and the snapshot names the written data was measured
+            against.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().snapshot(b"stuff")
+        destination = LocalVolumeManager(create_volume_service(self))
+        measured = []
+
+        def written_since(filesystem, snapshot):
+            measured.append(snapshot.name)
+            service._reactor.advance(seconds)
+            return succeed(written.pop(0))
+        self.patch(DirectoryFilesystem, "written_since", written_since)
+
+        result = self.successResultOf(service.precopy(
+            volume, destination, threshold=threshold, budget=budget))
+        return result, len(measured), measured
+
+    def test_precopy_below_threshold(self):
+        """
+        ``VolumeService.precopy`` pushes only once if less than the
+        threshold has been written to the volume by the time the push
+        finishes, and fires with the number of bytes written.
+        """
+        self.assertEqual(
+            self.precopy([10, 1000]), (10, 1, [b"stuff"]))
+
+    def test_precopy_repeats(self):
+        """
+        ``VolumeService.precopy`` keeps pushing while at least the threshold
+        has been written to the volume since the newest snapshot.
+        """
+        self.assertEqual(
+            self.precopy([1000, 500, 100, 99]),
+            (99, 4, [b"stuff"] * 4))
+
+    def test_precopy_budget(self):
+        """
+        ``VolumeService.precopy`` stops pushing once the time budget has been
+        used up, however much has been written to the volume.
+        """
+        self.assertEqual(
+            self.precopy([1000] * 10, budget=3, seconds=1),
+            (1000, 3, [b"stuff"] * 3))
+
+    def test_precopy_no_snapshots(self):
+        """
+        ``VolumeService.precopy`` pushes only once if the volume has no
+        snapshots to measure written data against, and fires with ``None``.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        destination = LocalVolumeManager(create_volume_service(self))
+        self.assertIs(
+            self.successResultOf(service.precopy(
+                volume, destination, threshold=100, budget=60)),
+            None)
+
+    @validateLogging(None)
+    def test_precopy_logged(self, logger):
+        """
+        Each push done by ``VolumeService.precopy`` is logged with the amount
+        of data written since.
+        """
+        self.patch(VolumeService, "logger", logger)
+        self.precopy([1000, 10])
+        self.assertEqual(
+            [(message.message[u"round"], message.message[u"written"])
+             for message in LoggedMessage.ofType(
+                 logger.messages, PRECOPY_ROUND)],
+            [(1, 1000), (2, 10)])
+
+    def test_precopy_many(self):
+        """
+        ``VolumeService.precopy_many`` asks the destination once for the
+        snapshots and resume tokens of all the volumes, instead of asking
+        about each of them before pushing it, pushes each volume and fires
+        with the results of ``precopy`` for each.
+        """
+        queries = []
+
+        class RecordingVolumeManager(LocalVolumeManager):
+            def snapshots(self, volume):
+                queries.append(volume.name)
+                return LocalVolumeManager.snapshots(self, volume)
+
+            def receive_state(self, volume):
+                queries.append(volume.name)
+                return LocalVolumeManager.receive_state(self, volume)
+
+            def receive_state_many(self, volumes):
+                volumes = list(volumes)
+                queries.append([volume.name for volume in volumes])
+                return LocalVolumeManager.receive_state_many(self, volumes)
+
+        service = create_volume_service(self)
+        volumes = [
+            self.successResultOf(service.create(service.get(name)))
+            for name in [MY_VOLUME, MY_VOLUME2]]
+        destination_service = create_volume_service(self)
+        result = self.successResultOf(service.precopy_many(
+            volumes, RecordingVolumeManager(destination_service),
+            threshold=100, budget=60))
+        self.assertEqual(
+            (result, queries,
+             sorted(volume.name for volume in self.successResultOf(
+                 destination_service.enumerate()))),
+            ([None, None], [[MY_VOLUME, MY_VOLUME2]],
+             sorted([MY_VOLUME, MY_VOLUME2])))
+
+    def test_precopy_many_failure(self):
+        """
+        The ``Deferred`` returned by ``VolumeService.precopy_many`` errbacks
+        with the reason a volume could not be pushed.
+        """
+        class FailingVolumeManager(LocalVolumeManager):
+            def receive_stream(self, volume, compression=None):
+                return fail(IOError("unreachable"))
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        self.failureResultOf(service.precopy_many(
+            [volume], FailingVolumeManager(create_volume_service(self)),
+            threshold=100, budget=60), IOError)
+
+    def test_precopy_many_limited(self):
+        """
+        ``VolumeService.precopy_many`` pre-copies the volumes through the
+        given limiter, starting with those the destination already has a
+        snapshot of.
+        """
+        class PartialVolumeManager(LocalVolumeManager):
+            def receive_state_many(self, volumes):
+                return succeed({
+                    volume: ReceiveState(snapshots=[Snapshot(name=b"old")]
+                                         if volume.name == MY_VOLUME2 else [])
+                    for volume in volumes})
+
+        service = create_volume_service(self)
+        volumes = [
+            self.successResultOf(service.create(service.get(name)))
+            for name in [MY_VOLUME, MY_VOLUME2]]
+        precopied = []
+
+        def precopy(volume, *args):
+            precopied.append(volume.name)
+            return succeed(None)
+        self.patch(service, "precopy", precopy)
+        limiter = PriorityLimiter(1)
+        self.successResultOf(service.precopy_many(
+            volumes, PartialVolumeManager(create_volume_service(self)),
+            threshold=100, budget=60, limiter=limiter))
+        self.assertEqual(precopied, [MY_VOLUME2, MY_VOLUME])
+
+    def test_push_splices_descriptors(self):
+        """
+        If both the volume's producer and the remote volume manager's consumer
+        can use file descriptors, they are connected with a pipe instead of
+        the data being written through this process.
+        """
+        @implementer(IDescriptorProducer)
+        class DescriptorProducer(object):
+            def produceToDescriptor(self, fd):
+                os.write(fd, b"spliced")
+                os.close(fd)
+                return succeed(None)
+
+        @implementer(IDescriptorConsumer)
+        class DescriptorConsumer(MemoryConsumer):
+            def consumeDescriptor(self, fd):
+                self.fd = fd
+
+            def finish(self):
+                with os.fdopen(self.fd) as f:
+                    self.write(f.read())
+                return MemoryConsumer.finish(self)
+
+        consumer = DescriptorConsumer()
+
+        class FakeVolumeManager(object):
+            def receive_state(self, volume):
+                return succeed(ReceiveState(snapshots=[]))
+
+            def receive_stream(self, volume, compression=None):
+                return succeed(consumer)
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        self.patch(volume.get_filesystem().__class__, "reader_stream",
+                   lambda self, snapshots: DescriptorProducer())
+
+        self.successResultOf(service.push(volume, FakeVolumeManager()))
+        self.assertEqual(consumer.output.read(), b"spliced")
+
+    def test_push_resumes(self):
+        """
+        If the remote volume manager has a resume token for the volume,
+        ``push`` first sends the rest of the interrupted stream and then an
+        update based on the remote snapshots.
+        """
+        streams = []
+
+        class RecordingFilesystem(object):
+            def reader_stream(self, remote_snapshots=None,
+                              resume_token=None):
+                streams.append((remote_snapshots, resume_token))
+                return MemoryConsumer()
+
+        class FakeVolumeManager(object):
+            def receive_state(self, volume):
+                return succeed(ReceiveState(
+                    snapshots=[Snapshot(name=b"old")], resume_token=b"token"))
+
+            def snapshots(self, volume):
+                return succeed([Snapshot(name=b"s")])
+
+            def receive_stream(self, volume, compression=None):
+                return succeed(MemoryConsumer())
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        self.patch(Volume, "get_filesystem",
+                   lambda self: RecordingFilesystem())
+        self.patch(service_module, "_send_to",
+                   lambda producer, consumer: succeed(None))
+
+        self.successResultOf(service.push(volume, FakeVolumeManager()))
+        self.assertEqual(streams, [(None, b"token"),
+                                   ([Snapshot(name=b"s")], None)])
+
+    def _recording_push(self, remote_state):
+        """
+        Push a volume to a destination which has the snapshot ``s`` and no
+        resume token, recording the streams read from the volume.
+
+        :param ReceiveState remote_state: Passed to ``VolumeService.push``.
+
+        :return: A ``tuple`` of the ``list`` of ``(remote_snapshots,
+            resume_token)`` for each stream read, and the names of the
+            queries made of the destination.
+        """
+        streams = []
+        queried = []
+
+        class RecordingFilesystem(object):
+            def reader_stream(self, remote_snapshots=None,
+                              resume_token=None):
+                streams.append((remote_snapshots, resume_token))
+                return MemoryConsumer()
+
+        class FakeVolumeManager(object):
+            def receive_state(self, volume):
+                queried.append("receive_state")
+                return succeed(ReceiveState(snapshots=[Snapshot(name=b"s")]))
+
+            def snapshots(self, volume):
+                queried.append("snapshots")
+                return succeed([Snapshot(name=b"s")])
+
+            def receive_stream(self, volume, compression=None):
+                return succeed(MemoryConsumer())
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        self.patch(Volume, "get_filesystem",
+                   lambda self: RecordingFilesystem())
+        self.patch(service_module, "_send_to",
+                   lambda producer, consumer: succeed(None))
+
+        self.successResultOf(service.push(
+            volume, FakeVolumeManager(), remote_state=remote_state))
+        return streams, queried
+
+    def test_push_asks_once(self):
+        """
+        Without ``remote_state``, ``push`` asks the remote volume manager for
+        its snapshots and resume token in a single query.
+        """
+        self.assertEqual(
+            self._recording_push(None),
+            ([([Snapshot(name=b"s")], None)], ["receive_state"]))
+
+    def test_push_remote_state(self):
+        """
+        If ``push`` is given what the remote volume manager has, it does not
+        ask for it and sends an update based on the given snapshots.
+        """
+        self.assertEqual(
+            self._recording_push(
+                ReceiveState(snapshots=[Snapshot(name=b"known")])),
+            ([([Snapshot(name=b"known")], None)], []))
+
+    def test_push_resumes_remote_state_stale(self):
+        """
+        If ``push`` is given a resume token, the interrupted push is resumed
+        and, since the snapshots given to ``push`` are then no longer what
+        the remote volume manager has, it is asked for them again.
+        """
+        self.assertEqual(
+            self._recording_push(ReceiveState(
+                snapshots=[Snapshot(name=b"known")], resume_token=b"token")),
+            ([(None, b"token"), ([Snapshot(name=b"s")], None)],
+             ["snapshots"]))
+
+    def _compressed_push(self, local, remote):
+        """
+        Start pushing a volume with ``zstd`` compression.
+
+        :param list local: The compression algorithms available on this node.
+        :param list remote: The compression algorithms the destination can
+            decompress.
+
+        :return: A ``list`` of the compression the destination was told the
+            data would be sent with.
+        """
+        received = []
+
+        class FakeVolumeManager(object):
+            def compressions(self):
+                return succeed(remote)
+
+            def receive_state(self, volume):
+                return succeed(ReceiveState(snapshots=[]))
+
+            def receive_stream(self, volume, compression=None):
+                received.append(compression)
+                return Deferred()
+
+        self.patch(service_module, "available_algorithms", lambda: local)
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        service.push(volume, FakeVolumeManager(),
+                     compression=Compression(algorithm=b"zstd", level=3))
+        return received
+
+    def test_push_compressed(self):
+        """
+        If both this node and the destination can handle the compression
+        asked for, ``push`` sends the data compressed.
+        """
+        self.assertEqual(self._compressed_push(ALGORITHMS, ALGORITHMS),
+                         [Compression(algorithm=b"zstd", level=3)])
+
+    @validateLogging(None)
+    def test_push_remote_compression_unavailable(self, logger):
+        """
+        If the destination cannot decompress the compression asked for,
+        ``push`` logs this and sends the data uncompressed.
+        """
+        self.patch(VolumeService, "logger", logger)
+        self.assertEqual(
+            (self._compressed_push(ALGORITHMS, [b"zlib"]),
+             [(message.message[u"algorithm"], message.message[u"where"])
+              for message in LoggedMessage.ofType(
+                  logger.messages, COMPRESSION_UNAVAILABLE)]),
+            ([None], [(u"zstd", u"remote")]))
+
+    def test_push_local_compression_unavailable(self):
+        """
+        If this node cannot do the compression asked for, ``push`` sends the
+        data uncompressed.
+        """
+        self.assertEqual(self._compressed_push([b"zlib"], ALGORITHMS),
+                         [None])
+
+    def test_push_failure_finishes_consumer(self):
+        """
+        If the volume's data cannot be read, the remote volume manager's
+        consumer is still finished and the push fails with the original
+        reason.
+        """
+        class FailingProducer(object):
+            def startProducing(self, consumer):
+                return fail(ZeroDivisionError())
+
+        class FinishRecordingConsumer(MemoryConsumer):
+            finished = False
+
+            def finish(self):
+                self.finished = True
+                return fail(IOError())
+
+        consumer = FinishRecordingConsumer()
+
+        class FakeVolumeManager(object):
+            def receive_state(self, volume):
+                return succeed(ReceiveState(snapshots=[]))
+
+            def receive_stream(self, volume, compression=None):
+                return succeed(consumer)
+
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        self.patch(volume.get_filesystem().__class__, "reader_stream",
+                   lambda self, snapshots: FailingProducer())
+
+        self.failureResultOf(service.push(volume, FakeVolumeManager()),
+                             ZeroDivisionError)
+        self.assertTrue(consumer.finished)
+
+    def test_receive_stream_local_uuid(self):
+        """
+        If ``receive_stream`` is called with the same uuid as the service,
+        ``ValueError`` is raised.
+        """
+        service = create_volume_service(self)
+        self.assertRaises(ValueError, service.receive_stream,
+                          service.uuid, MY_VOLUME)
+
+    def test_receive_stream_creates_volume(self):
+        """
+        Writing a volume's data to the consumer ``receive_stream`` returns
+        and finishing it creates a volume with the given uuid and name.
+        """
+        service = create_volume_service(self)
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"f").setContent(b"data")
+        manager_uuid = unicode(uuid4())
+
+        consumer = self.successResultOf(
+            service.receive_stream(manager_uuid, MY_VOLUME))
+        self.successResultOf(
+            volume.get_filesystem().reader_stream().startProducing(consumer))
+        self.successResultOf(consumer.finish())
+
+        received = Volume(uuid=manager_uuid, name=MY_VOLUME, service=service)
+        self.assertEqual(
+            (set(self.successResultOf(service.enumerate())),
+             received.get_filesystem().get_path().child(b"f").getContent()),
+            ({volume, received}, b"data"))
+
     def test_receive_local_uuid(self):
         """
         If a volume with same uuid as service is received, ``ValueError`` is
@@ -676,6 +1195,84 @@ class VolumeServiceAPITests(TestCase):
         created.addCallback(handed_off)
         return created
 
+    def test_handoff_pins_snapshot(self):
+        """
+        ``VolumeService.handoff()`` passes its ``peer`` to ``push`` so the
+        snapshot the destination has is pinned.
+        """
+        origin_service = create_volume_service(self)
+        destination_service = create_volume_service(self)
+        volume = self.successResultOf(
+            origin_service.create(origin_service.get(MY_VOLUME)))
+        volume.get_filesystem().snapshot(b"stuff")
+
+        self.successResultOf(origin_service.handoff(
+            volume, LocalVolumeManager(destination_service),
+            peer=u"dest.example.com"))
+        self.assertEqual(origin_service.pins.pinned(volume), {b"stuff"})
+
+    def test_handoff_single_operation(self):
+        """
+        ``VolumeService.handoff()`` sends the final data and has the
+        destination acquire the volume with ``receive_and_acquire_stream``,
+        rather than with separate ``receive_stream`` and ``acquire`` calls.
+        """
+        origin_service = create_volume_service(self)
+        destination_service = create_volume_service(self)
+        volume = self.successResultOf(
+            origin_service.create(origin_service.get(MY_VOLUME)))
+        calls = []
+
+        class RecordingVolumeManager(LocalVolumeManager):
+            def receive_stream(self, volume, compression=None):
+                calls.append("receive_stream")
+                return LocalVolumeManager.receive_stream(
+                    self, volume, compression)
+
+            def receive_and_acquire_stream(self, volume, compression=None):
+                calls.append("receive_and_acquire_stream")
+                return LocalVolumeManager.receive_and_acquire_stream(
+                    self, volume, compression)
+
+            def acquire(self, volume):
+                calls.append("acquire")
+                return LocalVolumeManager.acquire(self, volume)
+
+        self.successResultOf(origin_service.handoff(
+            volume, RecordingVolumeManager(destination_service)))
+        self.assertEqual(calls, ["receive_and_acquire_stream"])
+
+    def test_handoff_remote_calls(self):
+        """
+        ``VolumeService.handoff()`` makes only two requests of the
+        destination: one for what it has of the volume and one to receive
+        and acquire the volume.
+        """
+        origin_service = create_volume_service(self)
+        destination = LocalVolumeManager(create_volume_service(self))
+        volume = self.successResultOf(
+            origin_service.create(origin_service.get(MY_VOLUME)))
+        calls = []
+
+        class RecordingVolumeManager(object):
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(destination, name)
+
+        self.successResultOf(origin_service.handoff(
+            volume, RecordingVolumeManager()))
+        self.assertEqual(
+            calls, ["receive_state", "receive_and_acquire_stream"])
+
+    def test_receive_and_acquire_stream_rejects_local_volume(self):
+        """
+        ``VolumeService.receive_and_acquire_stream()`` raises a
+        ``ValueError`` if given a locally-owned volume.
+        """
+        service = create_volume_service(self)
+        self.assertRaises(ValueError, service.receive_and_acquire_stream,
+                          service.uuid, MY_VOLUME)
+
     def test_handoff_changes_uuid(self):
         """
         ```VolumeService.handoff()`` changes the owner UUID of the local
@@ -727,6 +1324,166 @@ class VolumeServiceAPITests(TestCase):
         return created
 
 
+# Owner UUID of volumes not owned by the service under test:
+OTHER_UUID = unicode(uuid4())
+
+
+class VolumeServiceRegistryTests(TestCase):
+    """
+    Tests for the registry of volumes kept by ``VolumeService``.
+    """
+    def setUp(self):
+        """
+        Create a ``VolumeService`` pointing at a new pool, without starting
+        it.
+        """
+        self.pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        self.service = VolumeService(FilePath(self.mktemp()), self.pool,
+                                     reactor=Clock())
+
+    def forbid_enumerate(self):
+        """
+        Make the pool fail the test if it is listed.
+        """
+        def enumerate():
+            self.fail("The pool was listed.")
+        self.patch(self.pool, "enumerate", enumerate)
+
+    def test_existing_volume(self):
+        """
+        ``VolumeService.lookup`` finds a volume which was in the pool when
+        the service started.
+        """
+        self.service.startService()
+        created = Volume(uuid=OTHER_UUID, name=MY_VOLUME, service=self.service)
+        self.successResultOf(self.pool.create(created))
+        self.service = VolumeService(FilePath(self.mktemp()), self.pool,
+                                     reactor=Clock())
+        self.service.startService()
+        self.forbid_enumerate()
+        self.assertEqual(
+            (self.service.lookup(MY_VOLUME, OTHER_UUID),
+             self.service.lookup(MY_VOLUME)),
+            (Volume(uuid=OTHER_UUID, name=MY_VOLUME, service=self.service),
+             None))
+
+    def test_create(self):
+        """
+        A volume created by the service can be looked up without listing the
+        pool.
+        """
+        self.service.startService()
+        self.forbid_enumerate()
+        volume = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+        self.assertEqual(self.service.lookup(MY_VOLUME), volume)
+
+    def test_clone_to(self):
+        """
+        A volume cloned by the service can be looked up without listing the
+        pool.
+        """
+        self.service.startService()
+        self.forbid_enumerate()
+        parent = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+        clone = self.successResultOf(self.service.clone_to(parent, MY_VOLUME2))
+        self.assertEqual(self.service.lookup(MY_VOLUME2), clone)
+
+    def test_acquire(self):
+        """
+        Once the service acquires a volume it can be looked up under the
+        service's UUID and no longer under the previous owner's, without
+        listing the pool.
+        """
+        self.service.startService()
+        self.successResultOf(self.pool.create(
+            Volume(uuid=OTHER_UUID, name=MY_VOLUME, service=self.service)))
+        self.successResultOf(self.service.enumerate())
+        self.forbid_enumerate()
+        volume = self.successResultOf(
+            self.service.acquire(OTHER_UUID, MY_VOLUME))
+        self.assertEqual(
+            (self.service.lookup(MY_VOLUME, OTHER_UUID),
+             self.service.lookup(MY_VOLUME)),
+            (None, volume))
+
+    def test_receive(self):
+        """
+        A volume received by the service can be looked up under its owner's
+        UUID without listing the pool.
+        """
+        origin = create_volume_service(self)
+        volume = self.successResultOf(
+            origin.create(origin.get(MY_VOLUME)))
+        self.service.startService()
+        self.forbid_enumerate()
+        with volume.get_filesystem().reader() as reader:
+            self.service.receive(origin.uuid, MY_VOLUME, reader)
+        self.assertEqual(
+            self.service.lookup(MY_VOLUME, origin.uuid),
+            Volume(uuid=origin.uuid, name=MY_VOLUME, service=self.service))
+
+    def test_receive_stream(self):
+        """
+        A volume received as a stream by the service can be looked up under
+        its owner's UUID without listing the pool once the stream has
+        finished.
+        """
+        origin = create_volume_service(self)
+        volume = self.successResultOf(
+            origin.create(origin.get(MY_VOLUME)))
+        self.service.startService()
+        self.forbid_enumerate()
+        with volume.get_filesystem().reader() as reader:
+            data = reader.read()
+        consumer = self.successResultOf(
+            self.service.receive_stream(origin.uuid, MY_VOLUME))
+        consumer.write(data)
+        before = self.service.lookup(MY_VOLUME, origin.uuid)
+        self.successResultOf(consumer.finish())
+        self.assertEqual(
+            (before, self.service.lookup(MY_VOLUME, origin.uuid)),
+            (None,
+             Volume(uuid=origin.uuid, name=MY_VOLUME, service=self.service)))
+
+    def test_volumes_in_namespace(self):
+        """
+        ``VolumeService.volumes_in_namespace`` returns the volumes in the
+        given namespace, whoever owns them.
+        """
+        self.service.startService()
+        self.successResultOf(self.pool.create(
+            Volume(uuid=OTHER_UUID, name=MY_VOLUME, service=self.service)))
+        self.successResultOf(self.service.enumerate())
+        mine = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME2)))
+        self.successResultOf(self.service.create(self.service.get(
+            VolumeName(namespace=u"otherns", id=u"myvolume"))))
+        self.assertItemsEqual(
+            self.service.volumes_in_namespace(u"myns"),
+            [Volume(uuid=OTHER_UUID, name=MY_VOLUME, service=self.service),
+             mine])
+
+    def test_enumerate_reconciles(self):
+        """
+        ``VolumeService.enumerate`` updates the registry with volumes which
+        were added to or removed from the pool without the service's
+        involvement.
+        """
+        self.service.startService()
+        removed = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+        self.pool.get(removed).get_path().remove()
+        added = Volume(uuid=OTHER_UUID, name=MY_VOLUME2, service=self.service)
+        self.successResultOf(self.pool.create(added))
+        self.successResultOf(self.service.enumerate())
+        self.assertEqual(
+            (self.service.lookup(MY_VOLUME),
+             self.service.lookup(MY_VOLUME2, OTHER_UUID)),
+            (None, added))
+
+
 class VolumeInitializationTests(make_with_init_tests(
         Volume,
         kwargs={
@@ -973,6 +1730,155 @@ class WaitForVolumeTests(TestCase):
 
         self.assertNoResult(self.service.wait_for_volume(MY_VOLUME))
 
+    def count_enumerations(self):
+        """
+        Record each time the service lists its volumes.
+
+        :return: A ``list`` which grows by one element per listing.
+        """
+        calls = []
+        enumerate = self.service.enumerate
+
+        def recording_enumerate():
+            calls.append(None)
+            return enumerate()
+        self.patch(self.service, "enumerate", recording_enumerate)
+        return calls
+
+    def test_acquired_volume(self):
+        """
+        The ``Deferred`` returned by ``VolumeService.wait_for_volume`` fires
+        as soon as the service acquires the volume, without waiting for the
+        next listing.
+        """
+        other_uuid = unicode(uuid4())
+        self.successResultOf(self.pool.create(
+            Volume(uuid=other_uuid, name=MY_VOLUME, service=self.service)))
+        wait = self.service.wait_for_volume(MY_VOLUME)
+        self.successResultOf(self.service.acquire(other_uuid, MY_VOLUME))
+        self.assertEqual(self.successResultOf(wait).uuid, self.service.uuid)
+
+    def test_external_volume(self):
+        """
+        A volume which appears without the service's involvement, e.g. one
+        acquired by another process, is found by a later listing.
+        """
+        wait = self.service.wait_for_volume(MY_VOLUME)
+        self.successResultOf(self.pool.create(self.service.get(MY_VOLUME)))
+        not_yet = wait.called
+        self.clock.advance(WAIT_FOR_VOLUME_INTERVAL)
+        self.assertEqual((not_yet, self.successResultOf(wait)),
+                         (False, self.service.get(MY_VOLUME)))
+
+    def test_backoff(self):
+        """
+        While the volume does not appear the interval between listings
+        doubles, up to ``WAIT_FOR_VOLUME_MAX_INTERVAL``.
+        """
+        calls = self.count_enumerations()
+        self.service.wait_for_volume(MY_VOLUME)
+        delays = []
+        while len(delays) < 8:
+            delays.append(round(self.clock.getDelayedCalls()[0].getTime() -
+                                self.clock.seconds(), 6))
+            self.clock.advance(delays[-1])
+        self.assertEqual(
+            (delays, len(calls)),
+            ([0.1, 0.2] + [WAIT_FOR_VOLUME_MAX_INTERVAL] * 6, 8))
+
+    def test_external_volume_worst_case(self):
+        """
+        However long the volume has been waited for, one which appears
+        without the service's involvement is found within 0.25 seconds.
+        """
+        wait = self.service.wait_for_volume(MY_VOLUME)
+        self.clock.pump([WAIT_FOR_VOLUME_INTERVAL] * 600)
+        # Just after a listing has found nothing:
+        self.clock.advance(
+            self.clock.getDelayedCalls()[0].getTime() - self.clock.seconds())
+        self.successResultOf(self.pool.create(self.service.get(MY_VOLUME)))
+        self.clock.advance(0.249)
+        not_yet = wait.called
+        self.clock.advance(0.001)
+        self.assertEqual((not_yet, self.successResultOf(wait)),
+                         (False, self.service.get(MY_VOLUME)))
+
+    def test_listing_not_cached(self):
+        """
+        The pool's cache is invalidated before each listing made to look
+        for volumes, so that changes made by other processes are seen.
+        """
+        calls = []
+        self.patch(self.pool, "invalidate",
+                   lambda: calls.append("invalidate"))
+        enumerate = self.pool.enumerate
+
+        def recording_enumerate():
+            calls.append("enumerate")
+            return enumerate()
+        self.patch(self.pool, "enumerate", recording_enumerate)
+        self.service.wait_for_volume(MY_VOLUME)
+        del calls[:]
+        self.clock.advance(WAIT_FOR_VOLUME_INTERVAL)
+        self.assertEqual(calls, ["invalidate", "enumerate"])
+
+    def test_shared_listing(self):
+        """
+        One listing serves all the volumes being waited for.
+        """
+        calls = self.count_enumerations()
+        self.service.wait_for_volume(MY_VOLUME)
+        self.service.wait_for_volume(MY_VOLUME2)
+        del calls[:]
+        self.clock.advance(WAIT_FOR_VOLUME_INTERVAL)
+        self.assertEqual(len(calls), 1)
+
+    def test_stops_listing(self):
+        """
+        Once no volumes are being waited for, the service stops listing its
+        volumes.
+        """
+        self.service.wait_for_volume(MY_VOLUME)
+        self.successResultOf(self.service.create(self.service.get(MY_VOLUME)))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        """
+        If the volume does not appear within the given timeout, the
+        ``Deferred`` returned by ``VolumeService.wait_for_volume`` errbacks
+        with ``VolumeWaitTimeout`` and the service stops looking for it.
+        """
+        wait = self.service.wait_for_volume(MY_VOLUME, timeout=5)
+        self.clock.advance(4.9)
+        self.assertNoResult(wait)
+        self.clock.advance(0.1)
+        self.failureResultOf(wait, VolumeWaitTimeout)
+        self.clock.advance(WAIT_FOR_VOLUME_MAX_INTERVAL)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_found_before_timeout(self):
+        """
+        If the volume appears before the timeout, the timeout is cancelled.
+        """
+        wait = self.service.wait_for_volume(MY_VOLUME, timeout=5)
+        volume = self.successResultOf(
+            self.service.create(self.service.get(MY_VOLUME)))
+        self.assertEqual((self.successResultOf(wait),
+                          self.clock.getDelayedCalls()),
+                         (volume, []))
+
+    def test_cancel(self):
+        """
+        Cancelling the ``Deferred`` returned by
+        ``VolumeService.wait_for_volume`` stops the service looking for the
+        volume.
+        """
+        wait = self.service.wait_for_volume(MY_VOLUME, timeout=5)
+        wait.cancel()
+        self.failureResultOf(wait)
+        self.clock.advance(WAIT_FOR_VOLUME_INTERVAL)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 
 class VolumeScriptCreateVolumeServiceTests(SynchronousTestCase):
     """
@@ -110,6 +110,9 @@ class MutatingProcessNode(ProcessNode):
     def run(self, remote_command):
         return ProcessNode.run(self, self._mutate(remote_command))
 
+    def run_stream(self, remote_command):
+        return ProcessNode.run_stream(self, self._mutate(remote_command))
+
     def get_output(self, remote_command):
         return ProcessNode.get_output(self, self._mutate(remote_command))
 
@@ -104,6 +104,7 @@ setup(
             'flocker-changestate = flocker.node.script:flocker_changestate_main',
             'flocker-reportstate = flocker.node.script:flocker_reportstate_main',
             'flocker-serve = flocker.node.script:flocker_serve_main',
+            'flocker-node-agent = flocker.node.script:flocker_node_agent_main',
         ],
     },
 
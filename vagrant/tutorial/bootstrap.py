@@ -67,6 +67,23 @@ check_call(['yum', 'install', '-y'] + branch_opt + [package])
 # the machine will be reset.
 check_call(['systemctl', 'enable', 'docker'])
 
+# Run flocker-serve, which flocker-deploy talks to, whenever the node boots.
+with open('/etc/systemd/system/flocker-serve.service', 'w') as f:
+    f.write(dedent("""\
+        [Unit]
+        Description=Flocker node service
+        Requires=docker.service
+        After=docker.service
+
+        [Service]
+        ExecStart=/usr/sbin/flocker-serve
+        Restart=always
+
+        [Install]
+        WantedBy=multi-user.target
+        """))
+check_call(['systemctl', 'enable', 'flocker-serve'])
+
 # Make it easy to authenticate as root
 check_call(['mkdir', '-p', '/root/.ssh'])
 check_call(